@@ -4,14 +4,24 @@ bench_inference.py – Measure raw tokens/s throughput for the Transformers LLM
 Usage:
     python benchmark/bench_inference.py --model Qwen/Qwen2.5-7B-Instruct
     python benchmark/bench_inference.py --model /path/to/local --warmup --torch_compile
+    python benchmark/bench_inference.py --model Qwen/Qwen2.5-7B-Instruct --compile_startup
+    python benchmark/bench_inference.py --model Qwen/Qwen2.5-7B-Instruct --draft_model Qwen/Qwen2.5-0.5B-Instruct
+    python benchmark/bench_inference.py --model Qwen/Qwen2.5-1.5B-Instruct --cpu_precisions
+    python benchmark/bench_inference.py --backend onnxruntime --model /path/to/onnx_model_dir
+    python benchmark/bench_inference.py --backend openvino --model /path/to/ov_model_dir --ov_startup
+    python benchmark/bench_inference.py --backend openvino --model /path/to/ov_model_dir --performance_hint throughput --concurrency 4
     python benchmark/bench_inference.py --help
 """
 
 import argparse
+import json
 import time
 import statistics
+import subprocess
 import sys
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 # Make sure the project root is on the path when run directly
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -19,7 +29,13 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 def _parse_args():
     p = argparse.ArgumentParser(description='Qwen-Agent inference benchmark (tokens/s)')
-    p.add_argument('--model', required=True, help='Model id or local path')
+    p.add_argument('--model',
+                   required=True,
+                   help='Model id or local path (the exported model dir for onnxruntime and openvino)')
+    p.add_argument('--backend',
+                   default='transformers',
+                   choices=['transformers', 'onnxruntime', 'openvino'],
+                   help='The local backend to benchmark')
     p.add_argument('--prompt', default='请介绍一下量子计算的基本原理，并举例说明其应用场景。', help='Benchmark prompt')
     p.add_argument('--max_new_tokens', type=int, default=256, help='Tokens to generate per run')
     p.add_argument('--runs', type=int, default=5, help='Number of timed runs')
@@ -30,11 +46,56 @@ def _parse_args():
     p.add_argument('--device', default=None, help='Force device (cuda/cpu). Auto-detected if omitted.')
     p.add_argument('--dtype', default=None, help='Force dtype (bfloat16/float16/float32).')
     p.add_argument('--stream', action='store_true', help='Benchmark streaming mode')
+    p.add_argument('--draft_model', default=None, help='Draft model for assisted generation, compared on vs. off')
+    p.add_argument('--num_assistant_tokens', type=int, default=None, help='Tokens drafted per verification step')
+    p.add_argument('--quantization', default=None, help='Force quantization (none/int8_dynamic/int8/int4).')
+    p.add_argument('--quantized_model_dir', default=None, help='Save/load the int8_dynamic weights in this directory')
+    p.add_argument('--cpu_precisions',
+                   action='store_true',
+                   help='Compare float32, bfloat16 and int8_dynamic on CPU, each in a fresh process')
+    p.add_argument('--performance_hint', default=None, help='OpenVINO performance hint (latency/throughput)')
+    p.add_argument('--ov_cache_dir', default=None, help='OpenVINO compiled model cache ("" disables it)')
+    p.add_argument('--ov_startup',
+                   action='store_true',
+                   help='Compare the OpenVINO startup with an empty and with a warm compiled model cache')
+    p.add_argument('--compile_cache_dir', default=None, help='torch.compile artifact cache ("" disables it)')
+    p.add_argument('--compile_startup',
+                   action='store_true',
+                   help='Compare the torch.compile startup with an empty and with a warm compile cache')
+    p.add_argument('--concurrency',
+                   type=int,
+                   default=1,
+                   help='Send this many requests at once per run, batched by backends that support it')
+    p.add_argument('--report_json', action='store_true', help=argparse.SUPPRESS)  # Used by --cpu_precisions
     return p.parse_args()
 
 
 def _build_llm(args):
     from qwen_agent.llm import get_chat_model
+    if args.backend == 'onnxruntime':
+        return get_chat_model({
+            'model_type': 'onnxruntime',
+            'onnx_model_dir': args.model,
+            'generate_cfg': {
+                'max_new_tokens': args.max_new_tokens
+            },
+        })
+    if args.backend == 'openvino':
+        cfg = {
+            'model_type': 'openvino',
+            'ov_model_dir': args.model,
+            'device': args.device or 'cpu',
+            'generate_cfg': {
+                'max_new_tokens': args.max_new_tokens
+            },
+        }
+        if args.performance_hint:
+            cfg['performance_hint'] = args.performance_hint
+        if args.ov_cache_dir is not None:
+            cfg['ov_cache_dir'] = args.ov_cache_dir
+        if args.concurrency > 1:
+            cfg.update(batching=True, max_batch_size=args.concurrency)
+        return get_chat_model(cfg)
     cfg = {
         'model': args.model,
         'model_type': 'transformers',
@@ -47,6 +108,16 @@ def _build_llm(args):
         cfg['device'] = args.device
     if args.dtype:
         cfg['torch_dtype'] = args.dtype
+    if args.quantization:
+        cfg['quantization'] = args.quantization
+    if args.quantized_model_dir:
+        cfg['quantized_model_dir'] = args.quantized_model_dir
+    if args.compile_cache_dir is not None:
+        cfg['compile_cache_dir'] = args.compile_cache_dir
+    if args.draft_model:
+        cfg['draft_model'] = args.draft_model
+        if args.num_assistant_tokens:
+            cfg['num_assistant_tokens'] = args.num_assistant_tokens
     return get_chat_model(cfg)
 
 
@@ -63,26 +134,237 @@ def _run_once(llm, messages: list, stream: bool) -> tuple[str, float]:
     if stream:
         for chunks in llm.chat(messages=messages, stream=True):
             if chunks:
-                full_text = chunks[-1].content
+                full_text = chunks[-1]['content']
     else:
         result = llm.chat(messages=messages, stream=False)
-        full_text = result[-1].content if result else ''
+        full_text = result[-1]['content'] if result else ''
     elapsed = time.perf_counter() - t0
     return full_text, elapsed
 
 
+def _timed_runs(llm, messages: list, args, tokenizer, label: str = '') -> float:
+    latencies = []
+    token_counts = []
+    print(f'Running {args.runs} timed pass(es)...')
+    for i in range(args.runs):
+        text, elapsed = _run_once(llm, messages, args.stream)
+        n_tokens = _count_tokens(text, tokenizer) if tokenizer else args.max_new_tokens
+        tps = n_tokens / elapsed if elapsed > 0 else 0
+        latencies.append(elapsed)
+        token_counts.append(n_tokens)
+        print(f'  Run {i+1:2d}: {elapsed:.2f}s  |  {n_tokens} tokens  |  {tps:.1f} tok/s')
+
+    # Summary
+    avg_lat = statistics.mean(latencies)
+    med_lat = statistics.median(latencies)
+    min_lat = min(latencies)
+    avg_tok = statistics.mean(token_counts)
+    avg_tps = avg_tok / avg_lat if avg_lat > 0 else 0
+    peak_tps = max(t / l for t, l in zip(token_counts, latencies))
+
+    print(f'\n{"="*60}')
+    print(f'  Results (avg of {args.runs} runs{", " + label if label else ""})')
+    print(f'{"="*60}')
+    print(f'  Avg latency   : {avg_lat:.2f} s')
+    print(f'  Median latency: {med_lat:.2f} s')
+    print(f'  Best latency  : {min_lat:.2f} s')
+    print(f'  Avg tokens    : {avg_tok:.0f}')
+    print(f'  Avg throughput: {avg_tps:.1f} tok/s')
+    print(f'  Peak throughput: {peak_tps:.1f} tok/s')
+    print(f'{"="*60}\n')
+    return avg_tps
+
+
+def _concurrent_runs(llm, messages: list, args, tokenizer) -> float:
+    # Each run sends `concurrency` requests at once, and measures the tokens/s of all of them together.
+    print(f'Running {args.runs} timed pass(es) of {args.concurrency} concurrent requests...')
+    throughputs = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i in range(args.runs):
+            t0 = time.perf_counter()
+            futures = [executor.submit(_run_once, llm, messages, args.stream) for _ in range(args.concurrency)]
+            texts = [f.result()[0] for f in futures]
+            elapsed = time.perf_counter() - t0
+            n_tokens = sum(_count_tokens(t, tokenizer) if tokenizer else args.max_new_tokens for t in texts)
+            throughputs.append(n_tokens / elapsed if elapsed > 0 else 0)
+            print(f'  Run {i+1:2d}: {elapsed:.2f}s  |  {n_tokens} tokens  |  {throughputs[-1]:.1f} tok/s')
+
+    print(f'\n{"="*60}')
+    print(f'  Results (avg of {args.runs} runs, {args.concurrency} concurrent requests)')
+    print(f'{"="*60}')
+    print(f'  Avg throughput: {statistics.mean(throughputs):.1f} tok/s')
+    print(f'  Peak throughput: {max(throughputs):.1f} tok/s')
+    batcher = getattr(llm, '_batcher', None)
+    if batcher is not None:
+        stats = batcher.stats()
+        print(f'  Batches       : {stats["batches"]}  (avg {stats["avg_batch_size"]:.2f}, max {stats["max_batch_size"]})')
+    print(f'{"="*60}\n')
+    return statistics.mean(throughputs)
+
+
+def _rss_gb() -> tuple:
+    # The current and the peak resident memory of this process
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = (max_rss if sys.platform == 'darwin' else max_rss * 1024) / (1024**3)  # Bytes on macOS, KiB on Linux
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024**3), peak
+    except ImportError:
+        return peak, peak
+
+
+_CPU_PRECISIONS = [
+    ('float32', ['--quantization', 'none', '--dtype', 'float32']),
+    ('bfloat16', ['--quantization', 'none', '--dtype', 'bfloat16']),
+    ('int8_dynamic', ['--quantization', 'int8_dynamic']),
+]
+
+
+def _compare_cpu_precisions(args):
+    # Each precision is measured in a fresh process, so that the load time and the RSS don't include the others.
+    base_cmd = [sys.executable, os.path.abspath(__file__), '--model', args.model, '--prompt', args.prompt]
+    base_cmd += ['--max_new_tokens', str(args.max_new_tokens), '--runs', str(args.runs)]
+    base_cmd += ['--warmup_runs', str(args.warmup_runs), '--device', 'cpu', '--report_json']
+    if args.quantized_model_dir:
+        base_cmd += ['--quantized_model_dir', args.quantized_model_dir]
+    rows = []
+    for label, extra in _CPU_PRECISIONS:
+        print(f'Benchmarking {label} on CPU...')
+        out = subprocess.run(base_cmd + extra, capture_output=True, text=True)
+        if out.returncode != 0:
+            print(f'  {label} failed:\n{out.stderr[-2000:]}')
+            continue
+        report = json.loads(out.stdout.strip().splitlines()[-1])
+        rows.append((label, report))
+
+    print(f'\n{"="*72}')
+    print(f'  {"precision":<14}{"load (s)":>10}{"RSS (GB)":>12}{"peak RSS (GB)":>16}{"tok/s":>10}')
+    print(f'{"="*72}')
+    for label, r in rows:
+        print(f'  {label:<14}{r["load_seconds"]:>10.1f}{r["rss_gb"]:>12.2f}{r["peak_rss_gb"]:>16.2f}'
+              f'{r["tokens_per_second"]:>10.1f}')
+    print(f'{"="*72}\n')
+
+
+def _compare_ov_startup(args):
+    # The first process compiles the model into an empty cache directory, and the second one loads it from there.
+    cache_dir = args.ov_cache_dir or tempfile.mkdtemp(prefix='qwen_agent_ov_cache_')
+    base_cmd = [sys.executable, os.path.abspath(__file__), '--backend', 'openvino', '--model', args.model]
+    base_cmd += ['--prompt', args.prompt, '--max_new_tokens', str(args.max_new_tokens), '--runs', str(args.runs)]
+    base_cmd += ['--warmup_runs', str(args.warmup_runs), '--device', args.device or 'cpu', '--report_json']
+    base_cmd += ['--ov_cache_dir', cache_dir]
+    if args.performance_hint:
+        base_cmd += ['--performance_hint', args.performance_hint]
+    rows = []
+    for label in ('cold cache', 'warm cache'):
+        print(f'Starting OpenVINO with a {label} ({cache_dir})...')
+        out = subprocess.run(base_cmd, capture_output=True, text=True)
+        if out.returncode != 0:
+            print(f'  {label} failed:\n{out.stderr[-2000:]}')
+            return
+        rows.append((label, json.loads(out.stdout.strip().splitlines()[-1])))
+
+    print(f'\n{"="*60}')
+    print(f'  {"startup":<14}{"load (s)":>10}{"first call (s)":>18}{"tok/s":>10}')
+    print(f'{"="*60}')
+    for label, r in rows:
+        print(f'  {label:<14}{r["load_seconds"]:>10.1f}{r["first_call_seconds"]:>18.2f}{r["tokens_per_second"]:>10.1f}')
+    print(f'{"="*60}\n')
+
+
+def _compare_compile_startup(args):
+    # The first process compiles the model into an empty cache directory, and the second one reuses its artifacts.
+    cache_dir = args.compile_cache_dir or tempfile.mkdtemp(prefix='qwen_agent_compile_cache_')
+    base_cmd = [sys.executable, os.path.abspath(__file__), '--model', args.model, '--prompt', args.prompt]
+    base_cmd += ['--max_new_tokens', str(args.max_new_tokens), '--runs', str(args.runs)]
+    base_cmd += ['--warmup_runs', str(args.warmup_runs), '--report_json', '--torch_compile', '--warmup']
+    base_cmd += ['--compile_cache_dir', cache_dir]
+    if args.device:
+        base_cmd += ['--device', args.device]
+    if args.dtype:
+        base_cmd += ['--dtype', args.dtype]
+    if args.static_cache:
+        base_cmd += ['--static_cache']
+    rows = []
+    for label in ('cold cache', 'warm cache'):
+        print(f'Starting with torch.compile and a {label} ({cache_dir})...')
+        out = subprocess.run(base_cmd, capture_output=True, text=True)
+        if out.returncode != 0:
+            print(f'  {label} failed:\n{out.stderr[-2000:]}')
+            return
+        report = json.loads(out.stdout.strip().splitlines()[-1])
+        startup = (report.get('compile_cache') or {}).get('warm' if label == 'warm cache' else 'cold')
+        if not startup:
+            print(f'  {label}: the compile cache recorded no startup (is torch.compile available?)')
+            return
+        rows.append((label, report, startup))
+
+    lengths = list(rows[0][2]['ttft'])
+    print(f'\n{"="*72}')
+    print(f'  {"startup":<14}{"load (s)":>10}{"warmup (s)":>12}{"TTFT (s)":>10}' +
+          ''.join(f'{"@" + n:>9}' for n in lengths) + f'{"tok/s":>10}')
+    print(f'{"="*72}')
+    for label, r, s in rows:
+        print(f'  {label:<14}{s["load_seconds"]:>10.1f}{s["warmup_seconds"]:>12.1f}{s["time_to_first_token"]:>10.2f}' +
+              ''.join(f'{s["ttft"].get(n, 0.0):>9.2f}' for n in lengths) + f'{r["tokens_per_second"]:>10.1f}')
+    cold, warm = rows[0][2], rows[1][2]
+    print(f'  Warm-start TTFT speedup: {cold["time_to_first_token"] / warm["time_to_first_token"]:.2f}x')
+    print(f'{"="*72}\n')
+
+
+def _report_json(args):
+    t0 = time.perf_counter()
+    llm = _build_llm(args)  # Loads the model
+    load_seconds = time.perf_counter() - t0
+    rss, peak = _rss_gb()
+    messages = [{'role': 'user', 'content': args.prompt}]
+    _, first_call_seconds = _run_once(llm, messages, stream=False)
+    for _ in range(args.warmup_runs - 1):
+        _run_once(llm, messages, stream=False)
+    tokens, seconds = 0, 0.0
+    for _ in range(args.runs):
+        text, elapsed = _run_once(llm, messages, stream=False)
+        tokens += _count_tokens(text, llm.tokenizer)
+        seconds += elapsed
+    report = {
+        'load_seconds': load_seconds,
+        'first_call_seconds': first_call_seconds,
+        'rss_gb': rss,
+        'peak_rss_gb': peak,
+        'tokens_per_second': tokens / seconds if seconds else 0.0,
+    }
+    if hasattr(llm, 'compile_cache_report'):
+        report['compile_cache'] = llm.compile_cache_report()
+    print(json.dumps(report))
+
+
 def main():
     args = _parse_args()
+    if args.report_json:
+        _report_json(args)
+        return
+    if args.cpu_precisions:
+        _compare_cpu_precisions(args)
+        return
+    if args.ov_startup:
+        _compare_ov_startup(args)
+        return
+    if args.compile_startup:
+        _compare_compile_startup(args)
+        return
 
     print(f'\n{"="*60}')
     print(f'  Qwen-Agent Inference Benchmark')
     print(f'{"="*60}')
     print(f'  Model         : {args.model}')
+    print(f'  Backend       : {args.backend}')
     print(f'  Max new tokens: {args.max_new_tokens}')
     print(f'  Timed runs    : {args.runs}  (+ {args.warmup_runs} warmup)')
     print(f'  torch.compile : {args.torch_compile}')
     print(f'  static_cache  : {args.static_cache}')
     print(f'  stream mode   : {args.stream}')
+    print(f'  draft model   : {args.draft_model}')
     print(f'{"="*60}\n')
 
     # Print hardware info
@@ -100,9 +382,10 @@ def main():
         pass
 
     print('Loading model...')
+    t0 = time.perf_counter()
     llm = _build_llm(args)
     tokenizer = getattr(llm, 'tokenizer', None)
-    print('Model loaded.\n')
+    print(f'Model loaded in {time.perf_counter() - t0:.1f}s.\n')
 
     messages = [{'role': 'user', 'content': args.prompt}]
 
@@ -113,36 +396,23 @@ def main():
             _run_once(llm, messages, args.stream)
         print('Warmup done.\n')
 
-    # Timed runs
-    latencies = []
-    token_counts = []
-    print(f'Running {args.runs} timed pass(es)...')
-    for i in range(args.runs):
-        text, elapsed = _run_once(llm, messages, args.stream)
-        n_tokens = _count_tokens(text, tokenizer) if tokenizer else args.max_new_tokens
-        tps = n_tokens / elapsed if elapsed > 0 else 0
-        latencies.append(elapsed)
-        token_counts.append(n_tokens)
-        print(f'  Run {i+1:2d}: {elapsed:.2f}s  |  {n_tokens} tokens  |  {tps:.1f} tok/s')
-
-    # Summary
-    avg_lat = statistics.mean(latencies)
-    med_lat = statistics.median(latencies)
-    min_lat = min(latencies)
-    avg_tok = statistics.mean(token_counts)
-    avg_tps = avg_tok / avg_lat if avg_lat > 0 else 0
-    peak_tps = max(t / l for t, l in zip(token_counts, latencies))
-
-    print(f'\n{"="*60}')
-    print(f'  Results (avg of {args.runs} runs)')
-    print(f'{"="*60}')
-    print(f'  Avg latency   : {avg_lat:.2f} s')
-    print(f'  Median latency: {med_lat:.2f} s')
-    print(f'  Best latency  : {min_lat:.2f} s')
-    print(f'  Avg tokens    : {avg_tok:.0f}')
-    print(f'  Avg throughput: {avg_tps:.1f} tok/s')
-    print(f'  Peak throughput: {peak_tps:.1f} tok/s')
-    print(f'{"="*60}\n')
+    if args.draft_model:
+        llm.use_draft_model = False
+        base = _timed_runs(llm, messages, args, tokenizer, label='assisted generation off')
+        llm.use_draft_model = True
+        assisted = _timed_runs(llm, messages, args, tokenizer, label='assisted generation on')
+        stats = llm.assisted_decoding_stats()
+        print(f'  Speedup        : {assisted / base:.2f}x  ({base:.1f} -> {assisted:.1f} tok/s)')
+        print(f'  Accept rate    : {stats["accept_rate"]:.1%} of {stats["drafted_tokens"]} drafted tokens')
+        print(f'  Tokens/verify  : {stats["tokens_per_verify_step"]:.2f}')
+        print(f'{"="*60}\n')
+    elif args.concurrency > 1:
+        sequential = _timed_runs(llm, messages, args, tokenizer, label='one request at a time')
+        concurrent = _concurrent_runs(llm, messages, args, tokenizer)
+        print(f'  Concurrent speedup: {concurrent / sequential:.2f}x  ({sequential:.1f} -> {concurrent:.1f} tok/s)')
+        print(f'{"="*60}\n')
+    else:
+        _timed_runs(llm, messages, args, tokenizer)
 
     # VRAM after inference
     try:
@@ -0,0 +1,129 @@
+"""
+bench_oai_client.py – Measure the per-request overhead of `TextChatAtOAI` against a local stub server.
+
+A stub server compatible with the OpenAI chat completions API answers at once, so the numbers only reflect the client
+side: building the client and its connection pool, and opening the connections. Two setups are compared:
+
+  per_request : a new `openai.OpenAI` client (and connection pool) for every request, as before
+  pooled      : the long-lived client of the LLM, whose connections are kept alive between requests
+
+The stub server speaks plain HTTP on localhost. Over TLS to a remote model server, each new connection costs extra
+round trips for the handshake, so the savings are larger than measured here. Note that the openai client closes a
+stream as soon as it reads `data: [DONE]`, before the end of the response body, so streams don't reuse connections and
+only save building the client.
+
+Usage:
+    python benchmark/bench_oai_client.py
+    python benchmark/bench_oai_client.py --requests 500
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Make sure the project root is on the path when run directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ANSWER = 'Hello from the stub server.'
+
+
+def _parse_args():
+    p = argparse.ArgumentParser(description='Qwen-Agent OpenAI client overhead benchmark')
+    p.add_argument('--requests', type=int, default=200, help='Number of timed requests per case')
+    return p.parse_args()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        # The headers and the body are written separately, so don't let Nagle's algorithm delay the body.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        type(self).connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if body.get('stream'):
+            chunks = [{'choices': [{'index': 0, 'delta': {'content': ANSWER[i:i + 5]}}]} for i in range(0, len(ANSWER), 5)]
+            out = ''.join(f'data: {json.dumps({"id": "x", "object": "chat.completion.chunk", "created": 0, "model": "stub", **c})}\n\n'
+                          for c in chunks) + 'data: [DONE]\n\n'
+            content_type = 'text/event-stream'
+        else:
+            out = json.dumps({
+                'id': 'x',
+                'object': 'chat.completion',
+                'created': 0,
+                'model': 'stub',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ANSWER}, 'finish_reason': 'stop'}],
+            })
+            content_type = 'application/json'
+        out = out.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def _build_llm(base_url: str, per_request: bool):
+    import openai
+
+    from qwen_agent.llm import get_chat_model
+
+    llm = get_chat_model({'model': 'stub', 'model_server': base_url, 'api_key': 'EMPTY', 'stream_usage': False})
+    if per_request:
+        clients = llm.clients
+        clients.get = lambda: openai.OpenAI(**clients.api_kwargs)
+    return llm
+
+
+def main():
+    args = _parse_args()
+    from qwen_agent.log import logger
+    logger.setLevel(logging.WARNING)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    messages = [{'role': 'user', 'content': 'hi'}]
+
+    print(f'\n{"="*60}')
+    print('  Qwen-Agent OpenAI Client Overhead Benchmark')
+    print(f'{"="*60}')
+    print(f'  Requests per case : {args.requests}')
+    for stream in [False, True]:
+        for setup in ['per_request', 'pooled']:
+            llm = _build_llm(base_url, per_request=(setup == 'per_request'))
+            for _ in range(3):  # Warm up
+                llm._chat_no_stream([], generate_cfg={})
+            _StubHandler.connections = 0
+            times = []
+            for _ in range(args.requests):
+                t0 = time.perf_counter()
+                if stream:
+                    *_, rsp = llm.chat(messages=messages, stream=True)
+                else:
+                    rsp = llm.chat(messages=messages, stream=False)
+                times.append(time.perf_counter() - t0)
+                assert rsp[-1]['content'] == ANSWER
+            case = f'{"stream" if stream else "no_stream"} {setup}'
+            print(f'  {case:<22}: {statistics.median(times) * 1000:6.2f} ms median, '
+                  f'{statistics.mean(times) * 1000:6.2f} ms mean per request, '
+                  f'{_StubHandler.connections} connections')
+    print(f'{"="*60}\n')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+bench_stream_postprocess.py – Measure the CPU time that `BaseChatModel.chat` spends per streamed token.
+
+A stub LLM streams a long answer one token at a time in full-stream mode (each chunk carries the whole answer so
+far), so the numbers only reflect the stream postprocessing (stop words, the fncall prompt parser and the output
+formatting). Three answers are measured: plain text, text ending with a tool call, and text with a qwen-style
+function call.
+
+Usage:
+    python benchmark/bench_stream_postprocess.py
+    python benchmark/bench_stream_postprocess.py --tokens 4000 --runs 3
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Iterator, List
+
+# Make sure the project root is on the path when run directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FUNCTIONS = [{
+    'name': 'bench_lookup',
+    'description': 'Look up a record.',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'key': {
+                'type': 'string'
+            }
+        },
+        'required': ['key']
+    },
+}]
+
+
+def _parse_args():
+    p = argparse.ArgumentParser(description='Qwen-Agent stream postprocessing benchmark')
+    p.add_argument('--tokens', type=int, default=4000, help='Number of streamed tokens per answer')
+    p.add_argument('--runs', type=int, default=3, help='Number of timed answers per case')
+    return p.parse_args()
+
+
+def _answers(num_tokens: int) -> dict:
+    from qwen_agent.llm.fncall_prompts.qwen_fncall_prompt import FN_ARGS, FN_NAME
+
+    words = [f'word{i % 97} ' for i in range(num_tokens)]
+    args = json.dumps({'key': 'abc'})
+    return {
+        'plain': ('nous', words),
+        'nous_tool_call': ('nous', words[:-20] + ['<tool_call>', '\n{"name": "bench_lookup", "arguments": ', args, '}\n', '</tool_call>']),
+        'qwen_fncall': ('qwen', words[:-20] + [f'\n{FN_NAME}', ': bench_lookup', f'\n{FN_ARGS}', ': ', args]),
+    }
+
+
+def _build_llm(fncall_prompt_type: str, tokens: List[str]):
+    from qwen_agent.llm.function_calling import BaseFnCallModel
+    from qwen_agent.llm.schema import ASSISTANT, Message
+
+    class StubLLM(BaseFnCallModel):
+
+        def _chat_stream(self, messages: List[Message], delta_stream: bool,
+                         generate_cfg: dict) -> Iterator[List[Message]]:
+            text = ''
+            for t in tokens:
+                text += t
+                yield [Message(ASSISTANT, text)]
+
+        def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+            return [Message(ASSISTANT, ''.join(tokens))]
+
+    return StubLLM({
+        'model': 'stub',
+        'generate_cfg': {
+            'fncall_prompt_type': fncall_prompt_type,
+            'stop': ['Observation:', '<|im_end|>']
+        }
+    })
+
+
+def main():
+    args = _parse_args()
+
+    print(f'\n{"="*60}')
+    print('  Qwen-Agent Stream Postprocessing Benchmark')
+    print(f'{"="*60}')
+    print(f'  Streamed tokens per answer : {args.tokens}')
+    for case, (fncall_prompt_type, tokens) in _answers(args.tokens).items():
+        llm = _build_llm(fncall_prompt_type, tokens)
+        messages = [{'role': 'user', 'content': 'Summarize the records.'}]
+        cpu_times = []
+        last = None
+        for _ in range(args.runs):
+            t0 = time.process_time()
+            for last in llm.chat(messages=messages, functions=FUNCTIONS, stream=True):
+                pass
+            cpu_times.append(time.process_time() - t0)
+        cpu = statistics.median(cpu_times)
+        print(f'  {case:<15}: {cpu * 1e6 / len(tokens):8.1f} us CPU per token, {cpu * 1000:8.1f} ms per answer '
+              f'({len(last)} output messages)')
+    print(f'{"="*60}\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,8 +13,13 @@
 # limitations under the License.
 
 __version__ = '0.0.34'
-from .agent import Agent
-from .multi_agent_hub import MultiAgentHub
+from qwen_agent.utils.registry import lazy_module_getattr
+
+# Imported on first use, so that importing a submodule, e.g., `qwen_agent.settings`, doesn't import the agents
+__getattr__ = lazy_module_getattr(__name__, {
+    'Agent': '.agent',
+    'MultiAgentHub': '.multi_agent_hub',
+})
 
 __all__ = [
     'Agent',
@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import json
 import traceback
 from abc import ABC, abstractmethod
@@ -22,10 +21,10 @@ from qwen_agent.llm import get_chat_model
 from qwen_agent.llm.base import BaseChatModel
 from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, ContentItem, Message
 from qwen_agent.log import logger
-from qwen_agent.tools import TOOL_REGISTRY, BaseTool, MCPManager
+from qwen_agent.tools import TOOL_REGISTRY, BaseTool
 from qwen_agent.tools.base import ToolServiceError
 from qwen_agent.tools.simple_doc_parser import DocParserError
-from qwen_agent.utils.utils import has_chinese_messages, merge_generate_cfgs
+from qwen_agent.utils.utils import derive_message, has_chinese_messages, merge_generate_cfgs, snapshot_messages
 
 
 class Agent(ABC):
@@ -88,18 +87,11 @@ class Agent(ABC):
         Yields:
             The response generator.
         """
-        messages = copy.deepcopy(messages)
-        _return_message_type = 'dict'
-        new_messages = []
         # Only return dict when all input messages are dict
+        new_messages, _return_message_type = snapshot_messages(messages)
         if not messages:
             _return_message_type = 'message'
-        for msg in messages:
-            if isinstance(msg, dict):
-                new_messages.append(Message(**msg))
-            else:
-                new_messages.append(msg)
-                _return_message_type = 'message'
+        input_message_ids = set(id(msg) for msg in new_messages)
 
         if 'lang' not in kwargs:
             if has_chinese_messages(new_messages):
@@ -107,29 +99,40 @@ class Agent(ABC):
             else:
                 kwargs['lang'] = 'en'
 
-        if self.system_message:
-            if not new_messages or new_messages[0][ROLE] != SYSTEM:
-                # Add the system instruction to the agent
-                new_messages.insert(0, Message(role=SYSTEM, content=self.system_message))
-            else:
-                # Already got system message in new_messages
-                if isinstance(new_messages[0][CONTENT], str):
-                    new_messages[0][CONTENT] = self.system_message + '\n\n' + new_messages[0][CONTENT]
-                else:
-                    assert isinstance(new_messages[0][CONTENT], list)
-                    assert new_messages[0][CONTENT][0].text
-                    new_messages[0][CONTENT] = [ContentItem(text=self.system_message + '\n\n')
-                                               ] + new_messages[0][CONTENT]  # noqa
+        new_messages = self._add_system_message(new_messages)
 
         for rsp in self._run(messages=new_messages, **kwargs):
             for i in range(len(rsp)):
                 if not rsp[i].name and self.name:
-                    rsp[i].name = self.name
+                    if id(rsp[i]) in input_message_ids:
+                        # Never modify the caller's messages
+                        rsp[i] = derive_message(rsp[i], name=self.name)
+                    else:
+                        rsp[i].name = self.name
             if _return_message_type == 'message':
                 yield [Message(**x) if isinstance(x, dict) else x for x in rsp]
             else:
                 yield [x.model_dump() if not isinstance(x, dict) else x for x in rsp]
 
+    def _add_system_message(self, messages: List[Message]) -> List[Message]:
+        """Add the system instruction of the agent to the messages, without modifying the inputted list."""
+        if not self.system_message:
+            return messages
+        messages = list(messages)
+        if not messages or messages[0][ROLE] != SYSTEM:
+            # Add the system instruction to the agent
+            messages.insert(0, Message(role=SYSTEM, content=self.system_message))
+        else:
+            # Already got system message in messages
+            if isinstance(messages[0][CONTENT], str):
+                new_content = self.system_message + '\n\n' + messages[0][CONTENT]
+            else:
+                assert isinstance(messages[0][CONTENT], list)
+                assert messages[0][CONTENT][0].text
+                new_content = [ContentItem(text=self.system_message + '\n\n')] + messages[0][CONTENT]
+            messages[0] = derive_message(messages[0], content=new_content)
+        return messages
+
     @abstractmethod
     def _run(self, messages: List[Message], lang: str = 'en', **kwargs) -> Iterator[List[Message]]:
         """Return one response generator based on the received messages.
@@ -216,6 +219,7 @@ class Agent(ABC):
                 logger.warning(f'Repeatedly adding tool {tool_name}, will use the newest tool in function list')
             self.function_map[tool_name] = tool
         elif isinstance(tool, dict) and 'mcpServers' in tool:
+            from qwen_agent.tools.mcp_manager import MCPManager
             tools = MCPManager().initConfig(tool)
             for tool in tools:
                 tool_name = tool.name
@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import datetime
 import json
 from typing import Dict, Iterator, List, Literal, Optional, Union
@@ -22,7 +21,7 @@ from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, ContentItem, Message
 from qwen_agent.log import logger
 from qwen_agent.tools import BaseTool
-from qwen_agent.utils.utils import get_basename_from_url, print_traceback
+from qwen_agent.utils.utils import derive_message, get_basename_from_url, print_traceback
 
 KNOWLEDGE_TEMPLATE_ZH = """# 知识库
 
@@ -118,7 +117,7 @@ class Assistant(FnCallAgent):
                                   lang: Literal['en', 'zh'] = 'en',
                                   knowledge: str = '',
                                   **kwargs) -> List[Message]:
-        messages = copy.deepcopy(messages)
+        messages = list(messages)
         if not knowledge:
             # Retrieval knowledge from files
             *_, last = self.mem.run(messages=messages, lang=lang, **kwargs)
@@ -140,10 +139,11 @@ class Assistant(FnCallAgent):
         if knowledge_prompt:
             if messages and messages[0][ROLE] == SYSTEM:
                 if isinstance(messages[0][CONTENT], str):
-                    messages[0][CONTENT] += '\n\n' + knowledge_prompt
+                    new_content = messages[0][CONTENT] + '\n\n' + knowledge_prompt
                 else:
                     assert isinstance(messages[0][CONTENT], list)
-                    messages[0][CONTENT] += [ContentItem(text='\n\n' + knowledge_prompt)]
+                    new_content = messages[0][CONTENT] + [ContentItem(text='\n\n' + knowledge_prompt)]
+                messages[0] = derive_message(messages[0], content=new_content)
             else:
                 messages = [Message(role=SYSTEM, content=knowledge_prompt)] + messages
         return messages
@@ -16,6 +16,7 @@ import copy
 import json
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Iterator, List, Optional, Union
 
 import json5
@@ -30,7 +31,6 @@ from qwen_agent.log import logger
 from qwen_agent.tools import BaseTool
 from qwen_agent.tools.doc_parser import DocParser
 from qwen_agent.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
-from qwen_agent.utils.parallel_executor import parallel_exec
 from qwen_agent.utils.tokenization_qwen import count_tokens
 from qwen_agent.utils.utils import (extract_files_from_messages, extract_text_from_message, get_file_type,
                                     print_traceback)
@@ -218,10 +218,9 @@ class ParallelDocQA(Assistant):
         member_res = ''
         while retry_cnt > 0:
             time1 = time.time()
-            results = parallel_exec(self._ask_member_agent, data, jitter=0.5)
-            # results = serial_exec(self._qa, data)
+            results = self._ask_member_agents(data)
             time2 = time.time()
-            logger.info(f'Finished parallel_exec. Time spent: {time2 - time1} seconds.')
+            logger.info(f'Finished member agents. Time spent: {time2 - time1} seconds.')
             ordered_results = sorted(results, key=lambda x: x[0])
             filtered_results = []
 
@@ -251,12 +250,31 @@ class ParallelDocQA(Assistant):
                                                                         member_res=member_res)
         return self.summary_agent.run(messages=messages, lang=lang, knowledge=retrieve_content)
 
-    def _ask_member_agent(self,
-                          index: int,
-                          messages: List[Message],
-                          lang: str = 'en',
-                          knowledge: str = '',
-                          instruction: str = '') -> tuple:
+    def _ask_member_agents(self, data: List[dict]) -> List[tuple]:
+        # The members are independent conversations, so they are sent to the LLM in batches of `max_batch_size`.
         doc_qa = ParallelDocQAMember(llm=self.llm)
-        *_, last = doc_qa.run(messages=messages, knowledge=knowledge, lang=lang, instruction=instruction)
-        return index, last[-1].content
+        messages_list = [
+            doc_qa.build_messages(doc_qa._add_system_message(x['messages']),
+                                  knowledge=x['knowledge'],
+                                  lang=x['lang'],
+                                  instruction=x['instruction']) for x in data
+        ]
+        try:
+            responses = self.llm.chat_batch(messages_list, extra_generate_cfg=doc_qa.extra_generate_cfg)
+            return [(x['index'], rsp[-1].content) for x, rsp in zip(data, responses)]
+        except Exception:
+            print_traceback(is_error=False)
+            logger.warning('The batch of member agents failed, so the members are asked one by one.')
+
+        # A member that fails, e.g., with a model service error, is dropped like a member without an answer.
+        def _ask_member(member_messages: List[Message]) -> str:
+            try:
+                rsp = self.llm.chat_batch([member_messages], extra_generate_cfg=doc_qa.extra_generate_cfg)[0]
+                return rsp[-1].content
+            except Exception:
+                print_traceback()
+                return NO_RESPONSE
+
+        with ThreadPoolExecutor(max_workers=self.llm.max_batch_size) as executor:
+            answers = list(executor.map(_ask_member, messages_list))
+        return [(x['index'], answer) for x, answer in zip(data, answers)]
@@ -132,7 +132,15 @@ class ParallelDocQAMember(Agent):
              lang: str = 'en',
              instruction: str = None,
              **kwargs) -> Iterator[List[Message]]:
+        messages = self.build_messages(messages, knowledge=knowledge, lang=lang, instruction=instruction)
+        return self._call_llm(messages=messages)
 
+    def build_messages(self,
+                       messages: List[Message],
+                       knowledge: str = '',
+                       lang: str = 'en',
+                       instruction: str = None) -> List[Message]:
+        """Build the LLM input of `_run`, so that callers can batch the inputs of many members."""
         messages = copy.deepcopy(messages)
 
         system_prompt = SYSTEM_PROMPT_TEMPLATE[lang].format(no_response=NO_RESPONSE)
@@ -150,4 +158,4 @@ class ParallelDocQAMember(Agent):
         prompt = PROMPT_TEMPLATE[lang].format(ref_doc=knowledge, instruction=instruction)
 
         messages[-1] = Message(USER, prompt)
-        return self._call_llm(messages=messages)
+        return messages
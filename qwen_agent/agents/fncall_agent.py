@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 from typing import Dict, Iterator, List, Literal, Optional, Union
 
 from qwen_agent import Agent
@@ -71,7 +70,7 @@ class FnCallAgent(Agent):
             self.mem = Memory(llm=mem_llm, files=files, **kwargs)
 
     def _run(self, messages: List[Message], lang: Literal['en', 'zh'] = 'en', **kwargs) -> Iterator[List[Message]]:
-        messages = copy.deepcopy(messages)
+        messages = list(messages)  # The messages are shared (copy-on-write); only the list is extended here.
         num_llm_calls_available = MAX_LLM_CALL_PER_RUN
         response = []
         while True and num_llm_calls_available > 0:
@@ -15,10 +15,10 @@
 import copy
 from typing import Dict, Iterator, List, Optional, Union
 
+from qwen_agent import settings
 from qwen_agent.agents.keygen_strategies.gen_keyword import GenKeyword
 from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, Message
-from qwen_agent.settings import DEFAULT_MAX_INPUT_TOKENS
 from qwen_agent.tools import BaseTool
 from qwen_agent.utils.tokenization_qwen import count_tokens, tokenizer
 
@@ -69,7 +69,7 @@ Keywords:
              **kwargs) -> Iterator[List[Message]]:
         messages = copy.deepcopy(messages)
         files = files or []
-        available_token = DEFAULT_MAX_INPUT_TOKENS - count_tokens(f'{self.PROMPT_TEMPLATE[lang]}') - count_tokens(
+        available_token = settings.DEFAULT_MAX_INPUT_TOKENS - count_tokens(f'{self.PROMPT_TEMPLATE[lang]}') - count_tokens(
             messages[-1][CONTENT]) - 100
 
         voc = self._call_tool(
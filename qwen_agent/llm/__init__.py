@@ -13,22 +13,37 @@
 # limitations under the License.
 
 import copy
-from typing import Union
-
-from .azure import TextChatAtAzure
-from .base import LLM_REGISTRY, BaseChatModel, ModelServiceError
-from .oai import TextChatAtOAI
-from .openvino import OpenVINO
-from .qwen_dashscope import QwenChatAtDS
-from .qwenaudio_dashscope import QwenAudioChatAtDS
-from .qwenomni_oai import QwenOmniChatAtOAI
-from .qwenvl_dashscope import QwenVLChatAtDS
-from .qwenvl_oai import QwenVLChatAtOAI
-from .qwenvlo_dashscope import QwenVLoChatAtDS
-from .transformers_llm import Transformers
-
-
-def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
+from typing import TYPE_CHECKING, Union
+
+from qwen_agent.utils.registry import lazy_module_getattr
+
+if TYPE_CHECKING:
+    from .base import BaseChatModel
+
+# The backends are imported on first use, e.g., `from qwen_agent.llm import Transformers` or a lookup in LLM_REGISTRY.
+# So is the base module, so that importing `qwen_agent.llm.schema` doesn't import it.
+__getattr__ = lazy_module_getattr(
+    __name__, {
+        'LLM_REGISTRY': '.base',
+        'BaseChatModel': '.base',
+        'ModelServiceError': '.base',
+        'TextChatAtAzure': '.azure',
+        'TextChatAtOAI': '.oai',
+        'TextChatAtOAIPool': '.oai_pool',
+        'LlamaCpp': '.llamacpp_llm',
+        'ONNXRuntime': '.onnx_llm',
+        'OpenVINO': '.openvino',
+        'QwenChatAtDS': '.qwen_dashscope',
+        'QwenAudioChatAtDS': '.qwenaudio_dashscope',
+        'QwenOmniChatAtOAI': '.qwenomni_oai',
+        'QwenVLChatAtDS': '.qwenvl_dashscope',
+        'QwenVLChatAtOAI': '.qwenvl_oai',
+        'QwenVLoChatAtDS': '.qwenvlo_dashscope',
+        'Transformers': '.transformers_llm',
+    })
+
+
+def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> 'BaseChatModel':
     """The interface of instantiating LLM objects.
 
     Args:
@@ -42,6 +57,9 @@ def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
               # 'model': 'Qwen',
               # 'model_server': 'http://127.0.0.1:7905/v1',
 
+              # Or route the requests among several replicas of your model service:
+              # 'model_servers': ['http://10.0.0.1:8000/v1', 'http://10.0.0.2:8000/v1'],
+
               # (Optional) LLM hyper-parameters:
               'generate_cfg': {
                   'top_p': 0.8,
@@ -53,6 +71,8 @@ def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
     Returns:
         LLM object.
     """
+    from .base import LLM_REGISTRY
+
     if isinstance(cfg, str):
         cfg = {'model': cfg}
 
@@ -65,7 +85,7 @@ def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
                     cfg['model_server'] = 'https://dashscope.aliyuncs.com/compatible-mode/v1'
             return LLM_REGISTRY[model_type](cfg)
         else:
-            raise ValueError(f'Please set model_type from {str(LLM_REGISTRY.keys())}')
+            raise ValueError(f'Please set model_type from {str(list(LLM_REGISTRY.keys()))}')
 
     # Deduce model_type from model and model_server if model_type is not provided:
 
@@ -74,6 +94,11 @@ def get_chat_model(cfg: Union[dict, str] = 'qwen-plus') -> BaseChatModel:
         cfg['model_type'] = model_type
         return LLM_REGISTRY[model_type](cfg)
 
+    if 'model_servers' in cfg:
+        model_type = 'oai_pool'
+        cfg['model_type'] = model_type
+        return LLM_REGISTRY[model_type](cfg)
+
     if 'model_server' in cfg:
         if cfg['model_server'].strip().startswith('http'):
             model_type = 'oai'
@@ -104,6 +129,7 @@ __all__ = [
     'BaseChatModel',
     'QwenChatAtDS',
     'TextChatAtOAI',
+    'TextChatAtOAIPool',
     'TextChatAtAzure',
     'QwenVLChatAtDS',
     'QwenVLChatAtOAI',
@@ -111,6 +137,8 @@ __all__ = [
     'QwenVLoChatAtDS',
     'QwenOmniChatAtOAI',
     'OpenVINO',
+    'ONNXRuntime',
+    'LlamaCpp',
     'Transformers',
     'get_chat_model',
     'ModelServiceError',
@@ -18,7 +18,7 @@ from typing import Dict, Optional
 import openai
 
 from qwen_agent.llm.base import register_llm
-from qwen_agent.llm.oai import TextChatAtOAI
+from qwen_agent.llm.oai import OpenAIClients, TextChatAtOAI
 
 
 @register_llm('azure')
@@ -39,6 +39,8 @@ class TextChatAtAzure(TextChatAtOAI):
         api_key = (api_key or 'EMPTY').strip()
 
         api_version = cfg.get('api_version', '2024-06-01')
+        # `stream_options` needs a recent api_version, so only ask for the usage of streams if configured.
+        self.stream_usage = cfg.get('stream_usage', False)
 
         api_kwargs = {}
         if api_base:
@@ -48,8 +50,5 @@ class TextChatAtAzure(TextChatAtOAI):
         if api_version:
             api_kwargs['api_version'] = api_version
 
-        def _chat_complete_create(*args, **kwargs):
-            client = openai.AzureOpenAI(**api_kwargs)
-            return client.chat.completions.create(*args, **kwargs)
-
-        self._chat_complete_create = _chat_complete_create
+        self._set_clients(
+            OpenAIClients(openai.AzureOpenAI, openai.AsyncAzureOpenAI, api_kwargs, cfg.get('http_client')))
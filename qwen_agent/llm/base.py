@@ -12,29 +12,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import copy
+import functools
 import json
 import os
 import random
 import time
 from abc import ABC, abstractmethod
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pprint import pformat
-from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
-
-from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, FUNCTION, SYSTEM, USER, Message
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union
+
+from qwen_agent import settings
+from qwen_agent.llm.cancellation import CancellationToken, acancel_on_exit, cancel_on_exit
+from qwen_agent.llm.hedging import HedgePolicy, get_hedge_policy
+from qwen_agent.llm.metrics import MetricsRecorder, attach_metrics, emit_metrics
+from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, FUNCTION, SYSTEM, USER, ContentItem, Message
+from qwen_agent.llm.stop_words import StopWordMatcher, get_stop_word_matcher
+from qwen_agent.llm.token_counter import message_token_counter
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_INPUT_TOKENS
+from qwen_agent.utils.async_utils import iterate_in_threadpool, iterate_sync, run_in_threadpool
+from qwen_agent.utils.cache import DEFAULT_MEMORY_CACHE_BYTES, TwoTierCache, make_cache_key
+from qwen_agent.utils.registry import LazyRegistry
 from qwen_agent.utils.tokenization_qwen import tokenizer
-from qwen_agent.utils.utils import (extract_text_from_message, format_as_multimodal_message, format_as_text_message,
-                                    has_chinese_messages, json_dumps_compact, merge_generate_cfgs, print_traceback)
-
-LLM_REGISTRY = {}
+from qwen_agent.utils.utils import (derive_message, format_as_multimodal_message, format_as_text_message,
+                                    has_chinese_messages, json_dumps_compact, merge_generate_cfgs, snapshot_messages)
+
+# The built-in model types, whose modules are imported when they are first looked up
+LLM_REGISTRY = LazyRegistry(
+    'LLM', {
+        'azure': 'qwen_agent.llm.azure',
+        'llamacpp': 'qwen_agent.llm.llamacpp_llm',
+        'oai': 'qwen_agent.llm.oai',
+        'oai_pool': 'qwen_agent.llm.oai_pool',
+        'onnxruntime': 'qwen_agent.llm.onnx_llm',
+        'openvino': 'qwen_agent.llm.openvino',
+        'qwen_dashscope': 'qwen_agent.llm.qwen_dashscope',
+        'qwenaudio_dashscope': 'qwen_agent.llm.qwenaudio_dashscope',
+        'qwenomni_oai': 'qwen_agent.llm.qwenomni_oai',
+        'qwenvl_dashscope': 'qwen_agent.llm.qwenvl_dashscope',
+        'qwenvl_oai': 'qwen_agent.llm.qwenvl_oai',
+        'qwenvlo_dashscope': 'qwen_agent.llm.qwenvlo_dashscope',
+        'transformers': 'qwen_agent.llm.transformers_llm',
+    })
 
 
 def register_llm(model_type):
 
     def decorator(cls):
+        if LLM_REGISTRY.is_builtin(model_type, cls) and LLM_REGISTRY.is_loaded(model_type):
+            return cls  # A class registered meanwhile to replace the built-in one stays
         LLM_REGISTRY[model_type] = cls
         return cls
 
@@ -75,12 +105,21 @@ class BaseChatModel(ABC):
     def support_audio_input(self) -> bool:
         return False
 
+    @property
+    def default_max_batch_size(self) -> int:
+        # The batch size of `chat_batch` when `max_batch_size` is not configured.
+        return 1
+
     def __init__(self, cfg: Optional[Dict] = None):
         cfg = cfg or {}
         self.model = cfg.get('model', '').strip()
         generate_cfg = copy.deepcopy(cfg.get('generate_cfg', {}))
         cache_dir = cfg.get('cache_dir', generate_cfg.pop('cache_dir', None))
         self.max_retries = generate_cfg.pop('max_retries', 0)
+        # The sinks that receive the metrics of every call of this LLM, in addition to the global ones.
+        self.metrics_sinks = list(cfg.get('metrics_sinks', []))
+        # Opt-in hedged requests for interactive traffic, see `HedgePolicy`.
+        self.hedge_policy = get_hedge_policy(cfg.get('hedge', generate_cfg.pop('hedge', None)))
         self.generate_cfg = generate_cfg
         self.model_type = cfg.get('model_type', '')
         if 'dashscope' in self.model_type:
@@ -95,18 +134,26 @@ class BaseChatModel(ABC):
                 logger.info('Setting `use_raw_api` to True when using `Qwen3-Max`')
                 self.use_raw_api = True
 
-        if cache_dir:
-            try:
-                import diskcache
-            except ImportError:
-                print_traceback(is_error=False)
-                logger.warning('Caching disabled because diskcache is not installed. Please `pip install diskcache`.')
-                cache_dir = None
-        if cache_dir:
-            os.makedirs(cache_dir, exist_ok=True)
-            self.cache = diskcache.Cache(directory=cache_dir)
-        else:
-            self.cache = None
+        # Response cache: an in-process LRU tier (bounded by `cache_max_memory_bytes`) in front of an optional
+        # disk tier under `cache_dir`. Setting only `cache_max_memory_bytes` gives a memory-only cache.
+        cache_max_memory_bytes = cfg.get('cache_max_memory_bytes', generate_cfg.pop('cache_max_memory_bytes', None))
+        cache_ttl = cfg.get('cache_ttl', generate_cfg.pop('cache_ttl', None))
+        cache_size_limit = cfg.get('cache_size_limit', generate_cfg.pop('cache_size_limit', None))
+        self.cache_replay_chunk_size = cfg.get('cache_replay_chunk_size',
+                                               generate_cfg.pop('cache_replay_chunk_size', 32))
+        if cache_max_memory_bytes is None:
+            cache_max_memory_bytes = DEFAULT_MEMORY_CACHE_BYTES if cache_dir else 0
+        # The max number of conversations that `chat_batch` sends to the model service together.
+        max_batch_size = cfg.get('max_batch_size', generate_cfg.pop('max_batch_size', None))
+        self.max_batch_size: int = max(1, max_batch_size or self.default_max_batch_size)
+        self.cache = None
+        if cache_dir or cache_max_memory_bytes:
+            cache = TwoTierCache(max_memory_bytes=cache_max_memory_bytes,
+                                 cache_dir=cache_dir,
+                                 disk_size_limit=cache_size_limit,
+                                 ttl=cache_ttl)
+            if cache.enabled:
+                self.cache = cache
 
     def quick_chat(self, prompt: str) -> str:
         *_, responses = self.chat(messages=[Message(role=USER, content=prompt)])
@@ -122,6 +169,7 @@ class BaseChatModel(ABC):
         stream: bool = True,
         delta_stream: bool = False,
         extra_generate_cfg: Optional[Dict] = None,
+        cancel_token: Optional[CancellationToken] = None,
     ) -> Union[List[Message], List[Dict], Iterator[List[Message]], Iterator[List[Dict]]]:
         """LLM chat interface.
 
@@ -133,38 +181,274 @@ class BaseChatModel(ABC):
               (1) When False (recommended): Stream the full response every iteration.
               (2) When True: Stream the chunked response, i.e, delta responses.
             extra_generate_cfg: Extra LLM generation hyper-parameters.
+            cancel_token: Cancelling it stops the generation, e.g., from another thread when the user presses stop.
+              The stream then ends early. The generation also stops when the consumer stops iterating the stream.
 
         Returns:
             the generated message list response by llm.
         """
+        req = self._prepare_chat(messages,
+                                 functions=functions,
+                                 stream=stream,
+                                 delta_stream=delta_stream,
+                                 extra_generate_cfg=extra_generate_cfg)
+
+        if req.cached_response is not None:
+            if stream:
+                return self._record_stream_metrics(
+                    self._convert_messages_iterator_to_target_type(
+                        _replay_cached_response(req.cached_response,
+                                                delta_stream=delta_stream,
+                                                chunk_size=self.cache_replay_chunk_size), req.return_message_type),
+                    req)
+            return self._record_metrics(
+                self._convert_messages_to_target_type(req.cached_response, req.return_message_type), req)
 
-        # Unify the input messages to type List[Message]:
-        messages = copy.deepcopy(messages)
-        _return_message_type = 'dict'
-        new_messages = []
-        for msg in messages:
-            if isinstance(msg, dict):
-                new_messages.append(Message(**msg))
+        if self.use_raw_api:
+            return self.raw_chat(messages=req.messages, functions=functions, stream=stream, generate_cfg=req.generate_cfg)
+
+        req.cancel_token = CancellationToken(parent=cancel_token)
+
+        def _call_model_service():
+            return req.metrics.call(req.cancel_token.call, self._call_model_service, req)
+
+        if stream and delta_stream:
+            # No retry for delta streaming
+            if self.hedge_policy:
+                output = self.hedge_policy.iterate(_call_model_service)
             else:
-                new_messages.append(msg)
-                _return_message_type = 'message'
-        messages = new_messages
+                output = _call_model_service()
+        elif stream and (not delta_stream):
+            output = retry_model_service_iterator(_call_model_service,
+                                                  max_retries=self.max_retries,
+                                                  hedge_policy=self.hedge_policy)
+        else:
+            try:
+                output = retry_model_service(_call_model_service,
+                                             max_retries=self.max_retries,
+                                             hedge_policy=self.hedge_policy)
+            finally:
+                req.cancel_token.close()
+
+        if isinstance(output, list):
+            assert not stream
+            return self._finish_chat(output, req)
+
+        assert stream
+        output = self._postprocess_messages_iterator(output,
+                                                     fncall_mode=req.fncall_mode,
+                                                     generate_cfg=self._stream_postprocess_cfg(req))
+
+        def _format_and_cache() -> Iterator[List[Message]]:
+            o = []
+            for o in output:
+                if o:
+                    o = self._format_output(o)
+                    yield o
+            if o:
+                self._cache_response(req, o)
+
+        return cancel_on_exit(
+            self._record_stream_metrics(
+                self._convert_messages_iterator_to_target_type(_format_and_cache(), req.return_message_type), req),
+            req.cancel_token)
+
+    async def achat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]] = None,
+        stream: bool = True,
+        delta_stream: bool = False,
+        extra_generate_cfg: Optional[Dict] = None,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Union[List[Message], List[Dict], AsyncIterator[List[Message]], AsyncIterator[List[Dict]]]:
+        """The asyncio version of `chat`, with the same arguments and the same preprocessing, truncation, caching,
+        retry and postprocessing steps.
+
+        Backends with a native async client (the OpenAI-compatible ones) wait for the model service without holding
+        a thread. Other backends run their sync implementation in the default executor of the event loop.
+
+        Returns:
+            The generated message list when `stream=False`, otherwise an async iterator of message lists, e.g.,
+            `async for rsp in await llm.achat(messages): ...`.
+        """
+        req = self._prepare_chat(messages,
+                                 functions=functions,
+                                 stream=stream,
+                                 delta_stream=delta_stream,
+                                 extra_generate_cfg=extra_generate_cfg)
+
+        if req.cached_response is not None:
+            if stream:
+                return iterate_sync(
+                    self._record_stream_metrics(
+                        self._convert_messages_iterator_to_target_type(
+                            _replay_cached_response(req.cached_response,
+                                                    delta_stream=delta_stream,
+                                                    chunk_size=self.cache_replay_chunk_size),
+                            req.return_message_type), req))
+            return self._record_metrics(
+                self._convert_messages_to_target_type(req.cached_response, req.return_message_type), req)
+
+        if self.use_raw_api:
+            return self.araw_chat(messages=req.messages, functions=functions, stream=stream, generate_cfg=req.generate_cfg)
+
+        req.cancel_token = CancellationToken(parent=cancel_token)
+
+        async def _call_model_service():
+            return await req.metrics.acall(req.cancel_token.acall, self._acall_model_service, req)
+
+        if stream and delta_stream:
+            # No retry for delta streaming
+            if self.hedge_policy:
+                output = self.hedge_policy.aiterate(_call_model_service)
+            else:
+                output = await _call_model_service()
+        elif stream and (not delta_stream):
+            output = aretry_model_service_iterator(_call_model_service,
+                                                   max_retries=self.max_retries,
+                                                   hedge_policy=self.hedge_policy)
+        else:
+            try:
+                output = await aretry_model_service(_call_model_service,
+                                                    max_retries=self.max_retries,
+                                                    hedge_policy=self.hedge_policy)
+            finally:
+                req.cancel_token.close()
+
+        if isinstance(output, list):
+            assert not stream
+            return self._finish_chat(output, req)
+
+        assert stream
+        output = self._apostprocess_messages_iterator(output,
+                                                      fncall_mode=req.fncall_mode,
+                                                      generate_cfg=self._stream_postprocess_cfg(req))
+
+        async def _format_and_cache() -> AsyncIterator[Union[List[Message], List[Dict]]]:
+            o, rsp = [], []
+            async for o in output:
+                if o:
+                    o = self._format_output(o)
+                    rsp = self._convert_messages_to_target_type(o, req.return_message_type)
+                    yield rsp
+            if o:
+                self._cache_response(req, o)
+            self._record_metrics(rsp, req)
+
+        return acancel_on_exit(_format_and_cache(), req.cancel_token)
+
+    def chat_batch(
+        self,
+        messages_list: List[List[Union[Message, Dict]]],
+        functions: Optional[List[Dict]] = None,
+        extra_generate_cfg: Optional[Dict] = None,
+    ) -> Union[List[List[Message]], List[List[Dict]]]:
+        """Non-streaming chat for many independent conversations.
+
+        Up to `max_batch_size` conversations are sent to the model service together, e.g., as one padded batch of
+        a local model or as concurrent requests to a remote service.
+
+        Args:
+            messages_list: The inputted messages of each conversation.
+            functions: Inputted functions for function calling, shared by all conversations.
+            extra_generate_cfg: Extra LLM generation hyper-parameters, shared by all conversations.
+
+        Returns:
+            The response of each conversation, in the same order as `messages_list`.
+        """
+        if self.use_raw_api:
+            # The raw API only supports full streaming, so keep the last response of each stream, running up to
+            # `max_batch_size` streams concurrently.
+            def _chat_raw(messages):
+                return _last_response(
+                    self.chat(messages, functions=functions, stream=True, extra_generate_cfg=extra_generate_cfg))
+
+            if self.max_batch_size == 1 or len(messages_list) <= 1:
+                return [_chat_raw(m) for m in messages_list]
+            with ThreadPoolExecutor(max_workers=min(self.max_batch_size, len(messages_list))) as executor:
+                return list(executor.map(_chat_raw, messages_list))
+
+        reqs = [
+            self._prepare_chat(m,
+                               functions=functions,
+                               stream=False,
+                               delta_stream=False,
+                               extra_generate_cfg=extra_generate_cfg) for m in messages_list
+        ]
+        results = [None] * len(reqs)
+        todo = []
+        for i, req in enumerate(reqs):
+            if req.cached_response is not None:
+                results[i] = self._record_metrics(
+                    self._convert_messages_to_target_type(req.cached_response, req.return_message_type), req)
+            else:
+                todo.append(i)
+        for start in range(0, len(todo), self.max_batch_size):
+            batch = todo[start:start + self.max_batch_size]
+            outputs = self._chat_batch([reqs[i] for i in batch])
+            for i, output in zip(batch, outputs):
+                # The overrides of `_chat_batch` that serve several requests with one call bypass their recorders.
+                reqs[i].metrics.record_output(output)
+                results[i] = self._finish_chat(output, reqs[i])
+        return results
+
+    def _chat_batch(self, reqs: List['_ChatRequest']) -> List[List[Message]]:
+        """Calls the model service for at most `max_batch_size` preprocessed requests, returning their outputs in
+        order. By default, the requests are sent concurrently from a thread pool."""
+        if len(reqs) == 1:
+            return [
+                retry_model_service(lambda: reqs[0].metrics.call(self._call_model_service, reqs[0]),
+                                    max_retries=self.max_retries)
+            ]
+        with ThreadPoolExecutor(max_workers=len(reqs)) as executor:
+            futures = [
+                executor.submit(retry_model_service,
+                                functools.partial(req.metrics.call, self._call_model_service, req),
+                                max_retries=self.max_retries) for req in reqs
+            ]
+            return [f.result() for f in futures]
+
+    def _prepare_chat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]],
+        stream: bool,
+        delta_stream: bool,
+        extra_generate_cfg: Optional[Dict],
+    ) -> '_ChatRequest':
+        """Looks up the cache and preprocesses the inputs. Shared by `chat` and `achat`."""
+
+        # Unify the input messages to type List[Message]. The snapshot shares the caller's messages (copy-on-write).
+        messages, _return_message_type = snapshot_messages(messages)
 
         if not messages:
             raise ValueError('Messages can not be empty.')
 
+        req = _ChatRequest(messages=messages,
+                           functions=functions,
+                           stream=stream,
+                           delta_stream=delta_stream,
+                           return_message_type=_return_message_type,
+                           metrics=MetricsRecorder(model=self.model,
+                                                   model_type=self.model_type,
+                                                   stream=stream,
+                                                   delta_stream=delta_stream))
+
         # Cache lookup:
         if self.cache is not None:
-            cache_key = dict(messages=messages, functions=functions, extra_generate_cfg=extra_generate_cfg)
-            cache_key: str = json_dumps_compact(cache_key, sort_keys=True)
-            cache_value: str = self.cache.get(cache_key)
+            req.cache_key = make_cache_key(
+                dict(model=self.model,
+                     messages=[_without_metrics(msg) for msg in messages],
+                     functions=functions,
+                     extra_generate_cfg=extra_generate_cfg),
+                namespace='llm',
+            )
+            cache_value: str = self.cache.get(req.cache_key)
             if cache_value:
-                cache_value: List[dict] = json.loads(cache_value)
-                if _return_message_type == 'message':
-                    cache_value: List[Message] = [Message(**m) for m in cache_value]
-                if stream:
-                    cache_value: Iterator[List[Union[Message, dict]]] = iter([cache_value])
-                return cache_value
+                logger.debug(f'LLM cache hit: {req.cache_key}')
+                req.cached_response = json.loads(cache_value)
+                return req
 
         if stream and delta_stream:
             logger.warning(
@@ -187,7 +471,7 @@ class BaseChatModel(ABC):
             messages = [Message(role=SYSTEM, content=DEFAULT_SYSTEM_MESSAGE)] + messages
 
         # Not precise. It's hard to estimate tokens related with function calling and multimodal items.
-        max_input_tokens = generate_cfg.pop('max_input_tokens', DEFAULT_MAX_INPUT_TOKENS)
+        max_input_tokens = generate_cfg.pop('max_input_tokens', settings.DEFAULT_MAX_INPUT_TOKENS)
         if max_input_tokens > 0:
             messages = _truncate_input_messages_roughly(
                 messages=messages,
@@ -220,74 +504,109 @@ class BaseChatModel(ABC):
         if self.use_raw_api:
             logger.debug('`use_raw_api` takes effect.')
             assert stream and (not delta_stream), '`use_raw_api` only support full stream!!!'
-            return self.raw_chat(messages=messages, functions=functions, stream=stream, generate_cfg=generate_cfg)
-
-        if not fncall_mode:
+        elif not fncall_mode:
             for k in ['parallel_function_calls', 'function_choice', 'thought_in_content']:
                 if k in generate_cfg:
                     del generate_cfg[k]
 
-        def _call_model_service():
-            if fncall_mode:
-                return self._chat_with_functions(
-                    messages=messages,
-                    functions=functions,
-                    stream=stream,
-                    delta_stream=delta_stream,
-                    generate_cfg=generate_cfg,
-                    lang=lang,
-                )
+        req.messages = messages
+        req.generate_cfg = generate_cfg
+        req.lang = lang
+        req.fncall_mode = fncall_mode
+        return req
+
+    def _call_model_service(self, req: '_ChatRequest') -> Union[List[Message], Iterator[List[Message]]]:
+        if req.fncall_mode:
+            return self._chat_with_functions(
+                messages=req.messages,
+                functions=req.functions,
+                stream=req.stream,
+                delta_stream=req.delta_stream,
+                generate_cfg=req.generate_cfg,
+                lang=req.lang,
+            )
+        else:
+            # TODO: Optimize code structure
+            if req.messages[-1].role == ASSISTANT:
+                assert not req.delta_stream, 'Continuation mode does not currently support `delta_stream`'
+                return self._continue_assistant_response(req.messages, generate_cfg=req.generate_cfg, stream=req.stream)
             else:
-                # TODO: Optimize code structure
-                if messages[-1].role == ASSISTANT:
-                    assert not delta_stream, 'Continuation mode does not currently support `delta_stream`'
-                    return self._continue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
-                else:
-                    return self._chat(
-                        messages,
-                        stream=stream,
-                        delta_stream=delta_stream,
-                        generate_cfg=generate_cfg,
-                    )
+                return self._chat(
+                    req.messages,
+                    stream=req.stream,
+                    delta_stream=req.delta_stream,
+                    generate_cfg=req.generate_cfg,
+                )
 
-        if stream and delta_stream:
-            # No retry for delta streaming
-            output = _call_model_service()
-        elif stream and (not delta_stream):
-            output = retry_model_service_iterator(_call_model_service, max_retries=self.max_retries)
+    async def _acall_model_service(self,
+                                   req: '_ChatRequest') -> Union[List[Message], AsyncIterator[List[Message]]]:
+        if req.fncall_mode:
+            return await self._achat_with_functions(
+                messages=req.messages,
+                functions=req.functions,
+                stream=req.stream,
+                delta_stream=req.delta_stream,
+                generate_cfg=req.generate_cfg,
+                lang=req.lang,
+            )
         else:
-            output = retry_model_service(_call_model_service, max_retries=self.max_retries)
+            if req.messages[-1].role == ASSISTANT:
+                assert not req.delta_stream, 'Continuation mode does not currently support `delta_stream`'
+                return await self._acontinue_assistant_response(req.messages,
+                                                                generate_cfg=req.generate_cfg,
+                                                                stream=req.stream)
+            else:
+                return await self._achat(
+                    req.messages,
+                    stream=req.stream,
+                    delta_stream=req.delta_stream,
+                    generate_cfg=req.generate_cfg,
+                )
 
-        if isinstance(output, list):
-            assert not stream
-            logger.debug(f'LLM Output: \n{pformat([_.model_dump() for _ in output], indent=2)}')
-            output = self._postprocess_messages(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
-            if not self.support_multimodal_output:
-                output = _format_as_text_messages(messages=output)
-            if self.cache:
-                self.cache.set(cache_key, json_dumps_compact(output))
-            return self._convert_messages_to_target_type(output, _return_message_type)
+    def _finish_chat(self, output: List[Message], req: '_ChatRequest') -> Union[List[Message], List[Dict]]:
+        logger.debug(f'LLM Output: \n{pformat([_.model_dump() for _ in output], indent=2)}')
+        output = self._postprocess_messages(output, fncall_mode=req.fncall_mode, generate_cfg=req.generate_cfg)
+        output = self._format_output(output)
+        self._cache_response(req, output)
+        return self._record_metrics(self._convert_messages_to_target_type(output, req.return_message_type), req)
+
+    def _record_metrics(self, output: Union[List[Message], List[Dict]], req: '_ChatRequest') -> Union[List[Message],
+                                                                                                      List[Dict]]:
+        # Attaches the metrics of the call to the final response, and emits them to the metrics sinks.
+        if req.cached_response is not None:
+            metrics = req.metrics.finish_cache_hit()
         else:
-            assert stream
-            if delta_stream:
-                # Hack: To avoid potential errors during the postprocessing of stop words when delta_stream=True.
-                # Man, we should never have implemented the support for `delta_stream=True` in the first place!
-                generate_cfg = copy.deepcopy(generate_cfg)  # copy to avoid conflicts with `_call_model_service`
-                assert 'skip_stopword_postproc' not in generate_cfg
-                generate_cfg['skip_stopword_postproc'] = True
-            output = self._postprocess_messages_iterator(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
-
-            def _format_and_cache() -> Iterator[List[Message]]:
-                o = []
-                for o in output:
-                    if o:
-                        if not self.support_multimodal_output:
-                            o = _format_as_text_messages(messages=o)
-                        yield o
-                if o and (self.cache is not None):
-                    self.cache.set(cache_key, json_dumps_compact(o))
-
-            return self._convert_messages_iterator_to_target_type(_format_and_cache(), _return_message_type)
+            metrics = req.metrics.finish(prompt=req.messages)
+        attach_metrics(output, metrics)
+        emit_metrics(metrics, self.metrics_sinks)
+        return output
+
+    def _record_stream_metrics(self, responses: Iterator[list], req: '_ChatRequest') -> Iterator[list]:
+        # The metrics are complete once the stream ends, so they are attached to the last response in place.
+        rsp = []
+        for rsp in responses:
+            yield rsp
+        self._record_metrics(rsp, req)
+
+    @staticmethod
+    def _stream_postprocess_cfg(req: '_ChatRequest') -> dict:
+        generate_cfg = req.generate_cfg
+        if req.delta_stream:
+            # Hack: To avoid potential errors during the postprocessing of stop words when delta_stream=True.
+            # Man, we should never have implemented the support for `delta_stream=True` in the first place!
+            generate_cfg = copy.deepcopy(generate_cfg)  # copy to avoid conflicts with `_call_model_service`
+            assert 'skip_stopword_postproc' not in generate_cfg
+            generate_cfg['skip_stopword_postproc'] = True
+        return generate_cfg
+
+    def _format_output(self, messages: List[Message]) -> List[Message]:
+        if not self.support_multimodal_output:
+            messages = _format_as_text_messages(messages=messages)
+        return messages
+
+    def _cache_response(self, req: '_ChatRequest', output: List[Message]):
+        if self.cache is not None and not req.cancel_token.cancelled:  # Not the response cut short by a cancel
+            self.cache.set(req.cache_key, json_dumps_compact(output))
 
     def _chat(
         self,
@@ -338,6 +657,67 @@ class BaseChatModel(ABC):
     ) -> List[Message]:
         raise NotImplementedError
 
+    # The async counterparts of the methods above. By default, they run the sync implementation in the default
+    # executor of the event loop. Backends with a native async client should override `_achat_stream` and
+    # `_achat_no_stream`.
+
+    async def _achat(
+        self,
+        messages: List[Message],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        if stream:
+            return self._achat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+        else:
+            return await self._achat_no_stream(messages, generate_cfg=generate_cfg)
+
+    async def _achat_with_functions(
+        self,
+        messages: List[Message],
+        functions: List[Dict],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        return await _call_in_threadpool(self._chat_with_functions,
+                                         iterate=stream,
+                                         messages=messages,
+                                         functions=functions,
+                                         stream=stream,
+                                         delta_stream=delta_stream,
+                                         generate_cfg=generate_cfg,
+                                         lang=lang)
+
+    async def _acontinue_assistant_response(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+        stream: bool,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        return await _call_in_threadpool(self._continue_assistant_response,
+                                         iterate=stream,
+                                         messages=messages,
+                                         generate_cfg=generate_cfg,
+                                         stream=stream)
+
+    def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        return iterate_in_threadpool(self._chat_stream, messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        return await run_in_threadpool(self._chat_no_stream, messages, generate_cfg=generate_cfg)
+
     def _preprocess_messages(
         self,
         messages: List[Message],
@@ -376,17 +756,47 @@ class BaseChatModel(ABC):
         if not generate_cfg.get('skip_stopword_postproc', False):
             stop = generate_cfg.get('stop', [])
             messages = _postprocess_stop_words(messages, stop=stop)
+        return self._postprocess_fncall_output(messages, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+
+    def _postprocess_fncall_output(
+        self,
+        messages: List[Message],
+        fncall_mode: bool,
+        generate_cfg: dict,
+    ) -> List[Message]:
+        # The last step of `_postprocess_messages`, e.g., parsing function calls out of the text.
+        # It must only depend on its inputs, since the stream postprocessor reuses its output for unchanged inputs.
         return messages
 
+    def _get_stream_postprocessor(self, fncall_mode: bool,
+                                  generate_cfg: dict) -> Callable[[List[Message]], List[Message]]:
+        if type(self)._postprocess_messages is not BaseChatModel._postprocess_messages:
+            # Customized postprocessing is applied to the whole response of every chunk.
+            return functools.partial(self._postprocess_messages, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        return _StreamPostprocessor(self, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+
     def _postprocess_messages_iterator(
         self,
         messages: Iterator[List[Message]],
         fncall_mode: bool,
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
+        postprocess = self._get_stream_postprocessor(fncall_mode=fncall_mode, generate_cfg=generate_cfg)
         pre_msg = []
         for pre_msg in messages:
-            yield self._postprocess_messages(pre_msg, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+            yield postprocess(pre_msg)
+        logger.debug(f'LLM Output: \n{pformat([_.model_dump() for _ in pre_msg], indent=2)}')
+
+    async def _apostprocess_messages_iterator(
+        self,
+        messages: AsyncIterator[List[Message]],
+        fncall_mode: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        postprocess = self._get_stream_postprocessor(fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        pre_msg = []
+        async for pre_msg in messages:
+            yield postprocess(pre_msg)
         logger.debug(f'LLM Output: \n{pformat([_.model_dump() for _ in pre_msg], indent=2)}')
 
     def _convert_messages_to_target_type(self, messages: List[Message],
@@ -411,13 +821,21 @@ class BaseChatModel(ABC):
         stream: bool = True,
         generate_cfg: Optional[Dict] = None,
     ) -> Union[List[Message], List[Dict], Iterator[List[Message]], Iterator[List[Dict]]]:
-        if functions and functions[0].get('type') != 'function':
-            functions = [{'type': 'function', 'function': f} for f in functions]
-        if functions:
-            generate_cfg['tools'] = functions
+        _add_raw_api_tools(functions, generate_cfg)
         if stream:
             return self._chat_stream(messages=messages, delta_stream=False, generate_cfg=generate_cfg)
 
+    def araw_chat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]] = None,
+        stream: bool = True,
+        generate_cfg: Optional[Dict] = None,
+    ) -> Union[AsyncIterator[List[Message]], AsyncIterator[List[Dict]]]:
+        _add_raw_api_tools(functions, generate_cfg)
+        if stream:
+            return self._achat_stream(messages=messages, delta_stream=False, generate_cfg=generate_cfg)
+
     @staticmethod
     def _conv_qwen_agent_messages_to_oai(messages: List[Union[Message, Dict]]):
         new_messages = []
@@ -441,7 +859,7 @@ class BaseChatModel(ABC):
                         }
                     })
             elif msg['role'] == FUNCTION:
-                new_msg = copy.deepcopy(msg)
+                new_msg = dict(msg)
                 new_msg['role'] = 'tool'
                 new_msg['id'] = msg.get('extra', {}).get('function_id', '1')
                 new_messages.append(new_msg)
@@ -464,7 +882,7 @@ class BaseChatModel(ABC):
                 if msg['role'] in ['system', 'user']:
                     new_messages.append(msg)
                 elif msg['role'] == 'tool':
-                    new_msg = copy.deepcopy(msg)
+                    new_msg = dict(msg)
                     new_msg['role'] = 'function'
                     new_messages.append(new_msg)
                 elif msg['role'] == 'assistant':
@@ -508,7 +926,7 @@ class BaseChatModel(ABC):
                         }
                     }
                     message['tool_calls'].append(tool_call)
-            # Fake token usage
+            # The token usage is filled in once the stream ends
             response = {
                 'choices': [{
                     'message': message
@@ -525,12 +943,67 @@ class BaseChatModel(ABC):
             functions = [tool['function'] for tool in tools]
         else:
             functions = None
+        rsp, response = [], None
         for rsp in self.chat(
                 messages=_convert_to_qwen_agent_messages(messages),
                 functions=functions,
                 stream=True,
         ):
-            yield _convert_to_oai_message(rsp)
+            response = _convert_to_oai_message(rsp)
+            yield response
+        metrics = (rsp[-1].get('extra') or {}).get('metrics') if rsp else None
+        if response and metrics:
+            # The metrics are attached to the last response once the stream ends, so update the last yielded one.
+            response['usage'] = {
+                'prompt_tokens': metrics['prompt_tokens'],
+                'completion_tokens': metrics['completion_tokens'],
+                'total_tokens': metrics['prompt_tokens'] + metrics['completion_tokens']
+            }
+
+
+@dataclass
+class _ChatRequest:
+    """The state of one `chat` or `achat` call, from preprocessing to caching the response."""
+    messages: List[Message]
+    functions: Optional[List[Dict]]
+    stream: bool
+    delta_stream: bool
+    return_message_type: str
+    generate_cfg: dict = field(default_factory=dict)
+    lang: Literal['en', 'zh'] = 'en'
+    fncall_mode: bool = False
+    cache_key: Optional[str] = None
+    cached_response: Optional[List[dict]] = None
+    metrics: Optional[MetricsRecorder] = None
+    cancel_token: CancellationToken = field(default_factory=CancellationToken)
+
+
+def _without_metrics(msg: Message) -> Message:
+    # The metrics of previous calls, e.g., of the responses in the history, don't affect the response.
+    if msg.extra and ('metrics' in msg.extra):
+        return derive_message(msg, extra={k: v for k, v in msg.extra.items() if k != 'metrics'} or None)
+    return msg
+
+
+def _last_response(responses: Iterator[list]) -> list:
+    response = []
+    for response in responses:
+        pass
+    return response
+
+
+async def _call_in_threadpool(fn, iterate: bool, **kwargs) -> Union[Any, AsyncIterator]:
+    # Adapts a call to a sync backend: an async iterator over its output if `iterate`, otherwise its awaited result.
+    if iterate:
+        return iterate_in_threadpool(fn, **kwargs)
+    return await run_in_threadpool(fn, **kwargs)
+
+
+def _add_raw_api_tools(functions: Optional[List[Dict]], generate_cfg: dict):
+    if functions and functions[0].get('type') != 'function':
+        functions = [{'type': 'function', 'function': f} for f in functions]
+    if functions:
+        generate_cfg['tools'] = functions
 
 
 def _format_as_text_messages(messages: List[Message]) -> List[Message]:
@@ -544,10 +1017,34 @@ def _format_as_text_messages(messages: List[Message]) -> List[Message]:
     return messages
 
 
+def _replay_cached_response(messages: List[dict], delta_stream: bool, chunk_size: int) -> Iterator[List[dict]]:
+    """Replay a cached response as a stream, splitting the text content into chunks of `chunk_size` chars."""
+    if chunk_size <= 0:
+        yield messages
+        return
+    done = []
+    for msg in messages:
+        content = msg.get('content')
+        if not isinstance(content, str) or len(content) <= chunk_size:
+            done.append(msg)
+            yield [msg] if delta_stream else list(done)
+            continue
+        for start in range(0, len(content), chunk_size):
+            if delta_stream:
+                if start == 0:
+                    yield [{**msg, 'content': content[:chunk_size]}]
+                else:
+                    yield [{'role': msg['role'], 'content': content[start:start + chunk_size]}]
+            else:
+                yield done + [{**msg, 'content': content[:start + chunk_size]}]
+        done.append(msg)
+
+
 def _postprocess_stop_words(messages: List[Message], stop: List[str]) -> List[Message]:
-    messages = copy.deepcopy(messages)
+    # The input messages are not modified. Messages and items that need no truncation are shared with the output.
     if not messages:
         return messages
+    matcher = get_stop_word_matcher(stop)
 
     # Make sure it stops before stop words.
     trunc_messages = []
@@ -557,11 +1054,14 @@ def _postprocess_stop_words(messages: List[Message], stop: List[str]) -> List[Me
         for i, item in enumerate(msg.content):
             item_type, item_text = item.get_type_and_value()
             if item_type == 'text':
-                truncated, item.text = _truncate_at_stop_word(text=item_text, stop=stop)
+                truncated, trunc_text = matcher.truncate(item_text)
+                if truncated:
+                    item = ContentItem(text=trunc_text)
             trunc_content.append(item)
             if truncated:
                 break
-        msg.content = trunc_content
+        if truncated:
+            msg = derive_message(msg, content=trunc_content)
         trunc_messages.append(msg)
         if truncated:
             break
@@ -569,34 +1069,107 @@ def _postprocess_stop_words(messages: List[Message], stop: List[str]) -> List[Me
 
     # It may ends with partial stopword 'Observation' when the full stopword is 'Observation:'.
     # The following post-processing step removes partial stop words.
-    partial_stop = []
-    for s in stop:
-        s = tokenizer.tokenize(s)[:-1]
-        if s:
-            s = tokenizer.convert_tokens_to_string(s)
-            partial_stop.append(s)
-    partial_stop = sorted(set(partial_stop))
     if messages:
-        last_msg = messages[-1].content
-        for i in range(len(last_msg) - 1, -1, -1):
-            item_type, item_text = last_msg[i].get_type_and_value()
-            if item_type == 'text':
-                for s in partial_stop:
-                    if item_text.endswith(s):
-                        last_msg[i].text = item_text[:-len(s)]
-                break
+        messages[-1] = _remove_partial_stop_word(messages[-1], matcher)
 
     return messages
 
 
-def _truncate_at_stop_word(text: str, stop: List[str]):
-    truncated = False
-    for s in stop:
-        k = text.find(s)
-        if k >= 0:
-            truncated = True
-            text = text[:k]
-    return truncated, text
+def _remove_partial_stop_word(msg: Message, matcher: StopWordMatcher) -> Message:
+    last_msg = msg.content
+    for i in range(len(last_msg) - 1, -1, -1):
+        item_type, item_text = last_msg[i].get_type_and_value()
+        if item_type == 'text':
+            trunc_text = matcher.remove_partial_stop(item_text)
+            if trunc_text != item_text:
+                new_content = list(last_msg)
+                new_content[i] = ContentItem(text=trunc_text)
+                msg = derive_message(msg, content=new_content)
+            break
+    return msg
+
+
+class _StreamPostprocessor:
+    """Postprocesses the responses of a full stream chunk by chunk, with the same results as `_postprocess_messages`.
+
+    Every chunk carries the whole response so far. Rather than postprocessing it from scratch, the messages that
+    are unchanged since the previous chunk are reused, only the newly arrived text is scanned for stop words, and
+    `_postprocess_fncall_output` is skipped if its input is unchanged.
+    """
+
+    def __init__(self, llm: BaseChatModel, fncall_mode: bool, generate_cfg: dict):
+        self.llm = llm
+        self.fncall_mode = fncall_mode
+        self.generate_cfg = generate_cfg
+        if generate_cfg.get('skip_stopword_postproc', False):
+            self.matcher = get_stop_word_matcher([])
+        else:
+            self.matcher = get_stop_word_matcher(generate_cfg.get('stop', []))
+        self._entries = []  # The per-message state of the previous chunk, see `_process_message`
+        self._fncall_input = None
+        self._fncall_output = None
+
+    def __call__(self, messages: List[Message]) -> List[Message]:
+        entries, output = [], []
+        for i, msg in enumerate(messages):
+            fingerprint = _message_fingerprint(msg)
+            entry = self._entries[i] if i < len(self._entries) else None
+            if (entry is None) or (entry[0] != fingerprint):
+                entry = self._process_message(msg, fingerprint, prev_entry=entry)
+            entries.append(entry)
+            output.append(entry[1])
+            if entry[2]:  # Truncated at a stop word, so the rest is dropped
+                break
+        self._entries = entries
+        if output:
+            output[-1] = _remove_partial_stop_word(output[-1], self.matcher)
+
+        if (self._fncall_input is None) or (len(output) != len(self._fncall_input)) or any(
+                a is not b for a, b in zip(output, self._fncall_input)):
+            self._fncall_input = output
+            self._fncall_output = self.llm._postprocess_fncall_output(output,
+                                                                      fncall_mode=self.fncall_mode,
+                                                                      generate_cfg=self.generate_cfg)
+        return list(self._fncall_output)
+
+    def _process_message(self, msg: Message, fingerprint: tuple, prev_entry: Optional[tuple]) -> tuple:
+        # Returns (fingerprint, the message truncated at stop words, whether it is truncated, the formatted message).
+        msg = format_as_multimodal_message(msg,
+                                           add_upload_info=False,
+                                           add_multimodel_upload_info=False,
+                                           add_audio_upload_info=False)
+        if not self.matcher.stop:
+            return fingerprint, msg, False, msg
+
+        # The text items of the previous version of this message had no stop word, unless it was truncated.
+        prev_content = prev_entry[3].content if (prev_entry is not None) and (not prev_entry[2]) else []
+        truncated = False
+        trunc_content = []
+        for i, item in enumerate(msg.content):
+            item_type, item_text = item.get_type_and_value()
+            if item_type == 'text':
+                scanned = 0
+                if i < len(prev_content):
+                    prev_type, prev_text = prev_content[i].get_type_and_value()
+                    if prev_type == 'text' and item_text.startswith(prev_text):
+                        scanned = len(prev_text)
+                truncated, trunc_text = self.matcher.truncate(item_text, scanned=scanned)
+                if truncated:
+                    item = ContentItem(text=trunc_text)
+            trunc_content.append(item)
+            if truncated:
+                break
+        trunc_msg = derive_message(msg, content=trunc_content) if truncated else msg
+        return fingerprint, trunc_msg, truncated, msg
+
+
+def _message_fingerprint(msg: Message) -> tuple:
+    # Changes whenever the postprocessing result of the message may change. The content items are compared by
+    # identity first, so comparing an unchanged message is cheap.
+    content = tuple(msg.content) if isinstance(msg.content, list) else msg.content
+    fn = msg.function_call
+    return (msg.role, content, msg.reasoning_content, msg.name, fn.name if fn else None,
+            fn.arguments if fn else None, msg.extra)
 
 
 def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -> List[Message]:
@@ -625,9 +1198,7 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
                 )
 
     def _count_tokens(msg: Message) -> int:
-        if msg.role == ASSISTANT and msg.function_call:
-            return tokenizer.count_tokens(f'{msg.function_call}')
-        return tokenizer.count_tokens(extract_text_from_message(msg, add_upload_info=True))
+        return message_token_counter.count(msg)
 
     def _truncate_message(msg: Message, max_tokens: int, keep_both_sides: bool = False):
         if isinstance(msg.content, str):
@@ -807,12 +1378,15 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
 def retry_model_service(
     fn,
     max_retries: int = 10,
+    hedge_policy: Optional[HedgePolicy] = None,
 ) -> Any:
-    """Retry a function"""
+    """Retry a function, and hedge each attempt if a hedge policy is given"""
 
     num_retries, delay = 0, 1.0
     while True:
         try:
+            if hedge_policy:
+                return hedge_policy.call(fn)
             return fn()
 
         except ModelServiceError as e:
@@ -822,13 +1396,14 @@ def retry_model_service(
 def retry_model_service_iterator(
     it_fn,
     max_retries: int = 10,
+    hedge_policy: Optional[HedgePolicy] = None,
 ) -> Iterator:
-    """Retry an iterator"""
+    """Retry an iterator, and hedge each attempt if a hedge policy is given"""
 
     num_retries, delay = 0, 1.0
     while True:
         try:
-            for rsp in it_fn():
+            for rsp in (hedge_policy.iterate(it_fn) if hedge_policy else it_fn()):
                 yield rsp
             break
 
@@ -836,6 +1411,45 @@ def retry_model_service_iterator(
             num_retries, delay = _raise_or_delay(e, num_retries, delay, max_retries)
 
 
+async def aretry_model_service(
+    fn,
+    max_retries: int = 10,
+    hedge_policy: Optional[HedgePolicy] = None,
+) -> Any:
+    """Retry a coroutine function, and hedge each attempt if a hedge policy is given"""
+
+    num_retries, delay = 0, 1.0
+    while True:
+        try:
+            if hedge_policy:
+                return await hedge_policy.acall(fn)
+            return await fn()
+
+        except ModelServiceError as e:
+            num_retries, delay = _raise_or_backoff(e, num_retries, delay, max_retries)
+            await asyncio.sleep(delay)
+
+
+async def aretry_model_service_iterator(
+    it_fn,
+    max_retries: int = 10,
+    hedge_policy: Optional[HedgePolicy] = None,
+) -> AsyncIterator:
+    """Retry an async iterator, which is returned by the coroutine function `it_fn`, and hedge each attempt if a
+    hedge policy is given"""
+
+    num_retries, delay = 0, 1.0
+    while True:
+        try:
+            async for rsp in (hedge_policy.aiterate(it_fn) if hedge_policy else await it_fn()):
+                yield rsp
+            break
+
+        except ModelServiceError as e:
+            num_retries, delay = _raise_or_backoff(e, num_retries, delay, max_retries)
+            await asyncio.sleep(delay)
+
+
 def _raise_or_delay(
     e: ModelServiceError,
     num_retries: int,
@@ -845,6 +1459,20 @@ def _raise_or_delay(
     exponential_base: float = 2.0,
 ) -> Tuple[int, float]:
     """Retry with exponential backoff"""
+    num_retries, delay = _raise_or_backoff(e, num_retries, delay, max_retries, max_delay, exponential_base)
+    time.sleep(delay)
+    return num_retries, delay
+
+
+def _raise_or_backoff(
+    e: ModelServiceError,
+    num_retries: int,
+    delay: float,
+    max_retries: int = 10,
+    max_delay: float = 300.0,
+    exponential_base: float = 2.0,
+) -> Tuple[int, float]:
+    """Raise the error if it should not be retried, otherwise compute the next delay of the exponential backoff"""
 
     if max_retries <= 0:  # no retry
         raise e
@@ -871,7 +1499,6 @@ def _raise_or_delay(
     num_retries += 1
     jitter = 1.0 + random.random()
     delay = min(delay * exponential_base, max_delay) * jitter
-    time.sleep(delay)
     return num_retries, delay
 
 
@@ -0,0 +1,182 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cooperative cancellation of the generation of a `chat` call.
+
+A `CancellationToken` passed to `chat` or `achat` is cancelled by the caller, e.g., when the user presses stop in a UI,
+and the call cancels its own token when its consumer stops iterating the stream. The backends register what releases
+their compute with `on_cancel`: a local model stops decoding at the next step, and a remote stream closes its HTTP
+response.
+"""
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from qwen_agent.log import logger
+
+
+class CancellationToken:
+    """A thread-safe flag with callbacks, which are called once when it is cancelled.
+
+    Args:
+        parent: If set, this token is also cancelled when the parent is.
+    """
+
+    def __init__(self, parent: Optional['CancellationToken'] = None):
+        self._cancelled = False
+        self._callbacks = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._detach = parent.on_cancel(self.cancel) if parent is not None else None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = list(self._callbacks.values()), {}
+        for callback in callbacks:
+            _run_callback(callback)
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Calls `callback` when the token is cancelled, or now if it already is. Returns the function that removes
+        the callback, to be called once the work it cancels has finished."""
+        with self._lock:
+            if not self._cancelled:
+                callback_id = self._next_id
+                self._next_id += 1
+                self._callbacks[callback_id] = callback
+                return lambda: self._remove(callback_id)
+        _run_callback(callback)
+        return _noop
+
+    def _remove(self, callback_id: int) -> None:
+        with self._lock:
+            self._callbacks.pop(callback_id, None)
+
+    def close(self) -> None:
+        """Detaches the token from its parent once the call it belongs to has finished."""
+        if self._detach is not None:
+            self._detach()
+            self._detach = None
+
+    @contextmanager
+    def _active(self):
+        token = _current_token.set(self)
+        try:
+            yield
+        finally:
+            _current_token.reset(token)
+
+    def call(self, fn: Callable, *args):
+        """Calls the model service with this token as the current one, also while its output stream is iterated.
+        The stream ends early once the token is cancelled."""
+        with self._active():
+            output = fn(*args)
+        if isinstance(output, list):
+            return output
+        return self._iterate(output)
+
+    def _iterate(self, iterator: Iterator) -> Iterator:
+        it = iter(iterator)
+        try:
+            while not self._cancelled:
+                try:
+                    with self._active():
+                        output = next(it)
+                except StopIteration:
+                    return
+                yield output
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+
+    async def acall(self, fn: Callable, *args):
+        with self._active():
+            output = await fn(*args)
+        if isinstance(output, list):
+            return output
+        return self._aiterate(output)
+
+    async def _aiterate(self, iterator: AsyncIterator) -> AsyncIterator:
+        try:
+            while not self._cancelled:
+                try:
+                    with self._active():
+                        output = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                yield output
+        finally:
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+
+_current_token: ContextVar[Optional[CancellationToken]] = ContextVar('qwen_agent_cancellation_token', default=None)
+
+
+def on_cancel(callback: Callable[[], None]) -> Callable[[], None]:
+    """Called by the backends to register how to stop the generation of the `chat` call being served, if any.
+    Returns the function that removes the callback."""
+    token = _current_token.get()
+    if token is None:
+        return _noop
+    return token.on_cancel(callback)
+
+
+def is_cancelled() -> bool:
+    token = _current_token.get()
+    return token is not None and token.cancelled
+
+
+def cancel_on_exit(responses: Iterator, token: CancellationToken) -> Iterator:
+    # Cancels the call if its consumer stops iterating before the stream ends.
+    completed = False
+    try:
+        yield from responses
+        completed = True
+    finally:
+        if not completed:
+            token.cancel()
+        token.close()
+
+
+async def acancel_on_exit(responses: AsyncIterator, token: CancellationToken) -> AsyncIterator:
+    completed = False
+    try:
+        async for rsp in responses:
+            yield rsp
+        completed = True
+    finally:
+        if not completed:
+            token.cancel()
+        token.close()
+
+
+def _run_callback(callback: Callable[[], None]) -> None:
+    try:
+        callback()
+    except Exception as e:
+        logger.warning(f'Failed to cancel the generation: {e}')
+
+
+def _noop() -> None:
+    pass
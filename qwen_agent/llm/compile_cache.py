@@ -0,0 +1,157 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A persistent cache of the artifacts of torch.compile, so that a restarted process doesn't compile from scratch.
+
+The FX graphs, kernels and autotuning results of inductor and the kernels compiled by Triton are written to a
+directory keyed by the model, its dtype, the torch version, the GPU and the shape buckets of the warmup. On
+torch>=2.6, the artifacts compiled by a process are also saved to one file with `torch.compiler.save_cache_artifacts()`,
+which the next process loads before compiling. Each startup appends the times of the load, the warmup and its first
+token to a report in the directory, to compare the cold starts with the warm ones.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import List, Optional, Sequence
+
+from qwen_agent.log import logger
+
+# The prompt lengths of the warmup, from a short chat to an agent prompt with a system message, the descriptions of
+# the tools and the history of a few steps
+DEFAULT_WARMUP_LENGTHS = (128, 512, 2048)
+
+_ARTIFACTS_FILE = 'artifacts.bin'
+_REPORT_FILE = 'startup_report.jsonl'
+
+_env_lock = threading.Lock()
+
+
+def get_compile_cache_root(cache_dir: Optional[str] = None) -> Optional[str]:
+    """The root of the compile caches: `cache_dir` if given, else QWEN_AGENT_COMPILE_CACHE_DIR, else
+    ~/.cache/qwen_agent/torch_compile. An empty string disables the cache."""
+    if cache_dir is None:
+        cache_dir = os.getenv('QWEN_AGENT_COMPILE_CACHE_DIR')
+    if cache_dir is None:
+        cache_home = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'qwen_agent', 'torch_compile')
+    return cache_dir or None
+
+
+def get_warmup_lengths(lengths: Optional[Sequence[int]], max_length: int) -> List[int]:
+    """The prompt lengths of the warmup that fit in `max_length`, the longest being clipped to it."""
+    lengths = sorted(set(int(n) for n in (lengths or DEFAULT_WARMUP_LENGTHS) if int(n) > 0))
+    fitting = [n for n in lengths if n <= max_length]
+    if len(fitting) < len(lengths) and max_length not in fitting:
+        fitting.append(max_length)  # The prompts up to the max input length are covered
+    return fitting
+
+
+class CompileCache:
+    """The compile cache of one model configuration.
+
+    Args:
+        root: The root directory of the caches, see `get_compile_cache_root`.
+        key: What the compiled artifacts depend on, e.g., the model, the dtype, the torch version and the GPU.
+    """
+
+    def __init__(self, root: str, key: dict):
+        self.key = key
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:24]
+        name = os.path.basename(str(key.get('model', '')).rstrip('/')) or 'model'
+        self.path = os.path.join(root, f'{name}-{digest}')
+        self.warm = False  # Whether the artifacts of a previous process were found
+
+    def activate(self) -> None:
+        """Points inductor and Triton to the cache directory, and loads the saved artifacts, before compiling."""
+        import torch
+
+        os.makedirs(self.path, exist_ok=True)
+        self.warm = self._has_artifacts()
+        with _env_lock:
+            # Read by inductor and Triton when they compile. They are global to the process, so the first model
+            # compiled with a cache sets them, unless they are set already.
+            for name, subdir in (('TORCHINDUCTOR_CACHE_DIR', 'inductor'), ('TRITON_CACHE_DIR', 'triton')):
+                path = os.path.join(self.path, subdir)
+                if os.environ.setdefault(name, path) != path:
+                    logger.info(f'[CompileCache] Keeping {name}={os.environ[name]}.')
+        try:
+            import torch._inductor.config as inductor_config
+            inductor_config.fx_graph_cache = True
+        except (ImportError, AttributeError):
+            pass
+
+        artifacts = os.path.join(self.path, _ARTIFACTS_FILE)
+        if os.path.isfile(artifacts) and hasattr(torch.compiler, 'load_cache_artifacts'):
+            try:
+                with open(artifacts, 'rb') as f:
+                    torch.compiler.load_cache_artifacts(f.read())
+            except Exception as e:
+                logger.warning(f'[CompileCache] Failed to load the compiled artifacts of {artifacts}: {e}')
+        logger.info(f'[CompileCache] Using {self.path} ({"warm" if self.warm else "cold"}).')
+
+    def save(self) -> None:
+        """Saves the artifacts compiled by this process to one file, e.g., after the warmup (torch>=2.6)."""
+        import torch
+
+        if not hasattr(torch.compiler, 'save_cache_artifacts'):
+            return  # Only the directories of inductor and Triton are reused
+        try:
+            saved = torch.compiler.save_cache_artifacts()
+        except Exception as e:
+            logger.warning(f'[CompileCache] Failed to save the compiled artifacts: {e}')
+            return
+        if not saved:
+            return
+        artifacts, _ = saved
+        path = os.path.join(self.path, _ARTIFACTS_FILE)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(artifacts)
+        os.replace(tmp_path, path)
+
+    def record_startup(self, **timings) -> dict:
+        """Appends the timings of this startup to the report of the cache, and returns the record."""
+        record = {'time': time.time(), 'start': 'warm' if self.warm else 'cold', **timings}
+        try:
+            with open(os.path.join(self.path, _REPORT_FILE), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            logger.warning(f'[CompileCache] Failed to record the startup: {e}')
+        return record
+
+    def report(self) -> dict:
+        """The last cold and the last warm startup, and the speedup of the time to the first token."""
+        cold, warm = None, None
+        try:
+            with open(os.path.join(self.path, _REPORT_FILE), encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record['start'] == 'cold':
+                        cold = record
+                    else:
+                        warm = record
+        except (OSError, ValueError, KeyError):
+            pass
+        report = {'path': self.path, 'cold': cold, 'warm': warm}
+        if cold and warm and warm.get('time_to_first_token'):
+            report['ttft_speedup'] = cold['time_to_first_token'] / warm['time_to_first_token']
+        return report
+
+    def _has_artifacts(self) -> bool:
+        if os.path.isfile(os.path.join(self.path, _ARTIFACTS_FILE)):
+            return True
+        inductor_dir = os.path.join(self.path, 'inductor')
+        return os.path.isdir(inductor_dir) and any(os.scandir(inductor_dir))
@@ -0,0 +1,356 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A continuous batching engine for the causal LMs of transformers.
+
+The requests of all users of a model share the decode steps: a step loop runs one forward pass for the whole running
+batch per token, adds the waiting requests to the batch at token boundaries, and retires the finished ones, instead
+of one `generate()` call per request.
+"""
+
+import queue
+import threading
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, Iterable, Iterator, List, Optional
+
+from qwen_agent.llm.kv_cache import PrefixKVCache, cache_to_tensors, tensors_to_cache
+from qwen_agent.llm.model_registry import ModelHandle
+from qwen_agent.llm.stop_words import StopSequenceDetector
+from qwen_agent.log import logger
+
+_FINISHED = object()
+
+
+class Sequence:
+    """A request being served by the engine. Its new tokens are put to `tokens`, followed by `_FINISHED`."""
+
+    def __init__(self,
+                 input_ids: List[int],
+                 max_new_tokens: int,
+                 eos_token_ids: set,
+                 do_sample: bool = False,
+                 temperature: float = 1.0,
+                 top_k: Optional[int] = None,
+                 top_p: Optional[float] = None,
+                 repetition_penalty: Optional[float] = None,
+                 seed: Optional[int] = None,
+                 stop_detector: Optional[StopSequenceDetector] = None):
+        self.input_ids = list(input_ids)
+        self.output_ids: List[int] = []
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = eos_token_ids
+        self.do_sample = do_sample and (temperature or 0) > 0
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.seed = seed
+        self.stop_detector = stop_detector
+        self.generator = None
+        self.position = len(self.input_ids)  # The position of the next token to feed
+        self.next_token: Optional[int] = None
+        self.cached_tokens = 0  # The prompt tokens served from the prefix cache
+        self.finished = False
+        self.cancelled = False
+        self.tokens = queue.Queue()
+
+    def cancel(self) -> None:
+        """Called by the consumer that stops early, so that the engine retires the sequence at the next step."""
+        self.cancelled = True
+
+
+class ContinuousBatchingEngine:
+    """Serves the requests of a causal LM with continuous batching.
+
+    The KV caches of the running sequences are kept as one left-padded batch. A new sequence is prefilled on its own
+    and then joins the batch, and the rows of the finished sequences are dropped, both between two decode steps.
+
+    Args:
+        model: A causal LM of transformers, whose KV cache has the layout [batch, heads, length, head_dim], or its
+            handle of the model registry. The model is pinned while there are sequences to decode.
+        tokenizer: The tokenizer used to decode the streamed tokens.
+        max_batch_size: The max number of sequences decoded together. The others wait in the queue.
+        prefix_cache: If set, the prefill of a new sequence reuses the KV cache of the longest cached prefix.
+    """
+
+    def __init__(self, model: Any, tokenizer: Any, max_batch_size: int, prefix_cache: Optional[PrefixKVCache] = None):
+        self._model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.prefix_cache = prefix_cache
+        eos_token_id = getattr(self.model.generation_config, 'eos_token_id', None)
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]) - {None}
+
+        self._waiting = deque()
+        self._running: List[Sequence] = []
+        self._kv = None  # [[key, value] per layer], each of [batch, heads, length, head_dim]
+        self._attention_mask = None  # [batch, length], zeros for the left padding
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.num_steps = 0
+        self.max_running = 0
+
+    @property
+    def model(self) -> Any:
+        return self._model.get() if isinstance(self._model, ModelHandle) else self._model
+
+    def submit(self, input_ids: List[int], generate_cfg: dict) -> Sequence:
+        gen_config = self.model.generation_config
+        seq = Sequence(
+            input_ids=input_ids,
+            max_new_tokens=generate_cfg.get('max_new_tokens') or getattr(gen_config, 'max_new_tokens', None) or 512,
+            eos_token_ids=self.eos_token_ids,
+            do_sample=generate_cfg.get('do_sample', getattr(gen_config, 'do_sample', False)),
+            temperature=generate_cfg.get('temperature', getattr(gen_config, 'temperature', 1.0)),
+            top_k=generate_cfg.get('top_k', getattr(gen_config, 'top_k', None)),
+            top_p=generate_cfg.get('top_p', getattr(gen_config, 'top_p', None)),
+            repetition_penalty=generate_cfg.get('repetition_penalty',
+                                                getattr(gen_config, 'repetition_penalty', None)),
+            seed=generate_cfg.get('seed'),
+            stop_detector=StopSequenceDetector(generate_cfg['stop'], self.tokenizer)
+            if generate_cfg.get('stop') else None,
+        )
+        with self._cond:
+            self._waiting.append(seq)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='continuous-batching', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return seq
+
+    def stream(self, seq: Sequence) -> Iterator[str]:
+        """Yields the text of the new tokens of the sequence as they are generated."""
+        try:
+            yield from detokenize_stream(_iter_tokens(seq.tokens), self.tokenizer)
+        finally:
+            seq.cancel()
+
+    def generate(self, input_ids: List[int], generate_cfg: dict) -> str:
+        return ''.join(self.stream(self.submit(input_ids, generate_cfg)))
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not (self._waiting or self._running):
+                    self._cond.wait()
+            # The model registry doesn't unload the model while the KV caches of the running sequences use it.
+            with self._pinned():
+                self._run_until_idle()
+
+    def _pinned(self):
+        return self._model.use() if isinstance(self._model, ModelHandle) else nullcontext()
+
+    def _run_until_idle(self) -> None:
+        import torch
+
+        while True:
+            with self._cond:
+                if not (self._waiting or self._running):
+                    return
+                new = []
+                while self._waiting and (len(self._running) + len(new) < self.max_batch_size):
+                    seq = self._waiting.popleft()
+                    if seq.cancelled:
+                        seq.finished = True
+                        seq.tokens.put(_FINISHED)
+                    else:
+                        new.append(seq)
+            try:
+                with torch.inference_mode():
+                    for seq in new:
+                        self._prefill(seq)
+                    if self._running:
+                        self._decode_step()
+            except Exception as e:
+                logger.exception('The continuous batching step failed.')
+                for seq in self._running + new:
+                    if not seq.finished:
+                        seq.finished = True
+                        seq.tokens.put(e)
+                self._running, self._kv, self._attention_mask = [], None, None
+                continue
+            self._retire()
+
+    def _prefill(self, seq: Sequence) -> None:
+        import torch
+
+        device = self.model.device
+        if seq.seed is not None:
+            seq.generator = torch.Generator(device=device).manual_seed(seq.seed)
+        prefix_length, prefix_kv = 0, None
+        if self.prefix_cache is not None:
+            prefix_length, prefix_kv = self.prefix_cache.lookup(seq.input_ids)
+        seq.cached_tokens = prefix_length
+        input_ids = torch.tensor([seq.input_ids[prefix_length:]], dtype=torch.long, device=device)
+        if prefix_kv is None:
+            out = self.model(input_ids=input_ids, use_cache=True)
+        else:
+            position_ids = torch.arange(prefix_length, len(seq.input_ids), dtype=torch.long, device=device)
+            out = self.model(input_ids=input_ids,
+                             position_ids=position_ids.unsqueeze(0),
+                             past_key_values=tensors_to_cache(prefix_kv),
+                             use_cache=True)
+        kv = cache_to_tensors(out.past_key_values)
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(seq.input_ids, kv)
+        self._on_tokens([seq], self._sample(out.logits[:, -1, :], [seq]))
+        if not seq.finished:
+            self._add_row(kv, length=len(seq.input_ids))
+            self._running.append(seq)
+            self.max_running = max(self.max_running, len(self._running))
+
+    def _decode_step(self) -> None:
+        import torch
+
+        device = self.model.device
+        running = self._running
+        input_ids = torch.tensor([[s.next_token] for s in running], dtype=torch.long, device=device)
+        position_ids = torch.tensor([[s.position] for s in running], dtype=torch.long, device=device)
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones(len(running), 1)], dim=1)
+        out = self.model(input_ids=input_ids,
+                         attention_mask=attention_mask,
+                         position_ids=position_ids,
+                         past_key_values=tensors_to_cache(self._kv),
+                         use_cache=True)
+        self._kv = cache_to_tensors(out.past_key_values)
+        self._attention_mask = attention_mask
+        for s in running:
+            s.position += 1
+        self._on_tokens(running, self._sample(out.logits[:, -1, :], running))
+        self.num_steps += 1
+
+    def _on_tokens(self, seqs: List[Sequence], tokens: List[int]) -> None:
+        for seq, token in zip(seqs, tokens):
+            if seq.cancelled:
+                # Cancelled from another thread, e.g., through its cancellation token, while its consumer may be
+                # waiting for the next token
+                seq.finished = True
+            elif token in seq.eos_token_ids:
+                seq.finished = True
+            else:
+                seq.output_ids.append(token)
+                seq.next_token = token
+                seq.tokens.put(token)
+                if len(seq.output_ids) >= seq.max_new_tokens:
+                    seq.finished = True
+                elif seq.stop_detector is not None and seq.stop_detector.update(seq.output_ids):
+                    seq.finished = True  # The postprocessing truncates the stop word
+            if seq.finished:
+                seq.tokens.put(_FINISHED)
+
+    def _sample(self, logits, seqs: List[Sequence]) -> List[int]:
+        import torch
+
+        if not any(s.do_sample or (s.repetition_penalty not in (None, 1.0)) for s in seqs):
+            return logits.argmax(dim=-1).tolist()
+        tokens = []
+        for row, seq in zip(logits.float(), seqs):
+            if seq.repetition_penalty not in (None, 1.0):
+                ids = torch.tensor(seq.input_ids + seq.output_ids, dtype=torch.long, device=row.device)
+                scores = row.gather(0, ids)
+                scores = torch.where(scores < 0, scores * seq.repetition_penalty, scores / seq.repetition_penalty)
+                row = row.scatter(0, ids, scores)
+            if not seq.do_sample:
+                tokens.append(int(row.argmax()))
+                continue
+            row = row / seq.temperature
+            if seq.top_k:
+                kth = torch.topk(row, min(seq.top_k, row.numel())).values[-1]
+                row = row.masked_fill(row < kth, float('-inf'))
+            if seq.top_p is not None and seq.top_p < 1.0:
+                sorted_logits, sorted_indices = torch.sort(row, descending=True)
+                probs = sorted_logits.softmax(dim=-1)
+                # Keep the smallest prefix whose probability reaches top_p, and at least one token.
+                sorted_logits[(probs.cumsum(dim=-1) - probs) > seq.top_p] = float('-inf')
+                row = torch.full_like(row, float('-inf')).scatter(0, sorted_indices, sorted_logits)
+            tokens.append(int(torch.multinomial(row.softmax(dim=-1), 1, generator=seq.generator)))
+        return tokens
+
+    def _add_row(self, kv: List[list], length: int) -> None:
+        import torch
+
+        row_mask = torch.ones(1, length, dtype=torch.long, device=kv[0][0].device)
+        if self._kv is None:
+            self._kv, self._attention_mask = kv, row_mask
+            return
+        batch_length = self._attention_mask.shape[1]
+        if length < batch_length:
+            kv = [[_left_pad(k, batch_length - length), _left_pad(v, batch_length - length)] for k, v in kv]
+            row_mask = torch.cat([row_mask.new_zeros(1, batch_length - length), row_mask], dim=1)
+        elif length > batch_length:
+            pad = length - batch_length
+            self._kv = [[_left_pad(k, pad), _left_pad(v, pad)] for k, v in self._kv]
+            self._attention_mask = torch.cat(
+                [self._attention_mask.new_zeros(self._attention_mask.shape[0], pad), self._attention_mask], dim=1)
+        self._kv = [[torch.cat([k0, k1]), torch.cat([v0, v1])] for (k0, v0), (k1, v1) in zip(self._kv, kv)]
+        self._attention_mask = torch.cat([self._attention_mask, row_mask])
+
+    def _retire(self) -> None:
+        keep = [i for i, s in enumerate(self._running) if not (s.finished or s.cancelled)]
+        if len(keep) == len(self._running):
+            return
+        for s in self._running:
+            if s.cancelled and not s.finished:
+                s.finished = True
+                s.tokens.put(_FINISHED)
+        if not keep:
+            self._running, self._kv, self._attention_mask = [], None, None
+            return
+        import torch
+
+        index = torch.tensor(keep, dtype=torch.long, device=self._attention_mask.device)
+        mask = self._attention_mask.index_select(0, index)
+        # Drop the columns that are padding for all the remaining rows.
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self._attention_mask = mask[:, start:]
+        self._kv = [[k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:]]
+                    for k, v in self._kv]
+        self._running = [self._running[i] for i in keep]
+
+
+def _left_pad(t, n: int):
+    import torch
+    return torch.cat([t.new_zeros(t.shape[0], t.shape[1], n, t.shape[3]), t], dim=2)
+
+
+def _iter_tokens(tokens: queue.Queue) -> Iterator[int]:
+    # The tokens put by the engine, until `_FINISHED` or the error that stopped the sequence
+    while True:
+        item = tokens.get()
+        if item is _FINISHED:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def detokenize_stream(token_ids: Iterable[int], tokenizer: Any) -> Iterator[str]:
+    """Yields the text of the tokens as they arrive, holding back an incomplete character."""
+    token_cache, printed = [], 0
+    for token_id in token_ids:
+        token_cache.append(token_id)
+        text = tokenizer.decode(token_cache, skip_special_tokens=True)
+        if text.endswith('\n'):
+            # Like `TextIteratorStreamer`, restart decoding at line breaks to keep decoding cheap.
+            yield text[printed:]
+            token_cache, printed = [], 0
+        elif not text.endswith('\ufffd'):  # Wait for the rest of an incomplete character
+            yield text[printed:]
+            printed = len(text)
+    if token_cache:
+        text = tokenizer.decode(token_cache, skip_special_tokens=True)
+        if text[printed:]:
+            yield text[printed:]
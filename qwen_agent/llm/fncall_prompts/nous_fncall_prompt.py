@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import copy
+import functools
 import json
 import os
 from typing import List, Literal, Union
@@ -22,6 +23,7 @@ import json5
 from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
 from qwen_agent.log import logger
+from qwen_agent.utils.utils import derive_message
 
 
 class NousFnCallPrompt(BaseFnCallPrompt):
@@ -40,9 +42,11 @@ class NousFnCallPrompt(BaseFnCallPrompt):
 
         ori_messages = messages
 
-        # Change function_call responses to plaintext responses:
+        # Change function_call responses to plaintext responses.
+        # The input messages are shared, so only their content lists are copied before being extended below.
         messages = []
-        for msg in copy.deepcopy(ori_messages):
+        for msg in ori_messages:
+            msg = derive_message(msg)
             role, content, reasoning_content = msg.role, msg.content, msg.reasoning_content
             if role in (SYSTEM, USER):
                 messages.append(msg)
@@ -211,7 +215,7 @@ class NousFnCallPrompt(BaseFnCallPrompt):
                                 fn['arguments']['code'] = code
                     else:
                         try:
-                            fn = json5.loads(one_tool_call_txt[0].strip())
+                            fn = _parse_tool_call(one_tool_call_txt[0].strip())
                         except Exception:
                             logger.warning('Invalid json tool-calling arguments')
                             fn_name, fn_args = extract_fn(one_tool_call_txt[0].strip())
@@ -297,6 +301,16 @@ def remove_incomplete_special_tokens(text: str) -> str:
     return text
 
 
+def _parse_tool_call(text: str) -> dict:
+    # A streamed response is postprocessed once per chunk, so the complete tool calls are parsed again and again.
+    return copy.deepcopy(_parse_tool_call_cached(text))
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_tool_call_cached(text: str):
+    return json5.loads(text)
+
+
 def extract_fn(text: str):
     fn_name, fn_args = '', ''
     fn_name_s = '"name": "'
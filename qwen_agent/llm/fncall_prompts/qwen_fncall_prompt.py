@@ -12,13 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import json
 from typing import Dict, List, Literal, Union
 
 from qwen_agent.llm.fncall_prompts.base_fncall_prompt import BaseFnCallPrompt
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
-from qwen_agent.utils.utils import extract_text_from_message
+from qwen_agent.llm.stop_words import get_stop_word_matcher
+from qwen_agent.utils.utils import derive_message, extract_text_from_message
 
 
 class QwenFnCallPrompt(BaseFnCallPrompt):
@@ -33,8 +33,10 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
         ori_messages = messages
 
         # Change function_call responses to plaintext responses:
+        # The input messages are shared, so each message gets its own content list and items are replaced, not edited.
         messages = []
-        for msg in copy.deepcopy(ori_messages):
+        for msg in ori_messages:
+            msg = derive_message(msg)
             role, content = msg.role, msg.content
             if role in (SYSTEM, USER):
                 messages.append(msg)
@@ -59,13 +61,13 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 assert isinstance(content, list)
                 assert all(isinstance(item, ContentItem) for item in content)
                 if content:
-                    f_result = copy.deepcopy(content)
+                    f_result = list(content)
                 else:
                     f_result = [ContentItem(text='')]
                 f_exit = f'\n{FN_EXIT}: '
                 last_text_content = messages[-1].content[-1].text
                 if last_text_content.endswith(f_exit):
-                    messages[-1].content[-1].text = last_text_content[:-len(f_exit)]
+                    messages[-1].content[-1] = ContentItem(text=last_text_content[:-len(f_exit)])
                 f_result = [ContentItem(text=f'\n{FN_RESULT}: ')] + f_result + [ContentItem(text=f_exit)]
                 messages[-1].content += f_result
             else:
@@ -89,7 +91,7 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 item_type, item_text = last_msg[i].get_type_and_value()
                 if item_type == 'text':
                     if item_text.endswith(f'{FN_EXIT}: '):
-                        last_msg[i].text = item_text[:-2]
+                        last_msg[i] = ContentItem(text=item_text[:-2])
                     break
 
         # Add the function_choice prefix:
@@ -114,7 +116,7 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                                     parallel_function_calls: bool = True,
                                     function_choice: Union[Literal['auto'], str] = 'auto',
                                     **kwargs) -> List[Message]:
-        messages = copy.deepcopy(messages)
+        messages = list(messages)  # Changed messages are replaced by derived copies, see `derive_message`.
 
         # Prepend a prefix for function_choice:
         if function_choice not in ('auto', 'none'):
@@ -123,17 +125,18 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                 if output.lstrip().startswith(FN_ARGS):
                     # Prepend this prefix only if the model correctly completes it
                     output = f'{FN_NAME}: {function_choice}\n' + output
-                messages[0].content[0].text = output
+                    messages[0] = derive_message(messages[0])
+                    messages[0].content[0] = ContentItem(text=output)
 
         # Remove ': ' brought by continued generation of function calling
         last_msg = messages[-1].content
         for i in range(len(last_msg)):
             item_type, item_text = last_msg[i].get_type_and_value()
             if item_type == 'text':
-                if item_text.startswith(': '):
-                    last_msg[i].text = item_text[2:]
-                elif item_text.startswith(':'):
-                    last_msg[i].text = item_text[1:]
+                if item_text.startswith(':'):
+                    item_text = item_text[2:] if item_text.startswith(': ') else item_text[1:]
+                    messages[-1] = derive_message(messages[-1])
+                    messages[-1].content[i] = ContentItem(text=item_text)
                 break
 
         # Convert plaintext responses to function_call responses:
@@ -154,8 +157,8 @@ class QwenFnCallPrompt(BaseFnCallPrompt):
                     new_content.append(item)
                     continue
 
-                for stop_word in FN_STOP_WORDS:
-                    assert stop_word not in item_text, 'Something wrong, stop words are expected to be excluded.'
+                assert not get_stop_word_matcher(FN_STOP_WORDS).contains(
+                    item_text), 'Something wrong, stop words are expected to be excluded.'
 
                 i = item_text.find(f'{FN_NAME}:')
 
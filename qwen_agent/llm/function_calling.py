@@ -14,10 +14,11 @@
 
 import copy
 from abc import ABC
-from typing import Dict, Iterator, List, Literal, Optional, Union
+from typing import AsyncIterator, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
-from qwen_agent.llm.base import BaseChatModel
+from qwen_agent.llm.base import BaseChatModel, _ChatRequest
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, USER, ContentItem, Message
+from qwen_agent.utils.utils import derive_message
 
 
 class BaseFnCallModel(BaseChatModel, ABC):
@@ -65,13 +66,12 @@ class BaseFnCallModel(BaseChatModel, ABC):
             )
         return messages
 
-    def _postprocess_messages(
+    def _postprocess_fncall_output(
         self,
         messages: List[Message],
         fncall_mode: bool,
         generate_cfg: dict,
     ) -> List[Message]:
-        messages = super()._postprocess_messages(messages, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
         if fncall_mode:
             messages = self.fncall_prompt.postprocess_fncall_messages(
                 messages=messages,
@@ -109,7 +109,8 @@ class BaseFnCallModel(BaseChatModel, ABC):
                         tool_text = f'\n\n该工具返回了以下结果：\n{tool_result}'
                     else:
                         tool_text = f'\n\nThe tool has returned the following result: \n{tool_result}'
-                new_messages[-1].content.append(ContentItem(text=tool_text))
+                new_messages[-1] = derive_message(new_messages[-1],
+                                                  content=new_messages[-1].content + [ContentItem(text=tool_text)])
             else:
                 if (msg.role == USER) and new_messages and (new_messages[-1].role == USER):
                     # Separate two user messages with an assistant message to make the bot focus on the latter:
@@ -126,13 +127,7 @@ class BaseFnCallModel(BaseChatModel, ABC):
         generate_cfg: dict,
         lang: Literal['en', 'zh'],
     ) -> Union[List[Message], Iterator[List[Message]]]:
-        if delta_stream:
-            raise NotImplementedError('Please use stream=True with delta_stream=False, because delta_stream=True'
-                                      ' is not implemented for function calling due to some technical reasons.')
-        generate_cfg = copy.deepcopy(generate_cfg)
-        for k in ['parallel_function_calls', 'function_choice', 'thought_in_content']:
-            if k in generate_cfg:
-                del generate_cfg[k]
+        generate_cfg = _get_fncall_generate_cfg(generate_cfg, delta_stream=delta_stream)
         return self._continue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
 
     def _continue_assistant_response(
@@ -144,6 +139,53 @@ class BaseFnCallModel(BaseChatModel, ABC):
         messages = simulate_response_completion_with_chat(messages)
         return self._chat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
 
+    async def _achat_with_functions(
+        self,
+        messages: List[Message],
+        functions: List[Dict],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        generate_cfg = _get_fncall_generate_cfg(generate_cfg, delta_stream=delta_stream)
+        return await self._acontinue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
+
+    async def _acontinue_assistant_response(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+        stream: bool,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        if type(self)._continue_assistant_response is not BaseFnCallModel._continue_assistant_response:
+            # The subclass continues responses in its own way (e.g., the partial mode of DashScope), so reuse it.
+            return await super()._acontinue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
+        messages = simulate_response_completion_with_chat(messages)
+        return await self._achat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
+
+    def _get_model_input(self, req: _ChatRequest) -> Tuple[List[Message], dict]:
+        # The messages and generate_cfg that `_call_model_service(req)` eventually passes to `_chat_no_stream`.
+        # Used by backends that implement `_chat_batch` at the level of `_chat_no_stream`.
+        generate_cfg = req.generate_cfg
+        messages = req.messages
+        if req.fncall_mode:
+            generate_cfg = _get_fncall_generate_cfg(generate_cfg, delta_stream=req.delta_stream)
+            messages = simulate_response_completion_with_chat(messages)
+        elif messages[-1].role == ASSISTANT:
+            messages = simulate_response_completion_with_chat(messages)
+        return messages, generate_cfg
+
+
+def _get_fncall_generate_cfg(generate_cfg: dict, delta_stream: bool) -> dict:
+    if delta_stream:
+        raise NotImplementedError('Please use stream=True with delta_stream=False, because delta_stream=True'
+                                  ' is not implemented for function calling due to some technical reasons.')
+    generate_cfg = copy.deepcopy(generate_cfg)
+    for k in ['parallel_function_calls', 'function_choice', 'thought_in_content']:
+        if k in generate_cfg:
+            del generate_cfg[k]
+    return generate_cfg
+
 
 def simulate_response_completion_with_chat(messages: List[Message]) -> List[Message]:
     if messages and (messages[-1].role == ASSISTANT):
@@ -158,8 +200,7 @@ def simulate_response_completion_with_chat(messages: List[Message]) -> List[Mess
             usr = usr + [ContentItem(text=sep)] + bot
         else:
             raise NotImplementedError
-        text_to_complete = copy.deepcopy(messages[-2])
-        text_to_complete.content = usr
+        text_to_complete = derive_message(messages[-2], content=usr)
         messages = messages[:-2] + [text_to_complete]
     return messages
 
@@ -0,0 +1,317 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextvars
+import math
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator, List, Optional
+
+from qwen_agent.utils.async_utils import iterate_sync
+
+_EXHAUSTED = object()
+
+
+class HedgePolicy:
+    """Hedged requests: if the first response of a request has not arrived within a percentile of the observed times
+    to first response (TTFT), the request is sent again. The attempt that responds first is used and the others are
+    cancelled.
+
+    Enable it for an LLM with cfg `'hedge': True` or with the arguments below, e.g., `'hedge': {'percentile': 90}`.
+    With `oai_pool`, the duplicate goes to another replica, since the replica of the first attempt is busy with it.
+
+    Args:
+        percentile: Hedge after this percentile of the observed TTFT.
+        min_samples: No hedging until this many TTFT samples are observed, unless `initial_delay` is set.
+        window: The number of most recent TTFT samples to keep.
+        min_delay: The lower bound of the delay before hedging, in seconds.
+        initial_delay: The delay before hedging while there are fewer than `min_samples` samples.
+        max_hedges: The max number of duplicates per request.
+    """
+
+    def __init__(self,
+                 percentile: float = 95.0,
+                 min_samples: int = 20,
+                 window: int = 1000,
+                 min_delay: float = 0.05,
+                 initial_delay: Optional[float] = None,
+                 max_hedges: int = 1):
+        if not 0 < percentile <= 100:
+            raise ValueError(f'percentile must be in (0, 100], but got {percentile}.')
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.max_hedges = max_hedges
+        self._ttft = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._num_requests = 0
+        self._num_hedged = 0  # Requests with at least one duplicate
+        self._num_hedges = 0  # Duplicates sent
+        self._num_hedge_wins = 0  # Requests won by a duplicate
+
+    def delay(self) -> Optional[float]:
+        """The time to wait for the first response before hedging, or None if no hedging for now."""
+        with self._lock:
+            if len(self._ttft) < self.min_samples:
+                delay = self.initial_delay
+            else:
+                samples = sorted(self._ttft)
+                delay = samples[max(0, math.ceil(len(samples) * self.percentile / 100) - 1)]
+        if delay is None:
+            return None
+        return max(delay, self.min_delay)
+
+    def observe(self, ttft: float) -> None:
+        with self._lock:
+            self._ttft.append(ttft)
+
+    def stats(self) -> dict:
+        with self._lock:
+            num_requests, num_hedged = self._num_requests, self._num_hedged
+            return {
+                'requests': num_requests,
+                'hedged_requests': num_hedged,
+                'hedges': self._num_hedges,
+                'hedge_wins': self._num_hedge_wins,
+                'hedge_rate': (num_hedged / num_requests) if num_requests else 0.0,
+                'hedge_win_rate': (self._num_hedge_wins / num_hedged) if num_hedged else 0.0,
+                'ttft_samples': len(self._ttft),
+            }
+
+    def _count(self, requests: int = 0, hedged: int = 0, hedges: int = 0, hedge_wins: int = 0) -> None:
+        with self._lock:
+            self._num_requests += requests
+            self._num_hedged += hedged
+            self._num_hedges += hedges
+            self._num_hedge_wins += hedge_wins
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        """Hedges a blocking function. Its return value counts as the first response."""
+        it = self.iterate(lambda: [fn()])
+        try:
+            return next(it)
+        finally:
+            it.close()
+
+    def iterate(self, it_fn: Callable[[], Iterable]) -> Iterator:
+        """Hedges a blocking iterator, until its first item arrives. The attempts run in threads."""
+        results = queue.Queue()
+        attempts: List[_Attempt] = []
+
+        def _start():
+            attempt = _Attempt(index=len(attempts))
+            attempts.append(attempt)
+            # The attempts see the context variables of the caller, e.g., to report their usage to its metrics.
+            threading.Thread(target=contextvars.copy_context().run,
+                             args=(_run_attempt, attempt, it_fn, results),
+                             daemon=True).start()
+
+        self._count(requests=1)
+        delay = self.delay()
+        if delay is None:
+            # Nothing to race, so only measure the TTFT without a thread.
+            yield from self._measure(it_fn)
+            return
+        deadline = time.monotonic() + delay
+        _start()
+        pending, winner = 1, None
+        try:
+            while winner is None:
+                if len(attempts) > self.max_hedges:
+                    timeout = None
+                else:
+                    timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    attempt = results.get(timeout=timeout)
+                except queue.Empty:
+                    self._count(hedged=int(len(attempts) == 1), hedges=1)
+                    _start()
+                    pending += 1
+                    deadline = time.monotonic() + delay
+                    continue
+                pending -= 1
+                if attempt.error is not None:
+                    if pending == 0:
+                        raise attempt.error
+                    continue  # Wait for the other attempts
+                winner = attempt
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+
+        self.observe(winner.ttft)
+        if winner.index > 0:
+            self._count(hedge_wins=1)
+        it = winner.iterator
+        try:
+            if winner.first is not _EXHAUSTED:
+                yield winner.first
+                yield from it
+        finally:
+            _close(it)
+
+    def _measure(self, it_fn: Callable[[], Iterable]) -> Iterator:
+        t0 = time.perf_counter()
+        it = iter(it_fn())
+        try:
+            first = next(it, _EXHAUSTED)
+            self.observe(time.perf_counter() - t0)
+            if first is not _EXHAUSTED:
+                yield first
+                yield from it
+        finally:
+            _close(it)
+
+    async def acall(self, fn: Callable) -> Any:
+        """Hedges a coroutine function. Its return value counts as the first response."""
+
+        async def _it_fn():
+            return iterate_sync([await fn()])
+
+        it = self.aiterate(_it_fn)
+        try:
+            return await it.__anext__()
+        finally:
+            await it.aclose()
+
+    async def aiterate(self, it_fn: Callable) -> AsyncIterator:
+        """Hedges an async iterator returned by the coroutine function `it_fn`, until its first item arrives."""
+        tasks = {}
+
+        def _start():
+            attempt = _Attempt(index=len(tasks))
+            tasks[asyncio.ensure_future(_arun_attempt(attempt, it_fn))] = attempt
+
+        self._count(requests=1)
+        delay = self.delay()
+        deadline = None if delay is None else time.monotonic() + delay
+        _start()
+        pending, winner, error = set(tasks), None, None
+        try:
+            while winner is None:
+                if (deadline is None) or (len(tasks) > self.max_hedges):
+                    timeout = None
+                else:
+                    timeout = max(0.0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._count(hedged=int(len(tasks) == 1), hedges=1)
+                    _start()
+                    pending = {t for t in tasks if not t.done()}
+                    deadline = time.monotonic() + delay
+                    continue
+                for task in sorted(done, key=lambda t: tasks[t].index):
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif winner is None:
+                        winner = tasks[task]
+                if (winner is None) and (not pending):
+                    raise error
+        finally:
+            for task, attempt in tasks.items():
+                if attempt is not winner:
+                    task.cancel()
+                    if task.done() and (not task.cancelled()) and (task.exception() is None):
+                        await _aclose(attempt.iterator)
+
+        self.observe(winner.ttft)
+        if winner.index > 0:
+            self._count(hedge_wins=1)
+        it = winner.iterator
+        try:
+            if winner.first is not _EXHAUSTED:
+                yield winner.first
+                async for item in it:
+                    yield item
+        finally:
+            await _aclose(it)
+
+
+class _Attempt:
+
+    def __init__(self, index: int):
+        self.index = index
+        self.iterator = None
+        self.first = _EXHAUSTED
+        self.ttft = 0.0
+        self.error: Optional[BaseException] = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            iterator = self.iterator
+        # Otherwise the attempt thread closes the iterator once its first item arrives.
+        _close(iterator)
+
+
+def _run_attempt(attempt: _Attempt, it_fn: Callable[[], Iterable], results: queue.Queue) -> None:
+    t0 = time.perf_counter()
+    try:
+        iterator = iter(it_fn())
+        first = next(iterator, _EXHAUSTED)
+    except Exception as e:
+        attempt.error = e
+        results.put(attempt)
+        return
+    with attempt.lock:
+        attempt.first = first
+        attempt.ttft = time.perf_counter() - t0
+        if not attempt.cancelled:
+            attempt.iterator = iterator
+            results.put(attempt)
+            return
+    _close(iterator)
+
+
+async def _arun_attempt(attempt: _Attempt, it_fn: Callable) -> None:
+    t0 = time.perf_counter()
+    iterator = await it_fn()
+    try:
+        attempt.first = await iterator.__anext__()
+    except StopAsyncIteration:
+        pass
+    except BaseException:
+        await _aclose(iterator)
+        raise
+    attempt.ttft = time.perf_counter() - t0
+    attempt.iterator = iterator
+
+
+def _close(iterator: Any) -> None:
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+async def _aclose(iterator: Any) -> None:
+    aclose = getattr(iterator, 'aclose', None)
+    if aclose is not None:
+        await aclose()
+
+
+def get_hedge_policy(cfg: Any) -> Optional[HedgePolicy]:
+    if not cfg:
+        return None
+    if isinstance(cfg, HedgePolicy):
+        return cfg
+    if cfg is True:
+        return HedgePolicy()
+    return HedgePolicy(**cfg)
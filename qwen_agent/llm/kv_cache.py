@@ -0,0 +1,150 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The KV caches of the local models of transformers, and the reuse of the KV cache of a common prompt prefix."""
+
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+# The KV cache as plain tensors: [[key, value] per layer], each of [batch, heads, length, head_dim].
+KVTensors = List[list]
+
+
+def cache_to_tensors(cache: Any) -> KVTensors:
+    if isinstance(cache, (tuple, list)):
+        return [[k, v] for k, v in cache]
+    if hasattr(cache, 'layers'):  # transformers>=4.54
+        return [[layer.keys, layer.values] for layer in cache.layers]
+    if hasattr(cache, 'key_cache'):
+        return [[k, v] for k, v in zip(cache.key_cache, cache.value_cache)]
+    raise TypeError(f'Unsupported KV cache {type(cache).__name__}.')
+
+
+def tensors_to_cache(kv: KVTensors) -> Any:
+    from transformers import DynamicCache
+
+    cache = DynamicCache()
+    for layer_idx, (k, v) in enumerate(kv):
+        cache.update(k, v, layer_idx)
+    return cache
+
+
+class _Entry:
+
+    def __init__(self, token_ids: List[int], kv: KVTensors):
+        self.token_ids = token_ids
+        self.kv = kv
+        self.num_bytes = sum(t.numel() * t.element_size() for layer in kv for t in layer)
+
+
+class PrefixKVCache:
+    """Reuses the KV cache of the longest cached prefix of a prompt, so that only the new suffix is prefilled.
+
+    The prompts of an agent (the system message, the function descriptions and the growing history) share long
+    prefixes across turns. Token ids are split into blocks of `block_size`, and every block boundary of a stored
+    sequence is indexed by the chained hash of its blocks, like a radix tree over blocks. A lookup returns the KV
+    cache of the longest indexed prefix, sliced from the entry that contains it. The entries are evicted in LRU order
+    to stay within `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 32):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._entries: 'OrderedDict[int, _Entry]' = OrderedDict()  # By the hash of the whole entry
+        self._index = {}  # The hash of a prefix -> the hashes of the entries that contain it, the newest last
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._hits = 0
+        self._prompt_tokens = 0
+        self._hit_tokens = 0
+
+    def _block_hashes(self, token_ids: List[int], max_length: int) -> List[int]:
+        hashes, h = [], 0
+        for end in range(self.block_size, max_length + 1, self.block_size):
+            h = hash((h, tuple(token_ids[end - self.block_size:end])))
+            hashes.append(h)
+        return hashes
+
+    def lookup(self, token_ids: List[int]) -> Tuple[int, Optional[KVTensors]]:
+        """Returns the number of cached prefix tokens and their KV cache, leaving at least one token to prefill."""
+        hashes = self._block_hashes(token_ids, len(token_ids) - 1)
+        with self._lock:
+            self._lookups += 1
+            self._prompt_tokens += len(token_ids)
+            for i in range(len(hashes) - 1, -1, -1):
+                entry_hashes = self._index.get(hashes[i])
+                if not entry_hashes:
+                    continue
+                entry_hash = next(reversed(entry_hashes))
+                entry = self._entries[entry_hash]
+                length = (i + 1) * self.block_size
+                if entry.token_ids[:length] != token_ids[:length]:
+                    continue  # A hash collision
+                self._entries.move_to_end(entry_hash)
+                self._hits += 1
+                self._hit_tokens += length
+                return length, [[k[:, :, :length], v[:, :, :length]] for k, v in entry.kv]
+        return 0, None
+
+    def store(self, token_ids: List[int], kv: KVTensors) -> None:
+        """Stores the KV cache of the longest block-aligned prefix of `token_ids` that `kv` covers."""
+        length = min(len(token_ids), kv[0][0].shape[2])
+        hashes = self._block_hashes(token_ids, length)
+        if not hashes:
+            return
+        length = len(hashes) * self.block_size
+        with self._lock:
+            if hashes[-1] in self._index:
+                return  # Already cached, as the prefix of this or a longer entry
+        entry = _Entry(list(token_ids[:length]), [[k[:, :, :length].clone(), v[:, :, :length].clone()] for k, v in kv])
+        if entry.num_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if hashes[-1] in self._index:
+                return  # Stored by another thread meanwhile
+            self._entries[hashes[-1]] = entry
+            self._num_bytes += entry.num_bytes
+            for h in hashes:
+                self._index.setdefault(h, {})[hashes[-1]] = None
+            while self._num_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        entry_hash, entry = self._entries.popitem(last=False)
+        self._num_bytes -= entry.num_bytes
+        for h in self._block_hashes(entry.token_ids, len(entry.token_ids)):
+            entry_hashes = self._index[h]
+            entry_hashes.pop(entry_hash, None)
+            if not entry_hashes:
+                del self._index[h]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._num_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._num_bytes,
+                'lookups': self._lookups,
+                'hits': self._hits,
+                'hit_rate': (self._hits / self._lookups) if self._lookups else 0.0,
+                'prompt_tokens': self._prompt_tokens,
+                'hit_tokens': self._hit_tokens,
+                'token_hit_rate': (self._hit_tokens / self._prompt_tokens) if self._prompt_tokens else 0.0,
+            }
@@ -0,0 +1,223 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import os
+import threading
+import weakref
+from typing import Dict, Iterator, List, Optional
+
+from qwen_agent.llm.base import register_llm
+from qwen_agent.llm.cancellation import on_cancel
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.metrics import report_usage
+from qwen_agent.llm.model_registry import get_model_registry
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.log import logger
+
+DEFAULT_N_CTX = 8192
+DEFAULT_PROMPT_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Used when the GGUF file has no chat template, which is the template of the Qwen models
+_CHATML_TEMPLATE = ("{% for message in messages %}"
+                    "{{ '<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n' }}"
+                    "{% endfor %}"
+                    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}")
+
+
+@register_llm('llamacpp')
+class LlamaCpp(BaseFnCallModel):
+    """
+    llama.cpp backend, which runs a quantized GGUF model on the CPU, or partly on the GPU with `n_gpu_layers`.
+
+    To use, you should have the 'llama-cpp-python' python package installed.
+
+    The KV cache of the last prompt is kept in the llama.cpp context, so the next turn of the same conversation only
+    evaluates the new messages. The states of the other conversations are kept in a prompt cache of up to
+    `prompt_cache_bytes` (QWEN_AGENT_LLAMACPP_PROMPT_CACHE_BYTES, 1 GiB by default, 0 to disable it), and restored
+    when their next turn starts with a cached prefix.
+
+    Example:
+        llm_cfg = {
+            'gguf_model_path': 'Qwen2.5-7B-Instruct-Q4_K_M.gguf',
+            'model_type': 'llamacpp',
+            # (Optional) 'n_ctx': 8192, 'n_threads': 8, 'n_gpu_layers': 0, 'prompt_cache_bytes': 1073741824,
+        }
+        bot = Assistant(llm=llm_cfg, ...)
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        model_path = cfg.get('gguf_model_path') or cfg.get('model')
+        if not model_path or not model_path.endswith('.gguf'):
+            raise ValueError('Please provide the path of the gguf model file through `gguf_model_path` in cfg.')
+
+        try:
+            import llama_cpp
+        except ImportError as e:
+            raise ImportError('Could not import llama_cpp python package. '
+                              'Please install it with: '
+                              "pip install -U 'llama-cpp-python'") from e
+
+        from qwen_agent.utils.hw_config import get_hw_profile
+        hw = get_hw_profile()
+        n_ctx = int(cfg.get('n_ctx', DEFAULT_N_CTX))
+        # The decode steps don't gain from the SMT siblings, unlike the prompt evaluation, which is compute bound
+        n_threads = int(cfg.get('n_threads', os.getenv('QWEN_AGENT_LLAMACPP_NUM_THREADS', 0))) or hw.cpu_cores
+        n_threads_batch = int(cfg.get('n_threads_batch', 0)) or max(hw.cpu_threads, n_threads)
+        n_gpu_layers = int(cfg.get('n_gpu_layers', 0))
+        prompt_cache_bytes = int(
+            cfg.get('prompt_cache_bytes',
+                    os.getenv('QWEN_AGENT_LLAMACPP_PROMPT_CACHE_BYTES', DEFAULT_PROMPT_CACHE_BYTES)))
+
+        def _load_model():
+            logger.info(f'[LlamaCpp] Loading {model_path} with {n_threads} threads, '
+                        f'n_ctx={n_ctx} and n_gpu_layers={n_gpu_layers}...')
+            llama = llama_cpp.Llama(
+                model_path=model_path,
+                n_ctx=n_ctx,
+                n_threads=n_threads,
+                n_threads_batch=n_threads_batch,
+                n_gpu_layers=n_gpu_layers,
+                use_mmap=True,
+                verbose=False,
+            )
+            if prompt_cache_bytes > 0:
+                llama.set_cache(llama_cpp.LlamaRAMCache(capacity_bytes=prompt_cache_bytes))
+            return _LlamaSession(llama)
+
+        # The instances of the same model share its context, see `qwen_agent.llm.model_registry`
+        self._model_handle = get_model_registry().acquire(
+            key=('llamacpp', os.path.abspath(model_path), n_ctx, n_threads, n_gpu_layers, prompt_cache_bytes),
+            loader=_load_model,
+            device='cuda' if n_gpu_layers else 'cpu',
+            size_hint=os.path.getsize(model_path) + prompt_cache_bytes,
+        )
+        self._formatter = _get_chat_formatter(self.llama)
+
+    @property
+    def llama(self):
+        return self._model_handle.get().llama
+
+    def _get_prompt_ids(self, messages: List[Message]):
+        messages_plain = [message.model_dump(include={'role', 'content'}) for message in messages]
+        formatted = self._formatter(messages=messages_plain)
+        prompt_ids = self.llama.tokenize(formatted.prompt.encode('utf-8'),
+                                         add_bos=not formatted.added_special,
+                                         special=True)
+        return prompt_ids, formatted.stop
+
+    def _chat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        generate_cfg = copy.deepcopy(generate_cfg)
+        prompt_ids, template_stop = self._get_prompt_ids(messages)
+        report_usage(prompt_tokens=len(prompt_ids))
+        stop = list(generate_cfg.pop('stop', None) or [])
+        if template_stop:
+            stop += [template_stop] if isinstance(template_stop, str) else list(template_stop)
+        cancelled = threading.Event()
+        remove_callback = on_cancel(cancelled.set)
+        partial_text = ''
+        try:
+            with self._model_handle.use() as session, session.lock:
+                n_ctx = session.llama.n_ctx()
+                if len(prompt_ids) >= n_ctx:
+                    raise ValueError(f'The prompt has {len(prompt_ids)} tokens, which exceeds n_ctx={n_ctx}. '
+                                     'Please increase `n_ctx` in cfg or decrease `max_input_tokens`.')
+                max_tokens = min(generate_cfg.get('max_new_tokens', 2048), n_ctx - len(prompt_ids))
+                chunks = session.llama.create_completion(
+                    prompt=prompt_ids,
+                    max_tokens=max_tokens,
+                    stop=stop,
+                    stream=True,
+                    **_sampling_kwargs(generate_cfg),
+                )
+                try:
+                    for chunk in chunks:
+                        if cancelled.is_set():
+                            break
+                        new_text = chunk['choices'][0]['text']
+                        if new_text:
+                            partial_text += new_text
+                            if delta_stream:
+                                yield [Message(ASSISTANT, new_text)]
+                            else:
+                                yield [Message(ASSISTANT, partial_text)]
+                finally:
+                    # Stops decoding at the next step if the consumer stops iterating, before the lock is released.
+                    chunks.close()
+        finally:
+            remove_callback()
+            if partial_text:
+                completion_ids = self.llama.tokenize(partial_text.encode('utf-8'), add_bos=False, special=True)
+                report_usage(completion_tokens=len(completion_ids))
+
+    def _chat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        response = [Message(ASSISTANT, '')]
+        for response in self._chat_stream(messages, delta_stream=False, generate_cfg=generate_cfg):
+            pass
+        return response
+
+
+class _LlamaSession:
+    """The llama.cpp model and the lock of its context, which evaluates one sequence at a time."""
+
+    def __init__(self, llama):
+        self.llama = llama
+        self.lock = threading.Lock()
+        # Frees the model when the session is evicted, or at exit before the bindings of llama_cpp are torn down.
+        weakref.finalize(self, llama.close)
+
+
+def _sampling_kwargs(generate_cfg: dict) -> dict:
+    # Maps the generate_cfg of the other local backends to the arguments of `Llama.create_completion`
+    kwargs = {}
+    for key, arg in (('temperature', 'temperature'), ('top_p', 'top_p'), ('top_k', 'top_k'),
+                     ('repetition_penalty', 'repeat_penalty'), ('seed', 'seed')):
+        if generate_cfg.get(key) is not None:
+            kwargs[arg] = generate_cfg[key]
+    if generate_cfg.get('do_sample') is False:
+        kwargs['temperature'] = 0.0  # Greedy
+    return kwargs
+
+
+def _get_chat_formatter(llama):
+    # Renders the chat template of the GGUF metadata, as `Llama.create_chat_completion` does, but returns the prompt,
+    # so that its tokens are counted and cached.
+    from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+
+    template = llama.metadata.get('tokenizer.chat_template')
+    if not template:
+        logger.warning('[LlamaCpp] The gguf model has no chat template, so the ChatML template is used.')
+        template = _CHATML_TEMPLATE
+
+    def _token_text(token_id: int) -> str:
+        if token_id < 0:
+            return ''
+        return llama.detokenize([token_id], special=True).decode('utf-8', errors='ignore')
+
+    return Jinja2ChatFormatter(
+        template=template,
+        eos_token=_token_text(llama.token_eos()),
+        bos_token=_token_text(llama.token_bos()),
+        stop_token_ids=[llama.token_eos()],
+    )
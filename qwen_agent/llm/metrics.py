@@ -0,0 +1,312 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The usage and latency metrics of LLM calls.
+
+Every `BaseChatModel.chat` (or `achat`, `chat_batch`) call produces a `ChatMetrics` record. It is attached to the
+last message of the response as `extra['metrics']` (for a stream, to the last response once the stream ends), and
+emitted to the metrics sinks registered with `add_metrics_sink` or configured with the LLM cfg `metrics_sinks`.
+"""
+
+import json
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional
+
+from qwen_agent.llm.schema import Message
+from qwen_agent.log import logger
+from qwen_agent.utils.tokenization_qwen import tokenizer
+from qwen_agent.utils.utils import extract_text_from_message
+
+
+@dataclass
+class ChatMetrics:
+    model: str
+    model_type: str
+    stream: bool
+    # The tokens processed by the model service, reported by the provider if it does, otherwise counted with the
+    # local tokenizer (see `usage_source`). Zero for cache hits.
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: Optional[int] = None  # The prompt tokens served from the prefix cache of the provider
+    usage_source: str = 'tokenizer'  # 'provider', 'tokenizer' or 'cache'
+    ttft: Optional[float] = None  # Seconds to the first streamed response, None if not streaming
+    latency: float = 0.0  # Seconds from the call to the complete response
+    tokens_per_second: Optional[float] = None  # Completion tokens per second of decoding
+    retries: int = 0  # Attempts that failed with a ModelServiceError and were retried
+    cache_hit: bool = False
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class MetricsSink:
+    """Receives the metrics of every LLM call. Subclass it to export them, e.g., to Prometheus."""
+
+    def emit(self, metrics: ChatMetrics) -> None:
+        raise NotImplementedError
+
+
+class LoggingMetricsSink(MetricsSink):
+
+    def emit(self, metrics: ChatMetrics) -> None:
+        logger.info(f'LLM metrics: {json.dumps(metrics.to_dict(), ensure_ascii=False)}')
+
+
+class InMemoryMetricsSink(MetricsSink):
+    """Keeps the most recent records, and summarizes them for capacity planning."""
+
+    def __init__(self, max_records: int = 10000):
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def emit(self, metrics: ChatMetrics) -> None:
+        with self._lock:
+            self._records.append(metrics)
+
+    def records(self) -> List[ChatMetrics]:
+        with self._lock:
+            return list(self._records)
+
+    def summary(self) -> dict:
+        records = self.records()
+        calls = [r for r in records if not r.cache_hit]
+        ttft = sorted(r.ttft for r in calls if r.ttft is not None)
+        latency = sorted(r.latency for r in calls)
+        tps = [r.tokens_per_second for r in calls if r.tokens_per_second]
+        return {
+            'calls': len(records),
+            'cache_hits': len(records) - len(calls),
+            'retries': sum(r.retries for r in calls),
+            'prompt_tokens': sum(r.prompt_tokens for r in calls),
+            'completion_tokens': sum(r.completion_tokens for r in calls),
+            'cached_tokens': sum(r.cached_tokens or 0 for r in calls),
+            'ttft_p50': _percentile(ttft, 50),
+            'ttft_p95': _percentile(ttft, 95),
+            'latency_p50': _percentile(latency, 50),
+            'latency_p95': _percentile(latency, 95),
+            'tokens_per_second_mean': (sum(tps) / len(tps)) if tps else None,
+        }
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(len(sorted_values) * percentile / 100) - 1)]
+
+
+_GLOBAL_SINKS: List[MetricsSink] = []
+
+
+def add_metrics_sink(sink: MetricsSink) -> None:
+    """Register a sink that receives the metrics of the calls of all LLMs."""
+    _GLOBAL_SINKS.append(sink)
+
+
+def remove_metrics_sink(sink: MetricsSink) -> None:
+    _GLOBAL_SINKS.remove(sink)
+
+
+def emit_metrics(metrics: ChatMetrics, sinks: List[MetricsSink]) -> None:
+    for sink in _GLOBAL_SINKS + sinks:
+        try:
+            sink.emit(metrics)
+        except Exception as e:
+            logger.warning(f'Failed to emit LLM metrics to {type(sink).__name__}: {e}')
+
+
+_current_recorder: ContextVar[Optional['MetricsRecorder']] = ContextVar('qwen_agent_metrics_recorder', default=None)
+
+
+def report_usage(prompt_tokens: Optional[int] = None,
+                 completion_tokens: Optional[int] = None,
+                 cached_tokens: Optional[int] = None) -> None:
+    """Called by the backends with the token usage reported by the model service, or counted exactly by a local
+    model. It is recorded for the `chat` call being served, if any."""
+    recorder = _current_recorder.get()
+    if recorder is not None:
+        recorder.record_usage(prompt_tokens=prompt_tokens,
+                              completion_tokens=completion_tokens,
+                              cached_tokens=cached_tokens)
+
+
+class MetricsRecorder:
+    """Measures one `chat` call. The model service is called through `call` or `acall`, so that the usage that the
+    backend reports while producing the output is recorded here, even across retries, hedges and threads."""
+
+    def __init__(self, model: str, model_type: str, stream: bool, delta_stream: bool):
+        self.t0 = time.perf_counter()
+        self.stream = stream
+        self.delta_stream = delta_stream
+        self.metrics = ChatMetrics(model=model, model_type=model_type, stream=stream)
+        self._first_time: Optional[float] = None
+        self._output: List[Message] = []  # The raw output, i.e., all deltas of a delta stream
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def record_usage(self, **usage) -> None:
+        with self._lock:
+            self._usage.update({k: v for k, v in usage.items() if v is not None})
+
+    @contextmanager
+    def _active(self):
+        token = _current_recorder.set(self)
+        try:
+            yield
+        finally:
+            _current_recorder.reset(token)
+
+    def _on_failure(self) -> None:
+        with self._lock:
+            self.metrics.retries += 1
+
+    def _on_output(self, output: List[Message]) -> None:
+        with self._lock:
+            if self._first_time is None:
+                self._first_time = time.perf_counter()
+            if self.delta_stream:
+                self._output.extend(output)
+            else:
+                self._output = output
+
+    def record_output(self, output: List[Message]) -> None:
+        """Records the output of a call not made through `call`, e.g., one row of a batched `generate()` call,
+        unless an output was recorded already."""
+        if not self._output:
+            self._on_output(output)
+
+    def call(self, fn: Callable, *args) -> Any:
+        from qwen_agent.llm.base import ModelServiceError
+
+        try:
+            with self._active():
+                output = fn(*args)
+        except ModelServiceError:
+            self._on_failure()
+            raise
+        if isinstance(output, list):
+            self._on_output(output)
+            return output
+        return self._iterate(output)
+
+    def _iterate(self, iterator: Iterator[List[Message]]) -> Iterator[List[Message]]:
+        from qwen_agent.llm.base import ModelServiceError
+
+        it = iter(iterator)
+        try:
+            while True:
+                try:
+                    with self._active():
+                        output = next(it)
+                except StopIteration:
+                    return
+                except ModelServiceError:
+                    self._on_failure()
+                    raise
+                self._on_output(output)
+                yield output
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+
+    async def acall(self, fn: Callable, *args) -> Any:
+        from qwen_agent.llm.base import ModelServiceError
+
+        try:
+            with self._active():
+                output = await fn(*args)
+        except ModelServiceError:
+            self._on_failure()
+            raise
+        if isinstance(output, list):
+            self._on_output(output)
+            return output
+        return self._aiterate(output)
+
+    async def _aiterate(self, iterator: AsyncIterator[List[Message]]) -> AsyncIterator[List[Message]]:
+        from qwen_agent.llm.base import ModelServiceError
+
+        try:
+            while True:
+                try:
+                    with self._active():
+                        output = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                except ModelServiceError:
+                    self._on_failure()
+                    raise
+                self._on_output(output)
+                yield output
+        finally:
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+    def finish(self, prompt: List[Message]) -> ChatMetrics:
+        """Completes the record once the whole response is received. `prompt` is the input sent to the model."""
+        from qwen_agent.llm.token_counter import message_token_counter
+
+        metrics = self.metrics
+        metrics.latency = time.perf_counter() - self.t0
+        if self.stream and (self._first_time is not None):
+            metrics.ttft = self._first_time - self.t0
+        with self._lock:
+            usage = dict(self._usage)
+            output = list(self._output)
+        if 'prompt_tokens' in usage and 'completion_tokens' in usage:
+            metrics.usage_source = 'provider'
+            metrics.prompt_tokens = usage['prompt_tokens']
+            metrics.completion_tokens = usage['completion_tokens']
+        else:
+            metrics.usage_source = 'tokenizer'
+            metrics.prompt_tokens = usage.get('prompt_tokens', sum(message_token_counter.count(m) for m in prompt))
+            metrics.completion_tokens = usage.get('completion_tokens', sum(_count_output_tokens(m) for m in output))
+        metrics.cached_tokens = usage.get('cached_tokens')
+        decode_time = metrics.latency - (metrics.ttft or 0.0)
+        if metrics.completion_tokens and decode_time > 0:
+            metrics.tokens_per_second = metrics.completion_tokens / decode_time
+        return metrics
+
+    def finish_cache_hit(self) -> ChatMetrics:
+        self.metrics.latency = time.perf_counter() - self.t0
+        self.metrics.usage_source = 'cache'
+        self.metrics.cache_hit = True
+        return self.metrics
+
+
+def _count_output_tokens(msg: Message) -> int:
+    n = 0
+    if msg.function_call:
+        n += tokenizer.count_tokens(msg.function_call.name + msg.function_call.arguments)
+    if msg.reasoning_content:
+        n += tokenizer.count_tokens(msg.reasoning_content if isinstance(msg.reasoning_content, str) else ''.join(
+            item.text or '' for item in msg.reasoning_content))
+    return n + tokenizer.count_tokens(extract_text_from_message(msg, add_upload_info=False))
+
+
+def attach_metrics(messages: list, metrics: ChatMetrics) -> None:
+    """Attaches the record to the last message, as `extra['metrics']`, in place."""
+    if not messages:
+        return
+    msg = messages[-1]
+    if isinstance(msg, dict):
+        msg['extra'] = {**(msg.get('extra') or {}), 'metrics': metrics.to_dict()}
+    else:
+        msg.extra = {**(msg.extra or {}), 'metrics': metrics.to_dict()}
@@ -0,0 +1,296 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The process-wide registry of the weights of the local models.
+
+The LLM instances of the same model, e.g., the agents of a group chat or the routes of a router, share its weights,
+which are loaded once. The loaded models of each kind of device are kept within a memory budget: loading a model
+unloads the least recently used others, which are loaded again when they are used next.
+"""
+
+import gc
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterator, List, Optional
+
+from qwen_agent.log import logger
+
+GiB = 1024**3
+
+
+class _Entry:
+
+    def __init__(self, key: Hashable, loader: Callable[[], Any], device: str, size_hint: int):
+        self.key = key
+        self.loader = loader
+        self.kind = _device_kind(device)
+        self.model = None
+        self.num_bytes = size_hint  # Measured once loaded
+        self.pins = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+        self.last_used = 0.0
+        self.load_lock = threading.Lock()
+
+
+class ModelHandle:
+    """An LLM instance's reference to a model of the registry, which loads the model again if it was evicted.
+
+    The backends keep the handle instead of the model, so that evicting the model frees its memory.
+    """
+
+    def __init__(self, registry: 'ModelRegistry', entry: _Entry):
+        self._registry = registry
+        self._entry = entry
+
+    @property
+    def key(self) -> Hashable:
+        return self._entry.key
+
+    @property
+    def loaded(self) -> bool:
+        return self._entry.model is not None
+
+    def get(self) -> Any:
+        """Returns the model, loading it if it is not loaded. Use `use` to keep it loaded while it is running."""
+        return self._registry._get(self._entry)
+
+    @contextmanager
+    def use(self) -> Iterator[Any]:
+        """Pins the model, so that it is not evicted until the block exits, e.g., during `generate()`."""
+        self._registry._pin(self._entry, 1)
+        try:
+            yield self.get()
+        finally:
+            self._registry._pin(self._entry, -1)
+
+
+class ModelRegistry:
+    """Shares the loaded models by key, and unloads the least recently used ones to stay within the memory budgets.
+
+    Args:
+        gpu_budget_bytes: The max bytes of the models on CUDA devices, or None for no limit.
+        cpu_budget_bytes: The max bytes of the models in RAM (CPU and other devices), or None for no limit.
+        max_events: The number of the latest load and evict events kept for `events()`.
+    """
+
+    def __init__(self,
+                 gpu_budget_bytes: Optional[int] = None,
+                 cpu_budget_bytes: Optional[int] = None,
+                 max_events: int = 256):
+        self.budgets = {'cuda': gpu_budget_bytes, 'cpu': cpu_budget_bytes}
+        self._entries: 'OrderedDict[Hashable, _Entry]' = OrderedDict()  # The least recently used first
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=max_events)
+
+    def acquire(self, key: Hashable, loader: Callable[[], Any], device: str = 'cpu', size_hint: int = 0) -> ModelHandle:
+        """Returns the handle of the model of `key`, and loads it with `loader` if it is not loaded.
+
+        Args:
+            key: Identifies the weights, e.g., the model path with the dtype and the quantization.
+            loader: Loads the model. It must not reference the LLM instance, which the registry would keep alive.
+            device: The device that the model is loaded to, which decides the budget it counts against.
+            size_hint: The estimated bytes of the model, used to make room before it is first loaded.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(key, loader, device=device, size_hint=size_hint)
+                self._entries[key] = entry
+        handle = ModelHandle(self, entry)
+        handle.get()
+        return handle
+
+    def _get(self, entry: _Entry) -> Any:
+        with self._lock:
+            model = entry.model
+            if model is not None:
+                self._touch(entry)
+                return model
+        with entry.load_lock:
+            with self._lock:
+                if entry.model is not None:  # Loaded by another thread meanwhile
+                    self._touch(entry)
+                    return entry.model
+                evicted = self._make_room(entry.kind, entry.num_bytes, keep=entry)
+            _free_memory(evicted)
+
+            t0 = time.perf_counter()
+            model = entry.loader()
+            seconds = time.perf_counter() - t0
+            num_bytes = _model_bytes(model) or entry.num_bytes
+            with self._lock:
+                entry.model = model
+                entry.num_bytes = num_bytes
+                entry.loads += 1
+                entry.load_seconds += seconds
+                self._touch(entry)
+                self._record('load', entry, seconds=seconds)
+                evicted = self._make_room(entry.kind, 0, keep=entry)  # The measured size may exceed the estimate
+            _free_memory(evicted)
+            return model
+
+    def _touch(self, entry: _Entry) -> None:
+        entry.last_used = time.time()
+        self._entries.move_to_end(entry.key)
+
+    def _pin(self, entry: _Entry, delta: int) -> None:
+        with self._lock:
+            entry.pins += delta
+
+    def _make_room(self, kind: str, num_bytes: int, keep: _Entry) -> List[_Entry]:
+        # Evicts the least recently used unpinned models of the kind until `num_bytes` more fit in the budget.
+        budget = self.budgets.get(kind)
+        if budget is None:
+            return []
+        loaded = [e for e in self._entries.values() if e.kind == kind and e.model is not None and e is not keep]
+        used = sum(e.num_bytes for e in loaded) + (keep.num_bytes if keep.model is not None else 0)
+        evicted = []
+        for victim in loaded:
+            if used + num_bytes <= budget:
+                break
+            if victim.pins > 0:
+                continue
+            victim.model = None
+            victim.evictions += 1
+            used -= victim.num_bytes
+            evicted.append(victim)
+            self._record('evict', victim)
+        if used + num_bytes > budget:
+            logger.warning(f'[ModelRegistry] The {kind} models need {(used + num_bytes) / GiB:.1f} GiB, over the '
+                           f'budget of {budget / GiB:.1f} GiB, but the others are in use.')
+        return evicted
+
+    def _record(self, event: str, entry: _Entry, seconds: float = 0.0) -> None:
+        self._events.append({
+            'time': time.time(),
+            'event': event,
+            'key': entry.key,
+            'device': entry.kind,
+            'bytes': entry.num_bytes,
+            'seconds': seconds,
+        })
+        if event == 'load':
+            logger.info(f'[ModelRegistry] Loaded {entry.key} ({entry.num_bytes / GiB:.2f} GiB) in {seconds:.1f}s.')
+        else:
+            logger.info(f'[ModelRegistry] Evicted {entry.key} ({entry.num_bytes / GiB:.2f} GiB) to stay within the '
+                        f'{entry.kind} memory budget.')
+
+    def evict(self, key: Hashable) -> bool:
+        """Unloads the model of `key` if it is loaded and not in use. Returns whether it was unloaded."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.model is None or entry.pins > 0:
+                return False
+            entry.model = None
+            entry.evictions += 1
+            self._record('evict', entry)
+        _free_memory([entry])
+        return True
+
+    def events(self) -> List[dict]:
+        """The latest load and evict events, the oldest first."""
+        with self._lock:
+            return list(self._events)
+
+    def stats(self) -> dict:
+        with self._lock:
+            used = {kind: 0 for kind in self.budgets}
+            models = []
+            for e in self._entries.values():
+                if e.model is not None:
+                    used[e.kind] += e.num_bytes
+                models.append({
+                    'key': e.key,
+                    'device': e.kind,
+                    'loaded': e.model is not None,
+                    'bytes': e.num_bytes,
+                    'in_use': e.pins,
+                    'loads': e.loads,
+                    'evictions': e.evictions,
+                    'load_seconds': e.load_seconds,
+                    'last_used': e.last_used,
+                })
+            return {'budgets': dict(self.budgets), 'used': used, 'models': models}
+
+
+def _device_kind(device: Optional[str]) -> str:
+    return 'cuda' if str(device or 'cpu').startswith(('cuda', 'auto')) else 'cpu'
+
+
+def _model_bytes(model: Any) -> int:
+    model = getattr(model, '_orig_mod', model)  # Compiled by torch.compile
+    if hasattr(model, 'get_memory_footprint'):
+        try:
+            return int(model.get_memory_footprint())
+        except Exception:
+            pass
+    if hasattr(model, 'parameters'):
+        return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    return 0
+
+
+def _free_memory(evicted: List[_Entry]) -> None:
+    if not evicted:
+        return
+    gc.collect()
+    if any(e.kind == 'cuda' for e in evicted) and 'torch' in sys.modules:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def dir_size_bytes(path: str, suffixes: tuple = ('.safetensors', '.bin', '.gguf', '.onnx', '.xml')) -> int:
+    """The size of the weight files of a local model directory, to estimate its memory before loading it."""
+    if not os.path.isdir(path):
+        return 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            if f.endswith(suffixes):
+                total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+def _budget_from_env(name: str, default_gb: Optional[float]) -> Optional[int]:
+    value = os.getenv(name)
+    gb = float(value) if value else default_gb
+    return int(gb * GiB) if gb else None
+
+
+_registry: Optional[ModelRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    """Returns the process-wide registry, whose budgets default to 80% of the VRAM and half of the RAM, leaving room
+    for the KV caches and activations. Set QWEN_AGENT_GPU_MEMORY_BUDGET_GB or QWEN_AGENT_CPU_MEMORY_BUDGET_GB to
+    override them, or 0 for no limit."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            from qwen_agent.utils.hw_config import get_hw_profile
+
+            hw = get_hw_profile()
+            gpu_default = 0.8 * hw.gpu_vram_gb * max(1, hw.gpu_count) if hw.cuda_available else None
+            cpu_default = 0.5 * hw.system_ram_gb if hw.system_ram_gb else None
+            _registry = ModelRegistry(
+                gpu_budget_bytes=_budget_from_env('QWEN_AGENT_GPU_MEMORY_BUDGET_GB', gpu_default),
+                cpu_budget_bytes=_budget_from_env('QWEN_AGENT_CPU_MEMORY_BUDGET_GB', cpu_default),
+            )
+        return _registry
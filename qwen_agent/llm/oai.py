@@ -12,25 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import copy
+import json
 import logging
 import os
+import threading
+import weakref
 from pprint import pformat
-from typing import Dict, Iterator, List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional
 
 import openai
 
-from qwen_agent.utils.utils import format_as_text_message
-
 if openai.__version__.startswith('0.'):
     from openai.error import OpenAIError  # noqa
 else:
     from openai import OpenAIError
 
 from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.cancellation import is_cancelled, on_cancel
 from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.metrics import report_usage
 from qwen_agent.llm.schema import ASSISTANT, FunctionCall, Message
 from qwen_agent.log import logger
+from qwen_agent.utils.async_utils import run_in_threadpool
+from qwen_agent.utils.utils import format_as_text_message, print_traceback
 
 
 @register_llm('oai')
@@ -50,6 +56,9 @@ class TextChatAtOAI(BaseFnCallModel):
         api_key = api_key or os.getenv('OPENAI_API_KEY')
         api_key = (api_key or 'EMPTY').strip()
 
+        # Ask for the token usage at the end of streams. Disable it for servers that reject `stream_options`.
+        self.stream_usage = cfg.get('stream_usage', True)
+
         if openai.__version__.startswith('0.'):
             if api_base:
                 openai.api_base = api_base
@@ -57,43 +66,35 @@ class TextChatAtOAI(BaseFnCallModel):
                 openai.api_key = api_key
             self._complete_create = openai.Completion.create
             self._chat_complete_create = openai.ChatCompletion.create
+            self._achat_complete_create = openai.ChatCompletion.acreate
         else:
             api_kwargs = {}
             if api_base:
                 api_kwargs['base_url'] = api_base
             if api_key:
                 api_kwargs['api_key'] = api_key
+            self._set_clients(OpenAIClients(openai.OpenAI, openai.AsyncOpenAI, api_kwargs, cfg.get('http_client')))
+
+    def _set_clients(self, clients: 'OpenAIClients'):
+        self.clients = clients
+
+        def _chat_complete_create(*args, **kwargs):
+            return clients.get().chat.completions.create(*args, **_to_oai_v1_kwargs(kwargs))
+
+        def _complete_create(*args, **kwargs):
+            return clients.get().completions.create(*args, **_to_oai_v1_kwargs(kwargs))
+
+        async def _achat_complete_create(*args, **kwargs):
+            return await clients.aget().chat.completions.create(*args, **_to_oai_v1_kwargs(kwargs))
+
+        self._complete_create = _complete_create
+        self._chat_complete_create = _chat_complete_create
+        self._achat_complete_create = _achat_complete_create
 
-            def _chat_complete_create(*args, **kwargs):
-                # OpenAI API v1 does not allow the following args, must pass by extra_body
-                extra_params = ['top_k', 'repetition_penalty']
-                if any((k in kwargs) for k in extra_params):
-                    kwargs['extra_body'] = copy.deepcopy(kwargs.get('extra_body', {}))
-                    for k in extra_params:
-                        if k in kwargs:
-                            kwargs['extra_body'][k] = kwargs.pop(k)
-                if 'request_timeout' in kwargs:
-                    kwargs['timeout'] = kwargs.pop('request_timeout')
-
-                client = openai.OpenAI(**api_kwargs)
-                return client.chat.completions.create(*args, **kwargs)
-
-            def _complete_create(*args, **kwargs):
-                # OpenAI API v1 does not allow the following args, must pass by extra_body
-                extra_params = ['top_k', 'repetition_penalty']
-                if any((k in kwargs) for k in extra_params):
-                    kwargs['extra_body'] = copy.deepcopy(kwargs.get('extra_body', {}))
-                    for k in extra_params:
-                        if k in kwargs:
-                            kwargs['extra_body'][k] = kwargs.pop(k)
-                if 'request_timeout' in kwargs:
-                    kwargs['timeout'] = kwargs.pop('request_timeout')
-
-                client = openai.OpenAI(**api_kwargs)
-                return client.completions.create(*args, **kwargs)
-
-            self._complete_create = _complete_create
-            self._chat_complete_create = _chat_complete_create
+    @property
+    def default_max_batch_size(self) -> int:
+        # `chat_batch` sends this many concurrent requests.
+        return 8
 
     def _chat_stream(
         self,
@@ -102,59 +103,23 @@ class TextChatAtOAI(BaseFnCallModel):
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
         messages = self.convert_messages_to_dicts(messages)
+        generate_cfg = self._with_stream_options(generate_cfg)
         logger.debug(f'LLM Input generate_cfg: \n{generate_cfg}')
         try:
             response = self._chat_complete_create(model=self.model, messages=messages, stream=True, **generate_cfg)
-            if delta_stream:
+            # Closing the HTTP response, also from another thread, tells the server to stop generating.
+            remove_callback = on_cancel(response.close)
+            try:
+                parser = _StreamResponseParser(delta_stream=delta_stream)
                 for chunk in response:
-                    if chunk.choices:
-                        if hasattr(chunk.choices[0].delta,
-                                   'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                            yield [
-                                Message(role=ASSISTANT,
-                                        content='',
-                                        reasoning_content=chunk.choices[0].delta.reasoning_content)
-                            ]
-                        if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
-                            yield [Message(role=ASSISTANT, content=chunk.choices[0].delta.content)]
-            else:
-                full_response = ''
-                full_reasoning_content = ''
-                full_tool_calls = []
-                for chunk in response:
-                    if chunk.choices:
-                        if hasattr(chunk.choices[0].delta,
-                                   'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                            full_reasoning_content += chunk.choices[0].delta.reasoning_content
-                        if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
-                            full_response += chunk.choices[0].delta.content
-                        if hasattr(chunk.choices[0].delta, 'tool_calls') and chunk.choices[0].delta.tool_calls:
-                            for tc in chunk.choices[0].delta.tool_calls:
-                                if full_tool_calls and (not tc.id or
-                                                        tc.id == full_tool_calls[-1]['extra']['function_id']):
-                                    if tc.function.name:
-                                        full_tool_calls[-1].function_call['name'] += tc.function.name
-                                    if tc.function.arguments:
-                                        full_tool_calls[-1].function_call['arguments'] += tc.function.arguments
-                                else:
-                                    full_tool_calls.append(
-                                        Message(role=ASSISTANT,
-                                                content='',
-                                                function_call=FunctionCall(name=tc.function.name,
-                                                                           arguments=tc.function.arguments),
-                                                extra={'function_id': tc.id}))
-
-                        res = []
-                        if full_reasoning_content:
-                            res.append(Message(role=ASSISTANT, content='', reasoning_content=full_reasoning_content))
-                        if full_response:
-                            res.append(Message(
-                                role=ASSISTANT,
-                                content=full_response,
-                            ))
-                        if full_tool_calls:
-                            res += full_tool_calls
-                        yield res
+                    yield from parser.feed(chunk)
+            except Exception:
+                if is_cancelled():
+                    return
+                raise
+            finally:
+                remove_callback()
+                response.close()
         except OpenAIError as ex:
             raise ModelServiceError(exception=ex)
 
@@ -166,17 +131,60 @@ class TextChatAtOAI(BaseFnCallModel):
         messages = self.convert_messages_to_dicts(messages)
         try:
             response = self._chat_complete_create(model=self.model, messages=messages, stream=False, **generate_cfg)
-            if hasattr(response.choices[0].message, 'reasoning_content'):
-                return [
-                    Message(role=ASSISTANT,
-                            content=response.choices[0].message.content,
-                            reasoning_content=response.choices[0].message.reasoning_content)
-                ]
-            else:
-                return [Message(role=ASSISTANT, content=response.choices[0].message.content)]
+            _report_usage(getattr(response, 'usage', None))
+            return _parse_response(response)
+        except OpenAIError as ex:
+            raise ModelServiceError(exception=ex)
+
+    async def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        # Off the event loop, since the multimodal subclasses read and encode local files here.
+        messages = await run_in_threadpool(self.convert_messages_to_dicts, messages)
+        generate_cfg = self._with_stream_options(generate_cfg)
+        logger.debug(f'LLM Input generate_cfg: \n{generate_cfg}')
+        try:
+            response = await self._achat_complete_create(model=self.model,
+                                                         messages=messages,
+                                                         stream=True,
+                                                         **generate_cfg)
+            try:
+                parser = _StreamResponseParser(delta_stream=delta_stream)
+                async for chunk in response:
+                    for rsp in parser.feed(chunk):
+                        yield rsp
+            finally:
+                # A cancelled token ends the stream at the next chunk, and so does a cancelled task at once.
+                close = getattr(response, 'close', None) or getattr(response, 'aclose', None)
+                if close is not None:
+                    await close()
+        except OpenAIError as ex:
+            raise ModelServiceError(exception=ex)
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        messages = await run_in_threadpool(self.convert_messages_to_dicts, messages)
+        try:
+            response = await self._achat_complete_create(model=self.model,
+                                                         messages=messages,
+                                                         stream=False,
+                                                         **generate_cfg)
+            _report_usage(getattr(response, 'usage', None))
+            return _parse_response(response)
         except OpenAIError as ex:
             raise ModelServiceError(exception=ex)
 
+    def _with_stream_options(self, generate_cfg: dict) -> dict:
+        if self.stream_usage and ('stream_options' not in generate_cfg):
+            generate_cfg = {**generate_cfg, 'stream_options': {'include_usage': True}}
+        return generate_cfg
+
     def convert_messages_to_dicts(self, messages: List[Message]) -> List[dict]:
         # TODO: Change when the VLLM deployed model needs to pass reasoning_complete.
         #  At this time, in order to be compatible with lower versions of vLLM,
@@ -188,3 +196,191 @@ class TextChatAtOAI(BaseFnCallModel):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f'LLM Input: \n{pformat(messages, indent=2)}')
         return messages
+
+
+DEFAULT_HTTP_CLIENT_CFG = {
+    'max_connections': 1000,
+    'max_keepalive_connections': 100,
+    'keepalive_expiry': 30.0,  # Seconds an idle connection is kept open for the next request
+    'http2': False,  # Requires `pip install httpx[http2]`
+    'timeout': 600.0,
+    'connect_timeout': 5.0,
+    'shared': True,  # Share the connection pool with the other LLMs of the same model server
+}
+
+_SHARED_HTTP_CLIENTS: Dict[str, object] = {}
+# The async connections are bound to the event loop that opened them, so the async clients are kept per event loop.
+_SHARED_ASYNC_HTTP_CLIENTS = weakref.WeakKeyDictionary()
+_SHARED_HTTP_CLIENTS_LOCK = threading.Lock()
+
+
+class OpenAIClients:
+    """The long-lived OpenAI clients of an LLM, created on first use and reused by all of its requests.
+
+    Creating a client per request pays for a new connection pool, and thus the TCP and TLS handshakes, every time.
+    The connection pool is configured with the cfg `http_client` of the LLM, see `DEFAULT_HTTP_CLIENT_CFG`, and is
+    shared by default among the LLMs of the same model server.
+    """
+
+    def __init__(self, client_cls, async_client_cls, api_kwargs: dict, http_cfg: Optional[dict] = None):
+        self.client_cls = client_cls
+        self.async_client_cls = async_client_cls
+        self.api_kwargs = api_kwargs
+        self.http_cfg = {**DEFAULT_HTTP_CLIENT_CFG, **(http_cfg or {})}
+        if self.http_cfg['http2']:
+            try:
+                import h2  # noqa
+            except ImportError:
+                print_traceback(is_error=False)
+                logger.warning('HTTP/2 disabled because h2 is not installed. Please `pip install httpx[http2]`.')
+                self.http_cfg['http2'] = False
+        server = api_kwargs.get('base_url') or api_kwargs.get('azure_endpoint') or ''
+        self._share_key = json.dumps([server, self.http_cfg], sort_keys=True)
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self.client_cls(**self.api_kwargs,
+                                                   timeout=self._timeout(),
+                                                   http_client=self._http_client(async_=False))
+        return self._client
+
+    def aget(self):
+        """Returns the async client of the running event loop."""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            _discard_closed_loops(self._async_clients)
+            client = self.async_client_cls(**self.api_kwargs,
+                                           timeout=self._timeout(),
+                                           http_client=self._http_client(async_=True))
+            self._async_clients[loop] = client
+        return client
+
+    def _timeout(self):
+        import httpx
+        return httpx.Timeout(self.http_cfg['timeout'], connect=self.http_cfg['connect_timeout'])
+
+    def _http_client(self, async_: bool):
+        if not self.http_cfg['shared']:
+            return self._new_http_client(async_)
+        with _SHARED_HTTP_CLIENTS_LOCK:
+            if async_:
+                _discard_closed_loops(_SHARED_ASYNC_HTTP_CLIENTS)
+                clients = _SHARED_ASYNC_HTTP_CLIENTS.setdefault(asyncio.get_running_loop(), {})
+            else:
+                clients = _SHARED_HTTP_CLIENTS
+            if self._share_key not in clients:
+                clients[self._share_key] = self._new_http_client(async_)
+            return clients[self._share_key]
+
+    def _new_http_client(self, async_: bool):
+        import httpx
+        limits = httpx.Limits(max_connections=self.http_cfg['max_connections'],
+                              max_keepalive_connections=self.http_cfg['max_keepalive_connections'],
+                              keepalive_expiry=self.http_cfg['keepalive_expiry'])
+        if async_:
+            http_client_cls = getattr(openai, 'DefaultAsyncHttpxClient', httpx.AsyncClient)
+        else:
+            http_client_cls = getattr(openai, 'DefaultHttpxClient', httpx.Client)
+        return http_client_cls(limits=limits, timeout=self._timeout(), http2=self.http_cfg['http2'])
+
+
+def _discard_closed_loops(clients_by_loop: weakref.WeakKeyDictionary) -> None:
+    # The connections of a closed event loop can't be reused, and they keep the loop alive.
+    for loop in [loop for loop in list(clients_by_loop.keys()) if loop.is_closed()]:
+        clients_by_loop.pop(loop, None)
+
+
+def _to_oai_v1_kwargs(kwargs: dict) -> dict:
+    # OpenAI API v1 does not allow the following args, must pass by extra_body
+    # `stream_options` is passed by extra_body too, since the openai versions before 1.26 don't accept it.
+    extra_params = ['top_k', 'repetition_penalty', 'stream_options']
+    if any((k in kwargs) for k in extra_params):
+        kwargs['extra_body'] = copy.deepcopy(kwargs.get('extra_body', {}))
+        for k in extra_params:
+            if k in kwargs:
+                kwargs['extra_body'][k] = kwargs.pop(k)
+    if 'request_timeout' in kwargs:
+        kwargs['timeout'] = kwargs.pop('request_timeout')
+    return kwargs
+
+
+def _report_usage(usage) -> None:
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    report_usage(prompt_tokens=getattr(usage, 'prompt_tokens', None),
+                 completion_tokens=getattr(usage, 'completion_tokens', None),
+                 cached_tokens=getattr(details, 'cached_tokens', None) if details else None)
+
+
+def _parse_response(response) -> List[Message]:
+    if hasattr(response.choices[0].message, 'reasoning_content'):
+        return [
+            Message(role=ASSISTANT,
+                    content=response.choices[0].message.content,
+                    reasoning_content=response.choices[0].message.reasoning_content)
+        ]
+    else:
+        return [Message(role=ASSISTANT, content=response.choices[0].message.content)]
+
+
+class _StreamResponseParser:
+    """Turns the chunks of a streamed chat completion into the responses to yield, shared by the sync and async
+    streaming methods."""
+
+    def __init__(self, delta_stream: bool):
+        self.delta_stream = delta_stream
+        self.full_response = ''
+        self.full_reasoning_content = ''
+        self.full_tool_calls = []
+
+    def feed(self, chunk) -> List[List[Message]]:
+        # With `stream_options={'include_usage': True}`, the last chunk has the usage and no choices.
+        _report_usage(getattr(chunk, 'usage', None))
+        if not chunk.choices:
+            return []
+        delta = chunk.choices[0].delta
+        if self.delta_stream:
+            outputs = []
+            if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
+                outputs.append([Message(role=ASSISTANT, content='', reasoning_content=delta.reasoning_content)])
+            if hasattr(delta, 'content') and delta.content:
+                outputs.append([Message(role=ASSISTANT, content=delta.content)])
+            return outputs
+
+        if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
+            self.full_reasoning_content += delta.reasoning_content
+        if hasattr(delta, 'content') and delta.content:
+            self.full_response += delta.content
+        if hasattr(delta, 'tool_calls') and delta.tool_calls:
+            full_tool_calls = self.full_tool_calls
+            for tc in delta.tool_calls:
+                if full_tool_calls and (not tc.id or tc.id == full_tool_calls[-1]['extra']['function_id']):
+                    if tc.function.name:
+                        full_tool_calls[-1].function_call['name'] += tc.function.name
+                    if tc.function.arguments:
+                        full_tool_calls[-1].function_call['arguments'] += tc.function.arguments
+                else:
+                    full_tool_calls.append(
+                        Message(role=ASSISTANT,
+                                content='',
+                                function_call=FunctionCall(name=tc.function.name, arguments=tc.function.arguments),
+                                extra={'function_id': tc.id}))
+
+        res = []
+        if self.full_reasoning_content:
+            res.append(Message(role=ASSISTANT, content='', reasoning_content=self.full_reasoning_content))
+        if self.full_response:
+            res.append(Message(
+                role=ASSISTANT,
+                content=self.full_response,
+            ))
+        if self.full_tool_calls:
+            res += self.full_tool_calls
+        return [res]
@@ -0,0 +1,336 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Set
+
+import openai
+
+from qwen_agent.llm.base import LLM_REGISTRY, BaseChatModel, ModelServiceError, register_llm
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import Message
+from qwen_agent.log import logger
+
+
+@register_llm('oai_pool')
+class TextChatAtOAIPool(BaseFnCallModel):
+    """Routes the requests among several replicas of a model service compatible with OpenAI API.
+
+    An example cfg:
+        cfg = {
+            'model': 'Qwen',
+            'model_servers': [
+                'http://10.0.0.1:8000/v1',
+                {'model_server': 'http://10.0.0.2:8000/v1', 'api_key': 'EMPTY'},
+            ],
+
+            # (Optional) 'least_outstanding' (default) sends a request to the replica with the fewest requests in
+            # flight, and 'ewma' to the one with the lowest EWMA latency (weighted by its requests in flight).
+            'routing': 'least_outstanding',
+            # (Optional) A replica that fails is ejected for `eject_seconds`, doubled on every consecutive failure
+            # up to `max_eject_seconds`. Once the time is up, one request probes whether it is back.
+            'eject_seconds': 5,
+            'max_eject_seconds': 300,
+            # (Optional) The model type of the replicas, e.g., 'qwenvl_oai' for multimodal models.
+            'endpoint_model_type': 'oai',
+            # (Optional) The connection pool of each replica, see `DEFAULT_HTTP_CLIENT_CFG` in oai.py.
+            'http_client': {'max_connections': 100},
+        }
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        if openai.__version__.startswith('0.'):
+            raise NotImplementedError('`oai_pool` requires openai>=1.0, since openai 0.x only has a global api_base.')
+        model_servers = cfg.get('model_servers') or []
+        if not model_servers:
+            raise ValueError('Please set `model_servers` to the list of the model services to route requests to.')
+        endpoint_model_type = cfg.get('endpoint_model_type', 'oai')
+
+        endpoints = []
+        for server in model_servers:
+            if isinstance(server, str):
+                server = {'model_server': server}
+            endpoint_cfg = {
+                'model': cfg.get('model', ''),
+                'api_key': cfg.get('api_key'),
+                'http_client': cfg.get('http_client'),
+                **server,
+                'model_type': endpoint_model_type,
+            }
+            endpoint_cfg['model_server'] = endpoint_cfg['model_server'].strip()
+            endpoints.append(_Endpoint(LLM_REGISTRY[endpoint_model_type](endpoint_cfg), endpoint_cfg['model_server']))
+        self.pool = _EndpointPool(
+            endpoints,
+            routing=cfg.get('routing', 'least_outstanding'),
+            eject_seconds=cfg.get('eject_seconds', 5.0),
+            max_eject_seconds=cfg.get('max_eject_seconds', 300.0),
+        )
+        super().__init__(cfg)
+        self.model = self.model or endpoints[0].llm.model
+
+    @property
+    def support_multimodal_input(self) -> bool:
+        return self.pool.endpoints[0].llm.support_multimodal_input
+
+    @property
+    def support_multimodal_output(self) -> bool:
+        return self.pool.endpoints[0].llm.support_multimodal_output
+
+    @property
+    def support_audio_input(self) -> bool:
+        return self.pool.endpoints[0].llm.support_audio_input
+
+    @property
+    def default_max_batch_size(self) -> int:
+        return sum(ep.llm.max_batch_size for ep in self.pool.endpoints)
+
+    def endpoint_stats(self) -> List[dict]:
+        return self.pool.stats()
+
+    def _chat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        return self.pool.iterate(
+            lambda llm: llm._chat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg))
+
+    def _chat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        return self.pool.call(lambda llm: llm._chat_no_stream(messages, generate_cfg=generate_cfg))
+
+    async def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        async for rsp in self.pool.aiterate(
+                lambda llm: llm._achat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)):
+            yield rsp
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        return await self.pool.acall(lambda llm: llm._achat_no_stream(messages, generate_cfg=generate_cfg))
+
+
+class _Endpoint:
+
+    def __init__(self, llm: BaseChatModel, url: str):
+        self.llm = llm
+        self.url = url
+        self.in_flight = 0
+        self.ewma_latency: Optional[float] = None  # The time to the first response, in seconds
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0  # Healthy if zero, otherwise ejected until then (time.monotonic) or probing
+        self.probing = False
+        self.num_requests = 0
+        self.num_failures = 0
+
+
+class _EndpointPool:
+    """Chooses an endpoint for each request and keeps track of the load and the health of the endpoints.
+
+    A request that fails on an endpoint because of the endpoint (e.g., connection errors, timeouts, 5xx and 429) is
+    sent to another endpoint right away, as long as nothing has been yielded yet. The error is only raised after every
+    endpoint has failed, and then `retry_model_service` backs off as usual.
+    """
+
+    EWMA_DECAY = 0.3
+
+    def __init__(self, endpoints: List[_Endpoint], routing: str, eject_seconds: float, max_eject_seconds: float):
+        if routing not in ('least_outstanding', 'ewma'):
+            raise ValueError(f'Unknown routing policy: {routing}. Please use "least_outstanding" or "ewma".')
+        self.endpoints = endpoints
+        self.routing = routing
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self._lock = threading.Lock()
+
+    def _acquire(self, tried: Set[_Endpoint]) -> Optional[_Endpoint]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep not in tried]
+            if not candidates:
+                return None
+            available = [
+                ep for ep in candidates if (not ep.ejected_until) or (ep.ejected_until <= now and not ep.probing)
+            ]
+            if available:
+                ep = min(available, key=self._score)
+            else:
+                # Every endpoint left is ejected. Try the one that is due first, rather than fail without trying.
+                ep = min(candidates, key=lambda x: x.ejected_until)
+            if ep.ejected_until:
+                ep.probing = True
+            ep.in_flight += 1
+            ep.num_requests += 1
+            return ep
+
+    def _score(self, ep: _Endpoint) -> tuple:
+        # Endpoints without latency measurements yet are preferred, so that every endpoint gets measured.
+        latency = ep.ewma_latency or 0.0
+        if self.routing == 'ewma':
+            return latency * (ep.in_flight + 1), ep.in_flight, random.random()
+        return ep.in_flight, latency, random.random()
+
+    def _release(self, ep: _Endpoint, latency: Optional[float], error: Optional[ModelServiceError]) -> None:
+        with self._lock:
+            ep.in_flight -= 1
+            if (error is not None) and _is_endpoint_failure(error):
+                ep.num_failures += 1
+                ep.consecutive_failures += 1
+                eject_seconds = min(self.max_eject_seconds, self.eject_seconds * 2**(ep.consecutive_failures - 1))
+                ep.ejected_until = time.monotonic() + eject_seconds
+                ep.probing = False
+                logger.warning(f'Ejecting {ep.url} for {eject_seconds:.1f}s - ' + str(error).strip('\n'))
+            elif latency is not None:
+                if ep.ejected_until:
+                    logger.info(f'{ep.url} is back')
+                ep.consecutive_failures = 0
+                ep.ejected_until = 0.0
+                ep.probing = False
+                if ep.ewma_latency is None:
+                    ep.ewma_latency = latency
+                else:
+                    ep.ewma_latency += self.EWMA_DECAY * (latency - ep.ewma_latency)
+            else:
+                ep.probing = False
+
+    def call(self, fn: Callable[[BaseChatModel], List[Message]]) -> List[Message]:
+        tried, last_error = set(), None
+        while True:
+            ep = self._acquire(tried)
+            if ep is None:
+                raise last_error
+            t0 = time.perf_counter()
+            try:
+                output = fn(ep.llm)
+            except ModelServiceError as e:
+                self._release(ep, latency=None, error=e)
+                if not _is_endpoint_failure(e):
+                    raise
+                tried.add(ep)
+                last_error = e
+                continue
+            except BaseException:
+                self._release(ep, latency=None, error=None)
+                raise
+            self._release(ep, latency=time.perf_counter() - t0, error=None)
+            return output
+
+    def iterate(self, it_fn: Callable[[BaseChatModel], Iterator[List[Message]]]) -> Iterator[List[Message]]:
+        tried, last_error = set(), None
+        while True:
+            ep = self._acquire(tried)
+            if ep is None:
+                raise last_error
+            t0 = time.perf_counter()
+            latency, error = None, None
+            try:
+                for rsp in it_fn(ep.llm):
+                    if latency is None:
+                        latency = time.perf_counter() - t0
+                    yield rsp
+            except ModelServiceError as e:
+                error = e
+            finally:
+                self._release(ep, latency=latency, error=error)
+            if error is None:
+                return
+            if (latency is not None) or (not _is_endpoint_failure(error)):
+                raise error
+            tried.add(ep)
+            last_error = error
+
+    async def acall(self, fn: Callable) -> List[Message]:
+        tried, last_error = set(), None
+        while True:
+            ep = self._acquire(tried)
+            if ep is None:
+                raise last_error
+            t0 = time.perf_counter()
+            try:
+                output = await fn(ep.llm)
+            except ModelServiceError as e:
+                self._release(ep, latency=None, error=e)
+                if not _is_endpoint_failure(e):
+                    raise
+                tried.add(ep)
+                last_error = e
+                continue
+            except BaseException:
+                self._release(ep, latency=None, error=None)
+                raise
+            self._release(ep, latency=time.perf_counter() - t0, error=None)
+            return output
+
+    async def aiterate(self, it_fn: Callable) -> AsyncIterator[List[Message]]:
+        tried, last_error = set(), None
+        while True:
+            ep = self._acquire(tried)
+            if ep is None:
+                raise last_error
+            t0 = time.perf_counter()
+            latency, error = None, None
+            try:
+                async for rsp in it_fn(ep.llm):
+                    if latency is None:
+                        latency = time.perf_counter() - t0
+                    yield rsp
+            except ModelServiceError as e:
+                error = e
+            finally:
+                self._release(ep, latency=latency, error=error)
+            if error is None:
+                return
+            if (latency is not None) or (not _is_endpoint_failure(error)):
+                raise error
+            tried.add(ep)
+            last_error = error
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'model_server': ep.url,
+                'in_flight': ep.in_flight,
+                'ewma_latency': ep.ewma_latency,
+                'healthy': not ep.ejected_until,
+                'ejected_for': max(0.0, ep.ejected_until - now) if ep.ejected_until else 0.0,
+                'num_requests': ep.num_requests,
+                'num_failures': ep.num_failures,
+            } for ep in self.endpoints]
+
+
+def _is_endpoint_failure(e: ModelServiceError) -> bool:
+    # Whether the error is caused by the endpoint rather than by the request, so that another endpoint may succeed.
+    if e.code == '400' or ('maximum context length' in str(e)):
+        return False
+    status_code = getattr(e.exception, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(e.exception, 'http_status', None)
+    if status_code is None:
+        return True  # e.g., connection errors and timeouts
+    return status_code >= 500 or status_code in (408, 429)
@@ -0,0 +1,299 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import os
+import re
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from qwen_agent.llm.base import register_llm
+from qwen_agent.llm.cancellation import on_cancel
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.metrics import report_usage
+from qwen_agent.llm.model_registry import dir_size_bytes, get_model_registry
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.stop_words import StopSequenceDetector
+from qwen_agent.log import logger
+
+_PAST_KEY_VALUE = re.compile(r'^past_key_values\.(\d+)\.(key|value)$')
+
+
+@register_llm('onnxruntime')
+class ONNXRuntime(BaseFnCallModel):
+    """
+    ONNX Runtime backend, which decodes with a decoder exported to ONNX and its KV cache on the CPU.
+
+    To use, you should have the 'onnxruntime' and 'transformers' (for the tokenizer) python packages installed.
+
+    Example export by command line:
+        optimum-cli export onnx --model Qwen/Qwen2.5-1.5B-Instruct --task text-generation-with-past Qwen2.5-1.5B-Instruct-onnx
+
+    The model takes `input_ids`, `attention_mask`, optionally `position_ids`, and `past_key_values.{i}.key/value` of
+    shape (batch, kv_heads, past_length, head_dim), and returns `logits` and `present.{i}.key/value`, as exported by
+    optimum. Its directory also holds the tokenizer, and optionally `generation_config.json` for the sampling defaults.
+
+    Example:
+        llm_cfg = {
+            'onnx_model_dir': 'Qwen2.5-1.5B-Instruct-onnx',
+            'model_type': 'onnxruntime',
+            # (Optional) 'onnx_file': 'model.onnx', 'providers': ['CPUExecutionProvider'], 'num_threads': 8,
+        }
+        bot = Assistant(llm=llm_cfg, ...)
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        if 'onnx_model_dir' not in cfg:
+            raise ValueError('Please provide the onnx model directory through `onnx_model_dir` in cfg.')
+
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError('Could not import onnxruntime python package. '
+                              'Please install it with: '
+                              "pip install -U 'onnxruntime'") from e
+        try:
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError('Could not import transformers python package for the tokenizer. '
+                              'Please install it with: '
+                              "pip install -U 'transformers'") from e
+
+        model_dir = cfg['onnx_model_dir']
+        model_file = os.path.join(model_dir, cfg.get('onnx_file', 'model.onnx'))
+        providers = list(cfg.get('providers') or ['CPUExecutionProvider'])
+        num_threads = int(cfg.get('num_threads', os.getenv('QWEN_AGENT_ONNX_NUM_THREADS', 0)))
+        if not num_threads:
+            from qwen_agent.utils.hw_config import get_hw_profile
+            num_threads = get_hw_profile().cpu_cores  # The decode steps don't gain from the SMT siblings
+
+        def _load_session():
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.intra_op_num_threads = num_threads
+            logger.info(f'[ONNXRuntime] Loading {model_file} with {providers} and {num_threads} threads...')
+            return onnxruntime.InferenceSession(model_file, sess_options=options, providers=providers)
+
+        # The instances of the same model share its session, see `qwen_agent.llm.model_registry`
+        self._model_handle = get_model_registry().acquire(
+            key=('onnxruntime', os.path.abspath(model_file), tuple(providers), num_threads),
+            loader=_load_session,
+            device='cpu',
+            size_hint=dir_size_bytes(model_dir, suffixes=('.onnx', '.onnx_data', '.onnx.data')),
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self._io = _DecoderIO(self._model_handle.get())
+        self._default_sampling, eos_token_id = _load_generation_defaults(model_dir)
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self._eos_token_ids = set(eos_token_id or [])
+        if self.tokenizer.eos_token_id is not None:
+            self._eos_token_ids.add(self.tokenizer.eos_token_id)
+
+    @property
+    def session(self):
+        return self._model_handle.get()
+
+    def _get_input_ids(self, messages: List[Message]) -> List[int]:
+        messages_plain = [message.model_dump() for message in messages]
+        prompt = self.tokenizer.apply_chat_template(messages_plain, add_generation_prompt=True, tokenize=False)
+        return self.tokenizer(prompt, add_special_tokens=False)['input_ids']
+
+    def _generate_ids(self, input_ids: List[int], generate_cfg: dict, cancelled: threading.Event) -> Iterator[int]:
+        """Yields the generated tokens one by one, feeding the KV cache of the previous steps back to the model."""
+        import numpy as np
+
+        sampling = dict(self._default_sampling)
+        sampling.update({k: generate_cfg[k] for k in _SAMPLING_KEYS if k in generate_cfg})
+        rng = np.random.default_rng(generate_cfg.get('seed'))
+        max_new_tokens = generate_cfg.get('max_new_tokens', 2048)
+
+        with self._model_handle.use() as session:
+            io = self._io
+            past = io.empty_past()
+            step_ids = np.asarray([input_ids], dtype=np.int64)
+            past_length = 0
+            output_ids = []
+            while len(output_ids) < max_new_tokens and not cancelled.is_set():
+                total_length = past_length + step_ids.shape[1]
+                feed = {'input_ids': step_ids, 'attention_mask': np.ones((1, total_length), dtype=np.int64)}
+                if io.has_position_ids:
+                    feed['position_ids'] = np.arange(past_length, total_length, dtype=np.int64)[None]
+                if io.has_use_cache_branch:
+                    feed['use_cache_branch'] = np.asarray([past_length > 0])
+                feed.update(past)
+                outputs = dict(zip(io.output_names, session.run(io.output_names, feed)))
+                past = {name: outputs[present] for name, present in io.present_of_past.items()}
+
+                token = _sample_next_token(outputs['logits'][0, -1], output_ids, rng=rng, **sampling)
+                output_ids.append(token)
+                yield token
+                if token in self._eos_token_ids:
+                    return
+                if io.present_of_past:
+                    step_ids = np.asarray([[token]], dtype=np.int64)
+                    past_length = total_length
+                else:
+                    step_ids = np.asarray([input_ids + output_ids], dtype=np.int64)
+
+    def _chat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        generate_cfg = copy.deepcopy(generate_cfg)
+        input_ids = self._get_input_ids(messages)
+        report_usage(prompt_tokens=len(input_ids))
+        stop_detector = StopSequenceDetector(generate_cfg.pop('stop', None) or [], self.tokenizer)
+        detokenizer = _IncrementalDetokenizer(self.tokenizer)
+        cancelled = threading.Event()
+        remove_callback = on_cancel(cancelled.set)
+        output_ids = []
+        try:
+            partial_text = ''
+            for token in self._generate_ids(input_ids, generate_cfg, cancelled):
+                output_ids.append(token)
+                new_text = detokenizer.add(token)
+                stopped = stop_detector.update(output_ids)
+                if new_text:
+                    partial_text += new_text
+                    if delta_stream:
+                        yield [Message(ASSISTANT, new_text)]
+                    else:
+                        yield [Message(ASSISTANT, partial_text)]
+                if stopped:
+                    break  # The stop word is removed from the response by the postprocessing
+        finally:
+            # Stops decoding at the next step if the consumer stops iterating.
+            cancelled.set()
+            remove_callback()
+            report_usage(completion_tokens=len(output_ids))
+
+    def _chat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        response = [Message(ASSISTANT, '')]
+        for response in self._chat_stream(messages, delta_stream=False, generate_cfg=generate_cfg):
+            pass
+        return response
+
+
+_SAMPLING_KEYS = ('do_sample', 'temperature', 'top_k', 'top_p', 'repetition_penalty')
+
+
+def _load_generation_defaults(model_dir: str):
+    # The sampling defaults and the EOS tokens of `generation_config.json`, if any
+    try:
+        from transformers import GenerationConfig
+        config = GenerationConfig.from_pretrained(model_dir)
+    except (ImportError, OSError):
+        return {}, None
+    defaults = {k: getattr(config, k) for k in _SAMPLING_KEYS if getattr(config, k, None) is not None}
+    return defaults, config.eos_token_id
+
+
+class _DecoderIO:
+    """The inputs and outputs of the exported decoder, read from the session once."""
+
+    def __init__(self, session):
+        import numpy as np
+
+        input_names = [i.name for i in session.get_inputs()]
+        self.output_names = [o.name for o in session.get_outputs()]
+        self.has_position_ids = 'position_ids' in input_names
+        self.has_use_cache_branch = 'use_cache_branch' in input_names
+        self.present_of_past = {}
+        self._past_shapes = {}
+        for i in session.get_inputs():
+            if not _PAST_KEY_VALUE.match(i.name):
+                continue
+            present = i.name.replace('past_key_values', 'present', 1)
+            if present not in self.output_names:
+                raise ValueError(f'The onnx model has the input {i.name} but not the output {present}.')
+            # (batch, kv_heads, past_length, head_dim), where only the heads and the head dim are fixed
+            _, heads, _, head_dim = i.shape
+            dtype = np.float16 if i.type == 'tensor(float16)' else np.float32
+            self.present_of_past[i.name] = present
+            self._past_shapes[i.name] = (heads, head_dim, dtype)
+        if 'logits' not in self.output_names:
+            raise ValueError('The onnx model has no `logits` output.')
+        if not self.present_of_past:
+            logger.warning('[ONNXRuntime] The onnx model has no KV cache inputs, so each step recomputes the prompt. '
+                           'Please export it with `--task text-generation-with-past`.')
+
+    def empty_past(self) -> dict:
+        import numpy as np
+        return {
+            name: np.zeros((1, heads, 0, head_dim), dtype=dtype)
+            for name, (heads, head_dim, dtype) in self._past_shapes.items()
+        }
+
+
+def _sample_next_token(logits,
+                       output_ids: List[int],
+                       rng,
+                       do_sample: bool = True,
+                       temperature: float = 1.0,
+                       top_k: int = 0,
+                       top_p: float = 1.0,
+                       repetition_penalty: float = 1.0) -> int:
+    import numpy as np
+
+    logits = logits.astype(np.float32)
+    if repetition_penalty and repetition_penalty != 1.0 and output_ids:
+        seen = np.unique(output_ids)
+        scores = logits[seen]
+        logits[seen] = np.where(scores > 0, scores / repetition_penalty, scores * repetition_penalty)
+    if not do_sample or not temperature or temperature <= 0:
+        return int(np.argmax(logits))
+
+    logits = logits / temperature
+    if top_k and 0 < top_k < logits.shape[-1]:
+        kth = np.partition(logits, -top_k)[-top_k]
+        logits = np.where(logits < kth, -np.inf, logits)
+    probs = np.exp(logits - logits.max())
+    probs /= probs.sum()
+    if top_p is not None and top_p < 1.0:
+        order = np.argsort(-probs)
+        cumulative = np.cumsum(probs[order])
+        keep = order[:int(np.searchsorted(cumulative, top_p)) + 1]  # The smallest set of tokens reaching top_p
+        kept = np.zeros_like(probs)
+        kept[keep] = probs[keep]
+        probs = kept / kept.sum()
+    return int(rng.choice(probs.shape[-1], p=probs))
+
+
+class _IncrementalDetokenizer:
+    """Decodes the tokens as they are generated, holding back the text of an incomplete UTF-8 character, and only
+    decoding the tokens since the last emitted text."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids = []
+        self._prefix_offset = 0  # Decoded with the new tokens, since a token's text may depend on the previous ones
+        self._read_offset = 0
+
+    def add(self, token: int) -> str:
+        self.ids.append(token)
+        prefix_text = self.tokenizer.decode(self.ids[self._prefix_offset:self._read_offset], skip_special_tokens=True)
+        text = self.tokenizer.decode(self.ids[self._prefix_offset:], skip_special_tokens=True)
+        if len(text) <= len(prefix_text) or text.endswith('�'):
+            return ''
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.ids)
+        return text[len(prefix_text):]
@@ -13,16 +13,28 @@
 # limitations under the License.
 
 import copy
+import json
+import os
+import threading
+import time
 from pprint import pformat
 from threading import Thread
 from typing import Dict, Iterator, List, Optional
 
 from qwen_agent.llm.base import register_llm
+from qwen_agent.llm.cancellation import on_cancel
+from qwen_agent.llm.continuous_batching import detokenize_stream
 from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.metrics import report_usage
+from qwen_agent.llm.model_registry import dir_size_bytes, get_model_registry
+from qwen_agent.llm.request_batcher import BatchRequest, RequestBatcher
 from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.stop_words import get_stopping_criteria
 from qwen_agent.log import logger
 from qwen_agent.utils.utils import build_text_completion_prompt
 
+PERFORMANCE_HINTS = ('latency', 'throughput')
+
 
 @register_llm('openvino')
 class OpenVINO(BaseFnCallModel):
@@ -38,7 +50,8 @@ class OpenVINO(BaseFnCallModel):
         llm_cfg = {
             'ov_model_dir': 'Qwen2-7B-Instruct-ov',
             'model_type': 'openvino',
-            'device': 'cpu'
+            'device': 'cpu',
+            # (Optional) 'performance_hint': 'throughput', 'max_batch_size': 4, 'ov_cache_dir': '/path/to/cache',
             }
         system_instruction = '''After receiving the user's request, you should:
         - first draw an image and obtain the image url,
@@ -51,6 +64,15 @@ class OpenVINO(BaseFnCallModel):
                 system_message=system_instruction,
                 function_list=tools,
                 files=files)
+
+    The compiled model is cached in `ov_cache_dir` (QWEN_AGENT_OV_CACHE_DIR, by default ~/.cache/qwen_agent/openvino,
+    an empty string to disable it), so that the next processes load it instead of compiling the IR model again.
+
+    With `'performance_hint': 'throughput'` (or QWEN_AGENT_OV_PERFORMANCE_HINT=throughput), the concurrent requests
+    with the same generation config are queued and served by one padded `generate()` call of up to `max_batch_size`
+    requests (by default `recommended_batch_size` of the hardware profile), waiting up to `batch_wait_ms` (20 by
+    default) for more requests. The default 'latency' hint calls `generate()` for each request as it arrives, unless
+    `'batching': True` is set, which then batches only the requests that are already waiting.
     """
 
     def __init__(self, cfg: Optional[Dict] = None):
@@ -71,39 +93,53 @@ class OpenVINO(BaseFnCallModel):
                               'Please install it with: '
                               "pip install -U 'transformers'") from e
 
-        self.ov_model = OVModelForCausalLM.from_pretrained(
-            cfg['ov_model_dir'],
-            device=cfg.get('device', 'cpu'),
-            ov_config=cfg.get('ov_config', {}),
-            config=AutoConfig.from_pretrained(cfg['ov_model_dir']),
-        )
-        self.tokenizer = AutoTokenizer.from_pretrained(cfg['ov_model_dir'])
-
-    def _get_stopping_criteria(self, generate_cfg: dict):
-        from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
-
-        class StopSequenceCriteria(StoppingCriteria):
-            """
-            This class can be used to stop generation whenever a sequence of tokens is encountered.
+        performance_hint = (cfg.get('performance_hint') or os.getenv('QWEN_AGENT_OV_PERFORMANCE_HINT') or
+                            'latency').lower()
+        if performance_hint not in PERFORMANCE_HINTS:
+            raise ValueError(f'Invalid performance_hint {performance_hint!r}, expected one of {PERFORMANCE_HINTS}.')
+        ov_config = _get_ov_config(cfg, performance_hint)
 
-            Args:
-                stop_sequences (`str` or `List[str]`):
-                    The sequence (or list of sequences) on which to stop execution.
-                tokenizer:
-                    The tokenizer used to decode the model outputs.
-            """
+        def _load_model():
+            t0 = time.perf_counter()
+            model = OVModelForCausalLM.from_pretrained(
+                cfg['ov_model_dir'],
+                device=cfg.get('device', 'cpu'),
+                ov_config=ov_config,
+                config=AutoConfig.from_pretrained(cfg['ov_model_dir']),
+            )
+            logger.info(f'[OpenVINO] Loaded {cfg["ov_model_dir"]} in {time.perf_counter() - t0:.1f}s '
+                        f'(PERFORMANCE_HINT={ov_config.get("PERFORMANCE_HINT")}, '
+                        f'CACHE_DIR={ov_config.get("CACHE_DIR") or None}).')
+            return model
 
-            def __init__(self, stop_sequences, tokenizer):
-                if isinstance(stop_sequences, str):
-                    stop_sequences = [stop_sequences]
-                self.stop_sequences = stop_sequences
-                self.tokenizer = tokenizer
+        # The instances of the same model share it, see `qwen_agent.llm.model_registry`
+        self._model_handle = get_model_registry().acquire(
+            key=('openvino', cfg['ov_model_dir'], cfg.get('device', 'cpu'),
+                 json.dumps(ov_config, sort_keys=True, default=str)),
+            loader=_load_model,
+            device='cpu',  # The RAM, also of the integrated GPUs
+            size_hint=dir_size_bytes(cfg['ov_model_dir']),
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(cfg['ov_model_dir'])
 
-            def __call__(self, input_ids, scores, **kwargs) -> bool:
-                decoded_output = self.tokenizer.decode(input_ids.tolist()[0])
-                return any(decoded_output.endswith(stop_sequence) for stop_sequence in self.stop_sequences)
+        # Optional: Concurrent requests share the `generate()` calls, see `qwen_agent.llm.request_batcher`
+        self._batcher = None
+        batching = cfg.get('batching', performance_hint == 'throughput')
+        if batching and self.max_batch_size == 1 and 'max_batch_size' not in cfg:
+            from qwen_agent.utils.hw_config import get_hw_profile
+            self.max_batch_size = get_hw_profile().recommended_batch_size
+        if batching and self.max_batch_size > 1:
+            max_wait_ms = cfg.get('batch_wait_ms', 20 if performance_hint == 'throughput' else 0)
+            self._batcher = RequestBatcher(self._run_batch,
+                                           max_batch_size=self.max_batch_size,
+                                           max_wait=max_wait_ms / 1000,
+                                           name='openvino-batcher')
+            logger.info(f'[OpenVINO] Batching enabled: max_batch_size={self.max_batch_size}, '
+                        f'batch_wait_ms={max_wait_ms}.')
 
-        return StoppingCriteriaList([StopSequenceCriteria(generate_cfg['stop'], self.tokenizer)])
+    @property
+    def ov_model(self):
+        return self._model_handle.get()
 
     def _chat_stream(
         self,
@@ -111,52 +147,187 @@ class OpenVINO(BaseFnCallModel):
         delta_stream: bool,
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
+        if self._batcher is not None:
+            yield from self._chat_stream_batched(messages, delta_stream, generate_cfg)
+            return
+
         from transformers import TextIteratorStreamer
         generate_cfg = copy.deepcopy(generate_cfg)
         messages_plain = [message.model_dump() for message in messages]
         input_token = self.tokenizer.apply_chat_template(messages_plain, add_generation_prompt=True, return_tensors='pt').to(self.ov_model.device)
+        report_usage(prompt_tokens=len(input_token[0]))
         streamer = TextIteratorStreamer(self.tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
+        cancelled = threading.Event()
         generate_cfg.update(
             dict(
                 input_ids=input_token,
                 streamer=streamer,
                 max_new_tokens=generate_cfg.get('max_new_tokens', 2048),
-                stopping_criteria=self._get_stopping_criteria(generate_cfg=generate_cfg),
+                stopping_criteria=get_stopping_criteria(generate_cfg.get('stop'),
+                                                        self.tokenizer,
+                                                        input_token.shape[-1],
+                                                        cancelled=cancelled),
             ))
-        del generate_cfg['stop']
+        generate_cfg.pop('stop', None)
         del generate_cfg['seed']
         
         def generate_and_signal_complete():
-            self.ov_model.generate(**generate_cfg)
+            with self._model_handle.use() as ov_model:
+                ov_model.generate(**generate_cfg)
 
         t1 = Thread(target=generate_and_signal_complete)
         t1.start()
-        partial_text = ''
-        for new_text in streamer:
-            partial_text += new_text
-            if delta_stream:
-                yield [Message(ASSISTANT, new_text)]
-            else:
-                yield [Message(ASSISTANT, partial_text)]
+        remove_callback = on_cancel(cancelled.set)
+        try:
+            partial_text = ''
+            for new_text in streamer:
+                partial_text += new_text
+                if delta_stream:
+                    yield [Message(ASSISTANT, new_text)]
+                else:
+                    yield [Message(ASSISTANT, partial_text)]
+        finally:
+            # Stops decoding at the next step if the consumer stops iterating.
+            cancelled.set()
+            remove_callback()
 
     def _chat_no_stream(
         self,
         messages: List[Message],
         generate_cfg: dict,
     ) -> List[Message]:
+        if self._batcher is not None:
+            response = [Message(ASSISTANT, '')]
+            for response in self._chat_stream_batched(messages, delta_stream=False, generate_cfg=generate_cfg):
+                pass
+            return response
+
         generate_cfg = copy.deepcopy(generate_cfg)
         messages_plain = [message.model_dump() for message in messages]
         input_token = self.tokenizer.apply_chat_template(messages_plain, add_generation_prompt=True, return_tensors='pt').to(self.ov_model.device)
+        cancelled = threading.Event()
         generate_cfg.update(
             dict(
                 input_ids=input_token,
                 max_new_tokens=generate_cfg.get('max_new_tokens', 2048),
-                stopping_criteria=self._get_stopping_criteria(generate_cfg=generate_cfg),
+                stopping_criteria=get_stopping_criteria(generate_cfg.get('stop'),
+                                                        self.tokenizer,
+                                                        input_token.shape[-1],
+                                                        cancelled=cancelled),
             ))
-        del generate_cfg['stop']
+        generate_cfg.pop('stop', None)
         del generate_cfg['seed']
 
-        response = self.ov_model.generate(**generate_cfg)
+        remove_callback = on_cancel(cancelled.set)
+        try:
+            with self._model_handle.use() as ov_model:
+                response = ov_model.generate(**generate_cfg)
+        finally:
+            remove_callback()
         response = response[:, len(input_token[0]):]
+        report_usage(prompt_tokens=len(input_token[0]), completion_tokens=response.shape[-1])
         answer = self.tokenizer.batch_decode(response, skip_special_tokens=True)[0]
         return [Message(ASSISTANT, answer)]
+
+    def _chat_stream_batched(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Iterator[List[Message]]:
+        generate_cfg = copy.deepcopy(generate_cfg)
+        generate_cfg.pop('seed', None)
+        messages_plain = [message.model_dump() for message in messages]
+        prompt = self.tokenizer.apply_chat_template(messages_plain, add_generation_prompt=True, tokenize=False)
+        input_ids = self.tokenizer(prompt, add_special_tokens=False)['input_ids']
+        report_usage(prompt_tokens=len(input_ids))
+
+        # Requests with the same generation config share one padded `generate()` call.
+        batch_key = json.dumps(generate_cfg, sort_keys=True, default=str)
+        request = self._batcher.submit({'input_ids': input_ids, 'generate_cfg': generate_cfg}, batch_key=batch_key)
+        remove_callback = on_cancel(request.cancel)
+        try:
+            partial_text = ''
+            for new_text in detokenize_stream(request.token_ids(), self.tokenizer):
+                partial_text += new_text
+                if delta_stream:
+                    yield [Message(ASSISTANT, new_text)]
+                else:
+                    yield [Message(ASSISTANT, partial_text)]
+        finally:
+            # Stops decoding the request at the next step if the consumer stops iterating.
+            request.cancel()
+            remove_callback()
+            report_usage(completion_tokens=request.num_tokens)
+
+    def _run_batch(self, requests: List[BatchRequest]) -> None:
+        # Runs in the thread of the batcher. The prompts are padded on the left, to continue from the right end.
+        import torch
+
+        generate_cfg = copy.deepcopy(requests[0].payload['generate_cfg'])
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        prompts = [r.payload['input_ids'] for r in requests]
+        prompt_length = max(len(ids) for ids in prompts)
+        input_ids = torch.tensor([[pad_token_id] * (prompt_length - len(ids)) + ids for ids in prompts])
+        attention_mask = torch.tensor([[0] * (prompt_length - len(ids)) + [1] * len(ids) for ids in prompts])
+
+        end_token_ids = {pad_token_id}
+        eos_token_id = getattr(self.ov_model.generation_config, 'eos_token_id', None) or self.tokenizer.eos_token_id
+        end_token_ids.update(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+        generate_cfg.update(
+            dict(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                pad_token_id=pad_token_id,
+                streamer=_BatchStreamer(requests, end_token_ids),
+                max_new_tokens=generate_cfg.get('max_new_tokens', 2048),
+                stopping_criteria=get_stopping_criteria(generate_cfg.pop('stop', None),
+                                                        self.tokenizer,
+                                                        prompt_length,
+                                                        cancelled=[r.cancelled for r in requests]),
+            ))
+        with self._model_handle.use() as ov_model:
+            ov_model.generate(**generate_cfg)
+
+
+class _BatchStreamer:
+    """The streamer of a batched `generate()` call, which puts the new token of each sequence to its request, and
+    finishes the request at its EOS token or at the padding that follows its stop word."""
+
+    def __init__(self, requests: List[BatchRequest], end_token_ids: set):
+        self.requests = requests
+        self.end_token_ids = end_token_ids
+        self._prompt = True
+
+    def put(self, value):
+        if self._prompt:
+            self._prompt = False  # The first call puts the prompts
+            return
+        for request, token_id in zip(self.requests, value.reshape(-1).tolist()):
+            if token_id in self.end_token_ids:
+                request.finish()
+            else:
+                request.put(token_id)
+
+    def end(self):
+        for request in self.requests:
+            request.finish()
+
+
+def _get_ov_config(cfg: dict, performance_hint: str) -> dict:
+    # The configured `ov_config` takes precedence over the cache directory and the performance hint.
+    ov_config = dict(cfg.get('ov_config', {}))
+    cache_dir = cfg.get('ov_cache_dir', os.getenv('QWEN_AGENT_OV_CACHE_DIR'))
+    if cache_dir is None:
+        cache_home = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'qwen_agent', 'openvino')
+    if cache_dir:
+        ov_config.setdefault('CACHE_DIR', cache_dir)
+    ov_config.setdefault('PERFORMANCE_HINT', performance_hint.upper())
+    if performance_hint == 'throughput':
+        # A batch runs in the single infer request of the model, so more CPU streams would split the cores among
+        # the idle streams instead.
+        ov_config.setdefault('NUM_STREAMS', '1')
+    return ov_config
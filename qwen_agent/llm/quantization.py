@@ -0,0 +1,180 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Dynamic int8 quantization of the local models on CPU.
+
+The weights of the Linear layers are quantized to int8 once, and the activations are quantized on the fly at each
+matmul, which runs on the int8 kernels of fbgemm (x86) or qnnpack (ARM). The decode steps on CPU are bound by reading
+the weights, so the 4x smaller weights of the Linear layers decode faster than float32, unlike the bitsandbytes
+quantization, which needs CUDA.
+
+Quantizing a 7B model takes a while, so the quantized state dict can be saved to a directory and loaded by the next
+processes into a model whose Linear layers are replaced by the quantized ones, without quantizing again.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import time
+from typing import Callable, Optional
+
+from qwen_agent.log import logger
+
+INT8_DYNAMIC = 'int8_dynamic'
+
+
+def resolve_quantization(quantization: Optional[str], device: str) -> Optional[str]:
+    """Maps the configured quantization to one that runs on the device: the bitsandbytes modes ('int8', 'int4') need
+    CUDA, so they are replaced by the dynamic int8 quantization on CPU, which in turn only runs on CPU."""
+    if not quantization or quantization == 'none':
+        return None
+    on_cpu = str(device).startswith('cpu')
+    if on_cpu and quantization in ('int8', 'int4'):
+        logger.info(f'[Quantization] Using {INT8_DYNAMIC} instead of {quantization}, since bitsandbytes needs CUDA.')
+        return INT8_DYNAMIC
+    if not on_cpu and quantization == INT8_DYNAMIC:
+        logger.warning(f'[Quantization] {INT8_DYNAMIC} only runs on CPU, so the model on {device} is not quantized.')
+        return None
+    return quantization
+
+
+def _set_quantized_engine() -> str:
+    import torch
+    supported = torch.backends.quantized.supported_engines
+    preferred = 'qnnpack' if platform.machine().lower() in ('arm64', 'aarch64') else 'fbgemm'
+    for engine in (preferred, 'x86', 'fbgemm', 'qnnpack'):
+        if engine in supported:
+            torch.backends.quantized.engine = engine
+            break
+    return torch.backends.quantized.engine
+
+
+def quantize_dynamic_int8(model):
+    """Quantizes the weights of the Linear layers of the float32 model to int8, in place."""
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    engine = _set_quantized_engine()
+    t0 = time.perf_counter()
+    model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    logger.info(f'[Quantization] Quantized the Linear layers to int8 ({engine}) in {time.perf_counter() - t0:.1f}s.')
+    return model
+
+
+def _swap_linear_for_dynamic_int8(module) -> None:
+    # Builds the same modules as `quantize_dynamic`, with empty weights that the saved state dict fills in.
+    import torch
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+    for name, child in module.named_children():
+        if type(child) is torch.nn.Linear:
+            setattr(module, name,
+                    DynamicQuantizedLinear(child.in_features,
+                                           child.out_features,
+                                           bias_=child.bias is not None,
+                                           dtype=torch.qint8))
+        else:
+            _swap_linear_for_dynamic_int8(child)
+
+
+def _weights_fingerprint(model_path: str, hf_config) -> dict:
+    # Identifies the weights being quantized, so that updated weights are quantized again.
+    files = []
+    if os.path.isdir(model_path):
+        for root, _, names in os.walk(model_path):
+            for f in sorted(names):
+                if f.endswith(('.safetensors', '.bin', 'config.json')):
+                    stat = os.stat(os.path.join(root, f))
+                    files.append([os.path.relpath(os.path.join(root, f), model_path), stat.st_size, stat.st_mtime_ns])
+    import torch
+    return {
+        'model': os.path.abspath(model_path) if os.path.isdir(model_path) else model_path,
+        'revision': getattr(hf_config, '_commit_hash', None),
+        'files': files,
+        'torch': torch.__version__,
+        'engine': torch.backends.quantized.engine,
+    }
+
+
+def load_dynamic_int8(load_float_model: Callable[[], object],
+                      model_path: str,
+                      hf_config,
+                      model_cls,
+                      save_dir: Optional[str] = None):
+    """Returns the model with its Linear layers quantized to int8.
+
+    Args:
+        load_float_model: Loads the float32 model to CPU, to be quantized.
+        model_path: The model id or directory, which identifies the saved quantized state dict with the files.
+        hf_config: The config of the model, used to build the model that loads the saved state dict.
+        model_cls: The class of the model.
+        save_dir: The directory of the saved quantized state dicts, or None to quantize at every load.
+    """
+    import torch
+
+    _set_quantized_engine()
+    if not save_dir:
+        return quantize_dynamic_int8(load_float_model())
+
+    fingerprint = _weights_fingerprint(model_path, hf_config)
+    digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()[:24]
+    path = os.path.join(save_dir, f'{os.path.basename(model_path.rstrip("/")) or "model"}-int8-{digest}.pt')
+
+    if os.path.isfile(path):
+        try:
+            t0 = time.perf_counter()
+            model = _build_empty_model(model_cls, hf_config)
+            _swap_linear_for_dynamic_int8(model)
+            # Written by `torch.save` below; the packed params of the quantized layers are not plain tensors.
+            state_dict = torch.load(path, map_location='cpu', weights_only=False)
+            model.load_state_dict(state_dict, strict=True, assign=True)
+            model.eval()
+            _load_generation_config(model, model_path)
+            logger.info(f'[Quantization] Loaded the int8 model from {path} in {time.perf_counter() - t0:.1f}s.')
+            return model
+        except Exception as e:
+            logger.warning(f'[Quantization] Failed to load the int8 model from {path}, quantizing it again: {e}')
+
+    model = quantize_dynamic_int8(load_float_model())
+    try:
+        os.makedirs(save_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.save(model.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+        logger.info(f'[Quantization] Saved the int8 model to {path}.')
+    except Exception as e:
+        logger.warning(f'[Quantization] Failed to save the int8 model to {path}: {e}')
+    return model
+
+
+def _build_empty_model(model_cls, hf_config):
+    # The parameters are allocated on the meta device where possible, and filled in by `load_state_dict(assign=True)`.
+    import torch
+    try:
+        from accelerate import init_empty_weights
+    except ImportError:
+        from transformers.modeling_utils import no_init_weights as init_empty_weights  # Allocated, not initialized
+
+    with init_empty_weights():
+        model = model_cls._from_config(hf_config, torch_dtype=torch.float32)
+    return model
+
+
+def _load_generation_config(model, model_path: str) -> None:
+    # Loaded by `from_pretrained`, but not by `_from_config`.
+    from transformers import GenerationConfig
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        pass  # The model has no generation config, so the defaults of the model config are kept
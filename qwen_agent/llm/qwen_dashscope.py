@@ -22,6 +22,7 @@ import dashscope
 
 from qwen_agent.llm.base import ModelServiceError, register_llm
 from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.metrics import report_usage
 from qwen_agent.llm.schema import ASSISTANT, FunctionCall, Message
 from qwen_agent.log import logger
 
@@ -29,6 +30,11 @@ from qwen_agent.log import logger
 @register_llm('qwen_dashscope')
 class QwenChatAtDS(BaseFnCallModel):
 
+    @property
+    def default_max_batch_size(self) -> int:
+        # `chat_batch` sends this many concurrent requests.
+        return 8
+
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
         self.model = self.model or 'qwen-max'
@@ -74,6 +80,7 @@ class QwenChatAtDS(BaseFnCallModel):
             stream=False,
             **generate_cfg)
         if response.status_code == HTTPStatus.OK:
+            report_dashscope_usage(response)
             return [
                 Message(role=ASSISTANT,
                         content=response.output.choices[0].message.content,
@@ -97,6 +104,7 @@ class QwenChatAtDS(BaseFnCallModel):
     def _delta_stream_output(response) -> Iterator[List[Message]]:
         for chunk in response:
             if chunk.status_code == HTTPStatus.OK:
+                report_dashscope_usage(chunk)
                 yield [
                     Message(role=ASSISTANT,
                             content=chunk.output.choices[0].message.content,
@@ -113,6 +121,7 @@ class QwenChatAtDS(BaseFnCallModel):
         full_tool_calls = []
         for chunk in response:
             if chunk.status_code == HTTPStatus.OK:
+                report_dashscope_usage(chunk)
                 if chunk.output.choices[0].message.get('reasoning_content', ''):
                     full_reasoning_content += chunk.output.choices[0].message.reasoning_content
                 if chunk.output.choices[0].message.content:
@@ -159,6 +168,17 @@ class QwenChatAtDS(BaseFnCallModel):
                 raise ModelServiceError(code=chunk.code, message=chunk.message, extra={'model_service_info': chunk})
 
 
+def report_dashscope_usage(response) -> None:
+    # The usage of a stream is cumulative, so the last chunk reports the usage of the whole response.
+    usage = getattr(response, 'usage', None)
+    if not usage:
+        return
+    details = usage.get('prompt_tokens_details') or {}
+    report_usage(prompt_tokens=usage.get('input_tokens'),
+                 completion_tokens=usage.get('output_tokens'),
+                 cached_tokens=details.get('cached_tokens'))
+
+
 def initialize_dashscope(cfg: Optional[Dict] = None) -> None:
     cfg = cfg or {}
 
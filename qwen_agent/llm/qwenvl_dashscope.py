@@ -24,7 +24,7 @@ import dashscope
 
 from qwen_agent.llm.base import ModelServiceError, register_llm
 from qwen_agent.llm.function_calling import BaseFnCallModel
-from qwen_agent.llm.qwen_dashscope import initialize_dashscope
+from qwen_agent.llm.qwen_dashscope import initialize_dashscope, report_dashscope_usage
 from qwen_agent.llm.schema import ASSISTANT, ContentItem, FunctionCall, Message
 from qwen_agent.log import logger
 from qwen_agent.settings import DEFAULT_WORKSPACE
@@ -38,6 +38,11 @@ class QwenVLChatAtDS(BaseFnCallModel):
     def support_multimodal_input(self) -> bool:
         return True
 
+    @property
+    def default_max_batch_size(self) -> int:
+        # `chat_batch` sends this many concurrent requests.
+        return 8
+
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
         self.model = self.model or 'qwen-vl-max'
@@ -75,6 +80,7 @@ class QwenVLChatAtDS(BaseFnCallModel):
         for chunk in response:
             # print(chunk)
             if chunk.status_code == HTTPStatus.OK:
+                report_dashscope_usage(chunk)
                 if chunk.output.choices:
                     if 'reasoning_content' in chunk.output.choices[0].message and chunk.output.choices[
                             0].message.reasoning_content:
@@ -198,6 +204,7 @@ class QwenVLChatAtDS(BaseFnCallModel):
                                                          stream=False,
                                                          **generate_cfg)
         if response.status_code == HTTPStatus.OK:
+            report_dashscope_usage(response)
             full_content = response.output.choices[0].message.content[0]['text']
             if 'reasoning_content' in response.output.choices[0].message:
                 full_reasoning_content = response.output.choices[0].message.reasoning_content
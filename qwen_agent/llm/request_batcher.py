@@ -0,0 +1,161 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A request queue that batches the concurrent requests of a local model into one `generate()` call.
+
+It is for the models whose KV cache is not accessible, e.g., the stateful models of OpenVINO, so that the continuous
+batching engine can't add requests to a running batch: a batch runs to completion, while the requests that arrive
+meanwhile wait in the queue, and those with the same batch key, e.g., the same generation config, are served by the
+next call together.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Hashable, Iterator, List, Optional
+
+from qwen_agent.log import logger
+
+_FINISHED = object()
+
+
+class BatchRequest:
+    """A request in the queue. The batch puts its new tokens to `tokens`, followed by `_FINISHED` or the error."""
+
+    def __init__(self, payload: Any, batch_key: Hashable):
+        self.payload = payload
+        self.batch_key = batch_key
+        self.tokens = queue.Queue()
+        self.num_tokens = 0
+        self.finished = False
+        self.cancelled = threading.Event()
+
+    def put(self, token_id: int) -> None:
+        if not self.finished:
+            self.num_tokens += 1
+            self.tokens.put(token_id)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Ends the token stream, e.g., at the EOS token of the request, before the rest of its batch finishes."""
+        if not self.finished:
+            self.finished = True
+            self.tokens.put(_FINISHED if error is None else error)
+
+    def cancel(self) -> None:
+        """Called by the consumer that stops early, so that the batch stops decoding the request at the next step."""
+        self.cancelled.set()
+
+    def token_ids(self) -> Iterator[int]:
+        """Yields the new tokens of the request as they are generated, raising the error of its batch, if any."""
+        while True:
+            item = self.tokens.get()
+            if item is _FINISHED:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+class RequestBatcher:
+    """Serves the requests submitted from concurrent threads in batches, one batch at a time.
+
+    Args:
+        run_batch: Generates the responses of a batch of requests, putting the new tokens of each request to it.
+        max_batch_size: The max number of requests in a batch.
+        max_wait: The seconds that a batch waits for more requests after its first one, 0 to only batch the requests
+            already waiting. It trades the latency of a request for larger batches, i.e., for throughput.
+        name: The name of the worker thread.
+    """
+
+    def __init__(self,
+                 run_batch: Callable[[List[BatchRequest]], None],
+                 max_batch_size: int,
+                 max_wait: float = 0.0,
+                 name: str = 'request-batcher'):
+        self._run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self.name = name
+        self._waiting = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.num_batches = 0
+        self.num_requests = 0
+        self.max_batch = 0
+
+    def submit(self, payload: Any, batch_key: Hashable = None) -> BatchRequest:
+        request = BatchRequest(payload, batch_key)
+        with self._cond:
+            self._waiting.append(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return request
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'batches': self.num_batches,
+                'requests': self.num_requests,
+                'avg_batch_size': self.num_requests / self.num_batches if self.num_batches else 0.0,
+                'max_batch_size': self.max_batch,
+                'waiting': len(self._waiting),
+            }
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                continue
+            with self._cond:
+                self.num_batches += 1
+                self.num_requests += len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+            try:
+                self._run_batch(batch)
+            except BaseException as e:
+                logger.warning(f'[{self.name}] A batch of {len(batch)} requests failed: {e}')
+                for request in batch:
+                    request.finish(e)
+            else:
+                for request in batch:
+                    request.finish()
+
+    def _take_batch(self) -> List[BatchRequest]:
+        # The oldest request and the next ones with its batch key, up to `max_batch_size`, in the order of arrival
+        with self._cond:
+            while not self._waiting:
+                self._cond.wait()
+            key = self._waiting[0].batch_key
+            deadline = time.monotonic() + self.max_wait
+            while self._count(key) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, rest = [], deque()
+            for request in self._waiting:
+                if request.cancelled.is_set():
+                    request.finish()  # Stopped by its consumer before it started
+                elif request.batch_key == key and len(batch) < self.max_batch_size:
+                    batch.append(request)
+                else:
+                    rest.append(request)
+            self._waiting = rest
+            return batch
+
+    def _count(self, key: Hashable) -> int:
+        return sum(1 for r in self._waiting if r.batch_key == key)
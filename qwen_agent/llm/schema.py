@@ -114,6 +114,10 @@ class ContentItem(BaseModelCompatibleDict):
         return f'ContentItem({self.model_dump()})'
 
     def get_type_and_value(self) -> Tuple[Literal['text', 'image', 'file', 'audio', 'video'], str]:
+        # Called on every content item of every streamed chunk, so text items skip model_dump.
+        if (self.text is not None) and (self.image is None) and (self.file is None) and (self.audio is None) and (
+                self.video is None):
+            return 'text', self.text
         (t, v), = self.model_dump().items()
         assert t in ('text', 'image', 'file', 'audio', 'video')
         return t, v
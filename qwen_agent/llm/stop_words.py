@@ -0,0 +1,156 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import threading
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+from qwen_agent.utils.tokenization_qwen import tokenizer
+
+
+class StopWordMatcher:
+    """Truncates texts at stop words. Use `get_stop_word_matcher` to share one matcher per list of stop words.
+
+    The stop words are applied in order, each one to the text already truncated by the previous ones, which is the
+    behavior that the responses of the LLMs have always been postprocessed with.
+    """
+
+    def __init__(self, stop: Sequence[str]):
+        # Applying the same stop word twice has no effect, so duplicates are dropped.
+        self.stop: Tuple[str, ...] = tuple(dict.fromkeys(stop))
+        self._plan = tuple((s, len(s), len(s) - 1) for s in self.stop)
+
+    def truncate(self, text: str, scanned: int = 0) -> Tuple[bool, str]:
+        """Returns whether the text contains a stop word, and the text truncated before it.
+
+        `text[:scanned]` must be known to contain no stop word, e.g., the text of the previous streamed chunk, so
+        that only the occurrences ending after it are searched for.
+        """
+        # A stop word truncates the text iff its first occurrence in the original text ends before the current cut.
+        cut = len(text)
+        for s, n, overlap in self._plan:
+            k = text.find(s, scanned - overlap if scanned > overlap else 0, cut)
+            if k >= 0:
+                cut = k
+        if cut == len(text):
+            return False, text
+        return True, text[:cut]
+
+    def contains(self, text: str) -> bool:
+        return any(s in text for s in self.stop)
+
+    @functools.cached_property
+    def partial_stop(self) -> Tuple[str, ...]:
+        """The stop words without their last token, e.g., 'Observation' for 'Observation:'.
+
+        A response may end with one of them when its stop word is still being streamed. They are sorted in the
+        reverse order of how they used to be applied, so that the first match is the one that used to win.
+        """
+        partial_stop = []
+        for s in self.stop:
+            s = tokenizer.tokenize(s)[:-1]
+            if s:
+                s = tokenizer.convert_tokens_to_string(s)
+                partial_stop.append(s)
+        return tuple(sorted(set(partial_stop), reverse=True))
+
+    def remove_partial_stop(self, text: str) -> str:
+        partial_stop = self.partial_stop
+        if partial_stop and text.endswith(partial_stop):
+            for s in partial_stop:
+                if text.endswith(s):
+                    return text[:-len(s)]
+        return text
+
+
+@functools.lru_cache(maxsize=128)
+def _get_stop_word_matcher(stop: Tuple[str, ...]) -> StopWordMatcher:
+    return StopWordMatcher(stop)
+
+
+def get_stop_word_matcher(stop: List[str]) -> StopWordMatcher:
+    return _get_stop_word_matcher(tuple(stop))
+
+
+class StopSequenceDetector:
+    """Detects the stop words in the tokens generated by a local model, as they are generated.
+
+    Only the new tokens and a window of the tokens before them are decoded at each step, instead of the whole output.
+    Every token is at least one byte of the text, so a window of as many tokens as the UTF-8 bytes of the longest stop
+    word covers a stop word that started before the new tokens.
+    """
+
+    def __init__(self, stop: Sequence[str], tokenizer: Any):
+        self.stop: Tuple[str, ...] = tuple(dict.fromkeys(s for s in stop if s))
+        self.tokenizer = tokenizer
+        self._window = max((len(s.encode('utf-8')) for s in self.stop), default=0)
+        self._scanned = 0  # The number of output tokens already scanned
+        self.stopped = False
+
+    def update(self, output_ids: List[int]) -> bool:
+        """Returns whether the output tokens generated so far contain a stop word."""
+        if self.stopped or not self.stop or len(output_ids) <= self._scanned:
+            return self.stopped
+        start = max(0, self._scanned - self._window)
+        text = self.tokenizer.decode(output_ids[start:], skip_special_tokens=False)
+        self._scanned = len(output_ids)
+        self.stopped = any(s in text for s in self.stop)
+        return self.stopped
+
+
+@functools.lru_cache(maxsize=None)
+def _stop_sequence_criteria_cls():
+    from transformers import StoppingCriteria
+
+    class StopSequenceCriteria(StoppingCriteria):
+        """Stops each sequence of a batch of `generate()` once its new tokens contain a stop word, and all of them
+        once `cancelled` is set, or each of them once its own event is set if `cancelled` has one per sequence."""
+
+        def __init__(self, stop: Sequence[str], tokenizer: Any, prompt_length: int, cancelled=None):
+            self.stop = stop or ()
+            self.tokenizer = tokenizer
+            self.prompt_length = prompt_length
+            self.cancelled = cancelled
+            self.detectors = []
+
+        def __call__(self, input_ids, scores, **kwargs):
+            import torch
+
+            if isinstance(self.cancelled, threading.Event) and self.cancelled.is_set():
+                return torch.ones(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+            while len(self.detectors) < input_ids.shape[0]:
+                self.detectors.append(StopSequenceDetector(self.stop, self.tokenizer))
+            done = [d.update(row[self.prompt_length:]) for d, row in zip(self.detectors, input_ids.tolist())]
+            if isinstance(self.cancelled, (list, tuple)):
+                done = [d or c.is_set() for d, c in zip(done, self.cancelled)]
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return StopSequenceCriteria
+
+
+def get_stopping_criteria(stop: Optional[Sequence[str]],
+                          tokenizer: Any,
+                          prompt_length: int,
+                          cancelled: Union[threading.Event, Sequence[threading.Event], None] = None):
+    """Returns the `stopping_criteria` of `generate()` of transformers that stop at the stop words, and at the next
+    step once `cancelled` is set, or None if neither is given. `cancelled` may also be a list with the event of each
+    sequence of the batch, which stops only that sequence.
+
+    The response then ends with the stop word, which the postprocessing of the LLM truncates.
+    """
+    if not (stop or cancelled):
+        return None
+    from transformers import StoppingCriteriaList
+
+    return StoppingCriteriaList([_stop_sequence_criteria_cls()(stop, tokenizer, prompt_length, cancelled)])
@@ -0,0 +1,129 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Optional
+
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.utils.tokenization_qwen import tokenizer
+from qwen_agent.utils.utils import extract_text_from_message
+
+# id(msg) -> (the fields of the message, its digest). The fields are kept to detect an assigned field, while the
+# messages of a history are otherwise not changed, since they are copy-on-write (see `derive_message`).
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def _fields(msg: Message) -> tuple:
+    return msg.role, msg.content, msg.reasoning_content, msg.name, msg.function_call, msg.extra
+
+
+def message_digest(msg: Message) -> Optional[str]:
+    """A digest of everything in the message that affects its token count, or None if it can't be serialized.
+
+    It is memoized per message, so that the history isn't serialized again on every step of an agent loop.
+    """
+    digest = _memoized_digest(msg)
+    if digest is not None:
+        return digest
+    fields = _fields(msg)
+    try:
+        data = msg.model_dump_json()
+    except Exception:
+        return None
+    digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+    with _digests_lock:
+        if id(msg) not in _digests:
+            weakref.finalize(msg, _forget_digest, id(msg))
+        _digests[id(msg)] = (fields, digest)
+    return digest
+
+
+def _memoized_digest(msg: Message) -> Optional[str]:
+    with _digests_lock:
+        memo = _digests.get(id(msg))
+    if memo is not None and all(a is b for a, b in zip(memo[0], _fields(msg))):
+        return memo[1]
+    return None
+
+
+def _forget_digest(msg_id: int) -> None:
+    with _digests_lock:
+        _digests.pop(msg_id, None)
+
+
+class MessageTokenCounter:
+    """Counts the tokens of messages, memoizing the count of each message by its content digest.
+
+    An agent loop sends the same growing history to the LLM on every step, so only the messages that are new or
+    changed since the previous step need to be tokenized.
+    """
+
+    def __init__(self, max_entries: int = 65536):
+        self.max_entries = max_entries
+        self._counts: 'OrderedDict[str, int]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.tokenizer_calls = 0
+        self.tokenizer_calls_saved = 0
+        self.serialized_messages = 0
+
+    def count(self, msg: Message) -> int:
+        key = _memoized_digest(msg)
+        serialized = key is None
+        if serialized:
+            key = message_digest(msg)
+        if key is not None:
+            with self._lock:
+                self.serialized_messages += serialized
+                n = self._counts.get(key)
+                if n is not None:
+                    self._counts.move_to_end(key)
+                    self.tokenizer_calls_saved += 1
+                    return n
+
+        n = self._count_uncached(msg)
+
+        with self._lock:
+            self.tokenizer_calls += 1
+            if key is not None:
+                self._counts[key] = n
+                while len(self._counts) > self.max_entries:
+                    self._counts.popitem(last=False)
+        return n
+
+    @staticmethod
+    def _count_uncached(msg: Message) -> int:
+        if msg.role == ASSISTANT and msg.function_call:
+            return tokenizer.count_tokens(f'{msg.function_call}')
+        return tokenizer.count_tokens(extract_text_from_message(msg, add_upload_info=True))
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'tokenizer_calls': self.tokenizer_calls,
+                'tokenizer_calls_saved': self.tokenizer_calls_saved,
+                'serialized_messages': self.serialized_messages,
+                'cached_messages': len(self._counts),
+            }
+
+
+# Shared by all LLM instances since token counts are estimated with the same Qwen tokenizer.
+message_token_counter = MessageTokenCounter()
@@ -13,17 +13,29 @@
 # limitations under the License.
 
 import copy
+import json
 import os
+import threading
+import time
 from pprint import pformat
 from threading import Thread
-from typing import Dict, Iterator, List, Optional
+from typing import Dict, Iterator, List, Optional, Sequence
 
-from qwen_agent.llm.base import register_llm
+from qwen_agent.llm.base import _ChatRequest, register_llm
+from qwen_agent.llm.cancellation import on_cancel
+from qwen_agent.llm.compile_cache import CompileCache, get_compile_cache_root, get_warmup_lengths
+from qwen_agent.llm.continuous_batching import ContinuousBatchingEngine
 from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.kv_cache import PrefixKVCache, cache_to_tensors, tensors_to_cache
+from qwen_agent.llm.metrics import report_usage
+from qwen_agent.llm.model_registry import dir_size_bytes, get_model_registry
+from qwen_agent.llm.quantization import INT8_DYNAMIC, load_dynamic_int8, resolve_quantization
 from qwen_agent.llm.schema import ASSISTANT, Message
 from qwen_agent.llm.schema import IMAGE, AUDIO, VIDEO
+from qwen_agent.llm.stop_words import get_stopping_criteria
 from qwen_agent.log import logger
-from qwen_agent.utils.hw_config import get_hw_profile, get_optimized_load_kwargs, get_generation_performance_kwargs
+from qwen_agent.utils.hw_config import (ensure_torch_optimizations, get_generation_performance_kwargs, get_hw_profile,
+                                        get_optimized_load_kwargs)
 
 
 @register_llm('transformers')
@@ -38,6 +50,34 @@ class Transformers(BaseFnCallModel):
             'device': 'cuda'           # optional: auto-detected if omitted
         }
         bot = Assistant(llm=llm_cfg, ...)
+
+    With `'continuous_batching': True` in cfg (or QWEN_AGENT_CONTINUOUS_BATCHING=true), the requests of text-only
+    models are served by one in-process engine that decodes up to `max_batch_size` sequences together (by default
+    `recommended_batch_size` of the hardware profile), adding new requests to the running batch at token boundaries.
+
+    With `'prefix_cache_max_bytes': N` in cfg (or QWEN_AGENT_PREFIX_CACHE_MAX_BYTES=N), the KV cache of the prompts of
+    text-only models is kept within N bytes, and a new prompt only prefills the part after its longest cached prefix,
+    e.g., the system message, the function descriptions and the history of the previous steps of an agent.
+
+    With `'draft_model': 'Qwen/Qwen2.5-0.5B-Instruct'` in cfg (or QWEN_AGENT_DRAFT_MODEL), a small model of the same
+    family drafts tokens that the model verifies in one forward pass (assisted generation). The output is the same,
+    faster when the draft is often right. See `assisted_decoding_stats()` for the accept rate.
+
+    With `'quantization': 'int8_dynamic'` in cfg (or QWEN_AGENT_QUANTIZATION), the Linear layers of a model on CPU are
+    quantized to int8, which is the default on CPU-only hosts, and `'quantized_model_dir': DIR` (or
+    QWEN_AGENT_QUANTIZED_MODEL_DIR) saves the quantized weights for the next processes to load. 'int8' and 'int4' use
+    bitsandbytes on CUDA, and 'none' loads the model unquantized.
+
+    With `'torch_compile': True` in cfg (or QWEN_AGENT_TORCH_COMPILE=true), the compiled artifacts are cached in
+    `compile_cache_dir` (QWEN_AGENT_COMPILE_CACHE_DIR, by default ~/.cache/qwen_agent/torch_compile, an empty string to
+    disable it), keyed by the model, dtype, torch version, GPU and warmup shapes, so that a restarted process reuses
+    them. The warmup, on by default with torch.compile, compiles the prompts of `compile_warmup_lengths` tokens (by
+    default 128, 512 and 2048, up to the max input tokens) and the decode steps, and `compile_cache_report()` compares
+    the time to the first token of the cold and the warm starts.
+
+    The instances of the same model share its weights through the model registry, which unloads the least recently
+    used models when the loaded ones exceed its memory budget, and loads them again on their next use. See
+    `qwen_agent.llm.model_registry` for the budgets and the load and evict events.
     """
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
@@ -53,8 +93,8 @@ class Transformers(BaseFnCallModel):
             raise ImportError('Could not import classes from transformers. '
                               'Please install it with `pip install -U transformers`') from e
 
-        # Detect hardware once and cache the profile
-        self._hw = get_hw_profile()
+        # Detect hardware once and cache the profile, and tune torch for it
+        self._hw = ensure_torch_optimizations()
 
         # Resolve target device: explicit cfg > env var > hw auto-detection
         self._device = cfg.get('device') or os.getenv('QWEN_AGENT_DEVICE') or self._hw.recommended_device
@@ -79,27 +119,21 @@ class Transformers(BaseFnCallModel):
         model_cls = getattr(transformers, arch)
 
         # Build hardware-optimised load kwargs (dtype, quantization, attention impl)
-        load_kwargs = get_optimized_load_kwargs(self._hw)
+        quantization = resolve_quantization(
+            cfg.get('quantization', os.getenv('QWEN_AGENT_QUANTIZATION', self._hw.recommended_quantization)),
+            self._device)
+        load_kwargs = get_optimized_load_kwargs(self._hw, quantization=quantization)
         # cfg-level overrides (e.g. explicit torch_dtype) take precedence
         if 'torch_dtype' in cfg:
-            load_kwargs['torch_dtype'] = cfg['torch_dtype']
-
-        logger.info(f'[Transformers] Loading model with kwargs: { {k: str(v) for k, v in load_kwargs.items()} }')
-        self.hf_model = model_cls.from_pretrained(
-            cfg['model'],
-            config=self.hf_config,
-            device_map=self._device if self._device != 'cpu' else None,
-            **load_kwargs,
-        )
-        if self._device == 'cpu':
-            self.hf_model = self.hf_model.to('cpu')
+            if quantization == INT8_DYNAMIC:
+                logger.warning(f'[Transformers] torch_dtype is ignored, since {INT8_DYNAMIC} quantizes float32 weights.')
+            else:
+                load_kwargs['torch_dtype'] = cfg['torch_dtype']
+        quantized_model_dir = cfg.get('quantized_model_dir', os.getenv('QWEN_AGENT_QUANTIZED_MODEL_DIR'))
 
         # Optional: torch.compile for extra ~20-30% throughput on CUDA (PyTorch >= 2.0)
         use_compile = cfg.get('torch_compile', os.getenv('QWEN_AGENT_TORCH_COMPILE', 'false').lower() == 'true')
-        if use_compile and self._hw.compile_available and self._device != 'cpu':
-            import torch
-            logger.info('[Transformers] Compiling model with torch.compile (mode=reduce-overhead)...')
-            self.hf_model = torch.compile(self.hf_model, mode='reduce-overhead')
+        use_compile = bool(use_compile and self._hw.compile_available and self._device != 'cpu')
 
         # Optional: CUDA Graph via static KV cache (transformers >= 4.45, PyTorch >= 2.1)
         # Reduces Python overhead per token by ~30-40% on RTX 5060 Ti
@@ -107,22 +141,202 @@ class Transformers(BaseFnCallModel):
             'use_static_cache',
             os.getenv('QWEN_AGENT_STATIC_CACHE', 'false').lower() == 'true',
         )
-        if use_static_cache and self._device != 'cpu' and not self._support_multimodal_input:
-            self._setup_static_cache(cfg)
+        use_static_cache = bool(use_static_cache and self._device != 'cpu' and not self._support_multimodal_input)
 
-        # Optional: KV Cache warmup – run one dummy forward pass to pre-allocate GPU memory
-        # and trigger CUDA kernel compilation before the first real request
+        # Optional: KV Cache warmup – run dummy forward passes to pre-allocate GPU memory
+        # and trigger CUDA kernel compilation before the first real request (by default with torch.compile)
         use_warmup = cfg.get(
             'warmup',
-            os.getenv('QWEN_AGENT_WARMUP', 'false').lower() == 'true',
+            os.getenv('QWEN_AGENT_WARMUP', str(use_compile)).lower() == 'true',
         )
-        if use_warmup and self._device != 'cpu':
-            self._warmup_model()
+        use_warmup = bool(use_warmup and self._device != 'cpu')
+
+        # Optional: A persistent cache of the compiled artifacts, reused by the next processes
+        warmup_lengths = [16]
+        compile_cache = None
+        if use_compile:
+            warmup_lengths = get_warmup_lengths(cfg.get('compile_warmup_lengths'),
+                                                self._hw.recommended_max_input_tokens)
+            cache_root = get_compile_cache_root(cfg.get('compile_cache_dir'))
+            if cache_root:
+                compile_cache = CompileCache(
+                    cache_root,
+                    key=_compile_cache_key(cfg['model'],
+                                           self.hf_config,
+                                           load_kwargs,
+                                           quantization=quantization,
+                                           hw=self._hw,
+                                           static_cache=use_static_cache,
+                                           warmup_lengths=warmup_lengths))
+        self._compile_cache = compile_cache
+
+        hf_config, device, hw = self.hf_config, self._device, self._hw
+
+        def _load_pretrained():
+            logger.info(f'[Transformers] Loading model with kwargs: { {k: str(v) for k, v in load_kwargs.items()} }')
+            model = model_cls.from_pretrained(
+                cfg['model'],
+                config=hf_config,
+                device_map=device if device != 'cpu' else None,
+                **load_kwargs,
+            )
+            if device == 'cpu':
+                model = model.to('cpu')
+            return model
+
+        def _load_model():
+            # Doesn't reference `self`, since the model registry keeps the loader.
+            t0 = time.perf_counter()
+            if quantization == INT8_DYNAMIC:
+                model = load_dynamic_int8(_load_pretrained,
+                                          cfg['model'],
+                                          hf_config,
+                                          model_cls,
+                                          save_dir=quantized_model_dir)
+            else:
+                model = _load_pretrained()
+            load_seconds = time.perf_counter() - t0
+            cache = compile_cache
+            if use_compile:
+                import torch
+                if cache is not None:
+                    try:
+                        cache.activate()
+                    except Exception as e:
+                        logger.warning(f'[Transformers] The compile cache is disabled: {e}')
+                        cache = None
+                logger.info('[Transformers] Compiling model with torch.compile (mode=reduce-overhead)...')
+                model = torch.compile(model, mode='reduce-overhead')
+            if use_static_cache:
+                Transformers._setup_static_cache(model, hf_config, cfg, hw)
+            if use_warmup:
+                timings = Transformers._warmup_model(model, warmup_lengths)
+                if cache is not None and timings:
+                    cache.save()
+                    record = cache.record_startup(
+                        load_seconds=load_seconds,
+                        warmup_seconds=timings['seconds'],
+                        ttft=timings['ttft'],
+                        time_to_first_token=load_seconds + timings['ttft'][str(warmup_lengths[0])],
+                    )
+                    logger.info(f'[Transformers] {record["start"].capitalize()} start: the first token after '
+                                f'{record["time_to_first_token"]:.1f}s (load {load_seconds:.1f}s), '
+                                f'the warmup took {timings["seconds"]:.1f}s.')
+            return model
+
+        # The instances of the same model share its weights, which the registry may unload to make room for others
+        self._model_handle = get_model_registry().acquire(
+            key=_model_key(cfg['model'],
+                           device,
+                           load_kwargs,
+                           quantization=quantization,
+                           compile=use_compile,
+                           static_cache=use_static_cache),
+            loader=_load_model,
+            device=device,
+            size_hint=dir_size_bytes(cfg['model']),
+        )
+
+        # Optional: Assisted generation – a small draft model proposes tokens for the model to verify
+        self._draft_handle = None
+        self._assisted_kwargs = {}
+        self._num_assistant_tokens = cfg.get('num_assistant_tokens')
+        self._assisted_stats = _AssistedDecodingStats()
+        draft_model = cfg.get('draft_model', os.getenv('QWEN_AGENT_DRAFT_MODEL'))
+        if draft_model:
+            if self._support_multimodal_input:
+                logger.warning('[Transformers] The draft model is ignored, since assisted generation does not '
+                               'support multimodal models.')
+            else:
+                self._load_draft_model(draft_model, load_kwargs)
+        self.use_draft_model = self._draft_handle is not None
 
         # Cache generation performance kwargs so we don't recompute each call
         self._gen_perf_kwargs = get_generation_performance_kwargs(self._hw)
 
-    def _setup_static_cache(self, cfg: dict):
+        # Optional: Prefix KV cache – reuse the KV cache of the prompt prefix shared with previous requests
+        prefix_cache_max_bytes = int(cfg.get('prefix_cache_max_bytes', os.getenv('QWEN_AGENT_PREFIX_CACHE_MAX_BYTES', 0)))
+        self._prefix_cache = None
+        if prefix_cache_max_bytes > 0:
+            if self._support_multimodal_input or use_static_cache:
+                logger.warning('[Transformers] The prefix KV cache is disabled, since it supports neither '
+                               'multimodal models nor the static KV cache.')
+            else:
+                self._prefix_cache = PrefixKVCache(max_bytes=prefix_cache_max_bytes,
+                                                   block_size=cfg.get('prefix_cache_block_size', 32))
+                logger.info(f'[Transformers] Prefix KV cache enabled: max_bytes={prefix_cache_max_bytes}.')
+
+        # Optional: Continuous batching – concurrent requests share the decode steps of one engine
+        use_continuous_batching = cfg.get(
+            'continuous_batching',
+            os.getenv('QWEN_AGENT_CONTINUOUS_BATCHING', 'false').lower() == 'true',
+        )
+        self._engine = None
+        if use_continuous_batching:
+            if self._support_multimodal_input or use_static_cache:
+                logger.warning('[Transformers] Continuous batching is disabled, since it supports neither '
+                               'multimodal models nor the static KV cache.')
+            else:
+                self._engine = ContinuousBatchingEngine(self._model_handle,
+                                                        self.tokenizer,
+                                                        max_batch_size=self.max_batch_size,
+                                                        prefix_cache=self._prefix_cache)
+                logger.info(f'[Transformers] Continuous batching enabled: max_batch_size={self.max_batch_size}.')
+
+    def _load_draft_model(self, draft_model: str, load_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        device = self._device
+
+        def _load_draft():
+            logger.info(f'[Transformers] Loading the draft model {draft_model} for assisted generation...')
+            model = AutoModelForCausalLM.from_pretrained(
+                draft_model,
+                device_map=device if device != 'cpu' else None,
+                **load_kwargs,
+            )
+            return model.to('cpu') if device == 'cpu' else model
+
+        self._draft_handle = get_model_registry().acquire(key=_model_key(draft_model, device, load_kwargs),
+                                                          loader=_load_draft,
+                                                          device=device,
+                                                          size_hint=dir_size_bytes(draft_model))
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_model)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            # Universal assisted generation re-tokenizes the drafts (transformers>=4.46)
+            self._assisted_kwargs.update(tokenizer=self.tokenizer, assistant_tokenizer=draft_tokenizer)
+
+    @property
+    def hf_model(self):
+        return self._model_handle.get()
+
+    def assisted_decoding_stats(self) -> Optional[dict]:
+        return self._assisted_stats.stats() if self._draft_handle is not None else None
+
+    def _generate(self, generate_cfg: dict):
+        # Calls `generate()`, with the draft model if enabled. Assisted generation only supports one sequence.
+        # The models are pinned meanwhile, so that the model registry doesn't unload them.
+        with self._model_handle.use() as model:
+            if not (self.use_draft_model and self._draft_handle is not None and
+                    generate_cfg['input_ids'].shape[0] == 1):
+                return model.generate(**generate_cfg)
+            with self._draft_handle.use() as draft:
+                if self._num_assistant_tokens:
+                    draft.generation_config.num_assistant_tokens = self._num_assistant_tokens
+                counter = self._assisted_stats.attach(target=model, draft=draft)
+                try:
+                    t0 = time.perf_counter()
+                    output = model.generate(**generate_cfg, assistant_model=draft, **self._assisted_kwargs)
+                finally:
+                    counter.remove()
+        sequences = output.sequences if generate_cfg.get('return_dict_in_generate') else output
+        self._assisted_stats.record(generated_tokens=sequences.shape[-1] - generate_cfg['input_ids'].shape[-1],
+                                    seconds=time.perf_counter() - t0,
+                                    counter=counter)
+        return output
+
+    @staticmethod
+    def _setup_static_cache(model, hf_config, cfg: dict, hw):
         """
         Enable static KV cache for CUDA Graph capture (transformers >= 4.45).
         This freezes the cache size and enables torch.cuda.graph() tracing,
@@ -131,15 +345,15 @@ class Transformers(BaseFnCallModel):
         try:
             from transformers import StaticCache
             max_batch = cfg.get('static_cache_batch_size', 1)
-            max_seq = cfg.get('static_cache_max_seq_len', self._hw.recommended_max_new_tokens * 2)
-            self.hf_model._static_cache = StaticCache(
-                config=self.hf_config,
+            max_seq = cfg.get('static_cache_max_seq_len', hw.recommended_max_new_tokens * 2)
+            model._static_cache = StaticCache(
+                config=hf_config,
                 max_batch_size=max_batch,
                 max_cache_len=max_seq,
-                device=self.hf_model.device,
-                dtype=self.hf_model.dtype,
+                device=model.device,
+                dtype=model.dtype,
             )
-            self.hf_model.generation_config.cache_implementation = 'static'
+            model.generation_config.cache_implementation = 'static'
             logger.info(
                 f'[Transformers] StaticCache enabled: batch={max_batch}, max_seq={max_seq}. '
                 f'CUDA Graph tracing will activate on first generate() call.'
@@ -147,34 +361,66 @@ class Transformers(BaseFnCallModel):
         except Exception as e:
             logger.warning(f'[Transformers] StaticCache setup failed (requires transformers>=4.45): {e}')
 
-    def _warmup_model(self):
+    @staticmethod
+    def _warmup_model(model, lengths: Sequence[int] = (16,)) -> Optional[dict]:
         """
-        Run a short dummy forward pass to:
+        Run short dummy generations to:
         1. Pre-allocate CUDA memory (avoids first-request OOM or stutter).
-        2. Trigger JIT / torch.compile kernel compilation.
+        2. Trigger JIT / torch.compile kernel compilation, for the prompts of each of `lengths` tokens and the
+           decode steps.
         3. Pre-populate the CUDA page table for KV cache buffers.
+
+        Returns the time to the first token of each prompt length and the time of the whole warmup, or None if it
+        failed.
         """
         try:
             import torch
-            logger.info('[Transformers] Running KV cache warmup pass...')
-            dummy_ids = torch.ones((1, 16), dtype=torch.long, device=self.hf_model.device)
+            logger.info(f'[Transformers] Running KV cache warmup passes for prompts of {list(lengths)} tokens...')
+            ttft = {}
+            t0 = time.perf_counter()
             with torch.no_grad():
-                self.hf_model.generate(
+                for length in lengths:
+                    dummy_ids = torch.ones((1, length), dtype=torch.long, device=model.device)
+                    t = time.perf_counter()
+                    model.generate(
+                        input_ids=dummy_ids,
+                        attention_mask=torch.ones_like(dummy_ids),
+                        max_new_tokens=1,
+                        do_sample=False,
+                        use_cache=True,
+                    )
+                    ttft[str(length)] = time.perf_counter() - t
+                # The decode steps, after the shortest prompt
+                dummy_ids = torch.ones((1, lengths[0]), dtype=torch.long, device=model.device)
+                model.generate(
                     input_ids=dummy_ids,
                     attention_mask=torch.ones_like(dummy_ids),
                     max_new_tokens=4,
                     do_sample=False,
                     use_cache=True,
                 )
+            seconds = time.perf_counter() - t0
             # Clear any intermediate allocations so real VRAM starts fresh
             torch.cuda.empty_cache()
-            logger.info('[Transformers] Warmup complete – CUDA memory pre-allocated.')
+            logger.info(f'[Transformers] Warmup complete in {seconds:.1f}s – CUDA memory pre-allocated.')
+            return {'ttft': ttft, 'seconds': seconds}
         except Exception as e:
             logger.warning(f'[Transformers] Warmup pass failed (non-fatal): {e}')
+            return None
 
     @property
     def support_multimodal_input(self) -> bool:
         return self._support_multimodal_input
+
+    def prefix_cache_stats(self) -> Optional[dict]:
+        return self._prefix_cache.stats() if self._prefix_cache is not None else None
+
+    def compile_cache_report(self) -> Optional[dict]:
+        return self._compile_cache.report() if self._compile_cache is not None else None
+
+    @property
+    def default_max_batch_size(self) -> int:
+        return get_hw_profile().recommended_batch_size
     
     @property
     def support_audio_input(self) -> bool:
@@ -190,14 +436,32 @@ class Transformers(BaseFnCallModel):
             skip_special_tokens=True,
         )
 
+    @property
+    def _pad_token_id(self) -> int:
+        pad_token_id = self.tokenizer.pad_token_id
+        return pad_token_id if pad_token_id is not None else self.tokenizer.eos_token_id
+
     def _get_inputs(self, messages: List[Message]):
+        return self._get_batch_inputs([messages])
+
+    def _get_batch_inputs(self, messages_list: List[List[Message]]):
+        # Inputs of several conversations are left-padded to the same length for batched generation.
         import torch
-        
-        messages_plain = [message.model_dump() for message in messages]
+
+        conversations = [[message.model_dump() for message in messages] for messages in messages_list]
         if not self.support_multimodal_input:
-            input_ids = self.tokenizer.apply_chat_template(messages_plain, add_generation_prompt=True, return_tensors='pt')
-            inputs = dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids))
+            if len(conversations) == 1:
+                input_ids = self.tokenizer.apply_chat_template(conversations[0], add_generation_prompt=True, return_tensors='pt')
+                inputs = dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids))
+            else:
+                prompts = [
+                    self.tokenizer.apply_chat_template(c, add_generation_prompt=True, tokenize=False)
+                    for c in conversations
+                ]
+                encoded = self.tokenizer(prompts, add_special_tokens=False)
+                inputs = _left_pad(encoded['input_ids'], self._pad_token_id)
         else:
+            messages_plain = [message for conversation in conversations for message in conversation]
             for message in messages_plain:
                 for content_item in message['content']:
                     content_item['type'] = [type_ for type_ in ('text', IMAGE, AUDIO, VIDEO) if type_ in content_item][0]
@@ -211,8 +475,11 @@ class Transformers(BaseFnCallModel):
                     if content_item['type'] in (AUDIO,):
                         audio_paths.append(content_item[AUDIO])
             
-            prompt = self.processor.apply_chat_template(messages_plain, add_generation_prompt=True, tokenize=False)
-            processor_kwargs = {'text': prompt}
+            prompts = [
+                self.processor.apply_chat_template(c, add_generation_prompt=True, tokenize=False)
+                for c in conversations
+            ]
+            processor_kwargs = {'text': prompts[0] if len(prompts) == 1 else prompts}
             
             if has_vision:
                 from qwen_vl_utils import process_vision_info
@@ -232,7 +499,11 @@ class Transformers(BaseFnCallModel):
                         audios.append(librosa.load(path, sr=self.processor.feature_extractor.sampling_rate)[0])
                 processor_kwargs['audios'] = audios
             
-            inputs = self.processor(**processor_kwargs, return_tensors="pt")
+            if len(prompts) == 1:
+                inputs = self.processor(**processor_kwargs, return_tensors="pt")
+            else:
+                # The padding side is passed per call, since the processor is shared by concurrent requests.
+                inputs = self.processor(**processor_kwargs, padding=True, padding_side='left', return_tensors="pt")
 
         for k, v in inputs.items():
             if torch.is_tensor(v):
@@ -247,6 +518,10 @@ class Transformers(BaseFnCallModel):
     ) -> Iterator[List[Message]]:
         generate_cfg = copy.deepcopy(generate_cfg)
         inputs = self._get_inputs(messages)
+        report_usage(prompt_tokens=inputs['input_ids'].size(-1))
+        if self._engine is not None:
+            yield from self._engine_stream(inputs, delta_stream=delta_stream, generate_cfg=generate_cfg)
+            return
         streamer = self._get_streamer()
 
         generate_cfg.update(inputs)
@@ -255,33 +530,112 @@ class Transformers(BaseFnCallModel):
             max_new_tokens=generate_cfg.get('max_new_tokens', self._hw.recommended_max_new_tokens),
         ))
         generate_cfg.update(self._gen_perf_kwargs)
+        self._use_prefix_cache(inputs, generate_cfg)
 
         if 'seed' in generate_cfg:
             from transformers import set_seed
             set_seed(generate_cfg['seed'])
             del generate_cfg['seed']
+        cancelled = threading.Event()
+        generate_cfg['stopping_criteria'] = get_stopping_criteria(generate_cfg.pop('stop', None),
+                                                                  self.tokenizer,
+                                                                  inputs['input_ids'].size(-1),
+                                                                  cancelled=cancelled)
 
         def generate_and_signal_complete():
-            self.hf_model.generate(**generate_cfg)
+            self._store_prefix(self._generate(generate_cfg))
 
         t1 = Thread(target=generate_and_signal_complete)
         t1.start()
-        partial_text = ''
-        for new_text in streamer:
-            partial_text += new_text
-            if delta_stream:
-                yield [Message(ASSISTANT, new_text)]
-            else:
-                yield [Message(ASSISTANT, partial_text)]
+        remove_callback = on_cancel(cancelled.set)
+        try:
+            partial_text = ''
+            for new_text in streamer:
+                partial_text += new_text
+                if delta_stream:
+                    yield [Message(ASSISTANT, new_text)]
+                else:
+                    yield [Message(ASSISTANT, partial_text)]
+        finally:
+            # Stops decoding at the next step if the consumer stops iterating.
+            cancelled.set()
+            remove_callback()
 
     def _chat_no_stream(
         self,
         messages: List[Message],
         generate_cfg: dict,
     ) -> List[Message]:
+        if self._engine is not None:
+            *_, output = self._chat_stream(messages, delta_stream=False, generate_cfg=generate_cfg)
+            return output
+        return self._chat_no_stream_batch([messages], generate_cfg=generate_cfg)[0]
+
+    def _engine_stream(self, inputs: dict, delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        generate_cfg.setdefault('max_new_tokens', self._hw.recommended_max_new_tokens)
+        seq = self._engine.submit(inputs['input_ids'][0].tolist(), generate_cfg)
+        remove_callback = on_cancel(seq.cancel)
+        try:
+            partial_text = ''
+            for new_text in self._engine.stream(seq):
+                partial_text += new_text
+                if delta_stream:
+                    yield [Message(ASSISTANT, new_text)]
+                else:
+                    yield [Message(ASSISTANT, partial_text)]
+        finally:
+            remove_callback()
+        report_usage(cached_tokens=seq.cached_tokens)
+        if not partial_text:
+            yield [Message(ASSISTANT, '')]
+
+    def _use_prefix_cache(self, inputs: dict, generate_cfg: dict) -> None:
+        # `generate()` continues from the KV cache of the longest cached prefix, so only the rest is prefilled.
+        if self._prefix_cache is None:
+            return
+        length, kv = self._prefix_cache.lookup(inputs['input_ids'][0].tolist())
+        report_usage(cached_tokens=length)
+        if kv is not None:
+            generate_cfg['past_key_values'] = tensors_to_cache(kv)
+        generate_cfg['return_dict_in_generate'] = True
+
+    def _store_prefix(self, output) -> None:
+        if self._prefix_cache is not None:
+            # The KV cache covers the prompt and the generated tokens but the last one.
+            self._prefix_cache.store(output.sequences[0].tolist(), cache_to_tensors(output.past_key_values))
+
+    def _chat_batch(self, reqs: List[_ChatRequest]) -> List[List[Message]]:
+        model_inputs = [self._get_model_input(req) for req in reqs]
+        if self._engine is not None:
+            # All requests are submitted first, so that the engine decodes them together.
+            seqs = []
+            for messages, generate_cfg in model_inputs:
+                generate_cfg = {'max_new_tokens': self._hw.recommended_max_new_tokens, **generate_cfg}
+                seqs.append(self._engine.submit(self._get_inputs(messages)['input_ids'][0].tolist(), generate_cfg))
+            return [[Message(ASSISTANT, ''.join(self._engine.stream(seq)))] for seq in seqs]
+
+        # Requests with the same generation config share one padded `generate()` call.
+        groups = {}
+        for i, (_, generate_cfg) in enumerate(model_inputs):
+            key = json.dumps({k: v for k, v in generate_cfg.items() if k != 'seed'}, sort_keys=True, default=str)
+            groups.setdefault(key, []).append(i)
+
+        outputs = [None] * len(reqs)
+        for indices in groups.values():
+            generate_cfg = model_inputs[indices[0]][1]
+            batch_outputs = self._chat_no_stream_batch([model_inputs[i][0] for i in indices], generate_cfg=generate_cfg)
+            for i, output in zip(indices, batch_outputs):
+                outputs[i] = output
+        return outputs
+
+    def _chat_no_stream_batch(
+        self,
+        messages_list: List[List[Message]],
+        generate_cfg: dict,
+    ) -> List[List[Message]]:
         generate_cfg = copy.deepcopy(generate_cfg)
 
-        inputs = self._get_inputs(messages)
+        inputs = self._get_batch_inputs(messages_list)
         generate_cfg.update(inputs)
         generate_cfg.update(dict(
             max_new_tokens=generate_cfg.get('max_new_tokens', self._hw.recommended_max_new_tokens),
@@ -292,8 +646,129 @@ class Transformers(BaseFnCallModel):
             from transformers import set_seed
             set_seed(generate_cfg['seed'])
             del generate_cfg['seed']
+        cancelled = threading.Event()
+        generate_cfg['stopping_criteria'] = get_stopping_criteria(generate_cfg.pop('stop', None),
+                                                                  self.tokenizer,
+                                                                  inputs['input_ids'].size(-1),
+                                                                  cancelled=cancelled)
+
+        if len(messages_list) > 1:
+            generate_cfg.setdefault('pad_token_id', self._pad_token_id)
+        else:
+            self._use_prefix_cache(inputs, generate_cfg)
 
-        response = self.hf_model.generate(**generate_cfg)
+        remove_callback = on_cancel(cancelled.set)
+        try:
+            response = self._generate(generate_cfg)
+        finally:
+            remove_callback()
+        if generate_cfg.get('return_dict_in_generate'):
+            self._store_prefix(response)
+            response = response.sequences
         response = response[:, inputs['input_ids'].size(-1):]
-        answer = self.tokenizer.batch_decode(response, skip_special_tokens=True)[0]
-        return [Message(ASSISTANT, answer)]
+        answers = self.tokenizer.batch_decode(response, skip_special_tokens=True)
+        return [[Message(ASSISTANT, answer)] for answer in answers]
+
+
+def _left_pad(input_ids_list: List[List[int]], pad_token_id: int) -> dict:
+    # Decoder-only models continue generating from the right end, so the prompts of a batch are padded on the left.
+    # Padded by hand rather than by the tokenizer, which is shared by concurrent requests.
+    import torch
+
+    length = max(len(ids) for ids in input_ids_list)
+    input_ids = torch.tensor([[pad_token_id] * (length - len(ids)) + list(ids) for ids in input_ids_list])
+    attention_mask = torch.tensor([[0] * (length - len(ids)) + [1] * len(ids) for ids in input_ids_list])
+    return dict(input_ids=input_ids, attention_mask=attention_mask)
+
+
+def _model_key(model: str, device: str, load_kwargs: dict, **options) -> tuple:
+    # The weights are shared by the instances that load the same model to the same device in the same way.
+    quantization = load_kwargs.get('quantization_config')
+    if hasattr(quantization, 'to_json_string'):
+        quantization = quantization.to_json_string(use_diff=True)
+    return (model, device, str(load_kwargs.get('torch_dtype')), str(quantization),
+            load_kwargs.get('attn_implementation'), tuple(sorted(options.items())))
+
+
+def _compile_cache_key(model: str, hf_config, load_kwargs: dict, quantization: Optional[str], hw, **options) -> dict:
+    # What the graphs and kernels compiled for the model depend on
+    import torch
+    import transformers
+
+    return {
+        'model': os.path.abspath(model) if os.path.isdir(model) else model,
+        'revision': getattr(hf_config, '_commit_hash', None),
+        'dtype': str(load_kwargs.get('torch_dtype')),
+        'quantization': quantization,
+        'attn_implementation': load_kwargs.get('attn_implementation'),
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'gpu': hw.gpu_name,
+        'compute_capability': hw.gpu_compute_capability,
+        'mode': 'reduce-overhead',
+        **options,
+    }
+
+
+class _AssistedDecodingStats:
+    """Estimates the accept rate of assisted generation from the forward passes of the two models: every verification
+    step is one forward pass of the model, which accepts some of the draft tokens and adds one token of its own."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._generated_tokens = 0
+        self._accepted_tokens = 0
+        self._drafted_tokens = 0
+        self._verify_steps = 0
+        self._seconds = 0.0
+
+    def attach(self, target, draft) -> '_ForwardCounter':
+        # Counts the forward passes of one `generate()` call, which runs on the calling thread.
+        return _ForwardCounter(target, draft)
+
+    def record(self, generated_tokens: int, seconds: float, counter: '_ForwardCounter') -> None:
+        verify_steps = counter.target_forwards
+        with self._lock:
+            self._calls += 1
+            self._generated_tokens += generated_tokens
+            self._accepted_tokens += max(0, generated_tokens - verify_steps)
+            self._drafted_tokens += counter.draft_forwards
+            self._verify_steps += verify_steps
+            self._seconds += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'generated_tokens': self._generated_tokens,
+                'drafted_tokens': self._drafted_tokens,
+                'accepted_tokens': self._accepted_tokens,
+                'accept_rate': (self._accepted_tokens / self._drafted_tokens) if self._drafted_tokens else 0.0,
+                'tokens_per_verify_step': (self._generated_tokens / self._verify_steps) if self._verify_steps else 0.0,
+                'tokens_per_second': (self._generated_tokens / self._seconds) if self._seconds else 0.0,
+            }
+
+
+class _ForwardCounter:
+    """Counts the forward passes of the two models made by the thread that attached it. The hooks see the passes of
+    all the concurrent calls, since the models are shared by the instances and the threads, and are removed after
+    the call."""
+
+    def __init__(self, target, draft):
+        self.thread_id = threading.get_ident()
+        self.target_forwards = 0
+        self.draft_forwards = 0
+        self._hooks = [target.register_forward_hook(self._on_target), draft.register_forward_hook(self._on_draft)]
+
+    def _on_target(self, *_) -> None:
+        if threading.get_ident() == self.thread_id:
+            self.target_forwards += 1
+
+    def _on_draft(self, *_) -> None:
+        if threading.get_ident() == self.thread_id:
+            self.draft_forwards += 1
+
+    def remove(self) -> None:
+        for hook in self._hooks:
+            hook.remove()
@@ -18,12 +18,11 @@ from typing import Dict, Iterator, List, Optional, Union
 
 import json5
 
-from qwen_agent import Agent
+from qwen_agent import Agent, settings
 from qwen_agent.llm import BaseChatModel
 from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, USER, Message
 from qwen_agent.log import logger
-from qwen_agent.settings import (DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_KEYGEN_STRATEGY,
-                                 DEFAULT_RAG_SEARCHERS)
+from qwen_agent.settings import DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_KEYGEN_STRATEGY, DEFAULT_RAG_SEARCHERS
 from qwen_agent.tools import BaseTool
 from qwen_agent.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
 from qwen_agent.utils.utils import extract_files_from_messages, extract_text_from_message, get_file_type
@@ -54,7 +53,7 @@ class Memory(Agent):
               And the above is the default settings.
         """
         self.cfg = rag_cfg or {}
-        self.max_ref_token: int = self.cfg.get('max_ref_token', DEFAULT_MAX_REF_TOKEN)
+        self.max_ref_token: int = self.cfg.get('max_ref_token', settings.DEFAULT_MAX_REF_TOKEN)
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
         self.rag_searchers = self.cfg.get('rag_searchers', DEFAULT_RAG_SEARCHERS)
         self.rag_keygen_strategy = self.cfg.get('rag_keygen_strategy', DEFAULT_RAG_KEYGEN_STRATEGY)
@@ -46,7 +46,7 @@ def _hw_default_max_ref_token() -> int:
 
 
 # Settings for LLMs
-DEFAULT_MAX_INPUT_TOKENS: int = _hw_default_max_input_tokens()  # The LLM will truncate the input messages if they exceed this limit
+DEFAULT_MAX_INPUT_TOKENS: int  # The LLM will truncate the input messages if they exceed this limit (see `__getattr__`)
 
 # Settings for agents
 MAX_LLM_CALL_PER_RUN: int = int(os.getenv('QWEN_AGENT_MAX_LLM_CALL_PER_RUN', 20))
@@ -55,7 +55,7 @@ MAX_LLM_CALL_PER_RUN: int = int(os.getenv('QWEN_AGENT_MAX_LLM_CALL_PER_RUN', 20)
 DEFAULT_WORKSPACE: str = os.getenv('QWEN_AGENT_DEFAULT_WORKSPACE', 'workspace')
 
 # Settings for RAG
-DEFAULT_MAX_REF_TOKEN: int = _hw_default_max_ref_token()  # The window size reserved for RAG materials
+DEFAULT_MAX_REF_TOKEN: int  # The window size reserved for RAG materials (see `__getattr__`)
 DEFAULT_PARSER_PAGE_SIZE: int = int(os.getenv('QWEN_AGENT_DEFAULT_PARSER_PAGE_SIZE',
                                               500))  # Max tokens per chunk when doing RAG
 DEFAULT_RAG_KEYGEN_STRATEGY: Literal['None', 'GenKeyword', 'SplitQueryThenGenKeyword', 'GenKeywordWithKnowledge',
@@ -64,3 +64,17 @@ DEFAULT_RAG_KEYGEN_STRATEGY: Literal['None', 'GenKeyword', 'SplitQueryThenGenKey
 DEFAULT_RAG_SEARCHERS: List[str] = ast.literal_eval(
     os.getenv('QWEN_AGENT_DEFAULT_RAG_SEARCHERS',
               "['keyword_search', 'front_page_search']"))  # Sub-searchers for hybrid retrieval
+
+# The settings that depend on the hardware are resolved on first access, so that importing the settings doesn't probe
+# the hardware, e.g., in the processes of the servers and the tools that don't run models.
+_HW_DEPENDENT_SETTINGS = {
+    'DEFAULT_MAX_INPUT_TOKENS': _hw_default_max_input_tokens,
+    'DEFAULT_MAX_REF_TOKEN': _hw_default_max_ref_token,
+}
+
+
+def __getattr__(name: str):
+    if name in _HW_DEPENDENT_SETTINGS:
+        value = globals()[name] = _HW_DEPENDENT_SETTINGS[name]()
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -12,22 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .amap_weather import AmapWeather
+from qwen_agent.utils.registry import lazy_module_getattr
+
 from .base import TOOL_REGISTRY, BaseTool
-from .code_interpreter import CodeInterpreter
-from .doc_parser import DocParser
-from .extract_doc_vocabulary import ExtractDocVocabulary
-from .image_gen import ImageGen
-from .python_executor import PythonExecutor
-from .retrieval import Retrieval
-from .image_zoom_in_qwen3vl import ImageZoomInToolQwen3VL
-from .image_search import ImageSearch
-from .search_tools import FrontPageSearch, HybridSearch, KeywordSearch, VectorSearch
-from .simple_doc_parser import SimpleDocParser
-from .storage import Storage
-from .web_extractor import WebExtractor
-from .mcp_manager import MCPManager
-from .web_search import WebSearch
+
+# The tools are imported on first use, e.g., `from qwen_agent.tools import CodeInterpreter` or a lookup in TOOL_REGISTRY
+__getattr__ = lazy_module_getattr(
+    __name__, {
+        'AmapWeather': '.amap_weather',
+        'CodeInterpreter': '.code_interpreter',
+        'DocParser': '.doc_parser',
+        'ExtractDocVocabulary': '.extract_doc_vocabulary',
+        'ImageGen': '.image_gen',
+        'PythonExecutor': '.python_executor',
+        'Retrieval': '.retrieval',
+        'ImageZoomInToolQwen3VL': '.image_zoom_in_qwen3vl',
+        'ImageSearch': '.image_search',
+        'FrontPageSearch': '.search_tools',
+        'HybridSearch': '.search_tools',
+        'KeywordSearch': '.search_tools',
+        'VectorSearch': '.search_tools',
+        'SimpleDocParser': '.simple_doc_parser',
+        'Storage': '.storage',
+        'WebExtractor': '.web_extractor',
+        'MCPManager': '.mcp_manager',
+        'WebSearch': '.web_search',
+    })
 
 __all__ = [
     'BaseTool',
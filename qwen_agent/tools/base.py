@@ -19,9 +19,29 @@ from typing import Dict, List, Optional, Union
 
 from qwen_agent.llm.schema import ContentItem
 from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.utils.registry import LazyRegistry
 from qwen_agent.utils.utils import has_chinese_chars, json_loads, logger, print_traceback, save_url_to_local_work_dir
 
-TOOL_REGISTRY = {}
+# The built-in tools, whose modules are imported when they are first looked up
+TOOL_REGISTRY = LazyRegistry(
+    'Tool', {
+        'amap_weather': 'qwen_agent.tools.amap_weather',
+        'code_interpreter': 'qwen_agent.tools.code_interpreter',
+        'doc_parser': 'qwen_agent.tools.doc_parser',
+        'extract_doc_vocabulary': 'qwen_agent.tools.extract_doc_vocabulary',
+        'front_page_search': 'qwen_agent.tools.search_tools.front_page_search',
+        'hybrid_search': 'qwen_agent.tools.search_tools.hybrid_search',
+        'image_gen': 'qwen_agent.tools.image_gen',
+        'image_search': 'qwen_agent.tools.image_search',
+        'image_zoom_in_tool': 'qwen_agent.tools.image_zoom_in_qwen3vl',
+        'keyword_search': 'qwen_agent.tools.search_tools.keyword_search',
+        'retrieval': 'qwen_agent.tools.retrieval',
+        'simple_doc_parser': 'qwen_agent.tools.simple_doc_parser',
+        'storage': 'qwen_agent.tools.storage',
+        'vector_search': 'qwen_agent.tools.search_tools.vector_search',
+        'web_extractor': 'qwen_agent.tools.web_extractor',
+        'web_search': 'qwen_agent.tools.web_search',
+    })
 
 
 class ToolServiceError(Exception):
@@ -44,6 +64,14 @@ class ToolServiceError(Exception):
 def register_tool(name, allow_overwrite=False):
 
     def decorator(cls):
+        if TOOL_REGISTRY.is_builtin(name, cls):
+            # Its module is imported on the first lookup, after which a tool registered meanwhile to overwrite it stays
+            if cls.name and (cls.name != name):
+                raise ValueError(f'{cls.__name__}.name="{cls.name}" conflicts with @register_tool(name="{name}").')
+            cls.name = name
+            if not TOOL_REGISTRY.is_loaded(name):
+                TOOL_REGISTRY[name] = cls
+            return cls
         if name in TOOL_REGISTRY:
             if allow_overwrite:
                 logger.warning(f'Tool `{name}` already exists! Overwriting with class {cls}.')
@@ -20,8 +20,9 @@ from typing import Dict, List, Optional, Union
 
 from pydantic import BaseModel
 
+from qwen_agent import settings
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_WORKSPACE
+from qwen_agent.settings import DEFAULT_PARSER_PAGE_SIZE, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import BaseTool, register_tool
 from qwen_agent.tools.simple_doc_parser import PARAGRAPH_SPLIT_SYMBOL, SimpleDocParser, get_plain_doc
 from qwen_agent.tools.storage import KeyNotExistsError, Storage
@@ -69,7 +70,7 @@ class DocParser(BaseTool):
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
-        self.max_ref_token: int = self.cfg.get('max_ref_token', DEFAULT_MAX_REF_TOKEN)
+        self.max_ref_token: int = self.cfg.get('max_ref_token', settings.DEFAULT_MAX_REF_TOKEN)
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
 
         self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
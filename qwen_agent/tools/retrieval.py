@@ -16,7 +16,8 @@ from typing import Dict, Optional, Union
 
 import json5
 
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_SEARCHERS
+from qwen_agent import settings
+from qwen_agent.settings import DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_SEARCHERS
 from qwen_agent.tools.base import TOOL_REGISTRY, BaseTool, register_tool
 from qwen_agent.tools.doc_parser import DocParser, Record
 from qwen_agent.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
@@ -65,7 +66,7 @@ class Retrieval(BaseTool):
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
-        self.max_ref_token: int = self.cfg.get('max_ref_token', DEFAULT_MAX_REF_TOKEN)
+        self.max_ref_token: int = self.cfg.get('max_ref_token', settings.DEFAULT_MAX_REF_TOKEN)
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
         self.doc_parse = DocParser({'max_ref_token': self.max_ref_token, 'parser_page_size': self.parser_page_size})
 
@@ -17,8 +17,8 @@ from typing import Dict, List, Optional, Tuple, Union
 
 from pydantic import BaseModel
 
+from qwen_agent import settings
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN
 from qwen_agent.tools.base import BaseTool
 from qwen_agent.tools.doc_parser import DocParser, Record
 from qwen_agent.utils.tokenization_qwen import count_tokens, tokenizer
@@ -51,7 +51,7 @@ class BaseSearch(BaseTool):
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
-        self.max_ref_token: int = self.cfg.get('max_ref_token', DEFAULT_MAX_REF_TOKEN)
+        self.max_ref_token: int = self.cfg.get('max_ref_token', settings.DEFAULT_MAX_REF_TOKEN)
 
     def call(self, params: Union[str, dict], docs: List[Union[Record, str, List[str]]] = None, **kwargs) -> list:
         """The basic search algorithm
@@ -86,7 +86,9 @@ class BaseSearch(BaseTool):
 
         return self.search(query=query, docs=new_docs, max_ref_token=max_ref_token)
 
-    def search(self, query: str, docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
+    def search(self, query: str, docs: List[Record], max_ref_token: Optional[int] = None) -> list:
+        if max_ref_token is None:
+            max_ref_token = settings.DEFAULT_MAX_REF_TOKEN
         chunk_and_score = self.sort_by_scores(query=query, docs=docs, max_ref_token=max_ref_token)
         return self.get_topk(chunk_and_score=chunk_and_score, docs=docs, max_ref_token=max_ref_token)
 
@@ -107,7 +109,9 @@ class BaseSearch(BaseTool):
     def get_topk(self,
                  chunk_and_score: List[Tuple[str, int, float]],
                  docs: List[Record],
-                 max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
+                 max_ref_token: Optional[int] = None) -> list:
+        if max_ref_token is None:
+            max_ref_token = settings.DEFAULT_MAX_REF_TOKEN
         available_token = max_ref_token
 
         docs_retrieved = {}  # [{'url': 'doc id', 'text': ['', '', ...]}]
@@ -163,7 +167,9 @@ class BaseSearch(BaseTool):
         return new_docs, all_tokens
 
     @staticmethod
-    def _get_the_front_part(docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
+    def _get_the_front_part(docs: List[Record], max_ref_token: Optional[int] = None) -> list:
+        if max_ref_token is None:
+            max_ref_token = settings.DEFAULT_MAX_REF_TOKEN
         single_max_ref_token = int(max_ref_token / len(docs))
         _ref_list = []
         for doc in docs:
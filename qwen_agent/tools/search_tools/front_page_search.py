@@ -13,9 +13,9 @@
 # limitations under the License.
 
 import math
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN
+from qwen_agent import settings
 from qwen_agent.tools.base import register_tool
 from qwen_agent.tools.doc_parser import Record
 from qwen_agent.tools.search_tools.base_search import BaseSearch
@@ -30,8 +30,10 @@ class FrontPageSearch(BaseSearch):
     def sort_by_scores(self,
                        query: str,
                        docs: List[Record],
-                       max_ref_token: int = DEFAULT_MAX_REF_TOKEN,
+                       max_ref_token: Optional[int] = None,
                        **kwargs) -> List[Tuple[str, int, float]]:
+        if max_ref_token is None:
+            max_ref_token = settings.DEFAULT_MAX_REF_TOKEN
         if len(docs) > 1:
             # This is a trick for improving performance for one doc
             # It is not recommended to splice multiple documents directly, so return [], which will not effect the rank
@@ -14,12 +14,11 @@
 
 import re
 import string
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import json5
 
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN
 from qwen_agent.tools.base import register_tool
 from qwen_agent.tools.doc_parser import Record
 from qwen_agent.tools.search_tools.base_search import BaseSearch
@@ -29,7 +28,7 @@ from qwen_agent.utils.utils import has_chinese_chars
 @register_tool('keyword_search')
 class KeywordSearch(BaseSearch):
 
-    def search(self, query: str, docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
+    def search(self, query: str, docs: List[Record], max_ref_token: Optional[int] = None) -> list:
         chunk_and_score = self.sort_by_scores(query=query, docs=docs)
         if not chunk_and_score:
             return self._get_the_front_part(docs, max_ref_token)
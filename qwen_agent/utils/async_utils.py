@@ -0,0 +1,75 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextvars
+import functools
+from typing import Any, AsyncIterator, Callable, Iterable, TypeVar
+
+T = TypeVar('T')
+
+_EXHAUSTED = object()
+
+
+async def run_in_threadpool(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking function in the event loop's default executor, with the context variables of the caller."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, contextvars.copy_context().run, functools.partial(fn, *args, **kwargs))
+
+
+async def iterate_in_threadpool(fn: Callable[..., Iterable[T]], *args, **kwargs) -> AsyncIterator[T]:
+    """Adapt a blocking iterator to an async iterator.
+
+    `fn(*args, **kwargs)` is called in the default executor, since sync backends often send the request before
+    returning the iterator, and then each item is fetched in the executor too. The event loop is never blocked, but
+    a thread is held while an item is being produced. Like `run_in_threadpool`, each call sees the context variables
+    of the caller at that time.
+    """
+    loop = asyncio.get_running_loop()
+    iterator, pending = None, None
+    try:
+        pending = loop.run_in_executor(None, contextvars.copy_context().run, lambda: iter(fn(*args, **kwargs)))
+        iterator = await pending
+        while True:
+            pending = loop.run_in_executor(None, contextvars.copy_context().run, next, iterator, _EXHAUSTED)
+            item = await pending
+            if item is _EXHAUSTED:
+                break
+            yield item
+    finally:
+        # Release the resources of the sync iterator (e.g., the HTTP stream) when the consumer stops early.
+        _close_when_done(iterator, pending)
+
+
+def _close_when_done(iterator: Any, pending: 'asyncio.Future') -> None:
+    if pending is not None and not pending.done():
+        # The worker thread is still inside `next()`. Closing a running generator raises, so close it afterwards.
+        def _on_done(fut: 'asyncio.Future'):
+            it = iterator
+            if it is None and (not fut.cancelled()) and (fut.exception() is None):
+                it = fut.result()
+            if it is not None:
+                _close_when_done(it, None)
+
+        pending.add_done_callback(_on_done)
+        return
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+async def iterate_sync(iterator: Iterable[T]) -> AsyncIterator[T]:
+    """Wrap a non-blocking iterator (e.g., over data already in memory) as an async iterator."""
+    for item in iterator:
+        yield item
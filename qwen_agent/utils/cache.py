@@ -0,0 +1,242 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Layered key-value caches.
+
+A bounded in-process LRU tier sits in front of an optional `diskcache` tier, so that hot entries are served
+without touching SQLite. Keys are fixed-size digests of a canonical serialization, see `make_cache_key`.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from qwen_agent.log import logger
+from qwen_agent.utils.utils import json_dumps_compact, print_traceback
+
+DEFAULT_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def make_cache_key(obj: Any, namespace: str = '') -> str:
+    """Return a sha256 hex digest of the canonical (sorted-keys, compact) JSON form of `obj`."""
+    if isinstance(obj, str):
+        data = obj
+    else:
+        data = json_dumps_compact(obj, sort_keys=True)
+    digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    if namespace:
+        return f'{namespace}:{digest}'
+    return digest
+
+
+def _sizeof(key: str, value: Any) -> int:
+    if isinstance(value, str):
+        size = len(value.encode('utf-8'))
+    elif isinstance(value, (bytes, bytearray)):
+        size = len(value)
+    else:
+        size = len(json_dumps_compact(value).encode('utf-8'))
+    return size + len(key)
+
+
+class MemoryLRUCache:
+    """A thread-safe LRU cache bounded by the total byte size of its entries, with optional TTL."""
+
+    def __init__(self, max_bytes: int = DEFAULT_MEMORY_CACHE_BYTES, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data: 'OrderedDict[str, Tuple[Any, int, Optional[float]]]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, size, expire_at = entry
+            if (expire_at is not None) and (expire_at <= time.time()):
+                self._pop(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, expire: Optional[float] = None) -> bool:
+        size = _sizeof(key, value)
+        if size > self.max_bytes:
+            # Never let a single entry flush the whole tier.
+            return False
+        expire = self.ttl if expire is None else expire
+        expire_at = (time.time() + expire) if expire else None
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, size, expire_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                old_key = next(iter(self._data))
+                self._pop(old_key)
+                self.evictions += 1
+        return True
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _pop(self, key: str) -> bool:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[1]
+        return True
+
+    @property
+    def num_bytes(self) -> int:
+        return self._bytes
+
+    @property
+    def num_items(self) -> int:
+        return len(self._data)
+
+
+class TwoTierCache:
+    """An in-process LRU tier in front of an optional disk tier.
+
+    Lookups check memory first and fall back to disk; disk hits are promoted into memory, for no longer than they
+    have left on disk. Writes go to both tiers.
+
+    Args:
+        max_memory_bytes: Byte budget of the memory tier. Set to 0 to disable the memory tier.
+        cache_dir: Directory of the disk tier. The disk tier is disabled if omitted or if diskcache is not installed.
+        disk_size_limit: Byte budget of the disk tier, enforced by diskcache with least-recently-used eviction.
+        ttl: Time-to-live in seconds for new entries in both tiers. None means no expiry.
+    """
+
+    def __init__(self,
+                 max_memory_bytes: int = DEFAULT_MEMORY_CACHE_BYTES,
+                 cache_dir: Optional[str] = None,
+                 disk_size_limit: Optional[int] = None,
+                 ttl: Optional[float] = None):
+        self.ttl = ttl
+        self.memory = MemoryLRUCache(max_bytes=max_memory_bytes, ttl=ttl) if max_memory_bytes > 0 else None
+
+        self.disk = None
+        if cache_dir:
+            try:
+                import diskcache
+            except ImportError:
+                print_traceback(is_error=False)
+                logger.warning('Disk caching disabled because diskcache is not installed. '
+                               'Please `pip install diskcache`.')
+            else:
+                os.makedirs(cache_dir, exist_ok=True)
+                disk_kwargs = {'eviction_policy': 'least-recently-used'}
+                if disk_size_limit:
+                    disk_kwargs['size_limit'] = disk_size_limit
+                self.disk = diskcache.Cache(directory=cache_dir, **disk_kwargs)
+
+        self._stats_lock = threading.Lock()
+        self._hits_memory = 0
+        self._hits_disk = 0
+        self._misses = 0
+        self._sets = 0
+
+    @property
+    def enabled(self) -> bool:
+        return (self.memory is not None) or (self.disk is not None)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                self._incr('_hits_memory')
+                return value
+        if self.disk is not None:
+            value, expire_at = self.disk.get(key, expire_time=True)
+            if value is not None:
+                self._incr('_hits_disk')
+                if self.memory is not None:
+                    self._promote(key, value, expire_at)
+                return value
+        self._incr('_misses')
+        return default
+
+    def _promote(self, key: str, value: Any, expire_at: Optional[float]):
+        # The promoted entry expires no later than its disk entry, which may have been written long ago.
+        expire = self.memory.ttl
+        if expire_at is not None:
+            remaining = expire_at - time.time()
+            if remaining <= 0:
+                return
+            expire = remaining if expire is None else min(expire, remaining)
+        self.memory.set(key, value, expire=expire)
+
+    def set(self, key: str, value: Any, expire: Optional[float] = None):
+        expire = self.ttl if expire is None else expire
+        if self.memory is not None:
+            self.memory.set(key, value, expire=expire)
+        if self.disk is not None:
+            self.disk.set(key, value, expire=expire)
+        self._incr('_sets')
+
+    def delete(self, key: str):
+        if self.memory is not None:
+            self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def clear(self):
+        if self.memory is not None:
+            self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def _incr(self, name: str):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the current size of each tier."""
+        with self._stats_lock:
+            hits = self._hits_memory + self._hits_disk
+            lookups = hits + self._misses
+            stats = {
+                'hits': hits,
+                'hits_memory': self._hits_memory,
+                'hits_disk': self._hits_disk,
+                'misses': self._misses,
+                'sets': self._sets,
+                'hit_rate': (hits / lookups) if lookups else 0.0,
+            }
+        if self.memory is not None:
+            stats['memory_items'] = self.memory.num_items
+            stats['memory_bytes'] = self.memory.num_bytes
+            stats['memory_evictions'] = self.memory.evictions
+        if self.disk is not None:
+            stats['disk_items'] = len(self.disk)
+            stats['disk_bytes'] = self.disk.volume()
+        return stats
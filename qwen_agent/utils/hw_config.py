@@ -18,9 +18,13 @@ Automatically detects GPU/CPU capabilities and recommends optimal inference sett
 Designed for RTX 5060 Ti (Blackwell GB206) + AMD Ryzen 7 9700X + 32GB DDR5.
 """
 
+import json
 import os
 import platform
-from dataclasses import dataclass, field
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, fields
 from typing import Optional
 
 from qwen_agent.log import logger
@@ -49,7 +53,7 @@ class HardwareProfile:
     # Flash Attention support (Ampere+)
     flash_attn_available: bool = False
     # Quantization recommendation
-    recommended_quantization: Optional[str] = None   # None | 'int8' | 'int4'
+    recommended_quantization: Optional[str] = None   # None | 'int8' | 'int4' (bitsandbytes) | 'int8_dynamic' (CPU)
     # torch.compile support
     compile_available: bool = False
     # Context window tuned
@@ -105,26 +109,32 @@ def detect_hardware() -> HardwareProfile:
             profile.recommended_device = 'cuda'
 
             # VRAM-based quantization recommendation
+            # The batch size is the number of sequences decoded together, bounded by the VRAM left for KV caches
             if profile.gpu_vram_gb >= 24:
                 profile.recommended_quantization = None           # Full precision fine-tune OK
                 profile.recommended_max_new_tokens = 4096
                 profile.recommended_max_input_tokens = 131072
+                profile.recommended_batch_size = 16
             elif profile.gpu_vram_gb >= 16:
                 profile.recommended_quantization = None           # BF16 7B/14B models fit
                 profile.recommended_max_new_tokens = 4096
                 profile.recommended_max_input_tokens = 65536
+                profile.recommended_batch_size = 8
             elif profile.gpu_vram_gb >= 10:
                 profile.recommended_quantization = 'int8'
                 profile.recommended_max_new_tokens = 2048
                 profile.recommended_max_input_tokens = 32768
+                profile.recommended_batch_size = 4
             elif profile.gpu_vram_gb >= 6:
                 profile.recommended_quantization = 'int4'
                 profile.recommended_max_new_tokens = 2048
                 profile.recommended_max_input_tokens = 16384
+                profile.recommended_batch_size = 2
             else:
                 profile.recommended_quantization = 'int4'
                 profile.recommended_max_new_tokens = 1024
                 profile.recommended_max_input_tokens = 8192
+                profile.recommended_batch_size = 1
 
             # torch.compile available in PyTorch >= 2.0
             torch_version = tuple(int(x) for x in torch.__version__.split('.')[:2])
@@ -151,10 +161,12 @@ def _set_cpu_profile(profile: HardwareProfile):
     """Fallback: CPU-only settings."""
     profile.recommended_device = 'cpu'
     profile.recommended_dtype = 'float32'
-    profile.recommended_quantization = 'int4'    # Needed to fit large models on CPU
+    profile.recommended_quantization = 'int8_dynamic'    # Fits larger models, and decodes faster than float32
     profile.recommended_max_new_tokens = 512
     profile.recommended_max_input_tokens = 8192
     profile.recommended_num_workers = max(1, profile.cpu_threads // 4)
+    # Decode steps are memory bound, so a few sequences share the cost of reading the weights
+    profile.recommended_batch_size = min(4, max(1, profile.cpu_cores // 2))
     logger.info('[HW] No CUDA GPU detected – falling back to CPU inference.')
 
 
@@ -197,16 +209,23 @@ def apply_torch_optimizations(profile: HardwareProfile):
         logger.warning(f'[HW] Could not apply torch optimizations: {e}')
 
 
-def get_optimized_load_kwargs(profile: HardwareProfile) -> dict:
+def get_optimized_load_kwargs(profile: HardwareProfile, quantization: Optional[str] = 'auto') -> dict:
     """
     Return kwargs suitable for `AutoModelForCausalLM.from_pretrained(..., **kwargs)`
     based on the hardware profile.
+
+    `quantization` overrides the recommended one ('auto'). The 'int8_dynamic' quantization is applied after loading
+    the float32 model, see `qwen_agent.llm.quantization`.
     """
     import torch
 
     kwargs = {}
+    if quantization == 'auto':
+        quantization = profile.recommended_quantization
 
-    if profile.recommended_dtype == 'bfloat16':
+    if quantization == 'int8_dynamic':
+        kwargs['torch_dtype'] = torch.float32
+    elif profile.recommended_dtype == 'bfloat16':
         kwargs['torch_dtype'] = torch.bfloat16
     elif profile.recommended_dtype == 'float16':
         kwargs['torch_dtype'] = torch.float16
@@ -218,7 +237,7 @@ def get_optimized_load_kwargs(profile: HardwareProfile) -> dict:
     elif profile.cuda_available:
         kwargs['attn_implementation'] = 'sdpa'
 
-    if profile.recommended_quantization == 'int8':
+    if quantization == 'int8':
         try:
             from transformers import BitsAndBytesConfig
             kwargs['quantization_config'] = BitsAndBytesConfig(load_in_8bit=True)
@@ -226,7 +245,7 @@ def get_optimized_load_kwargs(profile: HardwareProfile) -> dict:
         except ImportError:
             logger.warning('[HW] bitsandbytes not found – INT8 quantization skipped.')
 
-    elif profile.recommended_quantization == 'int4':
+    elif quantization == 'int4':
         try:
             from transformers import BitsAndBytesConfig
             kwargs['quantization_config'] = BitsAndBytesConfig(
@@ -250,14 +269,122 @@ def get_generation_performance_kwargs(profile: HardwareProfile) -> dict:
     return kwargs
 
 
-# Module-level singleton – computed once on first import
+# Bump when the fields of `HardwareProfile` or the detection logic change, to invalidate the cached profiles
+_PROFILE_SCHEMA_VERSION = 2
+_PROFILE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+
+def _profile_cache_path() -> Optional[str]:
+    """The on-disk profile cache. Set QWEN_AGENT_HW_PROFILE_CACHE to another path, or to an empty string to disable
+    it."""
+    path = os.getenv('QWEN_AGENT_HW_PROFILE_CACHE')
+    if path is not None:
+        return path or None
+    cache_home = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'qwen_agent', 'hw_profile.json')
+
+
+def _package_version(name: str) -> str:
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return ''
+
+
+def _hardware_fingerprint() -> dict:
+    """What the detected profile depends on, computed without importing torch, so that a cached profile is reused
+    only on the same machine, with the same visible GPUs, driver and packages."""
+    try:
+        ram_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        ram_bytes = 0
+    try:
+        with open('/proc/driver/nvidia/version') as f:
+            nvidia_driver = f.readline().strip()
+    except OSError:
+        nvidia_driver = ''
+    try:
+        stat = os.stat(__file__)
+        detector = f'{stat.st_mtime_ns}:{stat.st_size}'
+    except OSError:
+        detector = ''
+    return {
+        'schema': _PROFILE_SCHEMA_VERSION,
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'ram_bytes': ram_bytes,
+        'cuda_visible_devices': os.getenv('CUDA_VISIBLE_DEVICES'),
+        'nvidia_driver': nvidia_driver,
+        'packages': {name: _package_version(name) for name in ('torch', 'flash-attn', 'psutil')},
+        'detector': detector,
+    }
+
+
+def _load_cached_profile(path: str, fingerprint: dict) -> Optional[HardwareProfile]:
+    try:
+        with open(path, encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('fingerprint') != fingerprint:
+        return None
+    if time.time() - cached.get('created', 0) > _PROFILE_CACHE_TTL_SECONDS:
+        return None
+    names = {f.name for f in fields(HardwareProfile)}
+    try:
+        return HardwareProfile(**{k: v for k, v in cached.get('profile', {}).items() if k in names})
+    except TypeError:
+        return None
+
+
+def _save_cached_profile(path: str, fingerprint: dict, profile: HardwareProfile) -> None:
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'created': time.time(), 'fingerprint': fingerprint, 'profile': asdict(profile)}, f, indent=2)
+        os.replace(tmp_path, path)  # Atomic, as other processes may be reading it
+    except OSError as e:
+        logger.debug(f'[HW] Could not cache the hardware profile to {path}: {e}')
+
+
+# Process-wide singleton, detected or read from the on-disk cache on first use
 _profile: Optional[HardwareProfile] = None
+_profile_lock = threading.Lock()
+_torch_optimized = False
 
 
 def get_hw_profile() -> HardwareProfile:
-    """Return the (cached) hardware profile for this machine."""
+    """Return the (cached) hardware profile for this machine.
+
+    Detecting the hardware imports torch and queries CUDA, which takes seconds, so the profile is cached on disk and
+    reused by the later processes on the same machine until the fingerprint of the hardware changes or it expires.
+    """
     global _profile
-    if _profile is None:
-        _profile = detect_hardware()
-        apply_torch_optimizations(_profile)
+    if _profile is not None:
+        return _profile
+    with _profile_lock:
+        if _profile is None:
+            path = _profile_cache_path()
+            fingerprint = _hardware_fingerprint()
+            profile = _load_cached_profile(path, fingerprint) if path else None
+            if profile is None:
+                profile = detect_hardware()
+                if path:
+                    _save_cached_profile(path, fingerprint, profile)
+            _profile = profile
     return _profile
+
+
+def ensure_torch_optimizations() -> HardwareProfile:
+    """Apply `apply_torch_optimizations` once per process, before running a model with torch."""
+    global _torch_optimized
+    profile = get_hw_profile()
+    if not _torch_optimized and 'torch' in sys.modules:
+        _torch_optimized = True
+        apply_torch_optimizations(profile)
+    return profile
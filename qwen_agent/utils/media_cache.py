@@ -0,0 +1,82 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A cache of the encoded payloads of the local images, videos and audios sent to the multimodal model services.
+
+The messages of a conversation are sent again at each turn and at each step of a tool loop, so the same local files
+would be read, resized and base64-encoded again every time. The payloads are keyed by the file's path, mtime and size
+and the encoding parameters, e.g., the target resolution, so that a modified file is encoded again.
+"""
+
+import os
+import threading
+from typing import Callable, Optional
+
+from qwen_agent.utils.cache import TwoTierCache, make_cache_key
+
+DEFAULT_MEDIA_CACHE_BYTES = 256 * 1024 * 1024
+
+_cache: Optional[TwoTierCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_media_cache() -> TwoTierCache:
+    """Returns the process-wide cache of the encoded media.
+
+    Its memory tier holds up to QWEN_AGENT_MEDIA_CACHE_MAX_BYTES (256 MiB by default, 0 to disable it), and its disk
+    tier is enabled by setting QWEN_AGENT_MEDIA_CACHE_DIR, e.g., to share the payloads across the worker processes.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TwoTierCache(
+                    max_memory_bytes=int(os.getenv('QWEN_AGENT_MEDIA_CACHE_MAX_BYTES', DEFAULT_MEDIA_CACHE_BYTES)),
+                    cache_dir=os.getenv('QWEN_AGENT_MEDIA_CACHE_DIR') or None,
+                    disk_size_limit=int(os.getenv('QWEN_AGENT_MEDIA_CACHE_DISK_BYTES', 0)) or None,
+                )
+    return _cache
+
+
+def cached_media_encoding(path: str, kind: str, encode: Callable[[], str], **params) -> str:
+    """Returns the encoded payload of the local file, calling `encode` only if it is not cached.
+
+    Args:
+        path: The local file.
+        kind: The kind of the encoding, e.g., 'image_base64'.
+        encode: Encodes the file.
+        params: The parameters of the encoding that change the payload, e.g., the target resolution.
+    """
+    cache = get_media_cache()
+    if not cache.enabled:
+        return encode()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return encode()  # Raises the error of the missing file as without the cache
+    key = make_cache_key(
+        {
+            'path': os.path.abspath(path),
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'kind': kind,
+            'params': params,
+        },
+        namespace='media',
+    )
+    payload = cache.get(key)
+    if payload is None:
+        payload = encode()
+        cache.set(key, payload)
+    return payload
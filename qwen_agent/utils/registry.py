@@ -0,0 +1,109 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Registries of the built-in classes that import their modules on first lookup.
+
+Importing every tool and LLM backend up front pulls in their heavy dependencies, e.g., openai, dashscope and jupyter,
+and the side effects of their modules, which most processes never use. Instead, the built-in names are declared with
+the module that registers them, which is imported when the name is first looked up.
+"""
+
+import importlib
+import threading
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, Optional
+
+
+class LazyRegistry(MutableMapping):
+    """A name-to-class mapping, where the built-in names are resolved by importing their modules on first lookup.
+
+    The classes register themselves with `registry[name] = cls` when their modules are imported, as before. Checking
+    `name in registry` and iterating the names don't import anything, while the lookups and iterating the classes
+    (`values()`, `items()`) import the modules of the names that are not loaded yet.
+
+    Args:
+        kind: What is registered, used in the error messages, e.g., 'Tool'.
+        lazy_entries: The built-in names, each with the module that registers it.
+    """
+
+    def __init__(self, kind: str, lazy_entries: Optional[Dict[str, str]] = None):
+        self.kind = kind
+        self._loaded = {}
+        self._modules = dict(lazy_entries or {})  # Kept, to recognize the built-in classes when they register
+        self._pending = dict(self._modules)  # The lazy entries that are not loaded yet
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name: str):
+        cls = self._loaded.get(name)
+        if cls is not None:
+            return cls
+        with self._lock:
+            module = self._pending.get(name)
+            if module is not None:
+                importlib.import_module(module)  # Registers the class with `__setitem__`
+            if name not in self._loaded:
+                if module is not None:
+                    raise KeyError(f'{self.kind} `{name}` is not registered by module {module}.')
+                raise KeyError(name)
+            return self._loaded[name]
+
+    def __setitem__(self, name: str, cls) -> None:
+        with self._lock:
+            self._loaded[name] = cls
+            self._pending.pop(name, None)
+
+    def __delitem__(self, name: str) -> None:
+        with self._lock:
+            if name not in self:
+                raise KeyError(name)
+            self._loaded.pop(name, None)
+            self._pending.pop(name, None)
+
+    def __contains__(self, name) -> bool:
+        return name in self._loaded or name in self._pending
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._loaded) + [name for name in list(self._pending) if name not in self._loaded])
+
+    def __len__(self) -> int:
+        return len(self._loaded) + sum(1 for name in list(self._pending) if name not in self._loaded)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.kind}, loaded={list(self._loaded)}, lazy={list(self._pending)})'
+
+    def is_builtin(self, name: str, cls) -> bool:
+        """Whether `cls` is the built-in class declared for `name`, registering itself as its module is imported."""
+        return self._modules.get(name) == cls.__module__
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._loaded
+
+
+def lazy_module_getattr(package: str, attributes: Dict[str, str]):
+    """Returns the module `__getattr__` (PEP 562) of a package that imports its public classes on first access, so
+    that `from package import Class` keeps working without importing every submodule with the package.
+
+    Args:
+        package: The `__name__` of the package.
+        attributes: The names of the classes, each with the submodule that defines it, relative to the package.
+    """
+
+    def __getattr__(name: str):
+        module = attributes.get(name)
+        if module is None:
+            raise AttributeError(f'module {package!r} has no attribute {name!r}')
+        value = getattr(importlib.import_module(module, package), name)
+        setattr(importlib.import_module(package), name, value)  # Later accesses don't go through `__getattr__`
+        return value
+
+    return __getattr__
@@ -326,6 +326,38 @@ def json_dumps_compact(obj: dict, ensure_ascii=False, indent=None, **kwargs) ->
     return json.dumps(obj, ensure_ascii=ensure_ascii, indent=indent, cls=PydanticJSONEncoder, **kwargs)
 
 
+def snapshot_messages(messages: List[Union[Message, dict]]) -> Tuple[List[Message], Literal['message', 'dict']]:
+    """Take a copy-on-write snapshot of the input messages.
+
+    The returned list is new, but it shares the `Message` objects of the input (dicts are converted into new
+    messages). Code holding a snapshot must treat the messages as read-only and derive changed messages with
+    `derive_message` instead of mutating them, so that the caller's messages are never modified and no layer
+    has to deep-copy the whole conversation.
+
+    Returns:
+        The snapshot, and 'dict' if all input messages are dicts else 'message'.
+    """
+    return_message_type = 'dict'
+    snapshot = []
+    for msg in messages:
+        if isinstance(msg, dict):
+            snapshot.append(Message(**msg))
+        else:
+            snapshot.append(msg)
+            return_message_type = 'message'
+    return snapshot, return_message_type
+
+
+def derive_message(msg: Message, **updates) -> Message:
+    """Return a new message with `updates` applied, sharing the unchanged fields of `msg`.
+
+    A list-typed `content` is copied so that the new message can append to it without affecting `msg`.
+    """
+    if ('content' not in updates) and isinstance(msg.content, list):
+        updates['content'] = list(msg.content)
+    return msg.model_copy(update=updates)
+
+
 def format_as_multimodal_message(
     msg: Message,
     add_upload_info: bool,
@@ -551,6 +583,14 @@ def build_text_completion_prompt(
 
 
 def encode_image_as_base64(path: str, max_short_side_length: int = -1) -> str:
+    from qwen_agent.utils.media_cache import cached_media_encoding
+    return cached_media_encoding(path,
+                                 'image_base64',
+                                 lambda: _encode_image_as_base64(path, max_short_side_length),
+                                 max_short_side_length=max_short_side_length)
+
+
+def _encode_image_as_base64(path: str, max_short_side_length: int = -1) -> str:
     from PIL import Image
     image = Image.open(path)
 
@@ -566,13 +606,18 @@ def encode_image_as_base64(path: str, max_short_side_length: int = -1) -> str:
 
 
 def encode_audio_as_base64(path: str) -> str:
-    with open(path, 'rb') as audio_file:
-        return 'data:;base64,' + base64.b64encode(audio_file.read()).decode('utf-8')
+    from qwen_agent.utils.media_cache import cached_media_encoding
+    return cached_media_encoding(path, 'file_base64', lambda: _encode_file_as_base64(path))
 
 
 def encode_video_as_base64(path: str) -> str:
-    with open(path, 'rb') as video_file:
-        return 'data:;base64,' + base64.b64encode(video_file.read()).decode('utf-8')
+    from qwen_agent.utils.media_cache import cached_media_encoding
+    return cached_media_encoding(path, 'file_base64', lambda: _encode_file_as_base64(path))
+
+
+def _encode_file_as_base64(path: str) -> str:
+    with open(path, 'rb') as f:
+        return 'data:;base64,' + base64.b64encode(f.read()).decode('utf-8')
 
 
 def load_image_from_base64(image_base64: Union[bytes, str]):
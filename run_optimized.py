@@ -14,6 +14,9 @@ Usage:
     # With torch.compile + warmup for best steady-state throughput
     python run_optimized.py --model Qwen/Qwen2.5-7B-Instruct --torch_compile --warmup
 
+    # Interactive Web UI (quantized GGUF model on CPU via llama.cpp)
+    python run_optimized.py --gguf Qwen2.5-7B-Instruct-Q4_K_M.gguf
+
     # Run benchmark instead of UI
     python run_optimized.py --model Qwen/Qwen2.5-7B-Instruct --bench
 """
@@ -80,6 +83,8 @@ def _parse_args():
                          help='Local transformers model id or path (e.g. Qwen/Qwen2.5-7B-Instruct)')
     backend.add_argument('--model_server', default=None,
                          help='OpenAI-compatible API base URL (e.g. http://localhost:8000/v1)')
+    backend.add_argument('--gguf', default=None,
+                         help='Local GGUF model file, run by llama.cpp (e.g. Qwen2.5-7B-Instruct-Q4_K_M.gguf)')
 
     p.add_argument('--api_key', default='EMPTY', help='API key for model_server mode')
     p.add_argument('--model_name', default=None,
@@ -87,15 +92,21 @@ def _parse_args():
 
     # Inference optimisations
     p.add_argument('--torch_compile', action='store_true',
-                   help='Enable torch.compile(reduce-overhead) – adds ~60s first-run JIT cost')
+                   help='Enable torch.compile(reduce-overhead) – adds ~60s first-run JIT cost, '
+                        'cached for the next runs')
+    p.add_argument('--compile_cache_dir', default=None,
+                   help='Cache of the torch.compile artifacts (default: ~/.cache/qwen_agent/torch_compile, "" disables it)')
     p.add_argument('--warmup', action='store_true',
-                   help='Run a KV-cache warmup pass before serving the UI')
+                   help='Run a KV-cache warmup pass before serving the UI (always on with --torch_compile)')
     p.add_argument('--static_cache', action='store_true',
                    help='Enable StaticCache / CUDA Graph (text-only models, transformers>=4.45)')
     p.add_argument('--dtype', default=None,
                    help='Override dtype (bfloat16/float16/float32). Auto-detected if omitted.')
     p.add_argument('--device', default=None,
                    help='Override device (cuda/cpu). Auto-detected if omitted.')
+    p.add_argument('--n_ctx', type=int, default=8192, help='Context length of the llama.cpp backend (--gguf)')
+    p.add_argument('--n_gpu_layers', type=int, default=0,
+                   help='Layers offloaded to the GPU by the llama.cpp backend (--gguf), -1 for all')
 
     # Server options
     p.add_argument('--host', default='0.0.0.0', help='Web UI host address')
@@ -146,15 +157,25 @@ def _build_llm_cfg(args) -> dict:
             'api_key': args.api_key,
             'generate_cfg': {'max_new_tokens': 2048},
         }
+    elif args.gguf:
+        return {
+            'gguf_model_path': args.gguf,
+            'model_type': 'llamacpp',
+            'n_ctx': args.n_ctx,
+            'n_gpu_layers': args.n_gpu_layers,
+            'generate_cfg': {'max_new_tokens': 2048},
+        }
     else:
         cfg = {
             'model': args.model,
             'model_type': 'transformers',
             'torch_compile': args.torch_compile,
-            'warmup': args.warmup,
+            'warmup': args.warmup or args.torch_compile,
             'use_static_cache': args.static_cache,
             'generate_cfg': {'max_new_tokens': 2048},
         }
+        if args.compile_cache_dir is not None:
+            cfg['compile_cache_dir'] = args.compile_cache_dir
         if args.dtype:
             cfg['torch_dtype'] = args.dtype
         if args.device:
@@ -174,6 +195,8 @@ def _run_bench(args):
         bench_args.append('--warmup')
     if args.torch_compile:
         bench_args.append('--torch_compile')
+    if args.compile_cache_dir is not None:
+        bench_args += ['--compile_cache_dir', args.compile_cache_dir]
     if args.static_cache:
         bench_args.append('--static_cache')
     if args.dtype:
@@ -191,7 +214,7 @@ def _run_webui(args):
     from qwen_agent.gui import WebUI
 
     llm_cfg = _build_llm_cfg(args)
-    model_label = args.model or args.model_server or 'Qwen-Agent'
+    model_label = args.model or args.gguf or args.model_server or 'Qwen-Agent'
 
     agent = Assistant(
         llm=llm_cfg,
@@ -235,8 +258,8 @@ def main():
             sys.exit(1)
         _run_bench(args)
     else:
-        if not args.model and not args.model_server:
-            print('[run_optimized] Please provide --model or --model_server')
+        if not args.model and not args.model_server and not args.gguf:
+            print('[run_optimized] Please provide --model, --model_server or --gguf')
             sys.exit(1)
         _run_webui(args)
 
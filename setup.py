@@ -85,9 +85,15 @@ setup(
             'tabulate',
         ],
 
+        # Extra dependencies for the llama.cpp backend, which runs GGUF models on CPU:
+        'llamacpp': ['llama-cpp-python'],
+
         # Extra dependencies for MCP:
         'mcp': ['mcp'],
 
+        # Extra dependencies for the ONNX Runtime backend, which runs exported models on CPU:
+        'onnxruntime': ['onnxruntime', 'transformers'],
+
         # Extra dependencies for Python Executor, which is primarily for solving math problems:
         'python_executor': [
             'pebble',
@@ -12,7 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Iterator, List
+
 from qwen_agent.agents.doc_qa import ParallelDocQA
+from qwen_agent.agents.doc_qa.parallel_doc_qa_member import NO_RESPONSE
+from qwen_agent.llm.base import ModelServiceError
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, USER, Message
+from qwen_agent.utils.utils import extract_text_from_message
 
 
 def test_parallel_qa():
@@ -32,3 +39,31 @@ def test_parallel_qa():
     *_, last = agent.run(messages)
 
     assert len(last[-1]['content']) > 0
+
+
+class MemberLLM(BaseFnCallModel):
+    """Answers with the knowledge of each member, failing for the chunk that contains 'boom'."""
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        raise NotImplementedError
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        prompt = extract_text_from_message(messages[-1], add_upload_info=False)
+        if 'boom' in prompt:
+            raise ModelServiceError(code='400', message='The input is too long.')
+        return [Message(ASSISTANT, '{"res": "ans", "content": "chunk answer"}')]
+
+
+def test_failing_member_is_dropped():
+    agent = ParallelDocQA(llm=MemberLLM({'model': 'fake', 'max_batch_size': 4}))
+    data = [{
+        'index': i,
+        'messages': [Message(USER, 'What is it?')],
+        'lang': 'en',
+        'knowledge': knowledge,
+        'instruction': '',
+    } for i, knowledge in enumerate(['chunk 0', 'boom', 'chunk 2'])]
+    results = sorted(agent._ask_member_agents(data))
+    assert results[0] == (0, '{"res": "ans", "content": "chunk answer"}')
+    assert results[1] == (1, NO_RESPONSE)
+    assert results[2] == (2, '{"res": "ans", "content": "chunk answer"}')
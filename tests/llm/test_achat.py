@@ -0,0 +1,152 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from types import SimpleNamespace
+from typing import Iterator, List
+
+import pytest
+
+from qwen_agent.llm import ModelServiceError, TextChatAtOAI
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.utils.async_utils import iterate_in_threadpool
+
+FUNCTIONS = [{
+    'name': 'get_weather',
+    'description': 'Get the weather.',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'city': {
+                'type': 'string'
+            }
+        },
+        'required': ['city']
+    },
+}]
+
+ANSWER = 'Let me check.\n<tool_call>\n{"name": "get_weather", "arguments": {"city": "Hangzhou"}}\n</tool_call>'
+
+
+def _without_metrics(rsp: list) -> list:
+    # The metrics of each call differ, e.g., in latency.
+    return [{**msg, 'extra': {k: v for k, v in msg['extra'].items() if k != 'metrics'}} if 'extra' in msg else msg
+            for msg in rsp]
+
+
+async def _collect(rsp) -> list:
+    return [r async for r in await rsp]
+
+
+class SyncLLM(BaseFnCallModel):
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg)
+        self.threads = set()
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        for i in range(0, len(ANSWER), 8):
+            self.threads.add(threading.get_ident())
+            yield [Message(ASSISTANT, ANSWER[:i + 8])]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        self.threads.add(threading.get_ident())
+        return [Message(ASSISTANT, ANSWER)]
+
+
+def _fake_chunks(text: str) -> list:
+    return [
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + 8]))])
+        for i in range(0, len(text), 8)
+    ]
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_achat_matches_chat_for_sync_backend(stream):
+    llm = SyncLLM({'model': 'sync'})
+    messages = [{'role': 'user', 'content': 'Weather in Hangzhou?'}]
+    expected = llm.chat(messages=messages, functions=FUNCTIONS, stream=stream)
+    if stream:
+        expected = list(expected)
+    llm.threads.clear()
+    if stream:
+        got = asyncio.run(_collect(llm.achat(messages=messages, functions=FUNCTIONS)))
+    else:
+        got = asyncio.run(llm.achat(messages=messages, functions=FUNCTIONS, stream=False))
+    if stream:
+        assert [_without_metrics(x) for x in got] == [_without_metrics(x) for x in expected]
+    else:
+        assert _without_metrics(got) == _without_metrics(expected)
+    assert (got[-1] if stream else got)[-1]['function_call']['name'] == 'get_weather'
+    assert threading.get_ident() not in llm.threads  # the sync backend ran in the executor
+
+
+def test_achat_oai_uses_async_client():
+    llm = TextChatAtOAI({'model': 'fake', 'model_server': 'http://127.0.0.1:1/v1'})
+    calls = []
+
+    async def _achat_complete_create(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise ModelServiceError(code='500', message='try again')
+
+        async def _stream():
+            for chunk in _fake_chunks(ANSWER):
+                await asyncio.sleep(0)
+                yield chunk
+
+        return _stream()
+
+    def _chat_complete_create(**kwargs):
+        raise AssertionError('The sync client should not be used by achat.')
+
+    llm._achat_complete_create = _achat_complete_create
+    llm._chat_complete_create = _chat_complete_create
+    llm.max_retries = 1
+
+    async def _main():
+        sleep = asyncio.sleep
+        asyncio.sleep = lambda delay: sleep(0)  # skip the retry backoff
+        try:
+            return await _collect(llm.achat(messages=[Message('user', 'Weather in Hangzhou?')], functions=FUNCTIONS))
+        finally:
+            asyncio.sleep = sleep
+
+    rsp = asyncio.run(_main())
+    assert len(calls) == 2
+    assert len(rsp) > 1
+    assert rsp[-1][0].content.strip() == 'Let me check.'
+    assert rsp[-1][1].function_call.name == 'get_weather'
+
+
+def test_iterate_in_threadpool_closes_iterator():
+    closed = threading.Event()
+
+    def _gen():
+        try:
+            yield from range(100)
+        finally:
+            closed.set()
+
+    async def _main():
+        agen = iterate_in_threadpool(_gen)
+        async for i in agen:
+            if i == 2:
+                break
+        await agen.aclose()
+
+    asyncio.run(_main())
+    assert closed.wait(timeout=5)
@@ -0,0 +1,92 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from qwen_agent.llm.transformers_llm import _AssistedDecodingStats
+
+
+class FakeModule:
+
+    def __init__(self):
+        self.hooks = []
+
+    def register_forward_hook(self, hook):
+        self.hooks.append(hook)
+        return FakeHandle(self.hooks, hook)
+
+    def __call__(self):
+        for hook in list(self.hooks):
+            hook(self, (), None)
+
+
+class FakeHandle:
+
+    def __init__(self, hooks, hook):
+        self.hooks = hooks
+        self.hook = hook
+
+    def remove(self):
+        self.hooks.remove(self.hook)
+
+
+def _verify_steps(target, draft, accepted):
+    # One verification step per item, each after five drafted tokens
+    for _ in accepted:
+        for _ in range(5):
+            draft()
+        target()
+
+
+def test_accept_rate_from_forward_passes():
+    stats = _AssistedDecodingStats()
+    target, draft = FakeModule(), FakeModule()
+    counter = stats.attach(target=target, draft=draft)
+
+    # Four verification steps with five drafted tokens each: 4 + 3 + 5 + 0 tokens accepted, plus one per step.
+    _verify_steps(target, draft, [4, 3, 5, 0])
+    counter.remove()
+    stats.record(generated_tokens=16, seconds=2.0, counter=counter)
+    assert not target.hooks and not draft.hooks
+
+    result = stats.stats()
+    assert result['accepted_tokens'] == 12 and result['drafted_tokens'] == 20
+    assert result['accept_rate'] == 0.6
+    assert result['tokens_per_verify_step'] == 4.0
+    assert result['tokens_per_second'] == 8.0
+
+
+def test_overlapping_calls_count_their_own_forward_passes():
+    stats = _AssistedDecodingStats()
+    target, draft = FakeModule(), FakeModule()  # Shared by the calls, as the models of the registry are
+    attached = threading.Barrier(2)
+    counted = threading.Barrier(2)
+
+    def _call(num_steps):
+        counter = stats.attach(target=target, draft=draft)
+        attached.wait()  # Both calls are running
+        _verify_steps(target, draft, range(num_steps))
+        counted.wait()
+        counter.remove()
+        stats.record(generated_tokens=num_steps * 2, seconds=1.0, counter=counter)
+
+    threads = [threading.Thread(target=_call, args=(n,)) for n in (3, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    result = stats.stats()
+    assert result['drafted_tokens'] == 8 * 5 and result['accepted_tokens'] == 8
+    assert result['tokens_per_verify_step'] == 2.0
@@ -0,0 +1,118 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from typing import Dict, Iterator, List, Optional
+
+import pytest
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.utils.cache import MemoryLRUCache, TwoTierCache, make_cache_key
+
+
+class EchoLLM(BaseFnCallModel):
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.num_calls = 0
+
+    def _answer(self, messages: List[Message]) -> str:
+        self.num_calls += 1
+        return 'echo: ' + messages[-1].content * 10
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        yield [Message(ASSISTANT, self._answer(messages))]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        return [Message(ASSISTANT, self._answer(messages))]
+
+
+def _without_metrics(rsp: list) -> list:
+    # The metrics of each call differ, e.g., in latency.
+    return [{**msg, 'extra': {k: v for k, v in msg['extra'].items() if k != 'metrics'}} if 'extra' in msg else msg
+            for msg in rsp]
+
+
+def test_make_cache_key():
+    key1 = make_cache_key({'b': 1, 'a': [Message('user', 'hi')]})
+    key2 = make_cache_key({'a': [Message('user', 'hi')], 'b': 1})
+    assert key1 == key2
+    assert len(key1) == 64
+    assert make_cache_key({'a': 'x' * 100000}) != key1
+
+
+def test_memory_lru_byte_budget():
+    cache = MemoryLRUCache(max_bytes=100)
+    cache.set('a', 'x' * 40)
+    cache.set('b', 'y' * 40)
+    assert cache.get('a') == 'x' * 40  # `a` becomes the most recently used
+    cache.set('c', 'z' * 40)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.num_bytes <= 100
+    assert not cache.set('huge', 'w' * 1000)
+
+
+def test_memory_lru_ttl():
+    cache = MemoryLRUCache(max_bytes=100, ttl=0.05)
+    cache.set('a', 'x')
+    assert cache.get('a') == 'x'
+    time.sleep(0.1)
+    assert cache.get('a') is None
+
+
+def test_two_tier_promotion(tmp_path):
+    pytest.importorskip('diskcache')
+    cache = TwoTierCache(max_memory_bytes=1024, cache_dir=str(tmp_path))
+    cache.set('k', 'v')
+    cache.memory.clear()
+    assert cache.get('k') == 'v'  # served by disk and promoted
+    assert cache.get('k') == 'v'  # served by memory
+    assert cache.get('missing') is None
+    stats = cache.stats()
+    assert (stats['hits_disk'], stats['hits_memory'], stats['misses']) == (1, 1, 1)
+
+
+
+def test_two_tier_promotion_keeps_the_disk_expiry(tmp_path):
+    pytest.importorskip('diskcache')
+    cache = TwoTierCache(max_memory_bytes=1024, cache_dir=str(tmp_path), ttl=60)
+    cache.set('k', 'v', expire=0.2)
+    cache.memory.clear()
+    assert cache.get('k') == 'v'  # promoted with the 0.2s left on disk, not with the memory TTL of 60s
+    time.sleep(0.3)
+    assert cache.memory.get('k') is None
+    assert cache.get('k') is None
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_chat_memory_cache(stream):
+    llm = EchoLLM({'model': 'echo', 'cache_max_memory_bytes': 1024 * 1024, 'cache_replay_chunk_size': 8})
+    messages = [{'role': 'user', 'content': 'hello'}]
+
+    def _chat():
+        rsp = llm.chat(messages=messages, stream=stream)
+        if stream:
+            rsp = list(rsp)
+            assert all(isinstance(r, list) for r in rsp)
+            return rsp
+        return [rsp]
+
+    first = _chat()
+    second = _chat()
+    assert llm.num_calls == 1
+    assert _without_metrics(second[-1]) == _without_metrics(first[-1])
+    if stream:
+        assert len(second) > 1  # cached answers are replayed in chunks
+    assert llm.cache.stats()['hits_memory'] == 1
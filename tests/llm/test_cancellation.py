@@ -0,0 +1,138 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List
+
+import pytest
+
+from qwen_agent.llm import get_chat_model
+from qwen_agent.llm.cancellation import CancellationToken, on_cancel
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, Message
+
+MESSAGES = [{'role': 'user', 'content': 'Count to 100.'}]
+
+
+def _chat_and_cancel(llm, delay: float) -> list:
+    # Cancels the call from another thread `delay` seconds after the first response.
+    token, timer, rsp = CancellationToken(), None, []
+    for rsp in llm.chat(MESSAGES, cancel_token=token):
+        if timer is None:
+            timer = threading.Timer(delay, token.cancel)
+            timer.start()
+    return rsp
+
+
+class LocalLLM(BaseFnCallModel):
+    # Decodes like a local model: a step loop that stops at the next step once cancelled.
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg)
+        self.cancelled = threading.Event()
+        self.steps = 0
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        self.cancelled.clear()
+        remove_callback = on_cancel(self.cancelled.set)
+        try:
+            text = ''
+            for i in range(100):
+                if self.cancelled.is_set():
+                    return
+                self.steps += 1
+                text += f'{i} '
+                yield [Message(ASSISTANT, text)]
+                time.sleep(0.01)
+        finally:
+            self.cancelled.set()
+            remove_callback()
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        *_, rsp = self._chat_stream(messages, delta_stream=False, generate_cfg=generate_cfg)
+        return rsp
+
+
+def test_cancel_from_another_thread():
+    llm = LocalLLM({'model': 'local', 'cache_max_memory_bytes': 1 << 20})
+    rsp = _chat_and_cancel(llm, delay=0.1)
+    assert 0 < llm.steps < 100 and rsp[-1]['content'].startswith('0 1 ')
+
+    # The response cut short is not cached.
+    *_, rsp = llm.chat(MESSAGES)
+    assert rsp[-1]['content'].strip().endswith(' 99')
+
+
+def test_consumer_stops_iterating():
+    llm = LocalLLM({'model': 'local'})
+    token = CancellationToken()
+    responses = llm.chat(MESSAGES, cancel_token=token)
+    next(responses)
+    responses.close()
+    assert llm.cancelled.is_set() and llm.steps == 1
+    assert not token.cancelled  # Only the call is cancelled, not the token of the caller
+
+
+class SlowStreamHandler(BaseHTTPRequestHandler):
+    disconnected = threading.Event()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        try:
+            for i in range(200):
+                chunk = {
+                    'id': 'x',
+                    'object': 'chat.completion.chunk',
+                    'created': 0,
+                    'model': 'stub',
+                    'choices': [{
+                        'index': 0,
+                        'delta': {
+                            'content': f'{i} '
+                        },
+                        'finish_reason': None
+                    }],
+                }
+                self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+                self.wfile.flush()
+                time.sleep(0.02)
+        except (BrokenPipeError, ConnectionResetError):
+            type(self).disconnected.set()
+
+
+@pytest.fixture
+def base_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowStreamHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    SlowStreamHandler.disconnected.clear()
+    yield f'http://127.0.0.1:{server.server_address[1]}/v1'
+    server.shutdown()
+
+
+def test_cancel_closes_oai_stream(base_url):
+    llm = get_chat_model({'model': 'stub', 'model_server': base_url, 'api_key': 'EMPTY'})
+    t0 = time.perf_counter()
+    rsp = _chat_and_cancel(llm, delay=0.2)
+    assert time.perf_counter() - t0 < 3  # Streaming all 200 chunks takes 4s
+    assert rsp[-1]['content'].startswith('0 1 ')
+    assert SlowStreamHandler.disconnected.wait(timeout=2)  # The server sees the client go away
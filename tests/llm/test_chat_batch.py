@@ -0,0 +1,89 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import threading
+import time
+from typing import Iterator, List
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, Message
+
+
+class ConcurrentLLM(BaseFnCallModel):
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        raise NotImplementedError
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(random.random() * 0.02)
+        with self.lock:
+            self.running -= 1
+        return [Message(ASSISTANT, 're: ' + messages[-1].content + '\nObservation: x')]
+
+
+class BatchedLLM(ConcurrentLLM):
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg)
+        self.batches = []
+
+    def _chat_batch(self, reqs) -> List[List[Message]]:
+        model_inputs = [self._get_model_input(req) for req in reqs]
+        self.batches.append(len(model_inputs))
+        return [self._chat_no_stream(messages, generate_cfg) for messages, generate_cfg in model_inputs]
+
+
+def _messages_list(n: int) -> list:
+    return [[{'role': 'user', 'content': f'question {i}'}] for i in range(n)]
+
+
+def test_chat_batch_order_and_concurrency():
+    llm = ConcurrentLLM({'model': 'fake', 'max_batch_size': 3})
+    assert llm.max_batch_size == 3
+    responses = llm.chat_batch(_messages_list(10), extra_generate_cfg={'stop': ['Observation:']})
+    assert [r[-1]['content'] for r in responses] == [f're: question {i}\n' for i in range(10)]
+    assert 1 < llm.max_running <= 3
+
+
+def test_chat_batch_work_units_and_cache():
+    llm = BatchedLLM({'model': 'fake', 'generate_cfg': {'max_batch_size': 4}, 'cache_max_memory_bytes': 1 << 20})
+    assert llm.max_batch_size == 4
+    llm.chat_batch(_messages_list(3))
+    responses = llm.chat_batch(_messages_list(10))
+    assert llm.batches == [3, 4, 3]  # the 3 cached conversations are not sent again
+    assert [r[-1]['content'] for r in responses] == [f're: question {i}\nObservation: x' for i in range(10)]
+
+
+class RawApiLLM(ConcurrentLLM):
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        yield self._chat_no_stream(messages, generate_cfg)
+
+
+def test_chat_batch_runs_raw_api_streams_concurrently():
+    llm = RawApiLLM({'model': 'fake', 'max_batch_size': 3, 'generate_cfg': {'use_raw_api': True}})
+    assert llm.use_raw_api
+    responses = llm.chat_batch(_messages_list(10))
+    assert [r[-1].content for r in responses] == [f're: question {i}\nObservation: x' for i in range(10)]
+    assert 1 < llm.max_running <= 3
@@ -0,0 +1,62 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+from qwen_agent.llm.compile_cache import CompileCache, get_compile_cache_root, get_warmup_lengths
+
+
+def test_compile_cache_root(tmp_path, monkeypatch):
+    monkeypatch.delenv('QWEN_AGENT_COMPILE_CACHE_DIR', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert get_compile_cache_root() == str(tmp_path / 'qwen_agent' / 'torch_compile')
+    assert get_compile_cache_root('/my/cache') == '/my/cache'
+    assert get_compile_cache_root('') is None
+
+    monkeypatch.setenv('QWEN_AGENT_COMPILE_CACHE_DIR', '')
+    assert get_compile_cache_root() is None
+
+
+def test_warmup_lengths():
+    assert get_warmup_lengths(None, 58000) == [128, 512, 2048]
+    assert get_warmup_lengths(None, 1000) == [128, 512, 1000]
+    assert get_warmup_lengths([64, 64, 0, 32], 1000) == [32, 64]
+
+
+def test_cache_path_depends_on_the_whole_key(tmp_path):
+    key = {'model': 'Qwen/Qwen2.5-7B-Instruct', 'dtype': 'torch.bfloat16', 'torch': '2.6.0'}
+    cache = CompileCache(str(tmp_path), key)
+    assert os.path.dirname(cache.path) == str(tmp_path)
+    assert os.path.basename(cache.path).startswith('Qwen2.5-7B-Instruct-')
+    assert CompileCache(str(tmp_path), dict(key)).path == cache.path
+    assert CompileCache(str(tmp_path), {**key, 'torch': '2.7.0'}).path != cache.path
+
+
+def test_startup_report_compares_cold_and_warm_starts(tmp_path):
+    cache = CompileCache(str(tmp_path), {'model': 'qwen'})
+    assert cache.report() == {'path': cache.path, 'cold': None, 'warm': None}
+
+    os.makedirs(cache.path)
+    cold = cache.record_startup(load_seconds=5.0, time_to_first_token=60.0, ttft={'128': 55.0})
+    assert cold['start'] == 'cold'
+    cache.warm = True
+    cache.record_startup(load_seconds=5.0, time_to_first_token=20.0, ttft={'128': 15.0})
+    cache.record_startup(load_seconds=5.0, time_to_first_token=15.0, ttft={'128': 10.0})
+
+    report = cache.report()
+    assert report['cold']['time_to_first_token'] == 60.0
+    assert report['warm']['time_to_first_token'] == 15.0  # The last warm start
+    assert report['ttft_speedup'] == pytest.approx(4.0)
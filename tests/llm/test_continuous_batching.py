@@ -0,0 +1,106 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from qwen_agent.llm.cancellation import CancellationToken  # noqa: E402
+from qwen_agent.llm.continuous_batching import ContinuousBatchingEngine  # noqa: E402
+
+
+class CharTokenizer:
+    eos_token_id = None
+
+    def decode(self, ids, skip_special_tokens=True):
+        return ''.join(chr(ord('a') + i % 26) for i in ids)
+
+
+@pytest.fixture(scope='module')
+def tiny_model():
+    torch.manual_seed(0)
+    config = transformers.Qwen2Config(vocab_size=64,
+                                      hidden_size=32,
+                                      intermediate_size=64,
+                                      num_hidden_layers=2,
+                                      num_attention_heads=4,
+                                      num_key_value_heads=2,
+                                      max_position_embeddings=256)
+    model = transformers.Qwen2ForCausalLM(config).eval()
+    model.generation_config.eos_token_id = None
+    model.generation_config.pad_token_id = 0
+    return model
+
+
+def _reference(model, input_ids, max_new_tokens):
+    with torch.no_grad():
+        output = model.generate(torch.tensor([input_ids]), max_new_tokens=max_new_tokens, do_sample=False)
+    return output[0, len(input_ids):].tolist()
+
+
+def test_matches_generate_with_joining_and_retiring(tiny_model):
+    engine = ContinuousBatchingEngine(tiny_model, CharTokenizer(), max_batch_size=2)
+    prompts = [[1, 2, 3], [4, 5, 6, 7, 8, 9, 10], [11, 12], [13, 14, 15, 16]]
+    max_new_tokens = [12, 5, 9, 7]  # Sequences finish at different steps and the waiting ones take their place
+    seqs = [
+        engine.submit(p, {'max_new_tokens': n, 'do_sample': False}) for p, n in zip(prompts, max_new_tokens)
+    ]
+    texts = [''.join(engine.stream(seq)) for seq in seqs]
+    for seq, text, p, n in zip(seqs, texts, prompts, max_new_tokens):
+        assert seq.output_ids == _reference(tiny_model, p, n)
+        assert text == CharTokenizer().decode(seq.output_ids)
+    assert engine.max_running == 2
+
+
+def test_concurrent_consumers_and_cancel(tiny_model):
+    engine = ContinuousBatchingEngine(tiny_model, CharTokenizer(), max_batch_size=4)
+    results = {}
+
+    def _consume(i):
+        results[i] = engine.generate([i + 1, i + 2], {'max_new_tokens': 6, 'do_sample': False})
+
+    threads = [threading.Thread(target=_consume, args=(i,)) for i in range(3)]
+    for t in threads:
+        t.start()
+    cancelled = engine.stream(engine.submit([9, 9, 9], {'max_new_tokens': 200, 'do_sample': False}))
+    next(cancelled)
+    cancelled.close()  # The engine retires the sequence of a consumer that stops early
+    for t in threads:
+        t.join()
+    for i in range(3):
+        assert results[i] == CharTokenizer().decode(_reference(tiny_model, [i + 1, i + 2], 6))
+    assert engine.num_steps < 200
+
+
+def test_cancel_token_from_another_thread_ends_the_stream(tiny_model):
+    engine = ContinuousBatchingEngine(tiny_model, CharTokenizer(), max_batch_size=2)
+    token = CancellationToken()
+    seq = engine.submit([9, 9, 9], {'max_new_tokens': 200, 'do_sample': False})
+    token.on_cancel(seq.cancel)  # As `Transformers._engine_stream` registers it
+    texts = []
+
+    def _consume():
+        for text in engine.stream(seq):  # Blocks on the queue of the sequence between two tokens
+            texts.append(text)
+            if len(texts) == 2:
+                threading.Thread(target=token.cancel).start()
+
+    consumer = threading.Thread(target=_consume)
+    consumer.start()
+    consumer.join(timeout=30)
+    assert not consumer.is_alive()
+    assert seq.finished and len(seq.output_ids) < 200
@@ -0,0 +1,81 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+from typing import Iterator, List
+
+import pytest
+
+from qwen_agent.agents import FnCallAgent
+from qwen_agent.llm.base import _postprocess_stop_words
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, ContentItem, FunctionCall, Message
+
+FUNCTIONS = [{
+    'name': 'get_weather',
+    'description': 'Get the weather.',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'city': {
+                'type': 'string'
+            }
+        },
+        'required': ['city']
+    },
+}]
+
+
+class StubLLM(BaseFnCallModel):
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        yield [Message(ASSISTANT, 'It is sunny.')]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        return [Message(ASSISTANT, 'It is sunny.')]
+
+
+def _history() -> List[Message]:
+    return [
+        Message('system', [ContentItem(text='You are helpful.')]),
+        Message('user', [ContentItem(text='Weather in Hangzhou?')]),
+        Message(ASSISTANT, [], function_call=FunctionCall(name='get_weather', arguments='{"city": "Hangzhou"}')),
+        Message('function', [ContentItem(text='sunny')], name='get_weather'),
+    ]
+
+
+@pytest.mark.parametrize('fncall_prompt_type', ['nous', 'qwen'])
+def test_chat_does_not_modify_input(fncall_prompt_type):
+    llm = StubLLM({'model': 'stub', 'generate_cfg': {'fncall_prompt_type': fncall_prompt_type}})
+    messages = _history()
+    expected = copy.deepcopy(messages)
+    *_, rsp = llm.chat(messages=messages, functions=FUNCTIONS)
+    assert rsp[-1].content == 'It is sunny.'
+    assert messages == expected
+
+    agent = FnCallAgent(llm=llm, system_message='Be brief.', name='bot')
+    *_, rsp = agent.run(messages=messages)
+    assert rsp[-1].name == 'bot'
+    assert messages == expected
+
+
+def test_postprocess_stop_words_copy_on_write():
+    unchanged = Message(ASSISTANT, [ContentItem(text='Thought: ok')])
+    truncated = Message(ASSISTANT, [ContentItem(text='Action: x\nObservation: y')])
+    messages = [unchanged, truncated]
+    expected = copy.deepcopy(messages)
+    output = _postprocess_stop_words(messages, stop=['Observation:'])
+    assert output[0] is unchanged
+    assert output[1].content[0].text == 'Action: x\n'
+    assert messages == expected
@@ -0,0 +1,97 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from typing import AsyncIterator, Iterator, List
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.hedging import HedgePolicy
+from qwen_agent.llm.schema import ASSISTANT, Message
+
+
+class SlowFirstLLM(BaseFnCallModel):
+    """The first request stalls before its first token, the others respond at once."""
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg)
+        self.lock = threading.Lock()
+        self.num_calls = 0
+        self.closed = []
+
+    def _next_call(self) -> int:
+        with self.lock:
+            self.num_calls += 1
+            return self.num_calls
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        call = self._next_call()
+        try:
+            if call == 1:
+                time.sleep(0.5)
+            for i in range(1, 4):
+                yield [Message(ASSISTANT, f'attempt {call} ' + 'x' * i)]
+        finally:
+            self.closed.append(call)
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        raise NotImplementedError
+
+    async def _achat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        call = self._next_call()
+        if call == 1:
+            await asyncio.sleep(0.5)
+        return [Message(ASSISTANT, f'attempt {call}')]
+
+    async def _achat_stream(self, messages, delta_stream, generate_cfg) -> AsyncIterator[List[Message]]:
+        raise NotImplementedError
+        yield
+
+
+def test_hedge_delay_percentile():
+    policy = HedgePolicy(percentile=90, min_samples=10, min_delay=0.0)
+    assert policy.delay() is None
+    for i in range(1, 101):
+        policy.observe(i / 100)
+    assert policy.delay() == 0.9
+
+
+def test_hedged_stream_wins_and_cancels_the_slow_attempt():
+    llm = SlowFirstLLM({'model': 'fake', 'hedge': {'initial_delay': 0.05, 'min_samples': 100}})
+    t0 = time.perf_counter()
+    *_, rsp = llm.chat([{'role': 'user', 'content': 'hi'}])
+    assert time.perf_counter() - t0 < 0.4
+    assert rsp[-1]['content'] == 'attempt 2 xxx'
+    stats = llm.hedge_policy.stats()
+    assert stats['hedged_requests'] == 1 and stats['hedge_wins'] == 1 and stats['hedge_rate'] == 1.0
+
+    time.sleep(0.6)  # The slow attempt is closed as soon as its first token arrives
+    assert sorted(llm.closed) == [1, 2]
+
+
+def test_hedged_achat():
+    llm = SlowFirstLLM({'model': 'fake', 'generate_cfg': {'hedge': {'initial_delay': 0.05}}})
+    t0 = time.perf_counter()
+    rsp = asyncio.run(llm.achat([{'role': 'user', 'content': 'hi'}], stream=False))
+    assert time.perf_counter() - t0 < 0.4
+    assert rsp[-1]['content'] == 'attempt 2'
+    assert llm.hedge_policy.stats()['hedge_wins'] == 1
+
+
+def test_no_hedge_when_fast():
+    llm = SlowFirstLLM({'model': 'fake', 'hedge': {'initial_delay': 1.0}})
+    *_, rsp = llm.chat([{'role': 'user', 'content': 'hi'}])
+    assert rsp[-1]['content'] == 'attempt 1 xxx'
+    assert llm.num_calls == 1 and llm.hedge_policy.stats()['hedged_requests'] == 0
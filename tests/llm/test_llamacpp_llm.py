@@ -0,0 +1,100 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+pytest.importorskip('gguf')
+pytest.importorskip('llama_cpp')
+
+from tiny_gguf_model import build_tiny_gguf_model  # noqa: E402
+
+from qwen_agent.llm import get_chat_model  # noqa: E402
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+GREEDY = {'do_sample': False, 'max_new_tokens': 16}
+
+
+@pytest.fixture(scope='module')
+def llm(tmp_path_factory):
+    model_path = str(tmp_path_factory.mktemp('tiny_gguf') / 'tiny.gguf')
+    build_tiny_gguf_model(model_path)
+    return get_chat_model({'model_type': 'llamacpp', 'gguf_model_path': model_path, 'n_ctx': 2048, 'n_threads': 1})
+
+
+def test_stream_and_stop_words(llm):
+    *_, rsp = llm.chat(MESSAGES, extra_generate_cfg=GREEDY)
+    text = rsp[-1]['content']
+    assert text
+
+    # The deltas of the stream add up to the response.
+    deltas = [r[-1]['content'] for r in llm.chat(MESSAGES, extra_generate_cfg=GREEDY, delta_stream=True)]
+    assert ''.join(deltas) == text
+    assert llm.chat(MESSAGES, extra_generate_cfg=GREEDY, stream=False)[-1]['content'] == text
+
+    stop = text[4:6]
+    *_, rsp = llm.chat(MESSAGES, extra_generate_cfg={**GREEDY, 'stop': [stop]})
+    assert rsp[-1]['content'] == text[:text.index(stop)]
+
+
+def test_next_turn_reuses_the_prompt_cache(llm, monkeypatch):
+    evaluated, prompt_lengths = [], []
+    llama = llm.llama
+    eval_tokens = llama.eval
+    get_prompt_ids = type(llm)._get_prompt_ids
+
+    def _eval(tokens):
+        evaluated.append(len(tokens))
+        return eval_tokens(tokens)
+
+    def _get_prompt_ids(self, messages):
+        prompt_ids, stop = get_prompt_ids(self, messages)
+        prompt_lengths.append(len(prompt_ids))
+        return prompt_ids, stop
+
+    monkeypatch.setattr(llama, 'eval', _eval)
+    monkeypatch.setattr(type(llm), '_get_prompt_ids', _get_prompt_ids)
+
+    *_, rsp = llm.chat([{'role': 'user', 'content': 'conversation A'}], extra_generate_cfg=GREEDY)
+    history = [{'role': 'user', 'content': 'conversation A'}, rsp[-1]]
+    llm.chat([{'role': 'user', 'content': 'conversation B'}], extra_generate_cfg=GREEDY, stream=False)
+
+    # The next turn of conversation A restores its cached state, instead of evaluating its history again.
+    evaluated.clear()
+    llm.chat(history + [{'role': 'user', 'content': 'next'}], extra_generate_cfg=GREEDY, stream=False)
+    assert 0 < evaluated[0] < prompt_lengths[-1] - prompt_lengths[0]
+
+
+def test_function_calling_prompt(llm, monkeypatch):
+    prompts = []
+    get_prompt_ids = type(llm)._get_prompt_ids
+
+    def _get_prompt_ids(self, messages):
+        prompts.append(messages)
+        return get_prompt_ids(self, messages)
+
+    monkeypatch.setattr(type(llm), '_get_prompt_ids', _get_prompt_ids)
+    functions = [{'name': 'get_weather', 'description': 'Gets the weather', 'parameters': {'type': 'object'}}]
+    *_, rsp = llm.chat(MESSAGES, functions=functions, extra_generate_cfg=GREEDY)
+    assert rsp and rsp[-1]['role'] == 'assistant'
+    assert 'get_weather' in prompts[-1][0].content  # The functions are described in the system message
+
+
+def test_threads_default_to_the_physical_cores(tmp_path, monkeypatch):
+    from qwen_agent.utils.hw_config import get_hw_profile
+
+    monkeypatch.delenv('QWEN_AGENT_LLAMACPP_NUM_THREADS', raising=False)
+    model_path = str(tmp_path / 'tiny.gguf')
+    build_tiny_gguf_model(model_path)
+    llm = get_chat_model({'model_type': 'llamacpp', 'gguf_model_path': model_path, 'n_ctx': 256})
+    assert llm.llama.n_threads == get_hw_profile().cpu_cores
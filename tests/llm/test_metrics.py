@@ -0,0 +1,145 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Iterator, List
+
+import pytest
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.metrics import InMemoryMetricsSink, add_metrics_sink, remove_metrics_sink, report_usage
+from qwen_agent.llm.schema import ASSISTANT, Message
+
+
+class UsageLLM(BaseFnCallModel):
+    """Reports the usage like a model service if `report` is set."""
+
+    def __init__(self, cfg=None, report: bool = True):
+        super().__init__(cfg)
+        self.report = report
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        time.sleep(0.05)
+        for i in range(1, 4):
+            yield [Message(ASSISTANT, 'hello world ' * i)]
+            time.sleep(0.01)
+        if self.report:
+            report_usage(prompt_tokens=11, completion_tokens=6, cached_tokens=4)
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        if self.report:
+            report_usage(prompt_tokens=11, completion_tokens=6)
+        return [Message(ASSISTANT, 'hello world ' * 3)]
+
+
+def test_provider_usage_no_stream():
+    sink = InMemoryMetricsSink()
+    llm = UsageLLM({'model': 'fake', 'metrics_sinks': [sink]})
+    rsp = llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)
+    metrics = rsp[-1]['extra']['metrics']
+    assert metrics['usage_source'] == 'provider'
+    assert (metrics['prompt_tokens'], metrics['completion_tokens']) == (11, 6)
+    assert metrics['ttft'] is None and metrics['latency'] > 0
+    assert sink.records()[0].to_dict() == metrics
+
+
+def test_stream_ttft_and_tokenizer_fallback():
+    llm = UsageLLM({'model': 'fake'}, report=False)
+    *_, rsp = llm.chat([{'role': 'user', 'content': 'hi'}])
+    metrics = rsp[-1]['extra']['metrics']
+    assert metrics['usage_source'] == 'tokenizer'
+    assert metrics['prompt_tokens'] > 0 and metrics['completion_tokens'] == 6
+    assert 0.05 <= metrics['ttft'] < metrics['latency']
+    assert metrics['tokens_per_second'] > 0
+
+
+
+class BatchedUsageLLM(UsageLLM):
+    """Serves the requests of `chat_batch` with one call, like the padded batches of a local model."""
+
+    def _chat_batch(self, reqs) -> List[List[Message]]:
+        return [[Message(ASSISTANT, 'hello world ' * 3)] for _ in reqs]
+
+
+def test_chat_batch_metrics_of_a_batched_backend():
+    sink = InMemoryMetricsSink()
+    llm = BatchedUsageLLM({'model': 'fake', 'max_batch_size': 2, 'metrics_sinks': [sink]}, report=False)
+    responses = llm.chat_batch([[{'role': 'user', 'content': f'q{i}'}] for i in range(3)])
+    for rsp in responses:
+        metrics = rsp[-1]['extra']['metrics']
+        assert metrics['usage_source'] == 'tokenizer'
+        assert metrics['completion_tokens'] == 6
+        assert metrics['tokens_per_second'] > 0
+    assert len(sink.records()) == 3
+
+def test_stream_provider_usage_async():
+
+    async def _run():
+        llm = UsageLLM({'model': 'fake'})
+        rsp = []
+        async for rsp in await llm.achat([{'role': 'user', 'content': 'hi'}]):
+            pass
+        return rsp
+
+    metrics = asyncio.run(_run())[-1]['extra']['metrics']
+    assert (metrics['prompt_tokens'], metrics['completion_tokens'], metrics['cached_tokens']) == (11, 6, 4)
+    assert metrics['ttft'] is not None
+
+
+def test_cache_hit_metrics():
+    sink = InMemoryMetricsSink()
+    add_metrics_sink(sink)
+    try:
+        llm = UsageLLM({'model': 'fake', 'cache_max_memory_bytes': 1024 * 1024})
+        for _ in range(2):
+            rsp = llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)
+    finally:
+        remove_metrics_sink(sink)
+    assert rsp[-1]['extra']['metrics']['cache_hit']
+    summary = sink.summary()
+    assert summary['calls'] == 2 and summary['cache_hits'] == 1
+    assert summary['prompt_tokens'] == 11
+
+
+def test_metrics_in_history_do_not_change_the_cache_key():
+    llm = UsageLLM({'model': 'fake', 'cache_max_memory_bytes': 1024 * 1024})
+    messages = [{'role': 'user', 'content': 'hi'}]
+    rsp = llm.chat(messages, stream=False)
+    llm.chat(messages + rsp + [{'role': 'user', 'content': 'again'}], stream=False)
+    rsp = llm.chat(messages + rsp + [{'role': 'user', 'content': 'again'}], stream=False)
+    assert rsp[-1]['extra']['metrics']['cache_hit']
+
+
+def test_oai_stream_usage_chunk():
+    pytest.importorskip('openai')
+    from qwen_agent.llm.metrics import MetricsRecorder
+    from qwen_agent.llm.oai import _StreamResponseParser
+
+    def _chunk(content=None, usage=None):
+        choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content else []
+        return SimpleNamespace(choices=choices, usage=usage)
+
+    chunks = [_chunk('hello'), _chunk(' world'), _chunk(usage=SimpleNamespace(prompt_tokens=9, completion_tokens=2))]
+
+    def _stream():
+        parser = _StreamResponseParser(delta_stream=False)
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+
+    recorder = MetricsRecorder(model='fake', model_type='oai', stream=True, delta_stream=False)
+    assert list(recorder.call(_stream))[-1][-1].content == 'hello world'
+    metrics = recorder.finish(prompt=[Message('user', 'hi')])
+    assert (metrics.usage_source, metrics.prompt_tokens, metrics.completion_tokens) == ('provider', 9, 2)
@@ -0,0 +1,73 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import weakref
+
+from qwen_agent.llm.model_registry import ModelRegistry
+
+
+class FakeModel:
+
+    def __init__(self, name: str, num_bytes: int):
+        self.name = name
+        self.num_bytes = num_bytes
+
+    def get_memory_footprint(self):
+        return self.num_bytes
+
+
+def _loader(name: str, num_bytes: int, loads: list):
+
+    def _load():
+        loads.append(name)
+        return FakeModel(name, num_bytes)
+
+    return _load
+
+
+def test_shared_weights_and_lru_eviction():
+    registry = ModelRegistry(gpu_budget_bytes=100)
+    loads = []
+    a1 = registry.acquire('a', _loader('a', 40, loads), device='cuda')
+    a2 = registry.acquire('a', _loader('a', 40, loads), device='cuda')
+    assert a1.get() is a2.get() and loads == ['a']  # Loaded once for both instances
+
+    b = registry.acquire('b', _loader('b', 40, loads), device='cuda')
+    model_b = weakref.ref(b.get())
+    a1.get()  # `b` becomes the least recently used
+    c = registry.acquire('c', _loader('c', 40, loads), device='cuda')
+    assert a1.loaded and c.loaded and not b.loaded
+    assert model_b() is None  # Evicting frees the memory, since the instances only keep the handle
+
+    assert b.get().name == 'b' and loads == ['a', 'b', 'c', 'b']  # Loaded again on its next use
+    assert not a1.loaded
+    stats = registry.stats()
+    assert stats['used']['cuda'] == 80
+    # `b` is evicted after loading `c`, whose size was unknown, and `a` before loading `b` again, whose size is known.
+    assert [(e['event'], e['key']) for e in registry.events()] == [('load', 'a'), ('load', 'b'), ('load', 'c'),
+                                                                   ('evict', 'b'), ('evict', 'a'), ('load', 'b')]
+
+
+def test_models_in_use_are_not_evicted():
+    registry = ModelRegistry(cpu_budget_bytes=100)
+    loads = []
+    a = registry.acquire('a', _loader('a', 60, loads), device='cpu')
+    gpu = registry.acquire('gpu', _loader('gpu', 60, loads), device='cuda:0')  # Another budget, unlimited
+    with a.use():
+        b = registry.acquire('b', _loader('b', 60, loads), device='cpu')
+        assert a.loaded and b.loaded  # Over the budget, but `a` is generating
+    assert gpu.loaded
+    assert registry.evict('a') and not a.loaded
+    with b.use():
+        assert not registry.evict('b')
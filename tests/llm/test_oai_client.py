@@ -0,0 +1,97 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from qwen_agent.llm import get_chat_model
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        out = json.dumps({
+            'id': 'x',
+            'object': 'chat.completion',
+            'created': 0,
+            'model': 'stub',
+            'choices': [{
+                'index': 0,
+                'message': {
+                    'role': 'assistant',
+                    'content': 'pong'
+                },
+                'finish_reason': 'stop'
+            }],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+@pytest.fixture
+def base_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubHandler.connections = 0
+    yield f'http://127.0.0.1:{server.server_address[1]}/v1'
+    server.shutdown()
+
+
+def _llm(base_url: str, **kwargs):
+    return get_chat_model({'model': 'stub', 'model_server': base_url, 'api_key': 'EMPTY', **kwargs})
+
+
+def test_connections_are_reused(base_url):
+    llm1, llm2 = _llm(base_url), _llm(base_url)
+    for llm in [llm1, llm2, llm1]:
+        assert llm.chat([{'role': 'user', 'content': 'ping'}], stream=False)[-1]['content'] == 'pong'
+    assert llm1.clients.get() is llm1.clients.get()
+    assert llm1.clients.get()._client is llm2.clients.get()._client  # The connection pool is shared
+    assert StubHandler.connections == 1
+
+
+def test_unshared_http_client(base_url):
+    llm1 = _llm(base_url, http_client={'shared': False, 'timeout': 30})
+    llm2 = _llm(base_url)
+    assert llm1.clients.get()._client is not llm2.clients.get()._client
+    assert llm1.clients.get().timeout.read == 30
+
+
+def test_async_client_per_event_loop(base_url):
+    llm = _llm(base_url)
+
+    async def _chat():
+        return await llm.achat([{'role': 'user', 'content': 'ping'}], stream=False), llm.clients.aget()
+
+    rsp1, client1 = asyncio.run(_chat())
+    rsp2, client2 = asyncio.run(_chat())  # A new event loop can't use the connections of the closed one
+    assert rsp1[-1]['content'] == rsp2[-1]['content'] == 'pong'
+    assert client1 is not client2
@@ -0,0 +1,113 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import httpx
+import openai
+import pytest
+
+from qwen_agent.llm import ModelServiceError, TextChatAtOAIPool, get_chat_model
+from qwen_agent.llm.schema import ASSISTANT, Message
+
+
+def _connection_error() -> ModelServiceError:
+    return ModelServiceError(exception=openai.APIConnectionError(request=httpx.Request('POST', 'http://x/v1')))
+
+
+class FakeEndpoint:
+
+    def __init__(self, name: str, delay: float = 0.0):
+        self.name = name
+        self.delay = delay
+        self.down = False
+        self.calls = 0
+
+    def chat_no_stream(self, messages, generate_cfg):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.down:
+            raise _connection_error()
+        return [Message(ASSISTANT, self.name)]
+
+    def chat_stream(self, messages, delta_stream, generate_cfg):
+        self.calls += 1
+        if self.down:
+            raise _connection_error()
+        for i in range(1, 4):
+            yield [Message(ASSISTANT, self.name * i)]
+
+
+def _pool(num_endpoints: int, **kwargs):
+    llm = get_chat_model({
+        'model': 'fake',
+        'model_servers': [f'http://10.0.0.{i}:8000/v1' for i in range(num_endpoints)],
+        **kwargs,
+    })
+    assert isinstance(llm, TextChatAtOAIPool)
+    fakes = []
+    for i, ep in enumerate(llm.pool.endpoints):
+        fake = FakeEndpoint(str(i), delay=0.1)
+        ep.llm._chat_no_stream = fake.chat_no_stream
+        ep.llm._chat_stream = fake.chat_stream
+        fakes.append(fake)
+    return llm, fakes
+
+
+def test_least_outstanding_routing():
+    llm, fakes = _pool(3)
+    assert llm.max_batch_size == 24
+    llm.chat_batch([[{'role': 'user', 'content': f'q{i}'}] for i in range(6)])
+    assert [f.calls for f in fakes] == [2, 2, 2]
+    assert all(s['in_flight'] == 0 and s['ewma_latency'] >= 0.1 for s in llm.endpoint_stats())
+
+
+def test_failover_ejection_and_probe():
+    llm, fakes = _pool(2, eject_seconds=0.3)
+    fakes[0].down = True
+    for fake in fakes:
+        fake.delay = 0.0
+
+    *_, rsp = llm.chat([{'role': 'user', 'content': 'hi'}])
+    assert rsp[-1]['content'] == '111'
+    rsp = llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)
+    assert rsp[-1]['content'] == '1'
+    stats = llm.endpoint_stats()
+    assert (not stats[0]['healthy']) and stats[0]['num_failures'] == 1 and stats[1]['healthy']
+
+    # While ejected, endpoint 0 gets no requests.
+    calls = fakes[0].calls
+    for _ in range(3):
+        llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)
+    assert fakes[0].calls == calls
+
+    # Once the ejection is over, a request probes it back in.
+    fakes[0].down = False
+    time.sleep(0.35)
+    rsp = llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)
+    assert rsp[-1]['content'] == '0'
+    assert llm.endpoint_stats()[0]['healthy']
+
+
+def test_request_errors_are_not_failed_over():
+    llm, fakes = _pool(2)
+
+    def bad_request(messages, generate_cfg):
+        raise ModelServiceError(code='400', message='Bad request')
+
+    for ep in llm.pool.endpoints:
+        ep.llm._chat_no_stream = bad_request
+    with pytest.raises(ModelServiceError):
+        llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)
+    assert all(s['healthy'] for s in llm.endpoint_stats())
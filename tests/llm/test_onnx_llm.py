@@ -0,0 +1,83 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+pytest.importorskip('transformers')
+
+import numpy as np  # noqa: E402
+from tiny_onnx_model import build_tiny_onnx_model  # noqa: E402
+
+from qwen_agent.llm import get_chat_model  # noqa: E402
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+GREEDY = {'do_sample': False, 'max_new_tokens': 12}
+
+
+@pytest.fixture(scope='module')
+def llm(tmp_path_factory):
+    model_dir = str(tmp_path_factory.mktemp('tiny_onnx'))
+    build_tiny_onnx_model(model_dir)
+    return get_chat_model({'model_type': 'onnxruntime', 'onnx_model_dir': model_dir, 'num_threads': 1})
+
+
+def _greedy_without_cache(llm, input_ids: list, max_new_tokens: int) -> list:
+    output_ids = []
+    for _ in range(max_new_tokens):
+        ids = np.asarray([input_ids + output_ids], dtype=np.int64)
+        feed = {'input_ids': ids, 'attention_mask': np.ones_like(ids), 'position_ids': np.arange(ids.shape[1])[None]}
+        feed.update(llm._io.empty_past())
+        logits = llm.session.run(['logits'], feed)[0]
+        output_ids.append(int(np.argmax(logits[0, -1])))
+    return output_ids
+
+
+def test_kv_cache_decoding_matches_full_recompute(llm):
+    from qwen_agent.llm.schema import Message
+
+    input_ids = llm._get_input_ids([Message('user', 'hello')])
+    expected = _greedy_without_cache(llm, input_ids, GREEDY['max_new_tokens'])
+    *_, rsp = llm.chat(MESSAGES, extra_generate_cfg=GREEDY)
+    assert rsp[-1]['content'] == llm.tokenizer.decode(expected, skip_special_tokens=True)
+
+    # The deltas of the stream add up to the response.
+    deltas = [r[-1]['content'] for r in llm.chat(MESSAGES, extra_generate_cfg=GREEDY, delta_stream=True)]
+    assert ''.join(deltas) == rsp[-1]['content']
+    assert llm.chat(MESSAGES, extra_generate_cfg=GREEDY, stream=False)[-1]['content'] == rsp[-1]['content']
+
+
+def test_stops_at_stop_words(llm):
+    *_, rsp = llm.chat(MESSAGES, extra_generate_cfg=GREEDY)
+    words = rsp[-1]['content'].split()
+    # A word that doesn't occur earlier in the response, not even as part of a word
+    i = next(i for i in range(2, len(words)) if words[i] not in ' '.join(words[:i]))
+    *_, rsp = llm.chat(MESSAGES, extra_generate_cfg={**GREEDY, 'stop': [words[i]]})
+    assert rsp[-1]['content'].split() == words[:i]
+
+
+def test_function_calling_prompt(llm, monkeypatch):
+    prompts = []
+    get_input_ids = type(llm)._get_input_ids
+
+    def _get_input_ids(self, messages):
+        prompts.append(messages)
+        return get_input_ids(self, messages)
+
+    monkeypatch.setattr(type(llm), '_get_input_ids', _get_input_ids)
+    functions = [{'name': 'get_weather', 'description': 'Gets the weather', 'parameters': {'type': 'object'}}]
+    *_, rsp = llm.chat(MESSAGES, functions=functions, extra_generate_cfg=GREEDY)
+    assert rsp and rsp[-1]['role'] == 'assistant'
+    assert 'get_weather' in prompts[-1][0].content  # The functions are described in the system message
@@ -0,0 +1,45 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from qwen_agent.llm.openvino import _BatchStreamer, _get_ov_config
+from qwen_agent.llm.request_batcher import BatchRequest
+
+
+def test_ov_config(tmp_path, monkeypatch):
+    monkeypatch.delenv('QWEN_AGENT_OV_CACHE_DIR', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert _get_ov_config({}, 'latency') == {
+        'CACHE_DIR': str(tmp_path / 'qwen_agent' / 'openvino'),
+        'PERFORMANCE_HINT': 'LATENCY',
+    }
+    assert _get_ov_config({'ov_cache_dir': ''}, 'throughput') == {'PERFORMANCE_HINT': 'THROUGHPUT', 'NUM_STREAMS': '1'}
+
+    # The configured ov_config takes precedence.
+    monkeypatch.setenv('QWEN_AGENT_OV_CACHE_DIR', '/env/cache')
+    ov_config = _get_ov_config({'ov_config': {'NUM_STREAMS': '2', 'CACHE_DIR': '/my/cache'}}, 'throughput')
+    assert ov_config == {'CACHE_DIR': '/my/cache', 'PERFORMANCE_HINT': 'THROUGHPUT', 'NUM_STREAMS': '2'}
+    assert _get_ov_config({}, 'latency')['CACHE_DIR'] == '/env/cache'
+
+
+def test_batch_streamer_dispatches_the_tokens_of_each_sequence():
+    requests = [BatchRequest(None, None) for _ in range(3)]
+    streamer = _BatchStreamer(requests, end_token_ids={0, 9})
+    streamer.put(np.array([[5, 5, 5], [0, 6, 6], [0, 0, 7]]))  # The left-padded prompts
+    streamer.put(np.array([1, 2, 9]))
+    streamer.put(np.array([3, 0, 0]))  # The finished sequences are padded
+    streamer.put(np.array([4, 0, 0]))
+    streamer.end()
+    assert [list(r.token_ids()) for r in requests] == [[1, 3, 4], [2], []]
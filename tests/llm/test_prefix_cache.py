@@ -0,0 +1,103 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from qwen_agent.llm.continuous_batching import ContinuousBatchingEngine  # noqa: E402
+from qwen_agent.llm.kv_cache import PrefixKVCache, cache_to_tensors, tensors_to_cache  # noqa: E402
+
+
+def _kv(token_ids):
+    t = torch.tensor(token_ids, dtype=torch.float32).reshape(1, 1, -1, 1)
+    return [[t, t.clone()]]
+
+
+def test_longest_prefix_and_lru():
+    cache = PrefixKVCache(max_bytes=2 * 2 * 16 * 4, block_size=4)  # Room for two entries of 16 tokens
+    a, b, c = [list(range(s, s + 16)) for s in (100, 200, 300)]
+    assert cache.lookup(a) == (0, None)
+    cache.store(a, _kv(a))
+    length, kv = cache.lookup(a[:10] + [1, 2])
+    assert length == 8 and kv[0][0].flatten().tolist() == a[:8]
+    assert cache.lookup(a)[0] == 12  # At least one token is left to prefill
+
+    cache.store(b, _kv(b))
+    cache.lookup(a + [1])  # `a` becomes the most recently used
+    cache.store(c, _kv(c))
+    assert cache.lookup(b + [1])[0] == 0
+    assert cache.lookup(a + [1])[0] == cache.lookup(c + [1])[0] == 16
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['bytes'] <= cache.max_bytes
+    assert stats['hits'] == 5 and stats['lookups'] == 7
+
+
+@pytest.fixture(scope='module')
+def tiny_model():
+    torch.manual_seed(0)
+    config = transformers.Qwen2Config(vocab_size=64,
+                                      hidden_size=32,
+                                      intermediate_size=64,
+                                      num_hidden_layers=2,
+                                      num_attention_heads=4,
+                                      num_key_value_heads=2,
+                                      max_position_embeddings=256)
+    model = transformers.Qwen2ForCausalLM(config).eval()
+    model.generation_config.eos_token_id = None
+    model.generation_config.pad_token_id = 0
+    return model
+
+
+def test_generate_from_cached_prefix(tiny_model):
+    cache = PrefixKVCache(max_bytes=1 << 30, block_size=8)
+    turn1 = list(range(1, 41))
+    with torch.no_grad():
+        output = tiny_model.generate(torch.tensor([turn1]),
+                                     max_new_tokens=8,
+                                     do_sample=False,
+                                     return_dict_in_generate=True)
+    cache.store(output.sequences[0].tolist(), cache_to_tensors(output.past_key_values))
+
+    turn2 = output.sequences[0].tolist() + [5, 6, 7]
+    length, kv = cache.lookup(turn2)
+    assert length == 40
+    with torch.no_grad():
+        expected = tiny_model.generate(torch.tensor([turn2]), max_new_tokens=8, do_sample=False)
+        cached = tiny_model.generate(torch.tensor([turn2]),
+                                     past_key_values=tensors_to_cache(kv),
+                                     max_new_tokens=8,
+                                     do_sample=False)
+    assert cached.tolist() == expected.tolist()
+
+
+def test_engine_with_prefix_cache(tiny_model):
+
+    class CharTokenizer:
+        eos_token_id = None
+
+        def decode(self, ids, skip_special_tokens=True):
+            return ''.join(chr(ord('a') + i % 26) for i in ids)
+
+    plain = ContinuousBatchingEngine(tiny_model, CharTokenizer(), max_batch_size=2)
+    engine = ContinuousBatchingEngine(tiny_model,
+                                      CharTokenizer(),
+                                      max_batch_size=2,
+                                      prefix_cache=PrefixKVCache(max_bytes=1 << 30, block_size=8))
+    system = list(range(1, 33))
+    for question in ([40, 41], [42, 43, 44]):
+        cfg = {'max_new_tokens': 6, 'do_sample': False}
+        assert engine.generate(system + question, cfg) == plain.generate(system + question, cfg)
+    assert engine.prefix_cache.stats()['hit_tokens'] == 32  # The second prompt reuses the system prompt
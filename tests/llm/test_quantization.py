@@ -0,0 +1,67 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from qwen_agent.llm.quantization import INT8_DYNAMIC, resolve_quantization
+
+
+def test_resolve_quantization():
+    assert resolve_quantization('int4', 'cpu') == INT8_DYNAMIC  # bitsandbytes needs CUDA
+    assert resolve_quantization('int8', 'cuda') == 'int8'
+    assert resolve_quantization(INT8_DYNAMIC, 'cpu') == INT8_DYNAMIC
+    assert resolve_quantization(INT8_DYNAMIC, 'cuda:0') is None
+    assert resolve_quantization('none', 'cpu') is None and resolve_quantization(None, 'cpu') is None
+
+
+def test_saved_int8_model_skips_quantizing(tmp_path):
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('transformers')
+    from qwen_agent.llm.quantization import load_dynamic_int8
+
+    class TinyModel(torch.nn.Module):
+
+        def __init__(self):
+            super().__init__()
+            self.embed = torch.nn.Embedding(32, 16)
+            self.layers = torch.nn.Sequential(torch.nn.Linear(16, 64), torch.nn.ReLU(), torch.nn.Linear(64, 16))
+            self.lm_head = torch.nn.Linear(16, 32, bias=False)
+
+        @classmethod
+        def _from_config(cls, config, torch_dtype=None):
+            return cls()
+
+        def forward(self, input_ids):
+            return self.lm_head(self.layers(self.embed(input_ids)))
+
+    torch.manual_seed(0)
+    float_model = TinyModel()
+    state = {k: v.clone() for k, v in float_model.state_dict().items()}
+    loads = []
+
+    def _load_float():
+        loads.append(1)
+        model = TinyModel()
+        model.load_state_dict(state)
+        return model
+
+    input_ids = torch.arange(8).unsqueeze(0)
+    quantized = load_dynamic_int8(_load_float, str(tmp_path / 'tiny'), None, TinyModel, save_dir=str(tmp_path))
+    assert isinstance(quantized.lm_head, torch.ao.nn.quantized.dynamic.Linear)
+    expected = quantized(input_ids)
+    assert torch.allclose(expected, float_model(input_ids), atol=0.1)
+
+    loaded = load_dynamic_int8(_load_float, str(tmp_path / 'tiny'), None, TinyModel, save_dir=str(tmp_path))
+    assert len(loads) == 1  # The second load reads the saved int8 weights
+    assert torch.equal(loaded(input_ids), expected)
@@ -0,0 +1,90 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+from qwen_agent.llm.request_batcher import RequestBatcher
+
+
+class _Model:
+    """Generates the payload of each request three times, recording the batches."""
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def run_batch(self, requests):
+        self.release.wait()
+        self.batches.append([r.payload for r in requests])
+        if any(r.payload == 'bad' for r in requests):
+            raise RuntimeError('generate failed')
+        for _ in range(3):
+            for r in requests:
+                r.put(r.payload)
+
+
+def test_waiting_requests_with_the_same_key_share_a_batch():
+    model = _Model()
+    batcher = RequestBatcher(model.run_batch, max_batch_size=2)
+    model.release.clear()
+    first = batcher.submit(1, batch_key='a')
+    while not batcher.stats()['batches']:
+        time.sleep(0.001)  # The first batch started, and waits for the release
+    others = [batcher.submit(2, batch_key='a'), batcher.submit(3, batch_key='b'), batcher.submit(4, batch_key='a')]
+    model.release.set()
+
+    assert list(first.token_ids()) == [1, 1, 1]
+    assert [list(r.token_ids()) for r in others] == [[2, 2, 2], [3, 3, 3], [4, 4, 4]]
+    assert model.batches == [[1], [2, 4], [3]]
+    assert batcher.stats()['max_batch_size'] == 2
+
+
+def test_max_wait_collects_the_requests_that_arrive_meanwhile():
+    model = _Model()
+    batcher = RequestBatcher(model.run_batch, max_batch_size=4, max_wait=0.5)
+    requests = [batcher.submit(1)]
+    time.sleep(0.05)
+    requests.append(batcher.submit(2))
+    assert [list(r.token_ids()) for r in requests] == [[1, 1, 1], [2, 2, 2]]
+    assert model.batches == [[1, 2]]
+
+
+def test_errors_and_cancellation():
+    model = _Model()
+    batcher = RequestBatcher(model.run_batch, max_batch_size=1)
+    model.release.clear()
+    running = batcher.submit('bad')
+    while not batcher.stats()['batches']:
+        time.sleep(0.001)
+    cancelled = batcher.submit('cancelled')
+    cancelled.cancel()
+    after = batcher.submit('ok')
+    model.release.set()
+
+    with pytest.raises(RuntimeError, match='generate failed'):
+        list(running.token_ids())
+    assert list(cancelled.token_ids()) == []
+    assert list(after.token_ids()) == ['ok'] * 3
+    assert model.batches == [['bad'], ['ok']]  # The cancelled request never ran
+
+
+def test_finished_requests_ignore_the_rest_of_their_batch():
+    batcher = RequestBatcher(lambda requests: [requests[0].put(7), requests[0].finish(), requests[0].put(8)], 1)
+    request = batcher.submit(None)
+    assert list(request.token_ids()) == [7]
+    assert request.num_tokens == 1
@@ -0,0 +1,73 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+from qwen_agent.llm.stop_words import StopSequenceDetector, get_stop_word_matcher
+
+
+def _truncate_sequentially(text, stop):
+    truncated = False
+    for s in stop:
+        k = text.find(s)
+        if k >= 0:
+            truncated = True
+            text = text[:k]
+    return truncated, text
+
+
+def test_truncate_matches_sequential_truncation():
+    rng = random.Random(0)
+    for _ in range(2000):
+        stop = [''.join(rng.choice('abc') for _ in range(rng.randint(1, 3))) for _ in range(rng.randint(1, 4))]
+        text = ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 30)))
+        matcher = get_stop_word_matcher(stop)
+        expected = _truncate_sequentially(text, stop)
+        assert matcher.truncate(text) == expected
+
+        # Resuming the scan of a growing text from a prefix without stop words gives the same result.
+        prefix = text[:rng.randint(0, len(text))]
+        if not _truncate_sequentially(prefix, stop)[0]:
+            assert matcher.truncate(text, scanned=len(prefix)) == expected
+
+
+def test_matcher_is_shared_and_removes_partial_stop_words():
+    stop = ['Observation:', '<|im_end|>']
+    matcher = get_stop_word_matcher(stop)
+    assert get_stop_word_matcher(list(stop)) is matcher
+    assert matcher.remove_partial_stop('The answer.\nObservation') == 'The answer.\n'
+    assert matcher.remove_partial_stop('The answer.') == 'The answer.'
+
+
+class ByteTokenizer:
+    # Every byte is a token, so a multi-byte character is split across tokens like in byte-level BPE.
+
+    def decode(self, ids, skip_special_tokens=True):
+        return bytes(ids).decode('utf-8', errors='replace')
+
+
+def test_detector_matches_decoding_the_whole_output():
+    rng = random.Random(0)
+    tokenizer = ByteTokenizer()
+    for _ in range(500):
+        stop = [''.join(rng.choice('ab✿') for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 3))]
+        output_ids = list(''.join(rng.choice('abc✿') for _ in range(rng.randint(0, 20))).encode('utf-8'))
+        detector = StopSequenceDetector(stop, tokenizer)
+        length = 0
+        while length < len(output_ids):
+            length = min(len(output_ids), length + rng.randint(1, 3))  # Assisted decoding adds several tokens
+            expected = any(s in tokenizer.decode(output_ids[:length]) for s in stop)
+            assert detector.update(output_ids[:length]) == expected
+            if expected:
+                break
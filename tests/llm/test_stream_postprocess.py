@@ -0,0 +1,77 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from typing import Iterator, List
+
+import pytest
+
+from qwen_agent.llm.function_calling import BaseFnCallModel
+from qwen_agent.llm.schema import ASSISTANT, ContentItem, Message
+
+
+class StubLLM(BaseFnCallModel):
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        raise NotImplementedError
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        raise NotImplementedError
+
+
+PIECES = [
+    'Let me check. ', 'Observ', 'ation', ':', ' result', '<|im_', 'end|>', '<tool_call>\n', '{"name": "get_weather", ',
+    '"arguments": {"city": "Hangzhou"}}', '\n</tool_call>', '\n', '✿FUNCTION✿: get_weather\n✿ARGS✿: {"city": "Beijing"}',
+    '\n✿RESULT✿', 'The weather is sunny.', '<think>', 'hmm', '</think>'
+]
+
+
+def _random_stream(rng: random.Random) -> List[List[Message]]:
+    # Every chunk carries the whole response so far, as in the full stream mode.
+    texts, chunks = [''], []
+    for _ in range(rng.randint(1, 40)):
+        if rng.random() < 0.05:
+            texts.append('')  # e.g., the response moves on from the reasoning content to the answer
+        texts[-1] += rng.choice(PIECES)
+        chunks.append([Message(ASSISTANT, [ContentItem(text=t)]) for t in texts])
+    return chunks
+
+
+@pytest.mark.parametrize('fncall_prompt_type', ['nous', 'qwen'])
+@pytest.mark.parametrize('fncall_mode', [False, True])
+def test_stream_postprocess_matches_per_chunk_postprocess(fncall_prompt_type, fncall_mode):
+    llm = StubLLM({'model': 'stub', 'generate_cfg': {'fncall_prompt_type': fncall_prompt_type}})
+    generate_cfg = {'stop': llm.generate_cfg.get('stop', []) + ['Observation:', '<|im_end|>']}
+    if fncall_mode:
+        generate_cfg['parallel_function_calls'] = True
+    rng = random.Random(0)
+    for _ in range(200):
+        chunks = _random_stream(rng)
+        expected = [llm._postprocess_messages(c, fncall_mode=fncall_mode, generate_cfg=generate_cfg) for c in chunks]
+        actual = list(
+            llm._postprocess_messages_iterator(iter(chunks), fncall_mode=fncall_mode, generate_cfg=generate_cfg))
+        assert [[m.model_dump() for m in x] for x in actual] == [[m.model_dump() for m in x] for x in expected]
+
+
+def test_stream_postprocess_falls_back_for_custom_postprocess():
+
+    class CustomLLM(StubLLM):
+
+        def _postprocess_messages(self, messages, fncall_mode, generate_cfg):
+            return [Message(ASSISTANT, f'{len(messages[-1].content)} chars')]
+
+    llm = CustomLLM({'model': 'stub'})
+    chunks = [[Message(ASSISTANT, 'a' * n)] for n in range(1, 4)]
+    actual = list(llm._postprocess_messages_iterator(iter(chunks), fncall_mode=False, generate_cfg={}))
+    assert [x[0].content for x in actual] == ['1 chars', '2 chars', '3 chars']
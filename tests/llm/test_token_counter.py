@@ -0,0 +1,58 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from qwen_agent.llm.base import _truncate_input_messages_roughly
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, FunctionCall, Message
+from qwen_agent.llm.token_counter import MessageTokenCounter, message_digest, message_token_counter
+from qwen_agent.utils.tokenization_qwen import tokenizer
+from qwen_agent.utils.utils import derive_message
+
+
+def test_message_token_counter():
+    counter = MessageTokenCounter()
+    msg = Message(USER, 'hello world, ' * 20)
+    assert counter.count(msg) == tokenizer.count_tokens(msg.content.strip())
+    assert counter.count(Message(USER, 'hello world, ' * 20)) == counter.count(msg)
+    assert counter.stats()['tokenizer_calls'] == 1
+    assert counter.stats()['tokenizer_calls_saved'] == 2
+
+    fn_call = Message(ASSISTANT, '', function_call=FunctionCall(name='f', arguments='{"x": 1}'))
+    assert counter.count(fn_call) == tokenizer.count_tokens(f'{fn_call.function_call}')
+    assert counter.stats()['tokenizer_calls'] == 2
+
+
+def test_digest_follows_assigned_fields():
+    msg = Message(USER, 'hello')
+    digest = message_digest(msg)
+    assert message_digest(msg) == digest
+    assert msg == Message(USER, 'hello')  # The memo isn't part of the message
+    msg.content = 'hello world'
+    assert message_digest(msg) == message_digest(Message(USER, 'hello world')) != digest
+    assert message_digest(derive_message(msg, content='bye')) == message_digest(Message(USER, 'bye'))
+
+
+def test_truncation_only_tokenizes_new_messages():
+    message_token_counter.clear()
+    messages = [Message(SYSTEM, 'You are a helpful assistant.'), Message(USER, 'Plan a trip.')]
+    for step in range(10):
+        stats_before = message_token_counter.stats()
+        _truncate_input_messages_roughly(messages=messages, max_tokens=100000)
+        # Only the two messages appended since the previous step (or the initial two) are tokenized, and serialized.
+        stats = message_token_counter.stats()
+        assert stats['tokenizer_calls'] - stats_before['tokenizer_calls'] == 2
+        assert stats['serialized_messages'] - stats_before['serialized_messages'] == 2
+        messages = messages + [
+            Message(ASSISTANT, '', function_call=FunctionCall(name='search', arguments=f'{{"step": {step}}}')),
+            Message(FUNCTION, f'result {step} ' * 50, name='search'),
+        ]
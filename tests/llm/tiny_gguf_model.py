@@ -0,0 +1,104 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Builds a tiny randomly initialized llama model in a GGUF file, with a byte-level BPE vocabulary and the ChatML
+template, for the offline tests of the llama.cpp backend. Run `python tests/llm/tiny_gguf_model.py FILE` to write it."""
+
+import sys
+
+import numpy as np
+
+SPECIAL_TOKENS = ['<|endoftext|>', '<|im_start|>', '<|im_end|>']
+CHAT_TEMPLATE = ('{% for message in messages %}<|im_start|>{{ message.role }}\n{{ message.content }}<|im_end|>\n'
+                 '{% endfor %}{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}')
+NUM_LAYERS, NUM_HEADS, HEAD_DIM, FFN = 2, 2, 16, 64
+HIDDEN = NUM_HEADS * HEAD_DIM
+
+
+def _byte_tokens() -> list:
+    # The printable characters that stand for the 256 bytes in the byte-level BPE of GPT-2
+    printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(
+        range(ord('®'), ord('ÿ') + 1))
+    chars, n = {}, 0
+    for b in range(256):
+        if b in printable:
+            chars[b] = chr(b)
+        else:
+            chars[b] = chr(256 + n)
+            n += 1
+    return [chars[b] for b in range(256)]
+
+
+def build_tiny_gguf_model(path: str, seed: int = 0) -> None:
+    import gguf
+
+    byte_tokens = _byte_tokens()
+    tokens = byte_tokens + ['ab'] + SPECIAL_TOKENS
+    token_types = [gguf.TokenType.NORMAL] * (len(tokens) - len(SPECIAL_TOKENS)) + [gguf.TokenType.CONTROL] * len(
+        SPECIAL_TOKENS)
+    vocab_size = len(tokens)
+    rng = np.random.default_rng(seed)
+
+    writer = gguf.GGUFWriter(path, 'llama')
+    writer.add_name('tiny-llama')
+    writer.add_context_length(512)
+    writer.add_embedding_length(HIDDEN)
+    writer.add_block_count(NUM_LAYERS)
+    writer.add_feed_forward_length(FFN)
+    writer.add_head_count(NUM_HEADS)
+    writer.add_head_count_kv(NUM_HEADS)
+    writer.add_layer_norm_rms_eps(1e-6)
+    writer.add_rope_dimension_count(HEAD_DIM)
+    writer.add_file_type(gguf.LlamaFileType.ALL_F32)
+
+    writer.add_tokenizer_model('gpt2')
+    writer.add_tokenizer_pre('qwen2')
+    writer.add_token_list(tokens)
+    writer.add_token_types(token_types)
+    writer.add_token_merges(['a b'])
+    writer.add_eos_token_id(tokens.index('<|im_end|>'))
+    writer.add_bos_token_id(tokens.index('<|endoftext|>'))
+    writer.add_add_bos_token(False)
+    writer.add_chat_template(CHAT_TEMPLATE)
+
+    def _weight(*shape):
+        return (rng.standard_normal(shape) / np.sqrt(shape[-1])).astype(np.float32)
+
+    # Only the printable ASCII characters are generated, so that the responses are valid text: the other tokens have
+    # zero logits, which are below the largest logit of the printable ones.
+    output = _weight(vocab_size, HIDDEN) * 4
+    printable = [byte_tokens.index(chr(c)) for c in range(ord('!'), ord('~') + 1)] + [byte_tokens.index('Ġ')]
+    mask = np.zeros((vocab_size, 1), dtype=np.float32)
+    mask[printable] = 1
+    output *= mask
+
+    writer.add_tensor('token_embd.weight', _weight(vocab_size, HIDDEN))
+    for i in range(NUM_LAYERS):
+        writer.add_tensor(f'blk.{i}.attn_norm.weight', np.ones(HIDDEN, dtype=np.float32))
+        for name in ('attn_q', 'attn_k', 'attn_v', 'attn_output'):
+            writer.add_tensor(f'blk.{i}.{name}.weight', _weight(HIDDEN, HIDDEN))
+        writer.add_tensor(f'blk.{i}.ffn_norm.weight', np.ones(HIDDEN, dtype=np.float32))
+        writer.add_tensor(f'blk.{i}.ffn_gate.weight', _weight(FFN, HIDDEN))
+        writer.add_tensor(f'blk.{i}.ffn_up.weight', _weight(FFN, HIDDEN))
+        writer.add_tensor(f'blk.{i}.ffn_down.weight', _weight(HIDDEN, FFN))
+    writer.add_tensor('output_norm.weight', np.ones(HIDDEN, dtype=np.float32))
+    writer.add_tensor('output.weight', output)
+
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+
+if __name__ == '__main__':
+    build_tiny_gguf_model(sys.argv[1])
@@ -0,0 +1,135 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Builds a tiny randomly initialized decoder in the ONNX layout exported by optimum, for the offline tests of the
+onnxruntime backend. Run `python tests/llm/tiny_onnx_model.py DIR` to write it, e.g., to smoke-test the benchmark."""
+
+import sys
+
+import numpy as np
+
+SPECIAL_TOKENS = ['[UNK]', '<|endoftext|>', '<|im_start|>', '<|im_end|>']
+WORDS = ['system', 'user', 'assistant', 'You', 'are', 'a', 'helpful', 'hello', 'count'] + [f'w{i}' for i in range(51)]
+CHAT_TEMPLATE = ('{% for message in messages %}<|im_start|>{{ message.role }}\n{{ message.content }}<|im_end|>\n'
+                 '{% endfor %}{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}')
+NUM_LAYERS, NUM_HEADS, HEAD_DIM = 2, 2, 8
+HIDDEN = NUM_HEADS * HEAD_DIM
+
+
+def build_tiny_onnx_model(model_dir: str, seed: int = 0) -> None:
+    import onnx
+    from onnx import TensorProto, helper
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + WORDS)}
+    vocab_size = len(vocab)
+    eos = vocab['<|im_end|>']
+    rng = np.random.default_rng(seed)
+
+    nodes, initializers = [], []
+
+    def weight(name, shape, scale=0.5):
+        initializers.append(helper.make_tensor(name, TensorProto.FLOAT, shape, rng.normal(0, scale, shape).ravel()))
+        return name
+
+    def const(name, values, dtype=TensorProto.INT64):
+        initializers.append(helper.make_tensor(name, dtype, [len(values)], values))
+        return name
+
+    def node(op, inputs, output, **attrs):
+        nodes.append(helper.make_node(op, inputs, [output], **attrs))
+        return output
+
+    const('heads_shape', [0, 0, NUM_HEADS, HEAD_DIM])
+    const('hidden_shape', [0, 0, HIDDEN])
+    const('zero', [0])
+    const('one', [1])
+    const('two', [2])
+    initializers.append(helper.make_tensor('scale', TensorProto.FLOAT, [], [HEAD_DIM**-0.5]))
+    initializers.append(helper.make_tensor('neg_inf', TensorProto.FLOAT, [], [-1e9]))
+    initializers.append(helper.make_tensor('step', TensorProto.INT64, [], [1]))
+
+    # The causal mask of the new positions over the past and the new positions
+    node('Shape', ['input_ids'], 'ids_shape')
+    node('Gather', ['ids_shape', 'one'], 'new_len_1d', axis=0)
+    node('Shape', ['past_key_values.0.key'], 'past_shape')
+    node('Gather', ['past_shape', 'two'], 'past_len_1d', axis=0)
+    node('Add', ['past_len_1d', 'new_len_1d'], 'total_len_1d')
+    node('Squeeze', ['past_len_1d', 'zero'], 'past_len')
+    node('Squeeze', ['total_len_1d', 'zero'], 'total_len')
+    node('Range', ['past_len', 'total_len', 'step'], 'q_pos')
+    node('Range', [node('Squeeze', ['zero', 'zero'], 'zero_scalar'), 'total_len', 'step'], 'k_pos')
+    node('LessOrEqual', [node('Unsqueeze', ['k_pos', 'zero'], 'k_row'),
+                         node('Unsqueeze', ['q_pos', 'one'], 'q_col')], 'causal')
+
+    hidden = node('Gather', [weight('embed', [vocab_size, HIDDEN]), 'input_ids'], 'embeds')
+    for layer in range(NUM_LAYERS):
+        heads = {}
+        for proj in ('q', 'k', 'v'):
+            x = node('MatMul', [hidden, weight(f'{proj}{layer}', [HIDDEN, HIDDEN])], f'{proj}{layer}_x')
+            x = node('Reshape', [x, 'heads_shape'], f'{proj}{layer}_heads')
+            heads[proj] = node('Transpose', [x], f'{proj}{layer}_t', perm=[0, 2, 1, 3])
+        key = node('Concat', [f'past_key_values.{layer}.key', heads['k']], f'present.{layer}.key', axis=2)
+        value = node('Concat', [f'past_key_values.{layer}.value', heads['v']], f'present.{layer}.value', axis=2)
+        scores = node('MatMul', [heads['q'], node('Transpose', [key], f'k{layer}_T', perm=[0, 1, 3, 2])],
+                      f'scores{layer}')
+        scores = node('Mul', [scores, 'scale'], f'scaled{layer}')
+        scores = node('Where', ['causal', scores, 'neg_inf'], f'masked{layer}')
+        attn = node('MatMul', [node('Softmax', [scores], f'probs{layer}', axis=-1), value], f'attn{layer}')
+        attn = node('Reshape', [node('Transpose', [attn], f'attn{layer}_t', perm=[0, 2, 1, 3]), 'hidden_shape'],
+                    f'attn{layer}_flat')
+        out = node('MatMul', [attn, weight(f'o{layer}', [HIDDEN, HIDDEN])], f'o{layer}_x')
+        hidden = node('Add', [hidden, out], f'hidden{layer}')
+    bias = rng.normal(0, 0.5, vocab_size)
+    bias[eos] = -100.0  # Never ends, so that the tests decode up to `max_new_tokens`
+    initializers.append(helper.make_tensor('lm_bias', TensorProto.FLOAT, [vocab_size], bias))
+    node('Add', [node('MatMul', [hidden, weight('lm_head', [HIDDEN, vocab_size])], 'lm_x'), 'lm_bias'], 'logits')
+
+    past_shape = ['batch', NUM_HEADS, 'past_length', HEAD_DIM]
+    inputs = [
+        helper.make_tensor_value_info('input_ids', TensorProto.INT64, ['batch', 'sequence']),
+        helper.make_tensor_value_info('attention_mask', TensorProto.INT64, ['batch', 'total']),
+        helper.make_tensor_value_info('position_ids', TensorProto.INT64, ['batch', 'sequence']),
+    ]
+    outputs = [helper.make_tensor_value_info('logits', TensorProto.FLOAT, ['batch', 'sequence', vocab_size])]
+    for layer in range(NUM_LAYERS):
+        for kind in ('key', 'value'):
+            inputs.append(helper.make_tensor_value_info(f'past_key_values.{layer}.{kind}', TensorProto.FLOAT,
+                                                        past_shape))
+            outputs.append(helper.make_tensor_value_info(f'present.{layer}.{kind}', TensorProto.FLOAT,
+                                                         ['batch', NUM_HEADS, 'total', HEAD_DIM]))
+    # `attention_mask` and `position_ids` are inputs of the exported models, unused by this one
+    graph = helper.make_graph(nodes, 'tiny_decoder', inputs, outputs, initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 17)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+
+    import os
+    os.makedirs(model_dir, exist_ok=True)
+    onnx.save(model, os.path.join(model_dir, 'model.onnx'))
+
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer,
+                                        unk_token='[UNK]',
+                                        eos_token='<|im_end|>',
+                                        pad_token='<|endoftext|>',
+                                        additional_special_tokens=['<|im_start|>'])
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.save_pretrained(model_dir)
+
+
+if __name__ == '__main__':
+    build_tiny_onnx_model(sys.argv[1])
+    print(f'Saved the tiny onnx model to {sys.argv[1]}')
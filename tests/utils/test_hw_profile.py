@@ -0,0 +1,103 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+
+from qwen_agent.utils import hw_config
+
+PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import qwen_agent.settings as settings
+seconds = time.perf_counter() - t0
+hw_config = sys.modules.get('qwen_agent.utils.hw_config')
+print(json.dumps({
+    'seconds': seconds,
+    'detected': hw_config is not None and hw_config._profile is not None,
+    'probed': [m for m in ('torch', 'psutil') if m in sys.modules],
+    'resolved': [k for k in settings._HW_DEPENDENT_SETTINGS if k in vars(settings)],
+}))
+'''
+
+
+def _run(code: str, cache_path: str) -> dict:
+    env = dict(os.environ, QWEN_AGENT_HW_PROFILE_CACHE=cache_path)
+    env.pop('QWEN_AGENT_DEFAULT_MAX_INPUT_TOKENS', None)
+    env.pop('QWEN_AGENT_DEFAULT_MAX_REF_TOKEN', None)
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_importing_settings_does_not_probe_hardware(tmp_path):
+    cache_path = str(tmp_path / 'hw_profile.json')
+    result = _run(PROBE, cache_path)
+    assert not result['detected'] and not result['resolved']
+    assert result['probed'] == []  # Neither torch nor psutil is imported for the settings
+    assert not os.path.exists(cache_path)
+
+    # The first access resolves the value, and the profile detected for it is cached for the next processes.
+    resolve = PROBE + ('print(json.dumps({"value": settings.DEFAULT_MAX_REF_TOKEN, '
+                       '"detected": sys.modules["qwen_agent.utils.hw_config"]._profile is not None}))')
+    assert _run(resolve, cache_path)['detected'] and os.path.exists(cache_path)
+    no_detection = ('import qwen_agent.utils.hw_config as h\n'
+                    'h.detect_hardware = lambda: (_ for _ in ()).throw(AssertionError("detected again"))\n')
+    assert _run(no_detection + resolve, cache_path)['value'] >= 4000
+
+
+def test_profile_cache_invalidation(tmp_path, monkeypatch):
+    cache_path = str(tmp_path / 'hw_profile.json')
+    monkeypatch.setenv('QWEN_AGENT_HW_PROFILE_CACHE', cache_path)
+    detections = []
+
+    def _detect():
+        detections.append(1)
+        return hw_config.HardwareProfile(gpu_name='fake', recommended_max_input_tokens=12345)
+
+    monkeypatch.setattr(hw_config, 'detect_hardware', _detect)
+
+    def _get_fresh():
+        monkeypatch.setattr(hw_config, '_profile', None)
+        return hw_config.get_hw_profile()
+
+    assert _get_fresh().recommended_max_input_tokens == 12345
+    assert _get_fresh().gpu_name == 'fake' and len(detections) == 1  # Read from the disk cache
+
+    # Another GPU being made visible changes the fingerprint.
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', 'some-other-gpu')
+    _get_fresh()
+    assert len(detections) == 2
+    _get_fresh()
+    assert len(detections) == 2
+
+    # An expired or corrupted cache is detected again.
+    with open(cache_path) as f:
+        cached = json.load(f)
+    cached['created'] -= hw_config._PROFILE_CACHE_TTL_SECONDS + 1
+    with open(cache_path, 'w') as f:
+        json.dump(cached, f)
+    _get_fresh()
+    assert len(detections) == 3
+    with open(cache_path, 'w') as f:
+        f.write('{not json')
+    _get_fresh()
+    assert len(detections) == 4
+
+    # The cache can be disabled.
+    monkeypatch.setenv('QWEN_AGENT_HW_PROFILE_CACHE', '')
+    _get_fresh()
+    _get_fresh()
+    assert len(detections) == 6
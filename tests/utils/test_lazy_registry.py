@@ -0,0 +1,68 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+from qwen_agent.utils.registry import LazyRegistry
+
+PROBE = '''
+import json, sys
+import qwen_agent.llm, qwen_agent.tools
+from qwen_agent.llm.base import LLM_REGISTRY
+from qwen_agent.tools import TOOL_REGISTRY
+before = sorted(m for m in sys.modules if m.startswith(('qwen_agent.tools.', 'qwen_agent.llm.', 'openai', 'dashscope')))
+names = 'code_interpreter' in TOOL_REGISTRY and 'oai' in LLM_REGISTRY
+from qwen_agent.llm import TextChatAtOAI
+from qwen_agent.tools import CodeInterpreter
+print(json.dumps({
+    'before': before,
+    'names': names,
+    'resolved': LLM_REGISTRY['oai'] is TextChatAtOAI and TOOL_REGISTRY['code_interpreter'] is CodeInterpreter,
+}))
+'''
+
+
+def test_importing_the_package_does_not_import_the_backends():
+    out = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert not any(m.startswith(('openai', 'dashscope')) for m in result['before'])
+    for module in ('qwen_agent.llm.oai', 'qwen_agent.llm.transformers_llm', 'qwen_agent.tools.code_interpreter',
+                   'qwen_agent.tools.mcp_manager'):
+        assert module not in result['before']
+    assert result['names'] and result['resolved']
+
+
+class Builtin:
+    __module__ = 'json'  # Pretends to be registered by a module that is imported on lookup
+
+
+def test_lazy_registry():
+    registry = LazyRegistry('Tool', {'builtin': 'json', 'broken': 'json'})
+    assert 'builtin' in registry and 'missing' not in registry and len(registry) == 2
+
+    registry['builtin'] = Builtin  # Registered as its module is imported
+    assert registry['builtin'] is Builtin and registry.is_builtin('builtin', Builtin)
+    with pytest.raises(KeyError, match='is not registered by module json'):
+        registry['broken']
+    with pytest.raises(KeyError):
+        registry['missing']
+
+    registry['custom'] = dict
+    assert sorted(registry) == ['broken', 'builtin', 'custom']
+    del registry['broken']
+    assert dict(registry) == {'builtin': Builtin, 'custom': dict}
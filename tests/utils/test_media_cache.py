@@ -0,0 +1,68 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+from qwen_agent.utils import media_cache, utils
+
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture
+def encodes(monkeypatch):
+    calls = []
+    encode = utils._encode_image_as_base64
+
+    def _counting_encode(path, max_short_side_length=-1):
+        calls.append((path, max_short_side_length))
+        return encode(path, max_short_side_length)
+
+    monkeypatch.setattr(utils, '_encode_image_as_base64', _counting_encode)
+    monkeypatch.setattr(media_cache, '_cache', None)
+    return calls
+
+
+def test_image_encoded_once(tmp_path, encodes):
+    path = str(tmp_path / 'a.png')
+    Image.new('RGB', (64, 32), color=(255, 0, 0)).save(path)
+
+    payloads = [utils.encode_image_as_base64(path, max_short_side_length=16) for _ in range(10)]  # 10 steps
+    assert len(encodes) == 1 and len(set(payloads)) == 1 and payloads[0].startswith('data:image/jpeg;base64,')
+    utils.encode_image_as_base64(path)  # Another target resolution
+    assert len(encodes) == 2
+
+    # A modified file is encoded again.
+    Image.new('RGB', (64, 32), color=(0, 0, 255)).save(path)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+    assert utils.encode_image_as_base64(path, max_short_side_length=16) != payloads[0]
+    assert len(encodes) == 3
+
+    with pytest.raises(FileNotFoundError):
+        utils.encode_image_as_base64(str(tmp_path / 'missing.png'))
+
+
+def test_disk_tier_shared_across_processes(tmp_path, encodes, monkeypatch):
+    pytest.importorskip('diskcache')
+    monkeypatch.setenv('QWEN_AGENT_MEDIA_CACHE_DIR', str(tmp_path / 'cache'))
+    path = str(tmp_path / 'a.png')
+    Image.new('RGB', (8, 8)).save(path)
+    payload = utils.encode_image_as_base64(path)
+
+    media_cache._cache.close()
+    monkeypatch.setattr(media_cache, '_cache', None)  # As in a new process
+    assert utils.encode_image_as_base64(path) == payload and len(encodes) == 1
+    assert media_cache.get_media_cache().stats()['hits_disk'] == 1
+    media_cache._cache.close()